@@ -0,0 +1,101 @@
+"""Measures the import time of each service, and compares it to its baseline.
+
+Work done when `main.py` is imported adds directly to the cold start latency
+of the services. For each service, this imports `main` in a fresh
+interpreter with `python -X importtime`, `--runs` times, and reports the
+median cumulative import time, the slowest modules of the last run, and the
+change from the baseline recorded in `import_time_baseline.json`.
+
+With `--check`, exits with an error when a service is more than
+`--tolerance` percent slower than its baseline, e.g. after adding an import
+at module level. Baselines depend on the machine: record new ones with
+`--update` on the machine that runs the check. Import times vary by 20-30%
+from run to run on a small VM, hence the median and the default tolerance.
+
+Usage:
+    python script/import_time.py [web-proxy token-broker websocket-proxy]
+        [--runs 9] [--top 10] [--check] [--tolerance 50] [--update]
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+UTILS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+BASELINE_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "import_time_baseline.json"
+)
+SERVICES = ["web-proxy", "token-broker", "websocket-proxy"]
+
+
+def import_times(service):
+    """Imports `main` of a service, and returns {module: cumulative µs}.
+
+    Only `main` and the modules it imports are returned, not the ones
+    imported by the interpreter at startup.
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import main"],
+        cwd=os.path.join(UTILS_DIR, service, "src"),
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, module = line.split("|")
+        times[module.strip()] = int(cumulative)
+        if module == " main":
+            break
+        if not module.startswith("  "):
+            # A module imported at startup, with those it imported.
+            times = {}
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("services", nargs="*", default=SERVICES)
+    parser.add_argument("--runs", type=int, default=9)
+    parser.add_argument("--top", type=int, default=10)
+    parser.add_argument("--check", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=50)
+    parser.add_argument("--update", action="store_true")
+    args = parser.parse_args()
+
+    with open(BASELINE_PATH) as f:
+        baseline = json.load(f)
+
+    failed = []
+    for service in args.services:
+        runs = [import_times(service) for _ in range(args.runs)]
+        median_ms = statistics.median(run["main"] for run in runs) / 1000
+        print(f"{service}: {median_ms:.0f} ms (median of {args.runs})")
+        slowest = sorted(runs[-1].items(), key=lambda item: -item[1])
+        for module, micros in slowest[1 : args.top + 1]:
+            print(f"  {micros / 1000:8.1f} ms  {module}")
+
+        expected_ms = baseline["services"].get(service, {}).get("main_ms")
+        if expected_ms:
+            change = (median_ms / expected_ms - 1) * 100
+            print(f"  baseline {expected_ms} ms, {change:+.0f}%")
+            if change > args.tolerance:
+                failed.append(service)
+        if args.update:
+            baseline["services"].setdefault(service, {})["main_ms"] = round(median_ms)
+
+    if args.update:
+        with open(BASELINE_PATH, "w") as f:
+            json.dump(baseline, f, indent=2)
+            f.write("\n")
+    if args.check and failed:
+        sys.exit(f"Import time over the baseline for: {', '.join(failed)}")
+
+
+if __name__ == "__main__":
+    main()
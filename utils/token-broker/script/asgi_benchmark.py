@@ -0,0 +1,308 @@
+"""Compares the threaded and the ASGI serving modes against fake Google APIs.
+
+Serves token requests from `--concurrency` clients for `--seconds`, once
+with `main.get_access_token` from a pool of threads, as functions-framework and
+gunicorn do, and once with `asgi.app` from an asyncio event loop, as uvicorn
+does. Both run in this process, without an HTTP server in front of them.
+
+The Google APIs are local fakes: a Metadata Server, through which Application
+Default Credentials mint OAuth tokens in `--mint-ms`, and a gRPC IAM
+Credentials API, whose signJwt calls take `--sign-ms`. Tokens are served for
+`--ttl` seconds (`TOKEN_TTL`), and JWT requests are spread over `--sessions`
+target sessions.
+
+Reports, for each `TOKEN_TYPE` and serving mode, the upstream calls, the
+throughput and the request latencies.
+
+Usage:
+    python script/asgi_benchmark.py [--seconds 6] [--concurrency 32]
+        [--ttl 2] [--sessions 50]
+"""
+
+import argparse
+import asyncio
+import http.server
+import json
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+
+TOKEN_PATH = "/computeMetadata/v1/instance/service-accounts/default/token"
+SA_EMAIL = "broker@project.iam.gserviceaccount.com"
+
+
+class FakeMetadataServer(http.server.ThreadingHTTPServer):
+    """A fake Metadata Server, minting OAuth tokens after a delay."""
+
+    daemon_threads = True
+
+    def __init__(self, mint_ms):
+        super().__init__(("127.0.0.1", 0), FakeMetadataHandler)
+        self.mint_ms = mint_ms
+        self.calls = 0
+        self.lock = threading.Lock()
+
+
+class FakeMetadataHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        path = self.path.partition("?")[0]
+        content_type = "application/json"
+        if path == TOKEN_PATH:
+            with self.server.lock:
+                self.server.calls += 1
+                count = self.server.calls
+            time.sleep(self.server.mint_ms / 1000)
+            body = {
+                "access_token": f"token-{count}",
+                "expires_in": 3599,
+                "token_type": "Bearer",
+            }
+        elif path.endswith("/service-accounts/default/"):
+            body = {"email": SA_EMAIL, "scopes": [], "aliases": ["default"]}
+        else:
+            # The ping of ADC, the project ID and the service account email.
+            content_type = "text/plain"
+            body = SA_EMAIL if path.endswith("/email") else "project"
+        body = (json.dumps(body) if isinstance(body, dict) else body).encode()
+        self.send_response(200)
+        self.send_header("Metadata-Flavor", "Google")
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeIAM:
+    """A fake gRPC IAM Credentials API, answering signJwt calls after a delay."""
+
+    def __init__(self, sign_ms):
+        import grpc
+        from google.cloud import iam_credentials_v1
+
+        self.sign_ms = sign_ms
+        self.calls = 0
+        self.lock = threading.Lock()
+        handler = grpc.method_handlers_generic_handler(
+            "google.iam.credentials.v1.IAMCredentials",
+            {
+                "SignJwt": grpc.unary_unary_rpc_method_handler(
+                    self.sign_jwt,
+                    request_deserializer=iam_credentials_v1.SignJwtRequest.deserialize,
+                    response_serializer=iam_credentials_v1.SignJwtResponse.serialize,
+                )
+            },
+        )
+        self.server = grpc.server(ThreadPoolExecutor(64))
+        self.server.add_generic_rpc_handlers((handler,))
+        self.target = f"127.0.0.1:{self.server.add_insecure_port('127.0.0.1:0')}"
+        self.server.start()
+
+    def sign_jwt(self, request, context):
+        from google.cloud import iam_credentials_v1
+
+        with self.lock:
+            self.calls += 1
+        time.sleep(self.sign_ms / 1000)
+        return iam_credentials_v1.SignJwtResponse(
+            key_id="fake", signed_jwt="header.payload.signature"
+        )
+
+
+def request_bodies(args, token_type):
+    """Returns the bodies of the requests, one per session in JWT mode."""
+    if token_type != "jwt":
+        return [b""]
+    return [
+        json.dumps({"target_session": f"session-{index}"}).encode()
+        for index in range(args.sessions)
+    ]
+
+
+def run_threads(args, token_type, iam):
+    """Serves the requests with `main`, and returns their latencies."""
+    import flask
+    import grpc
+    import main
+    from google.cloud import iam_credentials_v1
+    from google.cloud.iam_credentials_v1.services.iam_credentials import transports
+
+    main.OAUTH_TOKEN_CACHE = main.TokenCache(
+        1, main.TOKEN_TTL, main.TOKEN_EXPIRY_MARGIN
+    )
+    main.JWT_CACHE = main.TokenCache(
+        main.JWT_CACHE_MAX_ENTRIES, main.JWT_LIFETIME, main.JWT_MIN_REMAINING_LIFETIME
+    )
+    main._iam_client = iam_credentials_v1.IAMCredentialsClient(
+        transport=transports.IAMCredentialsGrpcTransport(
+            channel=grpc.insecure_channel(iam.target)
+        )
+    )
+    app = flask.Flask(__name__)
+    bodies = request_bodies(args, token_type)
+    deadline = time.monotonic() + args.seconds
+
+    def client(index):
+        latencies = []
+        while time.monotonic() < deadline:
+            body = bodies[(index + len(latencies)) % len(bodies)]
+            begin = time.monotonic()
+            with app.test_request_context("/", method="POST", data=body):
+                _, status, _ = main.get_access_token(flask.request)
+            assert status == 200, status
+            latencies.append(time.monotonic() - begin)
+        return latencies
+
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        latencies = sum(pool.map(client, range(args.concurrency)), [])
+    main._iam_client.transport.close()
+    return latencies
+
+
+async def run_asgi(args, token_type, iam):
+    """Serves the requests with `asgi.app`, and returns their latencies."""
+    import asgi
+    import grpc
+    import main
+    from google.cloud import iam_credentials_v1
+    from google.cloud.iam_credentials_v1.services.iam_credentials import transports
+
+    asgi.TOKEN_TYPE = token_type
+    asgi.OAUTH_TOKEN_CACHE = asgi.AsyncTokenCache(
+        1, main.TOKEN_TTL, main.TOKEN_EXPIRY_MARGIN
+    )
+    asgi.JWT_CACHE = asgi.AsyncTokenCache(
+        main.JWT_CACHE_MAX_ENTRIES, main.JWT_LIFETIME, main.JWT_MIN_REMAINING_LIFETIME
+    )
+    asgi._iam_async_client = iam_credentials_v1.IAMCredentialsAsyncClient(
+        transport=transports.IAMCredentialsGrpcAsyncIOTransport(
+            channel=grpc.aio.insecure_channel(iam.target)
+        )
+    )
+    bodies = request_bodies(args, token_type)
+    deadline = time.monotonic() + args.seconds
+
+    async def client(index):
+        latencies = []
+        while time.monotonic() < deadline:
+            body = bodies[(index + len(latencies)) % len(bodies)]
+            messages = []
+
+            async def receive():
+                # Yields to the other clients, as reading a socket would.
+                await asyncio.sleep(0)
+                return {"type": "http.request", "body": body}
+
+            async def send(message):
+                messages.append(message)
+
+            begin = time.monotonic()
+            await asgi.app(
+                {"type": "http", "method": "POST", "headers": []}, receive, send
+            )
+            latencies.append(time.monotonic() - begin)
+            assert messages[0]["status"] == 200, messages[0]["status"]
+        return latencies
+
+    results = await asyncio.gather(*(client(i) for i in range(args.concurrency)))
+    await asgi._iam_async_client.transport.close()
+    return sum(results, [])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--seconds",
+        type=float,
+        default=6,
+        help="Duration of each run (default: 6).",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=32,
+        help="Concurrent clients (default: 32).",
+    )
+    parser.add_argument(
+        "--ttl",
+        type=int,
+        default=2,
+        help="TOKEN_TTL, in seconds (default: 2).",
+    )
+    parser.add_argument(
+        "--sessions",
+        type=int,
+        default=50,
+        help="Distinct target sessions of JWT requests (default: 50).",
+    )
+    parser.add_argument(
+        "--mint-ms",
+        type=float,
+        default=100,
+        help="Latency of the fake Metadata Server tokens (default: 100).",
+    )
+    parser.add_argument(
+        "--sign-ms",
+        type=float,
+        default=80,
+        help="Latency of the fake signJwt calls (default: 80).",
+    )
+    args = parser.parse_args()
+
+    metadata = FakeMetadataServer(args.mint_ms)
+    threading.Thread(target=metadata.serve_forever, daemon=True).start()
+    iam = FakeIAM(args.sign_ms)
+
+    # Application Default Credentials find the fake Metadata Server, and no
+    # credentials file.
+    host = f"127.0.0.1:{metadata.server_port}"
+    os.environ["GCE_METADATA_HOST"] = os.environ["GCE_METADATA_IP"] = host
+    os.environ["CLOUDSDK_CONFIG"] = tempfile.mkdtemp()
+    os.environ.pop("GOOGLE_APPLICATION_CREDENTIALS", None)
+    os.environ["TOKEN_TTL"] = str(args.ttl)
+    os.environ["OAUTH_SCOPES"] = "https://www.googleapis.com/auth/cloud-platform"
+    sys.path.insert(0, SRC_DIR)
+    import main as service
+
+    service.print_log = lambda severity, message: None
+    # The email lookup doesn't go through GCE_METADATA_HOST, but it's cached
+    # for the lifetime of the instance anyway.
+    service._sa_email = SA_EMAIL
+
+    print(
+        f"{args.concurrency} clients for {args.seconds:g}s, "
+        f"TOKEN_TTL={args.ttl}, {args.mint_ms:g} ms per token, "
+        f"{args.sign_ms:g} ms per signJwt call over {args.sessions} sessions"
+    )
+    for token_type in ("access_token", "jwt"):
+        os.environ["TOKEN_TYPE"] = token_type
+        for name, run in (
+            ("threads", lambda: run_threads(args, token_type, iam)),
+            ("asgi", lambda: asyncio.run(run_asgi(args, token_type, iam))),
+        ):
+            metadata.calls = iam.calls = 0
+            latencies = sorted(run())
+            p95 = latencies[int(len(latencies) * 0.95) - 1]
+            print(
+                f"{token_type:12} {name:7}: {metadata.calls} token and "
+                f"{iam.calls} signJwt calls, "
+                f"{len(latencies) / args.seconds:.0f} req/s, "
+                f"median {statistics.median(latencies) * 1000:.2f} ms, "
+                f"p95 {p95 * 1000:.2f} ms, slowest {latencies[-1] * 1000:.0f} ms"
+            )
+    metadata.shutdown()
+    iam.server.stop(None)
+
+
+if __name__ == "__main__":
+    main()
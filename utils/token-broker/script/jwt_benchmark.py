@@ -0,0 +1,153 @@
+"""Counts the signJwt calls of JWT mode, with and without the JWT cache.
+
+Serves `--requests` `get_access_token` requests in JWT mode from `--threads`
+threads, spread over `--sessions` target sessions, as when clients reconnect
+or open several tabs. The service (`src/main.py`) signs its JWTs with the
+real IAM Credentials client, pointed at a local fake signJwt endpoint that
+takes `--sign-ms` per call.
+
+Runs once with `JWT_CACHE_MAX_ENTRIES=0`, i.e. a signature per request, and
+once with the default cache, and reports the signJwt calls and the request
+latencies.
+
+Usage:
+    python script/jwt_benchmark.py [--requests 400] [--sessions 20]
+        [--threads 8] [--sign-ms 80]
+"""
+
+import argparse
+import http.server
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+
+
+class FakeIAM(http.server.ThreadingHTTPServer):
+    """A fake IAM Credentials API, answering signJwt calls after a delay."""
+
+    daemon_threads = True
+
+    def __init__(self, sign_ms):
+        super().__init__(("127.0.0.1", 0), FakeIAMHandler)
+        self.sign_ms = sign_ms
+        self.calls = 0
+        self.lock = threading.Lock()
+
+
+class FakeIAMHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        with self.server.lock:
+            self.server.calls += 1
+        time.sleep(self.server.sign_ms / 1000)
+        body = json.dumps({"keyId": "fake", "signedJwt": "header.payload.sig"})
+        body = body.encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def run(args, main, max_entries):
+    """Serves the requests, and returns the request latencies."""
+    import flask
+    from token_cache import TokenCache
+
+    main.JWT_CACHE = TokenCache(
+        max_entries, main.JWT_LIFETIME, main.JWT_MIN_REMAINING_LIFETIME
+    )
+    app = flask.Flask(__name__)
+
+    def request(index):
+        body = json.dumps({"target_session": f"session-{index % args.sessions}"})
+        begin = time.monotonic()
+        with app.test_request_context("/", method="POST", data=body):
+            _, status, _ = main.get_access_token(flask.request)
+        assert status == 200, status
+        return time.monotonic() - begin
+
+    with ThreadPoolExecutor(args.threads) as pool:
+        return list(pool.map(request, range(args.requests)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--requests",
+        type=int,
+        default=400,
+        help="Requests to serve (default: 400).",
+    )
+    parser.add_argument(
+        "--sessions",
+        type=int,
+        default=20,
+        help="Distinct target sessions (default: 20).",
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=8,
+        help="Concurrent requests (default: 8).",
+    )
+    parser.add_argument(
+        "--sign-ms",
+        type=float,
+        default=80,
+        help="Latency of the fake signJwt endpoint (default: 80).",
+    )
+    args = parser.parse_args()
+
+    iam = FakeIAM(args.sign_ms)
+    threading.Thread(target=iam.serve_forever, daemon=True).start()
+
+    sys.path.insert(0, SRC_DIR)
+    os.environ["TOKEN_TYPE"] = "jwt"
+    os.environ.setdefault("OAUTH_SCOPES", "https://www.googleapis.com/auth/ces")
+    import google.auth
+    import main as service
+    from google.auth.credentials import AnonymousCredentials
+    from google.cloud import iam_credentials_v1
+
+    service.print_log = lambda severity, message: None
+    google.auth.default = lambda scopes=None: (AnonymousCredentials(), "project")
+    service._sa_email = "broker@project.iam.gserviceaccount.com"
+    service._iam_client = iam_credentials_v1.IAMCredentialsClient(
+        transport="rest",
+        credentials=AnonymousCredentials(),
+        client_options={"api_endpoint": f"http://127.0.0.1:{iam.server_port}"},
+    )
+
+    print(
+        f"{args.requests} requests over {args.sessions} sessions from "
+        f"{args.threads} threads, {args.sign_ms:g} ms per signJwt call"
+    )
+    for name, max_entries in (
+        ("No cache", 0),
+        ("JWT cache", service.JWT_CACHE_MAX_ENTRIES),
+    ):
+        iam.calls = 0
+        latencies = sorted(run(args, service, max_entries))
+        p95 = latencies[int(len(latencies) * 0.95) - 1]
+        print(
+            f"{name}: {iam.calls} signJwt calls, "
+            f"median {statistics.median(latencies) * 1000:.1f} ms, "
+            f"p95 {p95 * 1000:.1f} ms"
+        )
+    iam.shutdown()
+
+
+if __name__ == "__main__":
+    main()
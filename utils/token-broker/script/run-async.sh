@@ -0,0 +1,5 @@
+#!/bin/bash
+
+source $(dirname "$0")/values.sh
+
+uvicorn asgi:app --host 0.0.0.0 --port 8080
@@ -0,0 +1,159 @@
+"""Counts the token refreshes of worker processes, with and without sharing.
+
+Starts `--workers` processes, like gunicorn or uvicorn workers of one
+instance, each importing the service (`src/main.py`) and serving
+`get_access_token` requests from `--threads` threads for `--seconds`.
+Minting a token calls a fake instead of Application Default Credentials: it
+takes `--mint-ms` and counts the calls across processes. Tokens are served
+for `--ttl` seconds (`TOKEN_TTL`).
+
+Runs once with per-process caches, and once with `SHARED_TOKEN_CACHE_PATH`
+set to a file in `--shared-dir`, and reports the refresh calls, the
+requests served, and the slowest request, which includes waiting for a
+refresh.
+
+Usage:
+    python script/shared_token_benchmark.py [--workers 4] [--seconds 8]
+        [--ttl 3]
+"""
+
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+
+
+def worker(args, environment, refreshes, results, start):
+    """Serves requests from threads of this process until the deadline."""
+    sys.path.insert(0, SRC_DIR)
+    os.environ.update(environment)
+    import flask
+    import main
+
+    main.print_log = lambda severity, message: None
+
+    def fake_generate_oauth_token():
+        with refreshes.get_lock():
+            refreshes.value += 1
+        time.sleep(args.mint_ms / 1000)
+        expiry = time.time() + 3600
+        token = {"access_token": "token", "expiry": int(expiry * 1000)}
+        return token, expiry
+
+    main.generate_oauth_token = fake_generate_oauth_token
+    app = flask.Flask(__name__)
+    served, slowest = [0], [0.0]
+
+    def serve(deadline):
+        while time.time() < deadline:
+            begin = time.monotonic()
+            with app.test_request_context("/", method="GET"):
+                _, status, _ = main.get_access_token(flask.request)
+            elapsed = time.monotonic() - begin
+            served[0] += status == 200
+            slowest[0] = max(slowest[0], elapsed)
+
+    # All the workers start at the same time, as on a cold instance.
+    start.wait()
+    deadline = time.time() + args.seconds
+    threads = [
+        threading.Thread(target=serve, args=(deadline,)) for _ in range(args.threads)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    results.put((served[0], slowest[0]))
+
+
+def run(args, shared_path):
+    context = multiprocessing.get_context("spawn")
+    environment = {
+        "TOKEN_TYPE": "access_token",
+        "TOKEN_TTL": str(args.ttl),
+        "OAUTH_SCOPES": "https://www.googleapis.com/auth/cloud-platform",
+        "SHARED_TOKEN_CACHE_PATH": shared_path,
+    }
+    refreshes = context.Value("i", 0)
+    results = context.Queue()
+    start = context.Barrier(args.workers)
+    workers = [
+        context.Process(
+            target=worker, args=(args, environment, refreshes, results, start)
+        )
+        for _ in range(args.workers)
+    ]
+    for process in workers:
+        process.start()
+    outcomes = [results.get() for _ in workers]
+    for process in workers:
+        process.join()
+    served = sum(outcome[0] for outcome in outcomes)
+    slowest = max(outcome[1] for outcome in outcomes)
+    return refreshes.value, served, slowest
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=4,
+        help="Worker processes (default: 4).",
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=4,
+        help="Request threads per worker (default: 4).",
+    )
+    parser.add_argument(
+        "--seconds",
+        type=float,
+        default=8,
+        help="Duration of the load (default: 8).",
+    )
+    parser.add_argument(
+        "--ttl",
+        type=int,
+        default=3,
+        help="TOKEN_TTL, in seconds (default: 3).",
+    )
+    parser.add_argument(
+        "--mint-ms",
+        type=float,
+        default=300,
+        help="Time taken to mint a token (default: 300).",
+    )
+    parser.add_argument(
+        "--shared-dir",
+        default="/dev/shm" if os.path.isdir("/dev/shm") else None,
+        help="Directory of the shared cache file (default: /dev/shm).",
+    )
+    args = parser.parse_args()
+    # A token is minted at least once per TTL, plus the first one.
+    expected = int(args.seconds // args.ttl) + 1
+    print(
+        f"{args.workers} workers x {args.threads} threads for {args.seconds:g}s, "
+        f"TOKEN_TTL={args.ttl}, {args.mint_ms:g} ms per refresh "
+        f"(one cache needs about {expected} refreshes)"
+    )
+    with tempfile.TemporaryDirectory(dir=args.shared_dir) as directory:
+        for name, shared_path in (
+            ("Per-process caches", ""),
+            ("Shared cache", os.path.join(directory, "ces-tokens.json")),
+        ):
+            refreshes, served, slowest = run(args, shared_path)
+            print(
+                f"{name}: {refreshes} refresh calls, {served} requests served, "
+                f"slowest request {slowest * 1000:.0f} ms"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,257 @@
+"""ASGI serving mode for the token broker.
+
+This module serves the same endpoint as `main.get_access_token`, reusing its
+CORS and token logic, from an asyncio event loop instead of a pool of worker
+threads:
+
+- Token state lives in `AsyncTokenCache` instances, whose refreshes are
+  guarded by per-key `asyncio.Lock`s, so concurrent requests wait for a
+  single refresh without blocking the event loop.
+- ADC refreshes run in a worker thread, and JWTs are signed with the async
+  IAM Credentials client, so slow upstream calls don't hold up other requests.
+
+Run it with any ASGI server, for example:
+
+    uvicorn asgi:app --host 0.0.0.0 --port 8080
+
+Configuration is the same as for `main.py`.
+"""
+
+import asyncio
+import json
+import os
+
+import main
+import tracing
+from main import print_log
+from token_cache import TokenCache
+
+
+class AsyncTokenCache(TokenCache):
+    """Asyncio counterpart of `TokenCache`.
+
+    The entries, their expiry and the counters are those of `TokenCache`;
+    only the locking differs: refreshes are single-flight per key with
+    `asyncio.Lock`s, so that concurrent requests wait for a single refresh
+    without blocking the event loop. The entries need no lock of their own,
+    as they're only used from the event loop.
+    """
+
+    async def get(self, key, mint):
+        """Returns a valid token for `key`, awaiting `mint()` on a cache miss.
+
+        Args:
+            key (hashable): The cache key.
+            mint (callable): Coroutine function returning a `(token, expiry)`
+                tuple, where expiry is a POSIX timestamp or None. A falsy
+                token signals a failure.
+
+        Returns:
+            The token returned by `mint`, or None if minting failed.
+        """
+        token = self._lookup(key)
+        if token is not None:
+            return token
+
+        key_lock = self._key_locks.setdefault(key, asyncio.Lock())
+        async with key_lock:
+            # Another request may have refreshed this key while we waited.
+            token = self._lookup(key)
+            if token is not None:
+                return token
+            self.misses += 1
+
+            if self.shared:
+                # The shared store blocks on its file lock, so it's used from a
+                # worker thread, which hands the minting back to the loop.
+                loop = asyncio.get_running_loop()
+                token, valid_until = await asyncio.to_thread(
+                    self.shared.get,
+                    key,
+                    lambda: self._valid(
+                        *asyncio.run_coroutine_threadsafe(mint(), loop).result()
+                    ),
+                )
+            else:
+                token, valid_until = self._valid(*await mint())
+            if not token:
+                if key not in self._entries:
+                    self._key_locks.pop(key, None)
+                return None
+
+            self._store(key, token, valid_until)
+        return token
+
+
+TOKEN_TYPE = os.environ.get("TOKEN_TYPE", "access_token")
+
+OAUTH_TOKEN_CACHE = AsyncTokenCache(
+    1, main.TOKEN_TTL, main.TOKEN_EXPIRY_MARGIN, main.shared_token_store
+)
+JWT_CACHE = AsyncTokenCache(
+    main.JWT_CACHE_MAX_ENTRIES, main.JWT_LIFETIME, main.JWT_MIN_REMAINING_LIFETIME
+)
+
+# Created on first use, so that it binds to the running event loop.
+_iam_async_client = None
+
+
+async def generate_oauth_token():
+    """Runs `main.generate_oauth_token` without blocking the event loop."""
+    return await asyncio.to_thread(main.generate_oauth_token)
+
+
+async def generate_jwt_response(target_session, metadata=()):
+    """
+    Signs a new JWT for a session with the async IAM Credentials client.
+
+    Args:
+        target_session (str): The session ID to include in the 'ces_session' claim.
+        metadata (tuple): Extra gRPC metadata of the signJwt call, e.g. the
+            trace context.
+
+    Returns:
+        tuple: (response_dict, expiry_timestamp_seconds) or (None, None) on failure.
+    """
+    global _iam_async_client
+
+    print_log("DEBUG", f"Generating session-specific JWT for session: {target_session}")
+    try:
+        from google.cloud import iam_credentials_v1
+
+        scopes_str = os.environ.get("OAUTH_SCOPES", "")
+        scopes = [scope.strip() for scope in scopes_str.split(",") if scope.strip()]
+
+        sa_email = await asyncio.to_thread(main.get_service_account_email)
+        if sa_email == "unknown":
+            print_log("ERROR", "Could not determine service account email.")
+            return None, None
+
+        if _iam_async_client is None:
+            _iam_async_client = iam_credentials_v1.IAMCredentialsAsyncClient()
+
+        payload, expiry_time = main.build_jwt_payload(sa_email, scopes, target_session)
+        print_log(
+            "DEBUG", f"Signing JWT for {sa_email} using IAMCredentialsAsyncClient..."
+        )
+        response = await _iam_async_client.sign_jwt(
+            name=f"projects/-/serviceAccounts/{sa_email}",
+            delegates=[],
+            payload=payload,
+            metadata=metadata,
+        )
+        return {
+            "access_token": response.signed_jwt,
+            "expiry": expiry_time * 1000,
+        }, expiry_time
+    except Exception as e:
+        print_log("ERROR", f"Failed to generate signed JWT: {e}")
+        return None, None
+
+
+async def get_access_token(method, headers, body, trace=tracing.NULL_TRACE):
+    """
+    Async equivalent of `main.get_access_token`.
+
+    Args:
+        method (str): The HTTP method of the request.
+        headers (dict): The request headers, with lowercase names.
+        body (bytes): The request body.
+        trace (tracing.RequestTrace): Times the phases of the request.
+
+    Returns:
+        tuple: (response_body, status_code, response_headers).
+    """
+    response, response_headers, target_session = main.check_token_request(
+        method, headers.get("origin"), lambda: json.loads(body), TOKEN_TYPE
+    )
+    if response:
+        return response
+
+    if TOKEN_TYPE == "jwt":
+
+        async def sign():
+            with trace.phase("sign") as span:
+                metadata = {}
+                trace.inject(metadata, span)
+                return await generate_jwt_response(
+                    target_session, tuple(metadata.items())
+                )
+
+        with trace.phase("token"):
+            jwt_response = await JWT_CACHE.get(target_session, sign)
+        print_log("DEBUG", f"JWT cache stats: {JWT_CACHE.stats()}")
+        return main.jwt_token_response(jwt_response, response_headers)
+
+    async def refresh():
+        with trace.phase("refresh"):
+            return await generate_oauth_token()
+
+    with trace.phase("token"):
+        access_token = await OAUTH_TOKEN_CACHE.get(main.OAUTH_TOKEN_KEY, refresh)
+    return main.oauth_token_response(
+        access_token,
+        response_headers,
+        OAUTH_TOKEN_CACHE.valid_until(main.OAUTH_TOKEN_KEY),
+        headers.get("if-none-match"),
+    )
+
+
+async def app(scope, receive, send):
+    """ASGI entry point."""
+    if scope["type"] == "lifespan":
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    if scope["type"] != "http":
+        return
+
+    headers = {
+        name.decode("latin-1").lower(): value.decode("latin-1")
+        for name, value in scope["headers"]
+    }
+
+    body = b""
+    more_body = True
+    while more_body:
+        message = await receive()
+        body += message.get("body", b"")
+        more_body = message.get("more_body", False)
+
+    trace = tracing.start_request(
+        "get_access_token", headers, "token-broker", print_log
+    )
+    # Unless set by the handler: an unhandled error, answered with a 500.
+    status = 500
+    try:
+        response_body, status, response_headers = await get_access_token(
+            scope["method"], headers, body, trace
+        )
+    finally:
+        trace.end(status)
+    server_timing = trace.server_timing()
+    if server_timing:
+        response_headers = {**response_headers, "Server-Timing": server_timing}
+
+    if isinstance(response_body, dict):
+        response_body = json.dumps(response_body).encode("utf-8")
+        response_headers = {**response_headers, "Content-Type": "application/json"}
+    else:
+        response_body = response_body.encode("utf-8")
+
+    await send(
+        {
+            "type": "http.response.start",
+            "status": status,
+            "headers": [
+                (name.encode("latin-1"), value.encode("latin-1"))
+                for name, value in response_headers.items()
+            ],
+        }
+    )
+    await send({"type": "http.response.body", "body": response_body})
@@ -11,13 +11,33 @@ Key features:
   (GET) requests, allowing access only from a configurable allowlist of origins.
 - Caches the generated access token in memory to reduce latency and avoid
   hitting token generation API quotas. The cache duration is configurable.
+- Sets private HTTP caching headers (`Cache-Control`, `ETag`) derived from the
+  token's remaining lifetime, and answers conditional requests with
+  `304 Not Modified`, so browsers reuse a token across page loads.
+- In JWT mode, caches the signed JWT of each session and keeps serving it while
+  it has enough remaining lifetime, so reconnects and multiple tabs for the same
+  session do not each require an IAM `signJwt` call.
 
 Configuration is managed through the following environment variables:
 - `AUTHORIZED_ORIGINS`: A semicolon-separated list of allowed origin URLs for CORS.
 - `TOKEN_TTL`: The time-to-live for the cached token in seconds. Defaults to 300.
 - `OAUTH_SCOPES`: A comma-separated list of OAuth scopes required for the access token.
+- `CORS_MAX_AGE`: How long, in seconds, browsers may cache CORS preflight
+  results. Defaults to 3600.
+- `JWT_CACHE_MAX_ENTRIES`: Maximum number of session JWTs kept in memory.
+  Defaults to 5000.
+- `JWT_MIN_REMAINING_LIFETIME`: Minimum remaining lifetime, in seconds, for a
+  cached JWT to be served. Defaults to 600.
+- `SHARED_TOKEN_CACHE_PATH`: Optional file, on a memory-backed filesystem (e.g.
+  `/dev/shm/ces-tokens.json`), through which the worker processes of an
+  instance share the OAuth token, so it's minted once per instance.
+- `SERVER_TIMING`: Set to "true" to send the duration of each phase of a
+  request in a `Server-Timing` response header. See `tracing.py`, which also
+  describes the OpenTelemetry tracing configured by the `OTEL_*` variables.
 """
 
+import datetime
+import hashlib
 import json
 import os
 import sys
@@ -25,15 +45,16 @@ import time
 
 import functions_framework
 import google.auth
-from google.cloud import iam_credentials_v1
-from google.api_core import exceptions
-import google.auth.transport.requests
-import requests
+import tracing
+from token_cache import TokenCache
 
-CURRENT_TOKEN = None
-CURRENT_TOKEN_TIMESTAMP = None
-AUDIENCE = "https://ces.googleapis.com/"
+# Heavier client libraries (google-cloud-iam, google-api-core, requests) are
+# imported by the functions that need them, so that they don't add to cold
+# start latency, and only the ones used by the configured TOKEN_TYPE are loaded.
 
+AUDIENCE = "https://ces.googleapis.com/"
+# Lifetime of the signed session JWTs, in seconds.
+JWT_LIFETIME = 3600
 
 
 def print_log(severity, message):
@@ -47,16 +68,25 @@ def print_log(severity, message):
     print(json.dumps(log_entry), file=stream)
 
 
+def get_int_env(name, default):
+    """Reads an integer environment variable, falling back to `default`."""
+    value = os.environ.get(name, str(default))
+    try:
+        return int(value)
+    except (ValueError, TypeError):
+        print_log(
+            "WARNING", f"Invalid value for {name}: '{value}'. It must be an integer."
+        )
+        # Fallback to a safe default
+        return default
+
+
 # We'll keep updated tokens only for a few minutes.
-TOKEN_TTL = os.environ.get("TOKEN_TTL", "300")
-try:
-    TOKEN_TTL = int(TOKEN_TTL)
-except (ValueError, TypeError):
-    print_log(
-        "WARNING", f"Invalid value for TOKEN_TTL: '{TOKEN_TTL}'. It must be an integer."
-    )
-    # Fallback to a safe default
-    TOKEN_TTL = 300
+TOKEN_TTL = get_int_env("TOKEN_TTL", 300)
+TOKEN_EXPIRY_MARGIN = get_int_env("TOKEN_EXPIRY_MARGIN", 60)
+CORS_MAX_AGE = get_int_env("CORS_MAX_AGE", 3600)
+JWT_CACHE_MAX_ENTRIES = get_int_env("JWT_CACHE_MAX_ENTRIES", 5000)
+JWT_MIN_REMAINING_LIFETIME = get_int_env("JWT_MIN_REMAINING_LIFETIME", 600)
 
 authorized_origins = []
 
@@ -65,11 +95,40 @@ env_origins = os.environ.get("AUTHORIZED_ORIGINS")
 if env_origins:
     # Split by comma and strip any whitespace from each origin.
     additional_origins = [
-        origin.strip().rstrip('/') for origin in env_origins.split(";") if origin.strip()
+        origin.strip().rstrip("/")
+        for origin in env_origins.split(";")
+        if origin.strip()
     ]
     authorized_origins.extend(additional_origins)
 
 
+# Preflight responses vary with the requested method and headers as well.
+PREFLIGHT_VARY = "Origin, Access-Control-Request-Method, Access-Control-Request-Headers"
+
+# The OAuth2 access token of the service account. It's the only entry of its
+# cache, which makes refreshes thread-safe and single-flight.
+OAUTH_TOKEN_KEY = "oauth"
+
+# The token can also be shared by the worker processes of the instance, e.g.
+# through a file in /dev/shm.
+SHARED_TOKEN_CACHE_PATH = os.environ.get("SHARED_TOKEN_CACHE_PATH", "")
+shared_token_store = None
+if SHARED_TOKEN_CACHE_PATH:
+    from shared_token_cache import SharedTokenStore
+
+    shared_token_store = SharedTokenStore(SHARED_TOKEN_CACHE_PATH, log=print_log)
+
+OAUTH_TOKEN_CACHE = TokenCache(1, TOKEN_TTL, TOKEN_EXPIRY_MARGIN, shared_token_store)
+
+# Signed JWTs, keyed by target session.
+JWT_CACHE = TokenCache(JWT_CACHE_MAX_ENTRIES, JWT_LIFETIME, JWT_MIN_REMAINING_LIFETIME)
+
+# The IAM client and the service account email never change during the
+# lifetime of the instance, so they are created on first use and reused.
+_iam_client = None
+_sa_email = None
+
+
 @functions_framework.http
 def get_access_token(request):
     """HTTP Cloud Function to retrieve an access token for the SA running this
@@ -87,11 +146,224 @@ def get_access_token(request):
         The response includes CORS headers for allowed origins.
 
     """
+    trace = tracing.start_request(
+        "get_access_token", request.headers, "token-broker", print_log
+    )
+    response = None
+    try:
+        response = handle_token_request(request, trace)
+    finally:
+        if response is None:
+            # An unhandled error, which Flask answers with a 500.
+            trace.end(500)
+    return trace.finish(response)
+
+
+def handle_token_request(request, trace):
+    """
+    Handles a request of `get_access_token`.
+
+    Args:
+        request (flask.Request): The request object.
+        trace (tracing.RequestTrace): Times the phases of the request.
+
+    Returns:
+        tuple: (response_body, status_code, response_headers).
+    """
+    token_type = os.environ.get("TOKEN_TYPE", "access_token")
+    response, headers, target_session = check_token_request(
+        request.method,
+        request.headers.get("Origin"),
+        lambda: request.get_json(force=True, silent=True),
+        token_type,
+    )
+    if response:
+        return response
+
+    # In JWT mode, tokens are bound to a session. A session's JWT is reused
+    # while it has at least JWT_MIN_REMAINING_LIFETIME seconds left, so that
+    # reconnects and multiple tabs don't each require a new signature.
+    if token_type == "jwt":
+
+        def sign():
+            with trace.phase("sign") as span:
+                metadata = {}
+                trace.inject(metadata, span)
+                return generate_jwt_response(target_session, tuple(metadata.items()))
+
+        with trace.phase("token"):
+            jwt_response = JWT_CACHE.get(target_session, sign)
+        print_log("DEBUG", f"JWT cache stats: {JWT_CACHE.stats()}")
+        return jwt_token_response(jwt_response, headers)
+
+    # For OAUTH2 mode, return the cached token, refreshing it if needed.
+    def refresh():
+        with trace.phase("refresh"):
+            return generate_oauth_token()
+
+    with trace.phase("token"):
+        access_token = OAUTH_TOKEN_CACHE.get(OAUTH_TOKEN_KEY, refresh)
+    return oauth_token_response(
+        access_token,
+        headers,
+        OAUTH_TOKEN_CACHE.valid_until(OAUTH_TOKEN_KEY),
+        request.headers.get("If-None-Match"),
+    )
+
+
+def check_token_request(method, origin, read_json, token_type):
+    """
+    Validates a token request, before its token is looked up.
+
+    This and the `*_token_response` functions hold the logic shared by the
+    Flask handler and the ASGI one (`asgi.py`), which only differ in how they
+    read requests and wait for tokens.
+
+    Args:
+        method (str): The HTTP method of the request.
+        origin (str): The value of the request's `Origin` header, if any.
+        read_json (callable): Returns the request body parsed as JSON. It's
+            only called in JWT mode, and may raise on invalid bodies.
+        token_type (str): The `TOKEN_TYPE` of the broker.
 
+    Returns:
+        tuple: (response, response_headers, target_session), where response is
+        a `(response_body, status_code, response_headers)` tuple if the request
+        is answered without a token, or None.
+    """
     # Determine the origin and prepare CORS headers. These headers will be used
     # for both preflight and main requests to ensure consistency.
-    origin = request.headers.get("Origin")
+    headers = get_cors_headers(origin)
 
+    # Handle CORS preflight requests.
+    if method == "OPTIONS":
+        # For preflight, return a 204 response. If the origin is not allowed,
+        # the headers dict will be empty, and the browser will block the request.
+        return ("", 204, {**headers, "Vary": PREFLIGHT_VARY}), headers, None
+
+    # Token responses depend on the origin, and must never be stored by
+    # shared caches. Successful OAuth responses override this in
+    # `oauth_token_response`.
+    headers["Vary"] = "Origin"
+    headers["Cache-Control"] = "no-store"
+
+    # This function should only handle GET and POST requests for the main logic.
+    if method not in ["GET", "POST"]:
+        return ({"error": "Method Not Allowed"}, 405, headers), headers, None
+
+    if token_type != "jwt":
+        return None, headers, None
+
+    target_session = None
+    # Try to get session from JSON body (allow missing Content-Type header)
+    try:
+        request_json = read_json()
+        if isinstance(request_json, dict):
+            target_session = request_json.get("target_session")
+    except Exception:
+        pass  # Ignore parsing errors
+
+    if not target_session:
+        error = "Missing required field: target_session"
+        return ({"error": error}, 400, headers), headers, None
+    if not isinstance(target_session, str):
+        error = "target_session must be a string"
+        return ({"error": error}, 400, headers), headers, None
+    return None, headers, target_session
+
+
+def jwt_token_response(jwt_response, headers):
+    """
+    Returns the response to a JWT request.
+
+    Args:
+        jwt_response (dict): The cached or signed JWT, or None on failure.
+        headers (dict): The response headers from `check_token_request`.
+
+    Returns:
+        tuple: (response_body, status_code, response_headers).
+    """
+    if not jwt_response:
+        return (
+            {"error": "Failed to generate signed JWT. Check server logs."},
+            500,
+            headers,
+        )
+    return jwt_response, 200, headers
+
+
+def oauth_token_response(access_token, headers, valid_until, if_none_match):
+    """
+    Returns the response to an OAuth token request.
+
+    Args:
+        access_token (dict): The cached or refreshed token, or None on failure.
+        headers (dict): The response headers from `check_token_request`.
+        valid_until (float): POSIX timestamp until which the token is served.
+        if_none_match (str): The request's `If-None-Match` header, if any.
+
+    Returns:
+        tuple: (response_body, status_code, response_headers).
+    """
+    if not access_token:
+        # If refresh fails, return an error. This ensures logs are flushed.
+        return (
+            {
+                "error": "Failed to generate a new access token. "
+                "Check server logs for details."
+            },
+            500,
+            headers,
+        )
+
+    headers.update(get_cache_headers(access_token, valid_until))
+    if is_not_modified(if_none_match, headers["ETag"]):
+        return ("", 304, headers)
+
+    return access_token, 200, headers
+
+
+def get_cache_headers(token_response, valid_until):
+    """Returns the HTTP caching headers for an OAuth token response.
+
+    Browsers may cache the response privately until the token stops being
+    served from the broker's own cache, which already keeps a safety margin of
+    `TOKEN_EXPIRY_MARGIN` seconds before the token's real expiry.
+
+    Args:
+        token_response (dict): The token response returned to the client.
+        valid_until (float): POSIX timestamp until which the token is served.
+
+    Returns:
+        dict: The `Cache-Control` and `ETag` headers.
+    """
+    etag_source = token_response["access_token"].encode("utf-8")
+    headers = {"ETag": f'"{hashlib.sha256(etag_source).hexdigest()[:32]}"'}
+    max_age = int((valid_until or 0) - time.time())
+    if max_age > 0:
+        headers["Cache-Control"] = f"private, max-age={max_age}"
+    else:
+        headers["Cache-Control"] = "no-store"
+    return headers
+
+
+def is_not_modified(if_none_match, etag):
+    """Checks an `If-None-Match` request header against a response's ETag."""
+    if not if_none_match:
+        return False
+    candidates = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return "*" in candidates or etag in candidates
+
+
+def get_cors_headers(origin):
+    """Returns the CORS headers for a request coming from `origin`.
+
+    Args:
+        origin (str): The value of the request's `Origin` header, if any.
+
+    Returns:
+        dict: The CORS headers, or an empty dict if the origin isn't allowed.
+    """
     is_authorized = False
     if origin:
         origin = origin.rstrip("/")
@@ -108,113 +380,62 @@ def get_access_token(request):
                     is_authorized = True
                     break
 
-    if is_authorized:
-        headers = {
-            "Access-Control-Allow-Credentials": "true",
-            "Access-Control-Allow-Origin": origin,
-            "Access-Control-Allow-Methods": "GET, POST, OPTIONS",
-            "Access-Control-Allow-Headers": "Content-Type",
-            "Access-Control-Max-Age": "3600",
-        }
-    else:
-        headers = {}
-
-    # Handle CORS preflight requests.
-    if request.method == "OPTIONS":
-        # For preflight, return a 204 response. If the origin is not allowed,
-        # the headers dict will be empty, and the browser will block the request.
-        return ("", 204, headers)
-
-    # This function should only handle GET and POST requests for the main logic.
-    if request.method not in ["GET", "POST"]:
-        return {"error": "Method Not Allowed"}, 405, headers
-
-    # Determine token type
-    token_type = os.environ.get("TOKEN_TYPE", "access_token")
-
-    # If in JWT mode, we ALWAYS generate a fresh token (no caching)
-    # This is to support session isolation and ensure every request gets a unique signature if needed.
-    if token_type == "jwt":
-        target_session = None
-        
-        # Try to get session from JSON body (allow missing Content-Type header)
-        try:
-             request_json = request.get_json(force=True, silent=True)
-             if request_json:
-                 target_session = request_json.get("target_session")
-        except Exception:
-             pass # Ignore parsing errors
-                 
-        if target_session:
-             print_log("DEBUG", f"Generating session-specific JWT for session: {target_session}")
-        else:
-             return {"error": "Missing required field: target_session"}, 400, headers
-        
-        jwt_token, expiry_time = generate_jwt_payload_and_sign(target_session=target_session)
-
-        
-        if jwt_token:
-            return {
-                "access_token": jwt_token,
-                "expiry": expiry_time * 1000
-            }, 200, headers
-        else:
-            return {
-                "error": "Failed to generate signed JWT. Check server logs."
-            }, 500, headers
-
-    # For OAUTH2 mode
-    # Check if the token is cached and not expired
-    if (
-        CURRENT_TOKEN
-        and CURRENT_TOKEN_TIMESTAMP
-        and (time.time() - CURRENT_TOKEN_TIMESTAMP < TOKEN_TTL)
-    ):
-        print_log("DEBUG", "Returning cached access token.")
-    else:  # Otherwise, refresh it
-        print_log("DEBUG", "Cached token is expired or missing. Refreshing...")
-        if not generate_oauth_token():
-            # If refresh fails, return an error. This ensures logs are flushed.
-            return (
-                {
-                    "error": "Failed to generate a new access token. Check server logs for details."
-                },
-                500,
-                headers,
-            )
-
-    return CURRENT_TOKEN, 200, headers  # Return the (newly) cached token
+    if not is_authorized:
+        return {}
+    headers = {
+        "Access-Control-Allow-Credentials": "true",
+        "Access-Control-Allow-Origin": origin,
+        "Access-Control-Allow-Methods": "GET, POST, OPTIONS",
+        "Access-Control-Allow-Headers": "Content-Type, traceparent, tracestate",
+        "Access-Control-Max-Age": str(CORS_MAX_AGE),
+    }
+    if tracing.SERVER_TIMING:
+        # Lets the page read the `Server-Timing` header, e.g. in RUM scripts.
+        headers["Timing-Allow-Origin"] = origin
+    return headers
 
 
-def generate_oauth_token():
+def get_oauth_scopes():
     """
-    Generates an access token using Application Default Credentials and saves it
-    in a global variable.
+    Reads the OAuth scopes from the `OAUTH_SCOPES` environment variable.
 
     Returns:
-        bool: True on success, False on failure.
+        list: The scopes, or None if the variable is missing or empty.
     """
-    global CURRENT_TOKEN
-    global CURRENT_TOKEN_TIMESTAMP
-
     try:
-        # 1. Get configuration from environment variables.
         # These are set in deploy.sh from values.sh.
         # Scopes are expected to be a comma-separated string.
         scopes_str = os.environ["OAUTH_SCOPES"]
         scopes = [scope.strip() for scope in scopes_str.split(",") if scope.strip()]
         if not scopes:
             raise ValueError(
-                "OAUTH_SCOPES environment variable cannot be empty or contain only commas."
+                "OAUTH_SCOPES environment variable cannot be empty or contain "
+                "only commas."
             )
-        print_log("INFO", f"Using OAuth scopes: {scopes}")
-
+        return scopes
     except KeyError as e:
         print_log("CRITICAL", f"Missing environment variable: {e.args[0]}")
-        return False
+        return None
     except ValueError as e:
         print_log("CRITICAL", f"Invalid environment variable: {e}")
-        return False
+        return None
+
+
+def generate_oauth_token():
+    """
+    Generates an access token using Application Default Credentials.
+
+    Returns:
+        tuple: (response_dict, expiry_timestamp_seconds) or (None, None) on failure.
+    """
+    import google.auth.transport.requests
+    from google.api_core import exceptions
+
+    # 1. Get configuration from environment variables.
+    scopes = get_oauth_scopes()
+    if not scopes:
+        return None, None
+    print_log("INFO", f"Using OAuth scopes: {scopes}")
 
     try:
         # 2. Generate an access token using Application Default Credentials (ADC).
@@ -225,22 +446,21 @@ def generate_oauth_token():
         # The token needs to be refreshed to be valid.
         credentials.refresh(google.auth.transport.requests.Request())
         access_token = credentials.token
-        expiry = credentials.expiry
 
         if not access_token:
             raise RuntimeError("Failed to retrieve a valid access token.")
         print_log("DEBUG", "Successfully generated access token.")
 
-        # 3. Save the access token and its expiry as global variable.
-        print_log("DEBUG", "Saving refreshed access token and expiry...")
-
-        # Create a JSON payload with the token and its expiry.
-        CURRENT_TOKEN = {
+        # 3. Create a JSON payload with the token and its expiry.
+        # google-auth reports the expiry as a naive UTC datetime.
+        expiry = credentials.expiry
+        if expiry:
+            expiry = expiry.replace(tzinfo=datetime.timezone.utc).timestamp()
+        token_response = {
             "access_token": access_token,
-            "expiry": int(expiry.timestamp() * 1000) if expiry else None,
+            "expiry": int(expiry * 1000) if expiry else None,
         }
-        CURRENT_TOKEN_TIMESTAMP = time.time()
-        return True
+        return token_response, expiry
     except (
         google.auth.exceptions.DefaultCredentialsError,
         exceptions.GoogleAPICallError,
@@ -248,84 +468,157 @@ def generate_oauth_token():
         print_log("ERROR", f"A Google Cloud error occurred: {e}")
         print_log(
             "ERROR",
-            "Ensure the service account has the required IAM permissions on the secret and/or project.",
+            "Ensure the service account has the required IAM permissions on the "
+            "secret and/or project.",
         )
-        return False
+        return None, None
     except Exception as e:
         print_log("ERROR", f"An unexpected error occurred: {e}")
-        return False
+        return None, None
 
 
-def generate_jwt_payload_and_sign(target_session):
+def generate_jwt_response(target_session, metadata=()):
+    """
+    Signs a new JWT for a session and wraps it in the broker's response format.
+
+    Args:
+        target_session (str): The session ID to include in the 'ces_session' claim.
+        metadata (tuple): Extra gRPC metadata of the signJwt call, e.g. the
+            trace context.
+
+    Returns:
+        tuple: (response_dict, expiry_timestamp_seconds) or (None, None) on failure.
+    """
+    print_log("DEBUG", f"Generating session-specific JWT for session: {target_session}")
+    jwt_token, expiry_time = generate_jwt_payload_and_sign(
+        target_session=target_session, metadata=metadata
+    )
+    if not jwt_token:
+        return None, None
+    return {"access_token": jwt_token, "expiry": expiry_time * 1000}, expiry_time
+
+
+def generate_jwt_payload_and_sign(target_session, metadata=()):
     """
     Helper function to generate a signed JWT using IAMCredentialsClient.
-    
+
     Args:
         target_session (str): The session ID to include in the 'ces_session' claim.
-        
+        metadata (tuple): Extra gRPC metadata of the signJwt call.
+
     Returns:
         tuple: (jwt_token_string, expiry_timestamp_seconds) or (None, None) on failure.
     """
+    global _iam_client
+
     try:
+        from google.cloud import iam_credentials_v1
+
         # 1. Get scopes for the payload
         scopes_str = os.environ.get("OAUTH_SCOPES", "")
         scopes = [scope.strip() for scope in scopes_str.split(",") if scope.strip()]
-        
+
         # 2. Get credentials to determine service account principal
         credentials, _ = google.auth.default(scopes=scopes)
-        
-        sa_email = getattr(credentials, "service_account_email", "default")
-
-        # If 'default' or missing, try to fetch from Metadata Server (Cloud Run/Functions environment)
-        if sa_email == "default":
-            try:
-                import urllib.request
-                req = urllib.request.Request(
-                    "http://metadata.google.internal/computeMetadata/v1/instance/service-accounts/default/email",
-                    headers={"Metadata-Flavor": "Google"}
-                )
-                with urllib.request.urlopen(req) as response:
-                    sa_email = response.read().decode("utf-8").strip()
-            except Exception as e:
-                print_log("WARNING", f"Failed to fetch SA email from Metadata Server: {e}")
-                sa_email = "unknown" # Let the client fail if it can't find it
-        
+
+        sa_email = get_service_account_email(credentials)
         if sa_email == "unknown":
-             print_log("ERROR", "Could not determine service account email.")
-             return None, None
+            print_log("ERROR", "Could not determine service account email.")
+            return None, None
 
-        # 3. Create IAM Credentials Client
-        client = iam_credentials_v1.IAMCredentialsClient()
+        # 3. Create IAM Credentials Client (once per instance)
+        if _iam_client is None:
+            _iam_client = iam_credentials_v1.IAMCredentialsClient()
 
         # 4. Construct Payload
         service_account_name = f"projects/-/serviceAccounts/{sa_email}"
-        
-        now = int(time.time())
-        expiry_time = now + 3600
-        
-        payload = {
-            "iss": sa_email,
-            "sub": sa_email,
-            "aud": AUDIENCE,
-            "iat": now,
-            "exp": expiry_time,
-            "scope": " ".join(scopes),
-            "ces_session": target_session
-        }
-        
+        payload, expiry_time = build_jwt_payload(sa_email, scopes, target_session)
+
         # 5. Sign JWT
         print_log("DEBUG", f"Signing JWT for {sa_email} using IAMCredentialsClient...")
-        
-        response = client.sign_jwt(
+
+        response = _iam_client.sign_jwt(
             name=service_account_name,
             delegates=[],
-            payload=json.dumps(payload)
+            payload=payload,
+            metadata=metadata,
         )
-        
+
         jwt_token = response.signed_jwt
-        
+
         return jwt_token, expiry_time
 
     except Exception as e:
         print_log("ERROR", f"Failed to generate signed JWT: {e}")
         return None, None
+
+
+def get_service_account_email(credentials=None):
+    """
+    Returns the email of the service account running this function.
+
+    The email is looked up once, from the credentials or the Metadata Server,
+    and cached for the lifetime of the instance.
+
+    Args:
+        credentials (google.auth.credentials.Credentials): The ADC. If not
+            provided, they are loaded when the email isn't cached yet.
+
+    Returns:
+        str: The service account email, or "unknown" if it can't be determined.
+    """
+    global _sa_email
+    if _sa_email:
+        return _sa_email
+
+    if credentials is None:
+        credentials, _ = google.auth.default()
+
+    sa_email = getattr(credentials, "service_account_email", "default")
+
+    # If 'default' or missing, try to fetch from Metadata Server (Cloud
+    # Run/Functions environment)
+    if sa_email == "default":
+        try:
+            import urllib.request
+
+            req = urllib.request.Request(
+                "http://metadata.google.internal/computeMetadata/v1/instance/"
+                "service-accounts/default/email",
+                headers={"Metadata-Flavor": "Google"},
+            )
+            with urllib.request.urlopen(req) as response:
+                sa_email = response.read().decode("utf-8").strip()
+        except Exception as e:
+            print_log("WARNING", f"Failed to fetch SA email from Metadata Server: {e}")
+            return "unknown"  # Let the client fail if it can't find it
+
+    _sa_email = sa_email
+    return sa_email
+
+
+def build_jwt_payload(sa_email, scopes, target_session):
+    """
+    Builds the claims of a session JWT.
+
+    Args:
+        sa_email (str): The service account that signs the JWT.
+        scopes (list): The OAuth scopes granted by the JWT.
+        target_session (str): The session ID to include in the 'ces_session' claim.
+
+    Returns:
+        tuple: (json_payload_string, expiry_timestamp_seconds).
+    """
+    now = int(time.time())
+    expiry_time = now + JWT_LIFETIME
+
+    payload = {
+        "iss": sa_email,
+        "sub": sa_email,
+        "aud": AUDIENCE,
+        "iat": now,
+        "exp": expiry_time,
+        "scope": " ".join(scopes),
+        "ces_session": target_session,
+    }
+    return json.dumps(payload), expiry_time
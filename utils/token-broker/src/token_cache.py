@@ -0,0 +1,130 @@
+"""Bounded LRU cache of tokens, with single-flight refreshes.
+
+Used for the access tokens (and session JWTs) minted by the service. The
+web-proxy, websocket-proxy and token-broker services are each deployed from
+their own `src` directory, so each has a copy of this module: keep the copies
+identical (`web-proxy/tests/test_shared_modules.py` checks it).
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class TokenCache:
+    """Bounded LRU cache of tokens.
+
+    Each entry is served until `ttl` seconds after it was minted or
+    `expiry_margin` seconds before the token's real expiry, whichever comes
+    first. Refreshes are single-flight per key: concurrent requests for the
+    same key wait for one refresh instead of each minting their own token.
+    With a `shared` store, the processes of the instance also share their
+    tokens and refreshes, see `shared_token_cache.py`.
+
+    The bookkeeping (`_lookup`, `_store`, `_valid`) is separate from the
+    locking of `get`, so that subclasses can serve the same cache with other
+    locks, e.g. `asyncio` ones.
+    """
+
+    def __init__(self, max_entries, ttl, expiry_margin, shared=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.expiry_margin = expiry_margin
+        self.shared = shared
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # key -> (token, valid_until)
+        self._key_locks = {}
+        self._lock = threading.Lock()
+
+    def _lookup(self, key):
+        """Returns the cached token for `key`, if still valid. Requires `_lock`."""
+        entry = self._entries.get(key)
+        if entry and time.time() < entry[1]:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+        return None
+
+    def _store(self, key, token, valid_until):
+        """Caches a minted token, evicting the least recently used ones.
+
+        Requires `_lock`.
+        """
+        self._entries[key] = (token, valid_until)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            evicted_key, _ = self._entries.popitem(last=False)
+            self._key_locks.pop(evicted_key, None)
+            self.evictions += 1
+
+    def get(self, key, mint):
+        """Returns a valid token for `key`, calling `mint` on a cache miss.
+
+        Args:
+            key (hashable): The cache key. With a `shared` store, it must also
+                be JSON-serializable.
+            mint (callable): Returns a `(token, expiry)` tuple, where expiry is
+                a POSIX timestamp or None. A falsy token signals a failure.
+
+        Returns:
+            The token returned by `mint`, or None if minting failed.
+        """
+        with self._lock:
+            token = self._lookup(key)
+            if token is not None:
+                return token
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+
+        with key_lock:
+            # Another request may have refreshed this key while we waited.
+            with self._lock:
+                token = self._lookup(key)
+                if token is not None:
+                    return token
+                self.misses += 1
+
+            if self.shared:
+                token, valid_until = self.shared.get(key, lambda: self._valid(*mint()))
+            else:
+                token, valid_until = self._valid(*mint())
+            if not token:
+                with self._lock:
+                    # Keys that fail to mint, e.g. for bad scopes, don't keep
+                    # a lock forever.
+                    if key not in self._entries:
+                        self._key_locks.pop(key, None)
+                return None
+
+            with self._lock:
+                self._store(key, token, valid_until)
+        return token
+
+    def _valid(self, token, expiry):
+        """Returns `(token, valid_until)` for a minted token."""
+        if not token:
+            return None, None
+        valid_until = time.time() + self.ttl
+        if expiry is not None:
+            valid_until = min(valid_until, expiry - self.expiry_margin)
+        return token, valid_until
+
+    def valid_until(self, key):
+        """Returns the POSIX timestamp until which `key` is served, or None."""
+        entry = self._entries.get(key)
+        return entry[1] if entry else None
+
+    def stats(self):
+        """Returns the cache counters, for logging."""
+        lookups = self.hits + self.misses
+        stats = {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+        }
+        if self.shared:
+            stats["shared"] = self.shared.stats()
+        return stats
@@ -0,0 +1,244 @@
+"""Timing of the phases of a request: `Server-Timing` and OpenTelemetry.
+
+Used by the request handlers of `main.py` (and `asgi.py` in token-broker) to
+tell where the time of a request went: token cache and refresh, upstream
+connection, upstream processing... Each handler names its phases, see the
+README of the service.
+
+- With `SERVER_TIMING=true`, the durations are sent back in a
+  `Server-Timing` response header, which the browser shows in the network
+  panel of its developer tools.
+- When an OTLP endpoint is configured (`OTEL_EXPORTER_OTLP_ENDPOINT` or
+  `OTEL_EXPORTER_OTLP_TRACES_ENDPOINT`) and the optional
+  `opentelemetry-sdk` and `opentelemetry-exporter-otlp-proto-http` packages
+  are installed, each request is also traced: a span for the request, child
+  of the caller's `traceparent` if any, and a child span per phase. The
+  standard `OTEL_*` variables apply, e.g. `OTEL_TRACES_SAMPLER` and
+  `OTEL_TRACES_SAMPLER_ARG` for sampling. The trace context is propagated
+  to the upstream APIs with `RequestTrace.inject`.
+
+When both are off, `start_request` returns `NULL_TRACE`, whose methods do
+nothing, and OpenTelemetry is never imported.
+
+web-proxy and token-broker each have a copy of this module, as they're
+deployed from their own `src` directory: keep the copies identical
+(`web-proxy/tests/test_shared_modules.py` checks it).
+"""
+
+import contextlib
+import os
+import threading
+import time
+
+SERVER_TIMING = os.environ.get("SERVER_TIMING", "false").lower() == "true"
+
+OTEL_ENABLED = (
+    bool(
+        os.environ.get("OTEL_EXPORTER_OTLP_TRACES_ENDPOINT")
+        or os.environ.get("OTEL_EXPORTER_OTLP_ENDPOINT")
+    )
+    and os.environ.get("OTEL_SDK_DISABLED", "false").lower() != "true"
+)
+
+# Trace context headers replaced by `RequestTrace.inject` (lowercase).
+TRACE_HEADERS = frozenset(["traceparent", "tracestate"])
+
+_NULL_PHASE = contextlib.nullcontext()
+
+_tracer = None
+_tracer_lock = threading.Lock()
+
+
+def get_tracer(service_name, log):
+    """Returns the OpenTelemetry tracer, set up on first use, or None.
+
+    It's set up by the first request of each process rather than at import,
+    so that the exporter's thread runs in the gunicorn or uvicorn workers.
+    """
+    global _tracer, OTEL_ENABLED
+    if _tracer is not None or not OTEL_ENABLED:
+        return _tracer
+    with _tracer_lock:
+        if _tracer is None and OTEL_ENABLED:
+            try:
+                from opentelemetry.exporter.otlp.proto.http.trace_exporter import (
+                    OTLPSpanExporter,
+                )
+                from opentelemetry.sdk.resources import Resource
+                from opentelemetry.sdk.trace import TracerProvider
+                from opentelemetry.sdk.trace.export import BatchSpanProcessor
+            except ImportError as e:
+                log(
+                    "WARNING", f"OpenTelemetry SDK not installed, tracing disabled: {e}"
+                )
+                OTEL_ENABLED = False
+                return None
+            # The sampler is configured by `OTEL_TRACES_SAMPLER`.
+            provider = TracerProvider(
+                resource=Resource.create(
+                    {"service.name": os.environ.get("OTEL_SERVICE_NAME", service_name)}
+                )
+            )
+            provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+            _tracer = provider.get_tracer(__name__)
+    return _tracer
+
+
+def start_request(name, headers, service_name, log):
+    """Starts timing a request.
+
+    Args:
+        name (str): The name of the request span.
+        headers: The request headers, with case-insensitive `get`.
+        service_name (str): The default `service.name` of the spans.
+        log (callable): `print_log`.
+
+    Returns:
+        RequestTrace, or `NULL_TRACE` if timing is off.
+    """
+    if not (SERVER_TIMING or OTEL_ENABLED):
+        return NULL_TRACE
+    return RequestTrace(name, headers, get_tracer(service_name, log))
+
+
+class NullTrace:
+    """A `RequestTrace` that does nothing, used when timing is off."""
+
+    __slots__ = ()
+
+    def phase(self, name):
+        return _NULL_PHASE
+
+    def add(self, name, seconds, start):
+        pass
+
+    def inject(self, headers, span=None):
+        pass
+
+    def server_timing(self):
+        return None
+
+    def end(self, status):
+        pass
+
+    def finish(self, response, timing_allow_origin=None):
+        return response
+
+
+NULL_TRACE = NullTrace()
+
+
+class RequestTrace:
+    """The phases of a request, timed for `Server-Timing` and as spans."""
+
+    __slots__ = ("timings", "span", "_tracer", "_start")
+
+    def __init__(self, name, headers, tracer):
+        self.timings = [] if SERVER_TIMING else None
+        self.span = None
+        self._tracer = tracer
+        self._start = time.perf_counter()
+        if tracer:
+            from opentelemetry import propagate
+            from opentelemetry.trace import SpanKind
+
+            self.span = tracer.start_span(
+                name, context=propagate.extract(headers), kind=SpanKind.SERVER
+            )
+
+    def _child_span(self, name, start_time=None):
+        """Starts a span for a phase, if the request is sampled."""
+        if not (self.span and self.span.is_recording()):
+            return None
+        from opentelemetry import trace
+
+        return self._tracer.start_span(
+            name, context=trace.set_span_in_context(self.span), start_time=start_time
+        )
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Times the block as the phase `name`. Yields its span, or None."""
+        span = self._child_span(name)
+        start = time.perf_counter()
+        try:
+            yield span
+        finally:
+            if self.timings is not None:
+                self.timings.append((name, time.perf_counter() - start))
+            if span:
+                span.end()
+
+    def add(self, name, seconds, start):
+        """Records a phase timed elsewhere, which began at `start`.
+
+        Args:
+            name (str): The phase name.
+            seconds (float): Its duration.
+            start (float): When it began, from `time.perf_counter`.
+        """
+        if self.timings is not None:
+            self.timings.append((name, seconds))
+        if self.span and self.span.is_recording():
+            start_time = time.time_ns() - int((time.perf_counter() - start) * 1e9)
+            span = self._child_span(name, start_time)
+            span.end(start_time + int(seconds * 1e9))
+
+    def inject(self, headers, span=None):
+        """Sets the trace context of `span` (or the request's) in `headers`.
+
+        Args:
+            headers (dict): Headers (or gRPC metadata) of an upstream request.
+                Trace context headers of the incoming request, in any case,
+                are replaced.
+            span: The span of the phase sending the request, if any.
+        """
+        if not self.span:
+            return
+        from opentelemetry import propagate, trace
+
+        for key in [key for key in headers if key.lower() in TRACE_HEADERS]:
+            del headers[key]
+        propagate.inject(headers, context=trace.set_span_in_context(span or self.span))
+
+    def server_timing(self):
+        """Returns the `Server-Timing` header value, or None if it's off."""
+        if self.timings is None:
+            return None
+        total = time.perf_counter() - self._start
+        return ", ".join(
+            f"{name};dur={seconds * 1000:.1f}"
+            for name, seconds in self.timings + [("total", total)]
+        )
+
+    def end(self, status):
+        """Ends the request span, with the response status."""
+        if self.span:
+            self.span.set_attribute("http.response.status_code", status)
+            if status >= 500:
+                from opentelemetry.trace import StatusCode
+
+                self.span.set_status(StatusCode.ERROR)
+            self.span.end()
+
+    def finish(self, response, timing_allow_origin=None):
+        """Ends the trace of a Flask request, and adds `Server-Timing` to its response.
+
+        Args:
+            response: The return value of the Flask view.
+            timing_allow_origin (str): An origin allowed to read the timings
+                from its scripts, e.g. for real user monitoring.
+
+        Returns:
+            The response, as a `flask.Response`.
+        """
+        import flask
+
+        response = flask.make_response(response)
+        self.end(response.status_code)
+        server_timing = self.server_timing()
+        if server_timing:
+            response.headers["Server-Timing"] = server_timing
+            if timing_allow_origin:
+                response.headers["Timing-Allow-Origin"] = timing_allow_origin
+        return response
@@ -0,0 +1,141 @@
+import asyncio
+import json
+import time
+
+import asgi
+import flask
+import main
+import pytest
+from asgi import AsyncTokenCache
+
+ORIGIN = "http://localhost:5173"
+
+
+def test_async_cache_mints_once_for_concurrent_gets():
+    cache = AsyncTokenCache(10, 300, 60)
+    mints = []
+
+    async def mint():
+        mints.append(1)
+        await asyncio.sleep(0.05)
+        return "token", time.time() + 3600
+
+    async def run():
+        return await asyncio.gather(*(cache.get("key", mint) for _ in range(10)))
+
+    assert asyncio.run(run()) == ["token"] * 10
+    assert len(mints) == 1
+    assert cache.stats()["misses"] == 1
+
+
+def test_async_cache_failed_mint_is_retried():
+    cache = AsyncTokenCache(10, 300, 60)
+    results = iter([(None, None), ("token", None)])
+
+    async def mint():
+        return next(results)
+
+    assert asyncio.run(cache.get("key", mint)) is None
+    assert "key" not in cache._key_locks
+    assert asyncio.run(cache.get("key", mint)) == "token"
+
+
+@pytest.fixture
+def mints(monkeypatch):
+    """OAuth mode, with a slow token refresh counting its calls."""
+    monkeypatch.setattr(asgi, "TOKEN_TYPE", "access_token")
+    monkeypatch.setattr(asgi, "OAUTH_TOKEN_CACHE", AsyncTokenCache(1, 300, 60))
+    calls = []
+
+    def fake_generate_oauth_token():
+        calls.append(1)
+        time.sleep(0.05)
+        expiry = time.time() + 3600
+        return {"access_token": "token", "expiry": int(expiry * 1000)}, expiry
+
+    monkeypatch.setattr(main, "generate_oauth_token", fake_generate_oauth_token)
+    return calls
+
+
+async def call(method="GET", headers=None, body=b""):
+    """Calls the ASGI app, and returns its status, headers and body."""
+    scope = {
+        "type": "http",
+        "method": method,
+        "headers": [
+            (name.encode("latin-1"), value.encode("latin-1"))
+            for name, value in {"Origin": ORIGIN, **(headers or {})}.items()
+        ],
+    }
+    sent = []
+
+    async def receive():
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    async def send(message):
+        sent.append(message)
+
+    await asgi.app(scope, receive, send)
+    start, response_body = sent
+    response_headers = {
+        name.decode("latin-1"): value.decode("latin-1")
+        for name, value in start["headers"]
+    }
+    return start["status"], response_headers, response_body["body"]
+
+
+def test_app_serves_the_token(mints):
+    status, headers, body = asyncio.run(call())
+    assert status == 200
+    assert json.loads(body)["access_token"] == "token"
+    assert headers["Content-Type"] == "application/json"
+    assert headers["Access-Control-Allow-Origin"] == ORIGIN
+    assert headers["Vary"] == "Origin"
+    assert 298 <= int(headers["Cache-Control"].rpartition("=")[2]) <= 300
+
+
+def test_app_answers_conditional_requests(mints):
+    _, headers, _ = asyncio.run(call())
+    status, revalidated, body = asyncio.run(
+        call(headers={"If-None-Match": headers["ETag"]})
+    )
+    assert status == 304
+    assert body == b""
+    assert revalidated["ETag"] == headers["ETag"]
+    assert revalidated["Access-Control-Allow-Origin"] == ORIGIN
+
+
+def test_app_answers_preflight_requests(mints):
+    status, headers, _ = asyncio.run(call("OPTIONS"))
+    assert status == 204
+    assert headers["Vary"] == main.PREFLIGHT_VARY
+    assert headers["Access-Control-Allow-Origin"] == ORIGIN
+    assert mints == []
+
+
+def test_app_rejects_other_methods(mints):
+    status, headers, _ = asyncio.run(call("DELETE"))
+    assert status == 405
+    assert headers["Cache-Control"] == "no-store"
+
+
+def test_app_refreshes_once_for_concurrent_requests(mints):
+    async def run():
+        return await asyncio.gather(*(call() for _ in range(10)))
+
+    assert [status for status, _, _ in asyncio.run(run())] == [200] * 10
+    assert len(mints) == 1
+
+
+def test_app_and_flask_handler_agree(mints, monkeypatch):
+    monkeypatch.setenv("TOKEN_TYPE", "access_token")
+    monkeypatch.setattr(main, "OAUTH_TOKEN_CACHE", main.TokenCache(1, 300, 60))
+    _, asgi_headers, asgi_body = asyncio.run(call())
+    app = flask.Flask(__name__)
+    with app.test_request_context("/", headers={"Origin": ORIGIN}):
+        body, _, headers = main.get_access_token(flask.request)
+    # Each handler refreshed its own token.
+    assert json.loads(asgi_body).keys() == body.keys()
+    del asgi_headers["Content-Type"]
+    assert asgi_headers.keys() == headers.keys()
+    assert asgi_headers["ETag"] == headers["ETag"]
@@ -0,0 +1,88 @@
+import time
+
+import flask
+import main
+import pytest
+from token_cache import TokenCache
+
+ORIGIN = "http://localhost:5173"
+
+
+def test_max_age_until_the_token_stops_being_served():
+    headers = main.get_cache_headers({"access_token": "a"}, time.time() + 120.5)
+    assert headers["Cache-Control"] in ("private, max-age=120", "private, max-age=119")
+    assert headers["ETag"].startswith('"') and len(headers["ETag"]) == 34
+
+
+@pytest.mark.parametrize("valid_until", [None, 0, time.time() - 10])
+def test_no_store_once_expired(valid_until):
+    headers = main.get_cache_headers({"access_token": "a"}, valid_until)
+    assert headers["Cache-Control"] == "no-store"
+
+
+def test_etag_depends_on_the_token_only():
+    first = main.get_cache_headers({"access_token": "a", "expiry": 1}, 0)["ETag"]
+    same = main.get_cache_headers({"access_token": "a", "expiry": 2}, 0)["ETag"]
+    other = main.get_cache_headers({"access_token": "b", "expiry": 1}, 0)["ETag"]
+    assert first == same != other
+
+
+@pytest.mark.parametrize(
+    "if_none_match,expected",
+    [
+        (None, False),
+        ("", False),
+        ('"abc"', True),
+        ('W/"abc"', True),
+        ('"x", "abc"', True),
+        ("*", True),
+        ('"abcd"', False),
+    ],
+)
+def test_is_not_modified(if_none_match, expected):
+    assert main.is_not_modified(if_none_match, '"abc"') is expected
+
+
+@pytest.fixture
+def oauth(monkeypatch):
+    """OAuth mode, with a token expiring in `lifetime` seconds."""
+    monkeypatch.setenv("TOKEN_TYPE", "access_token")
+    monkeypatch.setattr(main, "OAUTH_TOKEN_CACHE", TokenCache(1, 300, 60))
+
+    def set_lifetime(lifetime):
+        expiry = time.time() + lifetime
+        token = {"access_token": "token", "expiry": int(expiry * 1000)}
+        monkeypatch.setattr(main, "generate_oauth_token", lambda: (token, expiry))
+
+    return set_lifetime
+
+
+def get(headers=None):
+    app = flask.Flask(__name__)
+    with app.test_request_context("/", headers={"Origin": ORIGIN, **(headers or {})}):
+        return flask.make_response(main.get_access_token(flask.request))
+
+
+def max_age(response):
+    return int(response.headers["Cache-Control"].rpartition("=")[2])
+
+
+def test_max_age_is_capped_by_the_ttl(oauth):
+    oauth(3600)
+    assert 298 <= max_age(get()) <= 300
+
+
+def test_max_age_keeps_the_expiry_margin(oauth):
+    oauth(200)
+    assert 138 <= max_age(get()) <= 140
+
+
+def test_conditional_request_is_not_modified(oauth):
+    oauth(3600)
+    response = get()
+    assert response.status_code == 200
+    assert response.headers["Vary"] == "Origin"
+    revalidated = get({"If-None-Match": response.headers["ETag"]})
+    assert revalidated.status_code == 304
+    assert revalidated.headers["ETag"] == response.headers["ETag"]
+    assert revalidated.headers["Access-Control-Allow-Origin"] == ORIGIN
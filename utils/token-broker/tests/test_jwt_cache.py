@@ -0,0 +1,115 @@
+import json
+import threading
+import time
+import types
+
+import flask
+import main
+import pytest
+import token_cache
+from token_cache import TokenCache
+
+ORIGIN = "http://localhost:5173"
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """A controllable `time.time` for the cache."""
+    now = [time.time()]
+    monkeypatch.setattr(token_cache, "time", types.SimpleNamespace(time=lambda: now[0]))
+    return now
+
+
+class Signed(list):
+    """The signed sessions, in order."""
+
+    delay = 0
+
+
+@pytest.fixture
+def signer(monkeypatch, clock):
+    """JWT mode, with a fake signJwt call recording the signed sessions."""
+    monkeypatch.setenv("TOKEN_TYPE", "jwt")
+    monkeypatch.setattr(
+        main,
+        "JWT_CACHE",
+        TokenCache(10, main.JWT_LIFETIME, main.JWT_MIN_REMAINING_LIFETIME),
+    )
+    signed = Signed()
+
+    def fake_sign(target_session, metadata=()):
+        time.sleep(signed.delay)
+        signed.append(target_session)
+        return f"jwt-{len(signed)}", clock[0] + main.JWT_LIFETIME
+
+    monkeypatch.setattr(main, "generate_jwt_payload_and_sign", fake_sign)
+    return signed
+
+
+def request(target_session):
+    app = flask.Flask(__name__)
+    with app.test_request_context(
+        "/",
+        method="POST",
+        data=json.dumps({"target_session": target_session}),
+        headers={"Origin": ORIGIN},
+    ):
+        body, status, _ = main.handle_token_request(
+            flask.request, main.tracing.NULL_TRACE
+        )
+    assert status == 200
+    return body["access_token"]
+
+
+def test_jwt_is_reused_for_the_same_session(signer):
+    assert request("a") == request("a") == "jwt-1"
+    assert request("b") == "jwt-2"
+    assert signer == ["a", "b"]
+
+
+def test_jwt_is_resigned_before_its_min_remaining_lifetime(signer, clock):
+    assert request("a") == "jwt-1"
+    served_for = main.JWT_LIFETIME - main.JWT_MIN_REMAINING_LIFETIME
+    clock[0] += served_for - 1
+    assert request("a") == "jwt-1"
+    clock[0] += 2
+    assert request("a") == "jwt-2"
+    assert signer == ["a", "a"]
+
+
+def test_concurrent_requests_sign_once(signer):
+    signer.delay = 0.2
+    tokens = []
+    threads = [
+        threading.Thread(target=lambda: tokens.append(request("a"))) for _ in range(8)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert tokens == ["jwt-1"] * 8
+    assert signer == ["a"]
+
+
+def test_failed_signature_is_not_cached(signer, monkeypatch):
+    monkeypatch.setattr(
+        main, "generate_jwt_payload_and_sign", lambda **kwargs: (None, None)
+    )
+    app = flask.Flask(__name__)
+    with app.test_request_context(
+        "/", method="POST", data=json.dumps({"target_session": "a"})
+    ):
+        _, status, _ = main.handle_token_request(flask.request, main.tracing.NULL_TRACE)
+    assert status == 500
+    assert main.JWT_CACHE.valid_until("a") is None
+
+
+def test_jwt_payload_claims():
+    payload, expiry = main.build_jwt_payload(
+        "sa@example.com", ["scope-a", "scope-b"], "projects/p/sessions/s"
+    )
+    claims = json.loads(payload)
+    assert claims["iss"] == claims["sub"] == "sa@example.com"
+    assert claims["ces_session"] == "projects/p/sessions/s"
+    assert claims["scope"] == "scope-a scope-b"
+    assert claims["exp"] == expiry == claims["iat"] + main.JWT_LIFETIME
@@ -0,0 +1,45 @@
+import asyncio
+import json
+
+import asgi
+import flask
+import main
+import pytest
+
+ORIGIN = "http://localhost:5173"
+
+
+@pytest.fixture(autouse=True)
+def jwt_mode(monkeypatch):
+    monkeypatch.setenv("TOKEN_TYPE", "jwt")
+    monkeypatch.setattr(asgi, "TOKEN_TYPE", "jwt")
+
+
+def sync_request(body):
+    app = flask.Flask(__name__)
+    with app.test_request_context(
+        "/", method="POST", data=json.dumps(body), headers={"Origin": ORIGIN}
+    ):
+        return flask.make_response(main.get_access_token(flask.request))
+
+
+def async_request(body):
+    return asyncio.run(
+        asgi.get_access_token("POST", {"origin": ORIGIN}, json.dumps(body).encode())
+    )
+
+
+@pytest.mark.parametrize("target_session", [["a", "b"], {"a": 1}, 42])
+def test_non_string_session_is_rejected(target_session):
+    response = sync_request({"target_session": target_session})
+    assert response.status_code == 400
+    assert response.headers["Access-Control-Allow-Origin"] == ORIGIN
+
+    body, status, headers = async_request({"target_session": target_session})
+    assert status == 400
+    assert headers["Access-Control-Allow-Origin"] == ORIGIN
+
+
+def test_missing_session_is_rejected():
+    assert sync_request({}).status_code == 400
+    assert async_request({})[1] == 400
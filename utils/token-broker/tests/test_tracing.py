@@ -0,0 +1,57 @@
+import asyncio
+
+import asgi
+import flask
+import main
+import pytest
+import tracing
+
+
+@pytest.fixture
+def spans(monkeypatch):
+    """Traces requests to an in-memory exporter, which is returned."""
+    pytest.importorskip("opentelemetry.sdk.trace")
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import SimpleSpanProcessor
+    from opentelemetry.sdk.trace.export.in_memory_span_exporter import (
+        InMemorySpanExporter,
+    )
+
+    exporter = InMemorySpanExporter()
+    provider = TracerProvider()
+    provider.add_span_processor(SimpleSpanProcessor(exporter))
+    monkeypatch.setattr(tracing, "OTEL_ENABLED", True)
+    monkeypatch.setattr(tracing, "_tracer", provider.get_tracer(__name__))
+    return exporter
+
+
+def fail(*args):
+    raise RuntimeError("bug")
+
+
+def test_span_ends_on_unhandled_errors(monkeypatch, spans):
+    monkeypatch.setattr(main, "handle_token_request", fail)
+    app = flask.Flask(__name__)
+    with app.test_request_context("/"):
+        with pytest.raises(RuntimeError):
+            main.get_access_token(flask.request)
+    (span,) = spans.get_finished_spans()
+    assert span.attributes["http.response.status_code"] == 500
+
+
+def test_asgi_span_ends_on_unhandled_errors(monkeypatch, spans):
+    async def get_access_token(*args):
+        fail()
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        pass
+
+    monkeypatch.setattr(asgi, "get_access_token", get_access_token)
+    scope = {"type": "http", "method": "GET", "headers": []}
+    with pytest.raises(RuntimeError):
+        asyncio.run(asgi.app(scope, receive, send))
+    (span,) = spans.get_finished_spans()
+    assert span.attributes["http.response.status_code"] == 500
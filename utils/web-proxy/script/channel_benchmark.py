@@ -0,0 +1,204 @@
+"""Compares the turn latency of a text chat over `:runSession` and `:channel`.
+
+Runs the proxy (`src/main.py`) in-process against a fake CES API endpoint
+(see `fake_ces.py`) whose agent takes `--latency-ms` to generate each reply:
+`:runSession` answers once the reply is complete, and the `BidiRunSession`
+WebSocket of channels streams it in `--chunks` partial texts as it's
+generated.
+
+Plays a chat of `--turns` turns, each sent once the previous reply is
+complete, as the widget does: one `:runSession` request per turn, then one
+channel, opened once, with one POST per turn and the replies read from its
+event stream. Reports, per turn, the time until the first text of the reply
+and until the reply is complete, and the total time of the chat.
+
+Usage:
+    python script/channel_benchmark.py [--turns 20] [--latency-ms 1500]
+        [--chunks 10]
+"""
+
+import argparse
+import contextlib
+import importlib
+import io
+import json
+import os
+import queue
+import statistics
+import sys
+import threading
+import time
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(SCRIPT_DIR, "..", "src"))
+
+from fake_ces import FakeCES, trust_certificate  # noqa: E402
+
+SESSION = "projects/benchmark/locations/us/apps/app/sessions/s1"
+HEADERS = {"Authorization": "Bearer benchmark", "Content-Type": "application/json"}
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def run_session_chat(main, app, turns):
+    """Plays the chat with one `:runSession` request per turn.
+
+    Returns:
+        list: (time to first text, time to complete reply) of each turn, in
+        seconds, which are the same: the reply comes in one piece.
+    """
+    import flask
+
+    latencies = []
+    for turn in range(turns):
+        body = json.dumps({"inputs": [{"text": f"Question {turn}"}]})
+        with app.test_request_context(
+            f"/{SESSION}:runSession", method="POST", data=body, headers=HEADERS
+        ):
+            start = time.perf_counter()
+            response = main.ces_agent_request(flask.request)
+            elapsed = time.perf_counter() - start
+        assert response[1] == 200, response
+        latencies.append((elapsed, elapsed))
+    return latencies
+
+
+def read_events(response, events, stop):
+    """Puts the `(time, event, data)` of an event stream into `events`.
+
+    Once `stop` is set, closes the stream at the next event or keepalive, as
+    the server does when the client goes away.
+    """
+    for chunk in response.response:
+        if stop.is_set():
+            break
+        event, data = "message", []
+        for line in chunk.decode().splitlines():
+            if line.startswith("event: "):
+                event = line[len("event: ") :]
+            elif line.startswith("data: "):
+                data.append(line[len("data: ") :])
+        if data:
+            events.put((time.perf_counter(), event, json.loads("\n".join(data))))
+    response.close()
+
+
+def channel_chat(main, app, turns):
+    """Plays the chat over one channel.
+
+    Returns:
+        tuple: The time taken to open the channel, and the (time to first
+        text, time to complete reply) of each turn, in seconds.
+    """
+    import flask
+
+    start = time.perf_counter()
+    with app.test_request_context(f"/{SESSION}:channel", headers=HEADERS):
+        response = main.ces_agent_request(flask.request)
+    assert isinstance(response, flask.Response), response
+    events, stop = queue.Queue(), threading.Event()
+    reader = threading.Thread(target=read_events, args=(response, events, stop))
+    reader.start()
+    _, event, data = events.get(timeout=30)
+    assert event == "open", event
+    opening = time.perf_counter() - start
+
+    latencies = []
+    for turn in range(turns):
+        body = json.dumps({"realtimeInput": {"text": f"Question {turn}"}})
+        with app.test_request_context(
+            f"/{SESSION}:channel?id={data['channel']}",
+            method="POST",
+            data=body,
+            headers=HEADERS,
+        ):
+            start = time.perf_counter()
+            status = main.ces_agent_request(flask.request)[1]
+        assert status == 202, status
+        first_text = None
+        while True:
+            received, event, message = events.get(timeout=30)
+            assert event == "message", event
+            output = message["sessionOutput"]
+            if first_text is None and "text" in output:
+                first_text = received - start
+            if output.get("turnCompleted"):
+                latencies.append((first_text, received - start))
+                break
+    stop.set()
+    reader.join(10)
+    return opening, latencies
+
+
+def summarize(name, latencies, opening=0):
+    first = [latency[0] for latency in latencies]
+    complete = [latency[1] for latency in latencies]
+    print(
+        f"{name}: first text p50 {statistics.median(first) * 1000:.0f} ms, "
+        f"p95 {percentile(first, 0.95) * 1000:.0f} ms; complete reply "
+        f"p50 {statistics.median(complete) * 1000:.0f} ms, "
+        f"p95 {percentile(complete, 0.95) * 1000:.0f} ms; "
+        f"chat {(opening + sum(complete)):.2f} s"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--turns", type=int, default=20)
+    parser.add_argument(
+        "--latency-ms",
+        type=float,
+        default=1500,
+        help="Time taken by the agent to generate a reply (default: 1500).",
+    )
+    parser.add_argument(
+        "--chunks",
+        type=int,
+        default=10,
+        help="Partial texts of a streamed reply (default: 10).",
+    )
+    args = parser.parse_args()
+
+    import flask
+
+    trust_certificate()
+    endpoint = FakeCES(
+        "agent", lambda: args.latency_ms / 1000, chunks=args.chunks
+    ).start()
+    os.environ.update(
+        {
+            "CES_API_DOMAIN": endpoint.domain,
+            "CHANNEL_KEEPALIVE": "1",
+            "CHANNEL_MAX_SESSIONS": "4",
+            "DISABLE_REGION_CHECK": "true",
+            "RESPONSE_COMPRESSION": "false",
+            "UPSTREAM_MAX_RETRIES": "0",
+            "UPSTREAM_HEDGING": "false",
+        }
+    )
+    import main as proxy
+
+    proxy = importlib.reload(proxy)
+    proxy.region_lookup_started = True  # No metadata server here.
+    app = flask.Flask(__name__)
+
+    # The proxy's logs would bury the results.
+    with contextlib.redirect_stdout(io.StringIO()):
+        run_session = run_session_chat(proxy, app, args.turns)
+        opening, channel = channel_chat(proxy, app, args.turns)
+    endpoint.stop()
+
+    print(
+        f"{args.turns} turns, replies generated in {args.latency_ms:g} ms "
+        f"({args.chunks} partial texts when streamed)"
+    )
+    summarize(":runSession", run_session)
+    summarize(":channel", channel, opening)
+    print(f"  opening the channel: {opening * 1000:.0f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,214 @@
+"""Fake CES API endpoints for the web-proxy benchmarks.
+
+A `FakeCES` is a local HTTPS server that answers any GET or POST request with
+a small JSON response after a delay, e.g. to stand for a regional endpoint
+close to the proxy, a distant one, or an endpoint with latency spikes. It
+also serves the `BidiRunSession` WebSocket of channels. The proxy always
+connects to the CES API with `https://` (or `wss://`), so the fakes use a
+self-signed certificate for 127.0.0.1, which `trust_certificate` makes
+`requests` and `websockets` accept.
+"""
+
+import datetime
+import ipaddress
+import json
+import os
+import ssl
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+_certificate = None
+
+
+def make_certificate():
+    """Returns the paths of a self-signed certificate for 127.0.0.1, and its key."""
+    global _certificate
+    if _certificate:
+        return _certificate
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+    from cryptography.x509.oid import NameOID
+
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "127.0.0.1")])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    certificate = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(minutes=5))
+        .not_valid_after(now + datetime.timedelta(days=1))
+        .add_extension(
+            x509.SubjectAlternativeName(
+                [x509.IPAddress(ipaddress.ip_address("127.0.0.1"))]
+            ),
+            critical=False,
+        )
+        .add_extension(x509.BasicConstraints(ca=True, path_length=None), critical=True)
+        .sign(key, hashes.SHA256())
+    )
+    directory = tempfile.mkdtemp(prefix="fake-ces-")
+    cert_path = os.path.join(directory, "cert.pem")
+    key_path = os.path.join(directory, "key.pem")
+    with open(cert_path, "wb") as f:
+        f.write(certificate.public_bytes(serialization.Encoding.PEM))
+    with open(key_path, "wb") as f:
+        f.write(
+            key.private_bytes(
+                serialization.Encoding.PEM,
+                serialization.PrivateFormat.PKCS8,
+                serialization.NoEncryption(),
+            )
+        )
+    _certificate = cert_path, key_path
+    return _certificate
+
+
+def trust_certificate():
+    """Makes `requests` and `ssl` trust the certificate of the fakes.
+
+    Only in this process. `ssl` default contexts, used by `websockets`, then
+    trust it instead of the system certificates.
+    """
+    os.environ["REQUESTS_CA_BUNDLE"] = make_certificate()[0]
+    os.environ["SSL_CERT_FILE"] = make_certificate()[0]
+
+
+class FakeCES:
+    """A fake CES API endpoint, answering after `latency()` seconds.
+
+    With `status`, the status of each response is `status()` instead of 200,
+    e.g. to inject 503 errors. `headers` are added to every response, e.g.
+    `[("Cache-Control", "no-store")]`. With `upload_bps`, receiving a request
+    body takes as long as over a link of that many bits per second, e.g. to
+    stand for the upload of large requests.
+
+    A WebSocket request (`BidiRunSession`) gets a session that answers each
+    `realtimeInput` message with `chunks` partial texts spread over
+    `latency()` seconds, as an agent generating its reply, then a
+    `turnCompleted` message. Other messages, e.g. the config, get no answer.
+
+    Attributes:
+        name (str): Sent back in the `endpoint` field of the responses.
+        domain (str): `127.0.0.1:<port>`, for `CES_API_DOMAIN` and the like.
+        requests (int): Number of requests received.
+        bytes_received (int): Size of the request bodies received.
+    """
+
+    def __init__(
+        self, name, latency, status=None, headers=(), upload_bps=None, chunks=1
+    ):
+        self.name = name
+        self.latency = latency
+        self.status = status or (lambda: 200)
+        self.headers = list(headers)
+        self.upload_bps = upload_bps
+        self.chunks = chunks
+        self.requests = 0
+        self.bytes_received = 0
+        self._lock = threading.Lock()
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                if self.headers.get("Upgrade", "").lower() == "websocket":
+                    self.run_session()
+                else:
+                    self.respond()
+
+            def do_POST(self):
+                size = len(
+                    self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                )
+                with fake._lock:
+                    fake.bytes_received += size
+                if fake.upload_bps:
+                    time.sleep(size * 8 / fake.upload_bps)
+                self.respond()
+
+            def respond(self):
+                with fake._lock:
+                    fake.requests += 1
+                time.sleep(fake.latency())
+                body = json.dumps({"endpoint": fake.name, "path": self.path}).encode()
+                self.send_response(fake.status())
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                for name, value in fake.headers:
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def run_session(self):
+                """Serves a `BidiRunSession` WebSocket, until it's closed."""
+                from websockets.frames import Opcode
+                from websockets.protocol import State
+                from websockets.server import ServerProtocol
+                from websockets.utils import accept_key
+
+                with fake._lock:
+                    fake.requests += 1
+                self.close_connection = True
+                self.send_response(101)
+                self.send_header("Upgrade", "websocket")
+                self.send_header("Connection", "Upgrade")
+                self.send_header(
+                    "Sec-WebSocket-Accept",
+                    accept_key(self.headers["Sec-WebSocket-Key"]),
+                )
+                self.end_headers()
+                protocol = ServerProtocol(state=State.OPEN, max_size=None)
+
+                def flush():
+                    for data in protocol.data_to_send():
+                        if data:
+                            self.wfile.write(data)
+
+                def send(message):
+                    protocol.send_text(json.dumps(message).encode())
+                    flush()
+
+                while protocol.state is State.OPEN:
+                    data = self.rfile.read1(65536)
+                    if not data:
+                        protocol.receive_eof()
+                    else:
+                        protocol.receive_data(data)
+                    # Answers pings and closes.
+                    flush()
+                    for frame in protocol.events_received():
+                        if frame.opcode is not Opcode.TEXT:
+                            continue
+                        if "realtimeInput" not in json.loads(frame.data):
+                            continue
+                        latency = fake.latency()
+                        for chunk in range(fake.chunks):
+                            time.sleep(latency / fake.chunks)
+                            send({"sessionOutput": {"text": f"Part {chunk}. "}})
+                        send({"sessionOutput": {"turnCompleted": True}})
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(*make_certificate())
+        self._server.socket = context.wrap_socket(self._server.socket, server_side=True)
+        self.domain = f"127.0.0.1:{self._server.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
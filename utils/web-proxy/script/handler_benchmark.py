@@ -0,0 +1,189 @@
+"""Times the header handling of the proxy, before and after its precomputation.
+
+Compares, per request and without any network, the header steps of
+`ces_agent_request` as they were (CORS headers rebuilt from the allowlist,
+a full `dict(request.headers)` copy, list lookups for the response headers)
+with the current ones (`get_cors_headers`, `DROPPED_REQUEST_HEADERS`,
+`EXCLUDED_RESPONSE_HEADERS`), on the headers of a typical browser request.
+Also times the whole handler (`src/main.py`), with the upstream request
+replaced by a stub, for scale.
+
+Usage:
+    python script/handler_benchmark.py [--number 20000] [--origins 20]
+"""
+
+import argparse
+import contextlib
+import importlib
+import io
+import os
+import sys
+import timeit
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(SCRIPT_DIR, "..", "src"))
+
+PATH = "/projects/benchmark/locations/us/apps/app/sessions/s1:runSession"
+
+# The headers of a request of the web component, behind a load balancer.
+BROWSER_HEADERS = {
+    "Accept": "*/*",
+    "Accept-Encoding": "gzip, deflate, br, zstd",
+    "Accept-Language": "en-US,en;q=0.9,fr;q=0.8",
+    "Authorization": "Bearer " + "t" * 200,
+    "Connection": "keep-alive",
+    "Content-Type": "application/json",
+    "Cookie": "_ga=GA1.1.1234567890.1700000000; session=" + "s" * 120,
+    "Origin": None,  # The last authorized origin, see main().
+    "Referer": "https://shop.example.com/help",
+    "Sec-Fetch-Dest": "empty",
+    "Sec-Fetch-Mode": "cors",
+    "Sec-Fetch-Site": "cross-site",
+    "User-Agent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 Chrome/130.0",
+    "X-Forwarded-For": "203.0.113.7, 198.51.100.2",
+    "X-Forwarded-Proto": "https",
+}
+
+UPSTREAM_HEADERS = [
+    ("Content-Type", "application/json; charset=UTF-8"),
+    ("Vary", "Origin"),
+    ("Vary", "X-Origin"),
+    ("Vary", "Referer"),
+    ("Content-Encoding", "gzip"),
+    ("Date", "Mon, 19 Oct 2026 00:00:00 GMT"),
+    ("Server", "ESF"),
+    ("Cache-Control", "private"),
+    ("X-XSS-Protection", "0"),
+    ("X-Frame-Options", "SAMEORIGIN"),
+    ("X-Content-Type-Options", "nosniff"),
+    ("Alt-Svc", 'h3=":443"; ma=2592000'),
+    ("Transfer-Encoding", "chunked"),
+]
+
+
+def legacy_cors_headers(origin, authorized_origins):
+    """The CORS headers, as computed for each request before."""
+    is_authorized = False
+    if origin:
+        origin = origin.rstrip("/")
+        if origin.startswith("http://localhost:"):
+            is_authorized = True
+        else:
+            for authorized_origin in authorized_origins:
+                if isinstance(authorized_origin, str) and origin == authorized_origin:
+                    is_authorized = True
+                    break
+                if hasattr(authorized_origin, "match") and authorized_origin.match(
+                    origin
+                ):
+                    is_authorized = True
+                    break
+    if is_authorized:
+        return {
+            "Access-Control-Allow-Origin": origin,
+            "Access-Control-Allow-Methods": "GET, POST",
+            "Access-Control-Allow-Headers": "Content-Type, user-agent, Authorization",
+            "Access-Control-Max-Age": "3600",
+        }
+    return {}
+
+
+def legacy_response_headers(headers):
+    """The response headers, as filtered for each request before."""
+    excluded_headers = [
+        "content-encoding",
+        "content-length",
+        "transfer-encoding",
+        "connection",
+    ]
+    return [(k, v) for k, v in headers if k.lower() not in excluded_headers]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--number", type=int, default=20000)
+    parser.add_argument(
+        "--origins",
+        type=int,
+        default=20,
+        help="Origins in AUTHORIZED_ORIGINS (default: 20).",
+    )
+    args = parser.parse_args()
+
+    origins = [f"https://site-{i}.example.com" for i in range(args.origins)]
+    os.environ["AUTHORIZED_ORIGINS"] = ";".join(origins)
+    os.environ["DISABLE_REGION_CHECK"] = "true"
+    import flask
+    import main as proxy
+
+    proxy = importlib.reload(proxy)
+    proxy.region_lookup_started = True  # No metadata server here.
+    headers = {**BROWSER_HEADERS, "Origin": origins[-1]}
+    app = flask.Flask(__name__)
+    context = app.test_request_context(PATH, method="POST", data=b"{}", headers=headers)
+    context.push()
+    request = flask.request
+
+    def new_request_headers():
+        return {
+            k: v
+            for k, v in request.headers.items()
+            if k.lower() not in proxy.DROPPED_REQUEST_HEADERS
+        }
+
+    def new_response_headers():
+        return [
+            (k, v)
+            for k, v in UPSTREAM_HEADERS
+            if k.lower() not in proxy.EXCLUDED_RESPONSE_HEADERS
+        ]
+
+    steps = [
+        (
+            "CORS headers",
+            lambda: legacy_cors_headers(
+                request.headers.get("Origin"), proxy.authorized_origins
+            ),
+            lambda: proxy.get_cors_headers(request.headers.get("Origin").rstrip("/")),
+        ),
+        ("Request headers", lambda: dict(request.headers), new_request_headers),
+        (
+            "Response headers",
+            lambda: legacy_response_headers(UPSTREAM_HEADERS),
+            new_response_headers,
+        ),
+    ]
+
+    def per_call(function):
+        return min(timeit.repeat(function, number=args.number, repeat=5)) / args.number
+
+    print(
+        f"{len(headers)} request headers, {len(UPSTREAM_HEADERS)} response "
+        f"headers, {args.origins} authorized origins (the last one is used)"
+    )
+    total_before = total_after = 0
+    for name, before, after in steps:
+        before, after = per_call(before), per_call(after)
+        total_before += before
+        total_after += after
+        print(f"{name}: {before * 1e6:.2f} us before, {after * 1e6:.2f} us after")
+    print(
+        f"All header steps: {total_before * 1e6:.2f} us before, "
+        f"{total_after * 1e6:.2f} us after"
+    )
+
+    sent = {}
+    proxy.forward_request = lambda method, url, headers, *args: (
+        sent.update(headers) or (b"{}", 200, new_response_headers())
+    )
+    with contextlib.redirect_stdout(io.StringIO()):
+        handler = per_call(lambda: proxy.ces_agent_request(request))
+    context.pop()
+    print(
+        f"Whole handler, stubbed upstream: {handler * 1e6:.1f} us per request, "
+        f"{len(sent)} headers sent upstream for {len(headers)} received"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+"""Measures the tail latency saved by retries and hedging of GET requests.
+
+Runs the proxy (`src/main.py`) in-process against a fake CES API endpoint
+(see `fake_ces.py`) that answers after `--latency-ms`, except for:
+
+- `--spike-rate` of the requests, which answer after `--spike-ms` instead,
+  e.g. a slow upstream replica or a long garbage collection pause;
+- `--error-rate` of the requests, which fail with a 503.
+
+Sends `--requests` GET requests from `--concurrency` threads, with the
+upstream retries and hedging off, with retries only, and with both. Reports
+the share of successful responses, the latency percentiles, and the upstream
+requests sent per proxied request, i.e. the extra load put on the upstream.
+
+Usage:
+    python script/hedging_benchmark.py [--requests 1000] [--spike-rate 0.05]
+        [--spike-ms 500] [--error-rate 0.02]
+"""
+
+import argparse
+import contextlib
+import importlib
+import io
+import os
+import random
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(SCRIPT_DIR, "..", "src"))
+
+from fake_ces import FakeCES, trust_certificate  # noqa: E402
+
+PATH = "/projects/benchmark/locations/us/apps/app/sessions/s1"
+
+CONFIGURATIONS = [
+    ("No retries, no hedging", {"UPSTREAM_MAX_RETRIES": "0"}),
+    ("Retries", {"UPSTREAM_MAX_RETRIES": "2"}),
+    ("Retries and hedging", {"UPSTREAM_MAX_RETRIES": "2", "UPSTREAM_HEDGING": "true"}),
+]
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def run(requests, concurrency, environment):
+    """Sends the requests through a proxy configured with `environment`.
+
+    Returns:
+        tuple: The latencies of the requests in seconds, their statuses, and
+        the stats of the upstream client.
+    """
+    import flask
+
+    os.environ.update(environment)
+    import main
+
+    main = importlib.reload(main)
+    main.region_lookup_started = True  # No metadata server here.
+    app = flask.Flask(__name__)
+
+    def send(_):
+        with app.test_request_context(
+            PATH, method="GET", headers={"Authorization": "Bearer benchmark"}
+        ):
+            start = time.perf_counter()
+            response = main.ces_agent_request(flask.request)
+            return time.perf_counter() - start, response[1]
+
+    # The proxy's logs, interleaved by the threads, would bury the results.
+    with contextlib.redirect_stdout(io.StringIO()):
+        with ThreadPoolExecutor(concurrency) as executor:
+            results = list(executor.map(send, range(requests)))
+    latencies = [latency for latency, _ in results]
+    statuses = [status for _, status in results]
+    return latencies, statuses, main.UPSTREAM.stats()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--latency-ms", type=float, default=20)
+    parser.add_argument("--spike-rate", type=float, default=0.05)
+    parser.add_argument("--spike-ms", type=float, default=500)
+    parser.add_argument("--error-rate", type=float, default=0.02)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    rng_lock = threading.Lock()
+
+    def latency():
+        with rng_lock:
+            spike = rng.random() < args.spike_rate
+        return (args.spike_ms if spike else args.latency_ms) / 1000
+
+    def status():
+        with rng_lock:
+            return 503 if rng.random() < args.error_rate else 200
+
+    trust_certificate()
+    endpoint = FakeCES("spiky", latency, status).start()
+    os.environ.update(
+        {
+            "CES_API_DOMAIN": endpoint.domain,
+            "DISABLE_REGION_CHECK": "true",
+            "RESPONSE_COMPRESSION": "false",
+            "RESPONSE_CACHE_PATHS": "",
+            "UPSTREAM_RETRY_BACKOFF_MS": "10",
+            "UPSTREAM_HEDGE_MIN_DELAY_MS": "50",
+            "UPSTREAM_HEDGING": "false",
+        }
+    )
+
+    for name, environment in CONFIGURATIONS:
+        endpoint.requests = 0
+        latencies, statuses, stats = run(args.requests, args.concurrency, environment)
+        ok = statuses.count(200) / len(statuses)
+        print(f"{name}:")
+        print(
+            f"  {ok:.1%} OK, "
+            f"p50 {statistics.median(latencies) * 1000:.1f} ms, "
+            f"p95 {percentile(latencies, 0.95) * 1000:.1f} ms, "
+            f"p99 {percentile(latencies, 0.99) * 1000:.1f} ms"
+        )
+        print(
+            f"  {endpoint.requests / args.requests:.2f} upstream requests per "
+            f"request, retries {stats['retries']}, hedges {stats['hedges']} "
+            f"(won {stats['hedge_wins']}), budget exhausted "
+            f"{stats['budget_exhausted']}"
+        )
+    endpoint.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,238 @@
+"""Measures the upload size and latency of requests with images, downscaled or not.
+
+Generates synthetic images with Pillow: phone photos (4032x3024 JPEG, with
+the noise of a camera sensor), a screenshot with a picture (2560x1600 PNG)
+and a photo already smaller than `IMAGE_MAX_DIMENSION` (800x600 JPEG).
+Runs the proxy (`src/main.py`) in-process against a fake CES API endpoint
+(see `fake_ces.py`) that receives request bodies at `--upload-mbps` and
+answers after `--latency-ms`.
+
+Sends `--requests` `:runSession` requests with each set of images, without
+downscaling, then with `IMAGE_MAX_DIMENSION`. Reports the size of the bodies
+received by the endpoint, the end-to-end latency of the requests, and the
+time spent downscaling.
+
+Usage:
+    python script/image_resize_benchmark.py [--requests 5] [--upload-mbps 100]
+        [--max-dimension 1536]
+"""
+
+import argparse
+import base64
+import contextlib
+import importlib
+import io
+import json
+import os
+import statistics
+import sys
+import time
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(SCRIPT_DIR, "..", "src"))
+
+from fake_ces import FakeCES, trust_certificate  # noqa: E402
+
+PATH = "/projects/benchmark/locations/us/apps/app/sessions/s1:runSession"
+
+
+def make_photo(width, height, seed):
+    """Returns a synthetic photo: gradients and shapes, with sensor noise."""
+    import numpy as np
+    from PIL import Image, ImageDraw
+
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    base = np.stack(
+        [
+            128 + 100 * np.sin(x / width * 3 + seed),
+            128 + 100 * np.cos(y / height * 2),
+            128 + 80 * np.sin((x + y) / (width + height) * 5),
+        ],
+        axis=-1,
+    )
+    # The noise is what makes photos large once compressed.
+    base += rng.normal(0, 8, base.shape)
+    img = Image.fromarray(np.clip(base, 0, 255).astype(np.uint8))
+    draw = ImageDraw.Draw(img)
+    for _ in range(12):
+        left, top = int(rng.integers(0, width)), int(rng.integers(0, height))
+        size = int(rng.integers(width // 20, width // 5))
+        color = tuple(int(c) for c in rng.integers(0, 255, 3))
+        draw.ellipse((left, top, left + size, top + size), fill=color)
+    return img
+
+
+def make_image(kind, seed=0):
+    """Returns a synthetic image, encoded, and its MIME type.
+
+    Args:
+        kind (str): `photo` (4032x3024 JPEG), `small` (800x600 JPEG) or
+            `screenshot` (2560x1600 PNG of a page with text and a picture).
+    """
+    from PIL import Image, ImageDraw
+
+    output = io.BytesIO()
+    if kind == "photo":
+        make_photo(4032, 3024, seed).save(output, "JPEG", quality=92)
+        return output.getvalue(), "image/jpeg"
+    if kind == "small":
+        make_photo(800, 600, seed).save(output, "JPEG", quality=92)
+        return output.getvalue(), "image/jpeg"
+
+    img = Image.new("RGB", (2560, 1600), (246, 246, 248))
+    draw = ImageDraw.Draw(img)
+    draw.rectangle((0, 0, 2560, 96), fill=(32, 33, 36))
+    # Lines of "text", beside a picture.
+    words = 0
+    for y in range(160, 1560, 36):
+        x = 80
+        while x < 1100:
+            words += 1
+            width = 30 + words * 37 % 110
+            draw.rectangle((x, y, x + width, y + 16), fill=(60, 64, 67))
+            x += width + 14
+    img.paste(make_photo(1280, 960, seed), (1200, 200))
+    img.save(output, "PNG")
+    return output.getvalue(), "image/png"
+
+
+def make_body(images):
+    """Returns a `:runSession` request body with inline images."""
+    inputs = [{"text": "What is wrong with this?"}]
+    for data, mime_type in images:
+        inputs.append(
+            {
+                "image": {
+                    "data": base64.b64encode(data).decode("ascii"),
+                    "mime_type": mime_type,
+                }
+            }
+        )
+    return json.dumps({"inputs": inputs}).encode()
+
+
+def run(requests, bodies, endpoint, environment):
+    """Sends each body `requests` times through a proxy with `environment`.
+
+    Returns:
+        dict: For each body, the bytes received by the endpoint per request,
+        the latencies, and the downscaling times, in seconds.
+    """
+    import flask
+
+    os.environ.update(environment)
+    import main
+
+    main = importlib.reload(main)
+    main.region_lookup_started = True  # No metadata server here.
+    downscaling = []
+    downscaler = main.IMAGE_DOWNSCALER
+    if downscaler:
+
+        def process(body, process=downscaler.process):
+            start = time.perf_counter()
+            try:
+                return process(body)
+            finally:
+                downscaling.append(time.perf_counter() - start)
+
+        downscaler.process = process
+    app = flask.Flask(__name__)
+    results = {}
+    for name, body in bodies.items():
+        endpoint.bytes_received = 0
+        downscaling.clear()
+        latencies = []
+        for _ in range(requests):
+            with app.test_request_context(
+                PATH,
+                method="POST",
+                data=body,
+                headers={
+                    "Authorization": "Bearer benchmark",
+                    "Content-Type": "application/json",
+                },
+            ):
+                start = time.perf_counter()
+                # The proxy's logs would bury the results.
+                with contextlib.redirect_stdout(io.StringIO()):
+                    response = main.ces_agent_request(flask.request)
+                latencies.append(time.perf_counter() - start)
+            assert response[1] == 200, response
+        results[name] = (
+            endpoint.bytes_received / requests,
+            latencies,
+            list(downscaling),
+        )
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--requests", type=int, default=5)
+    parser.add_argument(
+        "--upload-mbps",
+        type=float,
+        default=100,
+        help="Speed at which the endpoint receives bodies (default: 100).",
+    )
+    parser.add_argument(
+        "--latency-ms",
+        type=float,
+        default=50,
+        help="Latency of the endpoint, after the body (default: 50).",
+    )
+    parser.add_argument("--max-dimension", type=int, default=1536)
+    args = parser.parse_args()
+
+    photos = [make_image("photo", seed) for seed in range(3)]
+    bodies = {
+        "1 photo": make_body(photos[:1]),
+        "3 photos": make_body(photos),
+        "Screenshot": make_body([make_image("screenshot")]),
+        "Small photo": make_body([make_image("small")]),
+    }
+
+    trust_certificate()
+    endpoint = FakeCES(
+        "images", lambda: args.latency_ms / 1000, upload_bps=args.upload_mbps * 1e6
+    ).start()
+    os.environ.update(
+        {
+            "CES_API_DOMAIN": endpoint.domain,
+            "DISABLE_REGION_CHECK": "true",
+            "RESPONSE_COMPRESSION": "false",
+            "UPSTREAM_MAX_RETRIES": "0",
+            "UPSTREAM_HEDGING": "false",
+        }
+    )
+    configurations = [
+        ("No downscaling", {"IMAGE_MAX_DIMENSION": "0"}),
+        (
+            f"IMAGE_MAX_DIMENSION={args.max_dimension}",
+            {"IMAGE_MAX_DIMENSION": str(args.max_dimension)},
+        ),
+    ]
+
+    print(
+        f"{args.requests} requests per image set, {args.upload_mbps:g} Mbit/s "
+        f"upload, {args.latency_ms:g} ms upstream latency"
+    )
+    for name, environment in configurations:
+        print(f"{name}:")
+        results = run(args.requests, bodies, endpoint, environment)
+        for body_name, (received, latencies, downscaling) in results.items():
+            line = (
+                f"  {body_name}: {len(bodies[body_name]) / 1e6:.2f} MB received, "
+                f"{received / 1e6:.2f} MB sent upstream, "
+                f"p50 {statistics.median(latencies) * 1000:.0f} ms"
+            )
+            if downscaling:
+                line += f" (downscaling {statistics.median(downscaling) * 1000:.0f} ms)"
+            print(line)
+    endpoint.stop()
+
+
+if __name__ == "__main__":
+    main()
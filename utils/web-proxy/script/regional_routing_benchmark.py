@@ -0,0 +1,127 @@
+"""Measures the latency saved by routing requests to regional CES endpoints.
+
+Runs the proxy (`src/main.py`) in-process against fake CES API endpoints
+(see `fake_ces.py`):
+
+- a global endpoint, standing for `ces.googleapis.com`, which answers after
+  `--global-ms`: the time to reach the agent's region from the global
+  front end;
+- a regional endpoint for the `eu` agents, close to the proxy, which answers
+  after `--regional-ms`.
+
+Sends `--requests` requests for an `eu` agent and for an agent in a location
+without a regional endpoint, first with `CES_API_DOMAIN` only, then with
+`CES_REGIONAL_API_DOMAINS` routing `eu` to its regional endpoint. Reports
+the latency percentiles of each, and the requests received by each
+endpoint, which shows where each location was routed.
+
+Usage:
+    python script/regional_routing_benchmark.py [--requests 100] [--global-ms 60]
+"""
+
+import argparse
+import importlib
+import os
+import statistics
+import sys
+import time
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(SCRIPT_DIR, "..", "src"))
+
+from fake_ces import FakeCES, trust_certificate  # noqa: E402
+
+LOCATIONS = {"eu": "routed", "asia-northeast1": "not routed"}
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def run(requests, environment):
+    """Sends the requests through a proxy configured with `environment`.
+
+    Returns:
+        dict: The latencies of the requests of each location, in seconds.
+    """
+    import flask
+
+    os.environ.update(environment)
+    import main
+
+    main = importlib.reload(main)
+    main.region_lookup_started = True  # No metadata server here.
+    app = flask.Flask(__name__)
+    latencies = {location: [] for location in LOCATIONS}
+    for _ in range(requests):
+        for location in LOCATIONS:
+            path = f"/projects/benchmark/locations/{location}/apps/app/sessions/s1"
+            with app.test_request_context(
+                path + ":runSession",
+                method="POST",
+                data=b'{"inputs": [{"text": "Hi"}]}',
+                headers={"Authorization": "Bearer benchmark"},
+            ):
+                start = time.perf_counter()
+                response = main.ces_agent_request(flask.request)
+                latencies[location].append(time.perf_counter() - start)
+            assert response[1] == 200, response
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument(
+        "--global-ms",
+        type=float,
+        default=60,
+        help="Latency of the global endpoint (default: 60).",
+    )
+    parser.add_argument(
+        "--regional-ms",
+        type=float,
+        default=5,
+        help="Latency of the regional endpoint (default: 5).",
+    )
+    args = parser.parse_args()
+
+    trust_certificate()
+    global_endpoint = FakeCES("global", lambda: args.global_ms / 1000).start()
+    regional_endpoint = FakeCES("eu", lambda: args.regional_ms / 1000).start()
+    os.environ.update(
+        {
+            "CES_API_DOMAIN": global_endpoint.domain,
+            "DISABLE_REGION_CHECK": "true",
+            "RESPONSE_COMPRESSION": "false",
+        }
+    )
+
+    configurations = [
+        ("CES_API_DOMAIN only", {"CES_REGIONAL_API_DOMAINS": ""}),
+        (
+            "CES_REGIONAL_API_DOMAINS",
+            {"CES_REGIONAL_API_DOMAINS": f"eu={regional_endpoint.domain}"},
+        ),
+    ]
+    for name, environment in configurations:
+        global_endpoint.requests = regional_endpoint.requests = 0
+        latencies = run(args.requests, environment)
+        print(f"{name}:")
+        for location, values in latencies.items():
+            print(
+                f"  {location} ({LOCATIONS[location]}): "
+                f"p50 {statistics.median(values) * 1000:.1f} ms, "
+                f"p95 {percentile(values, 0.95) * 1000:.1f} ms"
+            )
+        print(
+            f"  requests received: global {global_endpoint.requests}, "
+            f"eu {regional_endpoint.requests}"
+        )
+    global_endpoint.stop()
+    regional_endpoint.stop()
+
+
+if __name__ == "__main__":
+    main()
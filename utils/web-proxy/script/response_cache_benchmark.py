@@ -0,0 +1,118 @@
+"""Measures concurrent misses of the response cache against a slow upstream.
+
+Runs the proxy (`src/main.py`) in-process against a fake CES API endpoint
+(see `fake_ces.py`) that answers after `--latency-ms`. Sends `--bursts`
+bursts of `--concurrency` simultaneous GET requests for a cacheable path,
+each burst for a new query string, so that every burst is a cold miss.
+
+The endpoint answers with a cacheable 200, with a 200 marked `no-store`, or
+with a 503, and the proxy runs without and with `RESPONSE_CACHE_PATHS`.
+Reports the time taken by a burst and the upstream requests it sent.
+
+Usage:
+    python script/response_cache_benchmark.py [--bursts 10] [--concurrency 5]
+        [--latency-ms 200]
+"""
+
+import argparse
+import contextlib
+import importlib
+import io
+import os
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(SCRIPT_DIR, "..", "src"))
+
+from fake_ces import FakeCES, trust_certificate  # noqa: E402
+
+PATH = "/projects/benchmark/locations/us/apps/app"
+
+RESPONSES = [
+    ("Cacheable 200", 200, []),
+    ("200 no-store", 200, [("Cache-Control", "no-store")]),
+    ("503", 503, []),
+]
+
+CONFIGURATIONS = [
+    ("No cache", {"RESPONSE_CACHE_PATHS": ""}),
+    ("Response cache", {"RESPONSE_CACHE_PATHS": r"/apps/[^/]+$"}),
+]
+
+
+def run(bursts, concurrency, environment):
+    """Sends the bursts through a proxy configured with `environment`.
+
+    Returns:
+        list: The duration of each burst, in seconds.
+    """
+    import flask
+
+    os.environ.update(environment)
+    import main
+
+    main = importlib.reload(main)
+    main.region_lookup_started = True  # No metadata server here.
+    app = flask.Flask(__name__)
+
+    def send(burst):
+        with app.test_request_context(
+            f"{PATH}?burst={burst}",
+            method="GET",
+            headers={"Authorization": "Bearer benchmark"},
+        ):
+            return main.ces_agent_request(flask.request)[1]
+
+    durations = []
+    # The proxy's logs, interleaved by the threads, would bury the results.
+    with contextlib.redirect_stdout(io.StringIO()):
+        with ThreadPoolExecutor(concurrency) as executor:
+            for burst in range(bursts):
+                start = time.perf_counter()
+                list(executor.map(send, [burst] * concurrency))
+                durations.append(time.perf_counter() - start)
+    return durations
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--bursts", type=int, default=10)
+    parser.add_argument("--concurrency", type=int, default=5)
+    parser.add_argument("--latency-ms", type=float, default=200)
+    args = parser.parse_args()
+
+    trust_certificate()
+    endpoint = FakeCES("slow", lambda: args.latency_ms / 1000).start()
+    os.environ.update(
+        {
+            "CES_API_DOMAIN": endpoint.domain,
+            "DISABLE_REGION_CHECK": "true",
+            "RESPONSE_COMPRESSION": "false",
+            "UPSTREAM_MAX_RETRIES": "0",
+            "UPSTREAM_HEDGING": "false",
+        }
+    )
+
+    print(
+        f"{args.bursts} bursts of {args.concurrency} concurrent requests, "
+        f"{args.latency_ms:g} ms upstream latency"
+    )
+    for response_name, status, headers in RESPONSES:
+        endpoint.status = lambda: status
+        endpoint.headers = headers
+        print(f"{response_name}:")
+        for name, environment in CONFIGURATIONS:
+            endpoint.requests = 0
+            durations = run(args.bursts, args.concurrency, environment)
+            print(
+                f"  {name}: {statistics.mean(durations) * 1000:.0f} ms per burst, "
+                f"{endpoint.requests / args.bursts:.1f} upstream requests per burst"
+            )
+    endpoint.stop()
+
+
+if __name__ == "__main__":
+    main()
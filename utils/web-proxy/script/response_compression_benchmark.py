@@ -0,0 +1,152 @@
+"""Measures the bytes sent and the CPU time spent per compressed response.
+
+Builds synthetic agent responses of three sizes: a short text reply, a reply
+with the diagnostic info of its turn (the trace of the agent's spans, the
+messages and tool calls), and the reply of a long session with many tool
+calls. Compresses each with `ResponseCompressor` (`src/response_compression.py`)
+at several gzip levels, and Brotli qualities when the `brotli` package is
+installed, as for a browser sending `Accept-Encoding: gzip, deflate, br, zstd`.
+
+Reports, for each response and setting, the bytes sent to the browser and
+the CPU time of `compress`, per response. Also times a response already
+compressed by the CES API, which is passed through. It doesn't need the fake
+endpoints.
+
+Usage:
+    python script/response_compression_benchmark.py [--number 200]
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+import zlib
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(SCRIPT_DIR, "..", "src"))
+
+import response_compression  # noqa: E402
+from response_compression import ResponseCompressor  # noqa: E402
+
+ACCEPT_ENCODING = "gzip, deflate, br, zstd"
+HEADERS = [("Content-Type", "application/json; charset=UTF-8")]
+
+
+def make_response(turns, spans, seed=0):
+    """Returns a synthetic `runSession` response, as JSON bytes.
+
+    Args:
+        turns (int): Messages in the diagnostic info, or 0 for a text reply
+            without diagnostic info.
+        spans (int): Spans in the trace of the diagnostic info.
+    """
+    rng = random.Random(seed)
+    words = "order refund shipping account the your is was we can to".split()
+
+    def sentence(length):
+        return " ".join(rng.choice(words) for _ in range(length)).capitalize() + "."
+
+    response = {"outputs": [{"text": sentence(40), "turnCompleted": True}]}
+    if not turns:
+        return json.dumps(response).encode()
+    messages = []
+    for turn in range(turns):
+        messages.append({"role": "user", "chunks": [{"text": sentence(12)}]})
+        messages.append(
+            {
+                "role": "agent",
+                "chunks": [
+                    {
+                        "toolCall": {
+                            "tool": f"projects/p/locations/us/apps/a/tools/t{turn}",
+                            "args": {"orderId": str(rng.randrange(10**9))},
+                        }
+                    },
+                    {"text": sentence(30)},
+                ],
+            }
+        )
+    start = 1_760_000_000_000_000
+    trace = [
+        {
+            "name": rng.choice(["LLM", "Tool", "Callback", "Agent"]) + f" {span}",
+            "spanId": rng.randbytes(8).hex(),
+            "startTimeUs": str(start + span * 1000 + rng.randrange(1000)),
+            "durationUs": str(rng.randrange(10**6)),
+            "attributes": {
+                "model": "gemini",
+                "inputTokens": rng.randrange(10**4),
+                "outputTokens": rng.randrange(10**3),
+            },
+        }
+        for span in range(spans)
+    ]
+    response["outputs"][0]["diagnosticInfo"] = {
+        "messages": messages,
+        "rootSpan": {"name": "root", "childSpans": trace},
+    }
+    return json.dumps(response, indent=2).encode()
+
+
+def per_response(function, number):
+    """Returns the CPU time of `function`, in seconds per call."""
+    start = time.process_time()
+    for _ in range(number):
+        function()
+    return (time.process_time() - start) / number
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--number", type=int, default=200)
+    parser.add_argument(
+        "--min-bytes",
+        type=int,
+        default=1024,
+        help="RESPONSE_COMPRESSION_MIN_BYTES (default: 1024).",
+    )
+    args = parser.parse_args()
+
+    responses = {
+        "Text reply": make_response(0, 0),
+        "Reply with diagnostic info": make_response(4, 40),
+        "Long session with tool calls": make_response(30, 400),
+    }
+    settings = [("gzip", level, None) for level in (1, 6, 9)]
+    if "br" in response_compression.ENCODINGS:
+        settings += [("br", None, quality) for quality in (4, 11)]
+    else:
+        print("brotli is not installed, only gzip is measured")
+
+    for name, content in responses.items():
+        print(f"{name}: {len(content)} bytes uncompressed")
+        for encoding, level, quality in settings:
+            compressor = ResponseCompressor(args.min_bytes, level or 6, quality or 4)
+            accept_encoding = ACCEPT_ENCODING if encoding == "br" else "gzip"
+            sent, _ = compressor.compress(content, HEADERS, accept_encoding)
+            cpu = per_response(
+                lambda: compressor.compress(content, HEADERS, accept_encoding),
+                args.number,
+            )
+            setting = f"gzip level {level}" if level else f"br quality {quality}"
+            print(
+                f"  {setting}: {len(sent)} bytes sent "
+                f"({len(content) / len(sent):.1f}x), {cpu * 1e6:.0f} us CPU"
+            )
+        compressor = ResponseCompressor(args.min_bytes, 6, 4)
+        encoded = zlib.compress(content, 6, wbits=31)
+        headers = HEADERS + [("Content-Encoding", "gzip")]
+        cpu = per_response(
+            lambda: compressor.compress(encoded, headers, ACCEPT_ENCODING),
+            args.number,
+        )
+        print(
+            f"  Passed through (compressed by the CES API): {len(encoded)} bytes "
+            f"sent, {cpu * 1e6:.1f} us CPU"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+"""On-demand profiling of a running proxy instance.
+
+When `ADMIN_TOKEN` is set, `main.ces_agent_request` passes the requests to
+the `/admin/` paths below to `handle_admin_request` instead of proxying them.
+They must carry an `X-Admin-Token: <ADMIN_TOKEN>` header (not
+`Authorization`, which is used for the function's own authentication and
+forwarded to the CES API):
+
+- `/admin/stacks?seconds=5&interval_ms=10`: samples the stacks of all the
+  threads, i.e. of all the requests in flight, every `interval_ms`. Returns
+  collapsed stacks (one `frame;frame;... count` line per stack), for
+  flamegraph.pl or speedscope.
+- `/admin/memory?seconds=5&limit=30`: traces memory allocations for
+  `seconds`, and returns the `limit` lines that allocated the most of the
+  memory still in use at the end.
+- `/admin/threads`: the current stack of every thread, e.g. to find requests
+  stuck waiting for the CES API.
+
+cProfile is not offered: it only sees the thread that enables it, while
+requests are served by other threads. Nothing is installed until an admin
+request arrives, so there is no overhead otherwise, and only one profile
+runs at a time. Durations must be at most `MAX_SECONDS`, well below the
+function timeout; other values are rejected with a 400.
+"""
+
+import hmac
+import math
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import Counter
+
+# Enables the /admin/ endpoints, see above.
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN", "")
+
+MAX_SECONDS = 30
+
+_busy = threading.Lock()
+
+_TEXT_HEADERS = {
+    "Content-Type": "text/plain; charset=utf-8",
+    "Cache-Control": "no-store",
+}
+
+
+def collapse(frame):
+    """Returns a stack as `outermost;...;innermost` frames."""
+    frames = []
+    while frame is not None:
+        code = frame.f_code
+        frames.append(
+            f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})"
+        )
+        frame = frame.f_back
+    return ";".join(reversed(frames))
+
+
+def sample_stacks(seconds, interval):
+    """Samples the stacks of all the other threads. Blocks for `seconds`.
+
+    Returns:
+        Counter: The number of samples of each collapsed stack, across
+        threads.
+    """
+    own = threading.get_ident()
+    stacks = Counter()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        for ident, frame in sys._current_frames().items():
+            if ident != own:
+                stacks[collapse(frame)] += 1
+        time.sleep(interval)
+    return stacks
+
+
+def memory_report(seconds, limit):
+    """Traces allocations for `seconds`, and reports the largest ones."""
+    import tracemalloc
+
+    # Tracing may also have been started with PYTHONTRACEMALLOC.
+    started = not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    try:
+        time.sleep(seconds)
+        snapshot = tracemalloc.take_snapshot()
+    finally:
+        if started:
+            tracemalloc.stop()
+    snapshot = snapshot.filter_traces(
+        (tracemalloc.Filter(False, tracemalloc.__file__),)
+    )
+    statistics = snapshot.statistics("lineno")
+    lines = [f"Total: {sum(stat.size for stat in statistics) / 1024:.1f} KiB"]
+    lines.extend(str(stat) for stat in statistics[:limit])
+    return "\n".join(lines)
+
+
+def thread_dump():
+    """Returns the current stack of every thread."""
+    names = {thread.ident: thread.name for thread in threading.enumerate()}
+    frames = sys._current_frames()
+    sections = [f"{len(frames)} threads"]
+    for ident, frame in frames.items():
+        stack = "".join(traceback.format_stack(frame))
+        sections.append(f"Thread {names.get(ident, ident)}:\n{stack}")
+    return "\n\n".join(sections)
+
+
+def handle_admin_request(request, log):
+    """Answers a request to one of the /admin/ paths.
+
+    Args:
+        request (flask.Request): The request object.
+        log: Logging function, called with a severity and a message.
+
+    Returns:
+        A Flask response tuple.
+    """
+    token = request.headers.get("X-Admin-Token", "")
+    if not hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode()):
+        log("WARNING", f"Rejected admin request from {request.remote_addr}")
+        return ("Unauthorized\n", 401, _TEXT_HEADERS)
+
+    try:
+        seconds = float(request.args.get("seconds", 5))
+        interval = float(request.args.get("interval_ms", 10)) / 1000
+        limit = int(request.args.get("limit", 30))
+    except ValueError:
+        return ("Invalid parameter\n", 400, _TEXT_HEADERS)
+    # Also rejects nan, for which every comparison is false.
+    if not 0 < seconds <= MAX_SECONDS:
+        return (f"seconds must be in (0, {MAX_SECONDS}]\n", 400, _TEXT_HEADERS)
+    if not math.isfinite(interval) or limit < 1:
+        return ("Invalid parameter\n", 400, _TEXT_HEADERS)
+    if request.path == "/admin/threads":
+        return (thread_dump(), 200, _TEXT_HEADERS)
+    if request.path not in ("/admin/stacks", "/admin/memory"):
+        return ("Not found\n", 404, _TEXT_HEADERS)
+    if not _busy.acquire(blocking=False):
+        return ("A profile is already running\n", 409, _TEXT_HEADERS)
+
+    try:
+        log("INFO", f"Admin request: {request.path} for {seconds}s")
+        if request.path == "/admin/stacks":
+            stacks = sample_stacks(seconds, max(interval, 0.001))
+            body = "".join(
+                f"{stack} {count}\n" for stack, count in stacks.most_common()
+            )
+        else:
+            body = memory_report(seconds, limit)
+    finally:
+        _busy.release()
+    return (body, 200, _TEXT_HEADERS)
@@ -0,0 +1,286 @@
+"""Persistent channels to the CES API, for text chats.
+
+Used by `main.ces_agent_request` when `CHANNEL_MAX_SESSIONS` is set. A
+text-mode widget calls `:runSession` once per turn: each turn is a new
+request to the proxy and to the CES API, and the agent's reply only arrives
+once it's complete. A channel instead keeps a `BidiRunSession` WebSocket to
+the CES API open for the whole chat, and relays it to the browser over plain
+HTTP, which Cloud Functions can serve:
+
+- `GET <session>:channel` opens the channel, and sends the CES API the
+  config message of the session (with the `deployment` query parameter, if
+  any). The response is a stream of server-sent events, which an
+  `EventSource` can read: first an `open` event with the id of the channel,
+  then one event per message of the CES API, as it arrives (partial texts,
+  tool calls, ...), in the format of the WebSocket API. A `close` event ends
+  the stream when the CES API closes the connection, or when the channel is
+  idle for too long.
+- `POST <session>:channel?id=<channel id>` sends one message of the
+  WebSocket API to the CES API, e.g. `{"realtimeInput": {"text": "Hi"}}`,
+  and returns an empty 202 response: the reply comes on the event stream.
+
+Channels live in the instance that opened them, so with several instances
+the service needs session affinity. A POST for a channel the instance
+doesn't know gets a 404, after which the client can open a new channel, or
+fall back to `:runSession`, which is unchanged. See `ChannelRegistry`.
+"""
+
+import json
+import secrets
+import threading
+import time
+
+# `websockets` is imported by `ChannelRegistry.open`, so that deployments
+# without channels don't load it.
+
+# Maximum size of a message of the CES API (e.g. a large tool call).
+MAX_MESSAGE_BYTES = 4 * 1024 * 1024
+
+
+def format_event(data, event=None):
+    """Returns a server-sent event, as bytes.
+
+    Args:
+        data (str): The event data. Each of its lines is sent as a `data:`
+            field, so that the client reassembles it as is.
+        event (str): The event type, or None for the default `message`.
+    """
+    lines = [f"event: {event}"] if event else []
+    lines.extend(f"data: {line}" for line in data.split("\n"))
+    return ("\n".join(lines) + "\n\n").encode()
+
+
+class Channel:
+    """An open channel: the WebSocket to the CES API of a chat session."""
+
+    __slots__ = ("id", "session", "websocket", "last_used", "sent", "received")
+
+    def __init__(self, session, websocket):
+        self.id = secrets.token_urlsafe(24)
+        self.session = session
+        self.websocket = websocket
+        self.last_used = time.monotonic()
+        self.sent = 0
+        self.received = 0
+
+
+class ChannelRegistry:
+    """The channels open in this instance.
+
+    - At most `max_channels` are open, or being opened, at once; opening
+      another one fails with a 503. Each open channel holds one thread of
+      the server for its event stream, so the server needs more threads
+      than that.
+    - A comment line is sent on the event stream every `keepalive` seconds
+      without a message, so that it isn't cut by proxies on the way, and so
+      that a client gone away is noticed and its channel closed.
+    - A channel that doesn't get a POST for `idle_timeout` seconds is closed.
+    - The id of a channel, which is random and only sent to the client that
+      opened it, is what authorizes POSTs to it: they don't need an
+      `Authorization` header.
+    """
+
+    def __init__(
+        self, max_channels, idle_timeout, keepalive, connect_timeout, log=None
+    ):
+        self.max_channels = max_channels
+        self.idle_timeout = idle_timeout
+        self.keepalive = keepalive
+        self.connect_timeout = connect_timeout
+        self.log = log or (lambda severity, message: None)
+        self.opened = 0
+        self.rejected = 0
+        self.messages_sent = 0
+        self.messages_received = 0
+        self._channels = {}
+        # Channels being opened, which already count towards max_channels.
+        self._opening = 0
+        self._lock = threading.Lock()
+
+    def open(self, url, headers, session, config, cors_headers=()):
+        """Opens a channel, and returns the response streaming its events.
+
+        Args:
+            url (str): The `BidiRunSession` WebSocket URL of the CES API.
+            headers (dict): The headers of the WebSocket handshake, including
+                `Authorization`.
+            session (str): The session resource name.
+            config (dict): The config message sent first to the CES API.
+            cors_headers (tuple): CORS headers for the response.
+
+        Returns:
+            A Flask response, or a (body, status, headers) tuple on error.
+        """
+        import flask
+        from websockets.exceptions import InvalidHandshake, InvalidStatus
+        from websockets.sync.client import connect
+
+        with self._lock:
+            full = len(self._channels) + self._opening >= self.max_channels
+            if full:
+                self.rejected += 1
+            else:
+                self._opening += 1
+        if full:
+            self.log("WARNING", f"Channel limit reached ({self.max_channels})")
+            return (
+                {"error": "Too many open channels, retry or use :runSession."},
+                503,
+                cors_headers + (("Retry-After", "1"),),
+            )
+
+        try:
+            try:
+                websocket = connect(
+                    url,
+                    additional_headers=headers,
+                    open_timeout=self.connect_timeout,
+                    max_size=MAX_MESSAGE_BYTES,
+                    compression=None,
+                )
+            except InvalidStatus as e:
+                status = e.response.status_code
+                self.log(
+                    "WARNING", f"CES API refused the channel of {session}: {status}"
+                )
+                return (
+                    e.response.body or b"",
+                    status if status < 500 else 502,
+                    cors_headers,
+                )
+            except (InvalidHandshake, OSError, TimeoutError) as e:
+                error_message = f"Error opening a channel to the CES API: {e}"
+                self.log("ERROR", error_message)
+                return (error_message, 502, cors_headers)
+
+            channel = Channel(session, websocket)
+            try:
+                websocket.send(json.dumps(config))
+            except Exception as e:
+                websocket.close()
+                error_message = f"Error opening a channel to the CES API: {e}"
+                self.log("ERROR", error_message)
+                return (error_message, 502, cors_headers)
+            with self._lock:
+                self._channels[channel.id] = channel
+                self.opened += 1
+        finally:
+            with self._lock:
+                self._opening -= 1
+        self.log("DEBUG", f"Opened channel for {session}")
+
+        response = flask.Response(
+            self._events(channel),
+            headers=cors_headers
+            + (
+                ("Cache-Control", "no-cache"),
+                # Stops nginx-based proxies from buffering the stream.
+                ("X-Accel-Buffering", "no"),
+            ),
+            mimetype="text/event-stream",
+        )
+        # In case the server never starts the stream, e.g. if the client
+        # went away.
+        response.call_on_close(lambda: self._close(channel))
+        return response
+
+    def send(self, channel_id, session, data, cors_headers=()):
+        """Sends a message of the client to the CES API on its channel.
+
+        Args:
+            channel_id (str): The id of the channel, from its `open` event.
+            session (str): The session resource name of the request, which
+                must be the one of the channel.
+            data (bytes): The message, a JSON object.
+            cors_headers (tuple): CORS headers for the response.
+
+        Returns:
+            tuple: (body, status, headers).
+        """
+        from websockets.exceptions import ConnectionClosed
+
+        channel = self._channels.get(channel_id or "")
+        if channel is None or channel.session != session:
+            return ({"error": "Unknown channel."}, 404, cors_headers)
+        # Text frames must be UTF-8, which json.loads alone doesn't check:
+        # it also accepts UTF-16 and UTF-32 bytes.
+        try:
+            text = data.decode()
+            message = json.loads(text)
+        except ValueError:
+            message = None
+        if not isinstance(message, dict):
+            return (
+                {"error": "The message must be a UTF-8 JSON object."},
+                400,
+                cors_headers,
+            )
+
+        try:
+            channel.websocket.send(text)
+        except ConnectionClosed:
+            return ({"error": "Unknown channel."}, 404, cors_headers)
+        channel.last_used = time.monotonic()
+        channel.sent += 1
+        return ("", 202, cors_headers)
+
+    def _events(self, channel):
+        """Yields the server-sent events of a channel, until it's closed."""
+        from websockets.exceptions import ConnectionClosed
+
+        websocket = channel.websocket
+        try:
+            yield format_event(json.dumps({"channel": channel.id}), "open")
+            while True:
+                try:
+                    message = websocket.recv(timeout=self.keepalive)
+                except TimeoutError:
+                    if time.monotonic() - channel.last_used > self.idle_timeout:
+                        yield format_event(
+                            json.dumps({"code": 1000, "reason": "idle"}), "close"
+                        )
+                        return
+                    yield b": keepalive\n\n"
+                    continue
+                except ConnectionClosed as e:
+                    close = e.rcvd
+                    yield format_event(
+                        json.dumps(
+                            {
+                                "code": close.code if close else 1006,
+                                "reason": close.reason if close else "",
+                            }
+                        ),
+                        "close",
+                    )
+                    return
+                if isinstance(message, bytes):
+                    message = message.decode("utf-8", "replace")
+                channel.received += 1
+                yield format_event(message)
+        finally:
+            # Also reached when the client goes away: the server closes the
+            # generator once it fails to write to it.
+            self._close(channel)
+
+    def _close(self, channel):
+        """Closes a channel and unregisters it. Can be called several times."""
+        channel.websocket.close()
+        with self._lock:
+            if self._channels.pop(channel.id, None) is None:
+                return
+            self.messages_sent += channel.sent
+            self.messages_received += channel.received
+        self.log(
+            "DEBUG", f"Closed channel for {channel.session}, stats: {self.stats()}"
+        )
+
+    def stats(self):
+        """Returns the channel counters, for logging."""
+        return {
+            "open": len(self._channels),
+            "opened": self.opened,
+            "rejected": self.rejected,
+            "messages_sent": self.messages_sent,
+            "messages_received": self.messages_received,
+        }
@@ -0,0 +1,196 @@
+"""Downscaling of the inline images of CES API requests.
+
+Used by `main.ces_agent_request` to shrink the images the widget sends as
+session input (e.g. `{"inputs": [{"image": {"data": ..., "mime_type": ...}}]}`)
+before they are forwarded. Phone photos are often several megabytes, and
+sending them unmodified slows down the turn. See `ImageDownscaler`.
+"""
+
+import base64
+import io
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+
+class ImageDownscaler:
+    """Downscales and recompresses the base64 images of JSON request bodies.
+
+    - Images are found in any `image` object with a base64 `data` field.
+      Bodies that don't contain `"image"` are not parsed.
+    - Images smaller than `min_bytes` are forwarded as is. Larger ones are
+      resized to fit in `max_dimension` pixels, rotated according to their
+      EXIF orientation, and recompressed as JPEG with `quality` (or PNG when
+      they have transparency). The result is only used if it's smaller.
+    - Images are processed in a shared pool of `workers` threads, so the
+      images of a request are processed in parallel (Pillow releases the GIL
+      while decoding, resizing and encoding), and the number of images being
+      decoded at once, which dominates memory use, is bounded. An image that
+      fails to decode, or takes more than `timeout` seconds, is forwarded as
+      is.
+    - A worker keeps processing an image after its request timed out, so at
+      most `max_pending` images are queued or being processed. Images beyond
+      that are forwarded as is, instead of piling up behind slow ones.
+    """
+
+    def __init__(
+        self,
+        max_dimension,
+        quality,
+        min_bytes,
+        workers,
+        max_pending=None,
+        timeout=5,
+        log=None,
+    ):
+        self.max_dimension = max_dimension
+        self.quality = quality
+        self.min_bytes = min_bytes
+        self.max_pending = max_pending or 4 * workers
+        self.timeout = timeout
+        self.log = log or (lambda severity, message: None)
+        self.images = 0
+        self.resized = 0
+        self.skipped = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self._pending = 0
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="image")
+        self._lock = threading.Lock()
+
+    def process(self, body):
+        """Returns the request body with its images downscaled.
+
+        Args:
+            body (bytes): The request body.
+
+        Returns:
+            bytes: The new body, or `body` itself if nothing was changed.
+        """
+        if not body or b'"image"' not in body:
+            return body
+        try:
+            data = json.loads(body)
+        except ValueError:
+            return body
+
+        images = [
+            image
+            for image in _find_images(data)
+            if len(image["data"]) >= self.min_bytes
+        ]
+        if not images:
+            return body
+        futures = [self._submit(image) for image in images]
+        modified = False
+        for image, future in zip(images, futures):
+            if future is None:
+                self.log(
+                    "WARNING",
+                    "Too many images being downscaled, forwarding the original.",
+                )
+                continue
+            try:
+                result = future.result(timeout=self.timeout)
+            except FutureTimeoutError:
+                self.log(
+                    "WARNING", "Image downscaling timed out, forwarding the original."
+                )
+                continue
+            if result is not None:
+                image["data"], mime_type = result
+                # Keep the key style of the request.
+                image["mimeType" if "mimeType" in image else "mime_type"] = mime_type
+                modified = True
+        if not modified:
+            return body
+        return json.dumps(data, separators=(",", ":")).encode()
+
+    def _submit(self, image):
+        """Queues an image, and returns its future, or None if too many are."""
+        with self._lock:
+            if self._pending >= self.max_pending:
+                self.skipped += 1
+                return None
+            self._pending += 1
+        future = self._pool.submit(self._downscale, image)
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future):
+        with self._lock:
+            self._pending -= 1
+
+    def _downscale(self, image):
+        """Returns `(data, mime_type)` for a smaller image, or None."""
+        encoded = image["data"]
+        try:
+            from PIL import Image, ImageOps
+
+            original = base64.b64decode(encoded, validate=True)
+            with Image.open(io.BytesIO(original)) as img:
+                # JPEG images can be decoded at a fraction of their size,
+                # which is much faster than decoding then resizing them.
+                img.draft("RGB", (self.max_dimension, self.max_dimension))
+                img = ImageOps.exif_transpose(img)
+                img.thumbnail(
+                    (self.max_dimension, self.max_dimension), reducing_gap=2.0
+                )
+                output = io.BytesIO()
+                if img.mode in ("RGBA", "LA", "P") and _has_alpha(img):
+                    img.save(output, "PNG")
+                    mime_type = "image/png"
+                else:
+                    img.convert("RGB").save(
+                        output, "JPEG", quality=self.quality, optimize=True
+                    )
+                    mime_type = "image/jpeg"
+        except Exception as e:
+            # Any image that can't be processed, e.g. a decompression bomb or
+            # a Pillow bug on a malformed file, is forwarded as is.
+            self.log(
+                "WARNING", f"Could not downscale image, forwarding the original: {e}"
+            )
+            return None
+
+        resized = output.getvalue()
+        with self._lock:
+            self.images += 1
+            self.bytes_in += len(original)
+            if len(resized) >= len(original):
+                self.bytes_out += len(original)
+                return None
+            self.resized += 1
+            self.bytes_out += len(resized)
+        return base64.b64encode(resized).decode("ascii"), mime_type
+
+    def stats(self):
+        """Returns the downscaling counters, for logging."""
+        return {
+            "images": self.images,
+            "resized": self.resized,
+            "skipped": self.skipped,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+        }
+
+
+def _find_images(value):
+    """Yields the `image` objects with base64 `data` of a JSON value."""
+    if isinstance(value, dict):
+        image = value.get("image")
+        if isinstance(image, dict) and isinstance(image.get("data"), str):
+            yield image
+        for item in value.values():
+            yield from _find_images(item)
+    elif isinstance(value, list):
+        for item in value:
+            yield from _find_images(item)
+
+
+def _has_alpha(img):
+    """Whether an image has transparent pixels."""
+    if img.mode == "P":
+        return "transparency" in img.info
+    return img.getchannel("A").getextrema()[0] < 255
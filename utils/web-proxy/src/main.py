@@ -13,38 +13,180 @@ Key features:
 - **Authentication Handling**: If an incoming request lacks an 'Authorization'
   header, it generates a new OAuth2 access token using the function's service
   account credentials and adds it to the request before proxying.
-- **Token Caching**: Caches the generated access token in memory to reduce
-  latency and avoid hitting token generation API quotas.
+- **Token Caching**: Caches generated access tokens in a bounded in-memory
+  cache keyed by (principal, scopes). The agent's project is billed through
+  the `X-Goog-User-Project` header, so a single deployment can serve agents
+  from several projects without minting a token per project.
+  Optionally, the cache is shared by the worker processes of the instance.
 - **CORS Support**: Handles CORS preflight (OPTIONS) and main requests, allowing
   access only from a configurable allowlist of origins.
+- **Header Filtering**: Hop-by-hop and browser-only headers (e.g. cookies) are
+  not forwarded to the CES API.
 - **Region Validation**: Compares its own execution region with the agent's
   region to log a warning about potential cross-region latency.
+- **Regional Routing**: Optionally forwards requests to a regional CES
+  endpoint based on the agent's location, instead of the global domain.
+- **Upstream Retries**: Retries failed GET requests with exponential backoff,
+  and optionally hedges slow ones, within a retry budget.
+- **Response Caching**: Optionally serves allow-listed GET requests (e.g. app
+  or agent metadata) from a bounded in-memory cache, see `response_cache.py`.
+- **Image Downscaling**: Optionally downscales and recompresses large inline
+  images of POST requests before forwarding them, see `image_resize.py`.
+- **Response Compression**: Compresses JSON responses for the browser, or
+  passes through the compression of the CES API, see `response_compression.py`.
+- **Profiling**: Optionally serves authenticated `/admin/` endpoints that
+  profile the running instance on demand, see `admin_profiling.py`.
+- **Channels**: Optionally keeps a WebSocket to the CES API open for each chat
+  session, relayed to the browser as server-sent events, so that replies are
+  streamed as they're generated, see `channel.py`.
+- **Request Timing**: Optionally reports the duration of each phase of a
+  request in a `Server-Timing` header, and traces requests with
+  OpenTelemetry, propagating the trace context to the CES API, see
+  `tracing.py`.
 
 Configuration is managed through environment variables:
 - `AUTHORIZED_ORIGINS`: A semicolon-separated list of allowed origin URLs.
 - `TOKEN_TTL`: The time-to-live for the cached token in seconds.
 - `OAUTH_SCOPES`: A comma-separated list of OAuth scopes for the token.
-- `DISABLE_REGION_CHECK`: Set to "true" to disable the region mismatch warning.
+- `OAUTH_SCOPES_BY_PROJECT`: Optional per-project scope overrides, formatted as
+  `project-a=scope1,scope2;project-b=scope3`.
+- `TOKEN_CACHE_MAX_ENTRIES`: Maximum number of cached tokens. Defaults to 64.
+- `TOKEN_EXPIRY_MARGIN`: Seconds before a token's real expiry at which it is
+  no longer served from the cache. Defaults to 60.
+- `SHARED_TOKEN_CACHE_PATH`: Optional file, on a memory-backed filesystem (e.g.
+  `/dev/shm/ces-tokens.json`), through which the worker processes of an
+  instance share their tokens, so they're minted once per instance.
+- `CES_API_DOMAIN`: The default CES API domain. Defaults to `ces.googleapis.com`.
+- `CES_REGIONAL_API_DOMAINS`: Optional per-location API domains, formatted as
+  `us-central1=us-central1-ces.googleapis.com;eu=eu-ces.example.com`. Keys may
+  be agent locations or the regions they resolve to.
+- `DISABLE_REGION_CHECK`: Set to "true" to disable the region mismatch warning
+  and the metadata server lookup it requires.
+- `RESPONSE_CACHE_PATHS`: Optional semicolon-separated list of regular
+  expressions. GET requests whose path matches one of them are served from an
+  in-memory response cache. The cache is disabled when unset.
+- `RESPONSE_CACHE_TTL`: Seconds a cached response is fresh, when the upstream
+  doesn't send `Cache-Control: max-age`. Defaults to 60.
+- `RESPONSE_CACHE_STALE_TTL`: Seconds a response may be served stale while it
+  is refreshed in the background. Defaults to 30.
+- `RESPONSE_CACHE_MAX_BYTES`: Memory budget of the response cache. Defaults to
+  16 MiB.
+- `UPSTREAM_TIMEOUT`: Timeout of each request to the CES API, in seconds.
+  Defaults to 30.
+- `UPSTREAM_MAX_RETRIES`: Maximum retries of a failed GET request. Defaults
+  to 2.
+- `UPSTREAM_RETRY_BACKOFF_MS`: Base delay of the exponential backoff between
+  retries. Defaults to 100.
+- `UPSTREAM_HEDGING`: Set to "true" to send a second copy of slow GET requests.
+- `UPSTREAM_HEDGE_MIN_DELAY_MS`: Minimum wait before hedging. Defaults to 200.
+- `UPSTREAM_RETRY_BUDGET_PERCENT`: Retries and hedged requests allowed, as a
+  percentage of requests over the last 10 seconds. Defaults to 10.
+- `UPSTREAM_RETRY_BUDGET_MIN`: Retries and hedged requests always allowed
+  over the last 10 seconds. Defaults to 10.
+- `IMAGE_MAX_DIMENSION`: Optional maximum width and height, in pixels, of the
+  images of POST requests. Larger images are downscaled. Disabled when unset.
+- `IMAGE_QUALITY`: JPEG quality of downscaled images. Defaults to 85.
+- `IMAGE_MIN_BYTES`: Size of the base64 data under which images are forwarded
+  as is. Defaults to 100 KiB.
+- `IMAGE_WORKERS`: Threads used to downscale images. Defaults to 2.
+- `IMAGE_MAX_PENDING`: Images queued or being downscaled, over which images
+  are forwarded as is. Defaults to 4 per worker.
+- `RESPONSE_COMPRESSION`: Set to "false" to send responses uncompressed.
+- `RESPONSE_COMPRESSION_MIN_BYTES`: Size under which responses are not
+  compressed. Defaults to 1024.
+- `RESPONSE_COMPRESSION_GZIP_LEVEL`: gzip level, 1 to 9. Defaults to 6.
+- `RESPONSE_COMPRESSION_BROTLI_QUALITY`: Brotli quality, 0 to 11, used when
+  the optional `brotli` package is installed. Defaults to 5.
+- `ADMIN_TOKEN`: Token of the `/admin/` profiling endpoints, sent in an
+  `X-Admin-Token` header. They are disabled when unset.
+- `CHANNEL_MAX_SESSIONS`: Maximum number of channels open at once in an
+  instance. Channels are disabled when unset or 0.
+- `CHANNEL_IDLE_TIMEOUT`: Seconds after which a channel that gets no message
+  from its client is closed. Defaults to 600.
+- `CHANNEL_KEEPALIVE`: Seconds between keepalive comments on a quiet event
+  stream. Defaults to 15.
+- `STATS_LOG_INTERVAL`: Minimum seconds between two logs of the counters of
+  each cache and client (token cache, CES API client, response cache,
+  compression, image downscaling), which are only logged when they changed.
+  Defaults to 60.
+- `SERVER_TIMING`: Set to "true" to send the duration of each phase of a
+  request in a `Server-Timing` response header. See `tracing.py`, which also
+  describes the OpenTelemetry tracing configured by the `OTEL_*` variables.
 """
 
+import datetime
+import functools
+import hashlib
 import json
 import os
 import re
 import sys
+import threading
 import time
 
+import admin_profiling
 import functions_framework
 import google.auth
-import google.auth.transport.requests
-import requests
-from google.api_core import exceptions
+import tracing
+from channel import ChannelRegistry
+from image_resize import ImageDownscaler
+from response_cache import ResponseCache
+from response_compression import ResponseCompressor, accepts
+from token_cache import TokenCache
+from upstream import RetryBudget, UpstreamClient, take_connect_time
+
+# `requests`, `google.auth.transport.requests` and `google.api_core` are
+# imported by the functions that need them, so that they don't add to cold
+# start latency (e.g. CORS preflights and requests carrying their own
+# Authorization header never load the token refresh dependencies).
 
 CES_API_DOMAIN = os.getenv("CES_API_DOMAIN", "ces.googleapis.com")
 CES_API_VERSION = "v1"
 
-# Keep latest token in cache for TOKEN_TTL seconds
-CURRENT_TOKEN = None
-CURRENT_TOKEN_TIMESTAMP = None
+# Default specific regions for CES multi-region locations.
+MULTI_REGION_MAP = {"eu": "europe-west1", "us": "us-central1"}
+
+# Matches the project and location of an agent resource name.
+AGENT_PATH_PATTERN = re.compile(r"projects/([^/]+)/locations/([^/]+)")
+
+# Request headers that are not forwarded to the CES API (lowercase): hop-by-hop
+# headers, headers recomputed for the upstream request, and browser or
+# load balancer headers the CES API has no use for. `Accept-Encoding` is
+# dropped so that `requests` only negotiates encodings it can decode.
+DROPPED_REQUEST_HEADERS = frozenset(
+    [
+        "accept-encoding",
+        "connection",
+        "content-length",
+        "cookie",
+        "forwarded",
+        "host",
+        "keep-alive",
+        "proxy-authorization",
+        "proxy-connection",
+        "te",
+        "trailer",
+        "transfer-encoding",
+        "upgrade",
+        "x-forwarded-for",
+        "x-forwarded-host",
+        "x-forwarded-proto",
+    ]
+)
+
+# Response headers that are not forwarded to the client (lowercase).
+# `Content-Encoding` is kept when the compressed content is passed through.
+EXCLUDED_RESPONSE_HEADERS = frozenset(
+    [
+        "content-encoding",
+        "content-length",
+        "transfer-encoding",
+        "connection",
+    ]
+)
+
+# Header naming the project billed for a request made with the proxy's token.
+QUOTA_HEADER = "x-goog-user-project"
 
 
 def print_log(severity, message):
@@ -58,16 +200,49 @@ def print_log(severity, message):
     print(json.dumps(log_entry), file=stream)
 
 
+def get_int_env(name, default):
+    """Reads an integer environment variable, falling back to `default`."""
+    value = os.environ.get(name, str(default))
+    try:
+        return int(value)
+    except (ValueError, TypeError):
+        print_log(
+            "WARNING", f"Invalid value for {name}: '{value}'. It must be an integer."
+        )
+        # Fallback to a safe default
+        return default
+
+
+# The counters of the caches and clients are logged at most this often, in
+# seconds, each, and only when they changed, rather than on every request.
+STATS_LOG_INTERVAL = get_int_env("STATS_LOG_INTERVAL", 60)
+_stats_logged = {}  # name -> (time.monotonic(), stats)
+_stats_lock = threading.Lock()
+
+
+def log_stats(name, stats):
+    """Logs the counters of a component, if they're due.
+
+    Args:
+        name (str): The component, e.g. "Token cache".
+        stats (callable): Returns its counters. Only called when they're due.
+    """
+    now = time.monotonic()
+    with _stats_lock:
+        last = _stats_logged.get(name)
+        if last and now - last[0] < STATS_LOG_INTERVAL:
+            return
+        current = stats()
+        if last and current == last[1]:
+            return
+        _stats_logged[name] = (now, current)
+    print_log("DEBUG", f"{name} stats: {current}")
+
+
 # We'll keep updated tokens only for a few minutes.
-TOKEN_TTL = os.environ.get("TOKEN_TTL", "300")
-try:
-    TOKEN_TTL = int(TOKEN_TTL)
-except (ValueError, TypeError):
-    print_log(
-        "WARNING", f"Invalid value for TOKEN_TTL: '{TOKEN_TTL}'. It must be an integer."
-    )
-    # Fallback to a safe default
-    TOKEN_TTL = 300
+TOKEN_TTL = get_int_env("TOKEN_TTL", 300)
+TOKEN_CACHE_MAX_ENTRIES = get_int_env("TOKEN_CACHE_MAX_ENTRIES", 64)
+TOKEN_EXPIRY_MARGIN = get_int_env("TOKEN_EXPIRY_MARGIN", 60)
 
 authorized_origins = []
 
@@ -76,11 +251,174 @@ env_origins = os.environ.get("AUTHORIZED_ORIGINS")
 if env_origins:
     # Split by comma and strip any whitespace from each origin.
     additional_origins = [
-        origin.strip().rstrip('/') for origin in env_origins.split(";") if origin.strip()
+        origin.strip().rstrip("/")
+        for origin in env_origins.split(";")
+        if origin.strip()
     ]
     authorized_origins.extend(additional_origins)
 
 
+def build_cors_headers(origin):
+    """Returns the CORS response headers for an authorized origin."""
+    return (
+        ("Access-Control-Allow-Origin", origin),
+        ("Access-Control-Allow-Methods", "GET, POST"),
+        (
+            "Access-Control-Allow-Headers",
+            "Content-Type, user-agent, Authorization, traceparent, tracestate",
+        ),
+        ("Access-Control-Max-Age", "3600"),
+    )
+
+
+# CORS headers for each origin in the allowlist, built once at startup.
+cors_headers_by_origin = {
+    origin: build_cors_headers(origin)
+    for origin in authorized_origins
+    if isinstance(origin, str)
+}
+
+
+@functools.lru_cache(maxsize=256)
+def get_cors_headers(origin):
+    """Returns the CORS headers for a request's origin.
+
+    Args:
+        origin (str): The `Origin` request header, without a trailing slash.
+
+    Returns:
+        tuple: (name, value) header pairs, empty if the origin isn't authorized.
+    """
+    if origin in cors_headers_by_origin:
+        return cors_headers_by_origin[origin]
+    if origin.startswith("http://localhost:"):
+        return build_cors_headers(origin)
+    for authorized_origin in authorized_origins:
+        if hasattr(authorized_origin, "match") and authorized_origin.match(origin):
+            return build_cors_headers(origin)
+    return ()
+
+
+# Regional CES API domains, e.g. "us-central1=us-central1-ces.googleapis.com".
+regional_api_domains = {}
+env_regional_api_domains = os.environ.get("CES_REGIONAL_API_DOMAINS")
+if env_regional_api_domains:
+    for entry in env_regional_api_domains.split(";"):
+        location, _, domain = entry.partition("=")
+        if location.strip() and domain.strip():
+            regional_api_domains[location.strip()] = domain.strip()
+        elif entry.strip():
+            print_log(
+                "WARNING", f"Ignoring invalid CES_REGIONAL_API_DOMAINS entry: '{entry}'"
+            )
+
+
+def parse_scopes(scopes_str):
+    """Splits a comma-separated scope list into a sorted, de-duplicated tuple."""
+    return tuple(
+        sorted({scope.strip() for scope in scopes_str.split(",") if scope.strip()})
+    )
+
+
+# Per-project scope overrides, e.g. "project-a=scope1,scope2;project-b=scope3".
+scopes_by_project = {}
+env_scopes_by_project = os.environ.get("OAUTH_SCOPES_BY_PROJECT")
+if env_scopes_by_project:
+    for entry in env_scopes_by_project.split(";"):
+        project, _, project_scopes = entry.partition("=")
+        if project.strip() and parse_scopes(project_scopes):
+            scopes_by_project[project.strip()] = parse_scopes(project_scopes)
+        elif entry.strip():
+            print_log(
+                "WARNING", f"Ignoring invalid OAUTH_SCOPES_BY_PROJECT entry: '{entry}'"
+            )
+
+
+# Paths of the GET requests whose responses can be cached, as regular expressions.
+response_cache_paths = [
+    pattern.strip()
+    for pattern in os.environ.get("RESPONSE_CACHE_PATHS", "").split(";")
+    if pattern.strip()
+]
+RESPONSE_CACHE = None
+if response_cache_paths:
+    try:
+        RESPONSE_CACHE = ResponseCache(
+            response_cache_paths,
+            max_bytes=get_int_env("RESPONSE_CACHE_MAX_BYTES", 16 * 1024 * 1024),
+            default_ttl=get_int_env("RESPONSE_CACHE_TTL", 60),
+            stale_ttl=get_int_env("RESPONSE_CACHE_STALE_TTL", 30),
+            log=print_log,
+        )
+    except re.error as e:
+        print_log("ERROR", f"Invalid RESPONSE_CACHE_PATHS, cache disabled: {e}")
+
+# Large inline images of POST requests are downscaled to this size, in pixels.
+IMAGE_MAX_DIMENSION = get_int_env("IMAGE_MAX_DIMENSION", 0)
+IMAGE_DOWNSCALER = None
+if IMAGE_MAX_DIMENSION > 0:
+    IMAGE_DOWNSCALER = ImageDownscaler(
+        IMAGE_MAX_DIMENSION,
+        quality=get_int_env("IMAGE_QUALITY", 85),
+        min_bytes=get_int_env("IMAGE_MIN_BYTES", 100 * 1024),
+        workers=max(1, get_int_env("IMAGE_WORKERS", 2)),
+        max_pending=get_int_env("IMAGE_MAX_PENDING", 0),
+        log=print_log,
+    )
+
+RESPONSE_COMPRESSOR = None
+if os.environ.get("RESPONSE_COMPRESSION", "true").lower() != "false":
+    RESPONSE_COMPRESSOR = ResponseCompressor(
+        min_bytes=get_int_env("RESPONSE_COMPRESSION_MIN_BYTES", 1024),
+        gzip_level=get_int_env("RESPONSE_COMPRESSION_GZIP_LEVEL", 6),
+        brotli_quality=get_int_env("RESPONSE_COMPRESSION_BROTLI_QUALITY", 5),
+    )
+
+UPSTREAM = UpstreamClient(
+    timeout=get_int_env("UPSTREAM_TIMEOUT", 30),
+    max_retries=get_int_env("UPSTREAM_MAX_RETRIES", 2),
+    backoff=get_int_env("UPSTREAM_RETRY_BACKOFF_MS", 100) / 1000,
+    hedging=os.environ.get("UPSTREAM_HEDGING", "false").lower() == "true",
+    hedge_min_delay=get_int_env("UPSTREAM_HEDGE_MIN_DELAY_MS", 200) / 1000,
+    retry_budget=RetryBudget(
+        ratio=get_int_env("UPSTREAM_RETRY_BUDGET_PERCENT", 10) / 100,
+        minimum=get_int_env("UPSTREAM_RETRY_BUDGET_MIN", 10),
+    ),
+    log=print_log,
+)
+
+CHANNEL_MAX_SESSIONS = get_int_env("CHANNEL_MAX_SESSIONS", 0)
+CHANNELS = None
+if CHANNEL_MAX_SESSIONS > 0:
+    CHANNELS = ChannelRegistry(
+        CHANNEL_MAX_SESSIONS,
+        idle_timeout=get_int_env("CHANNEL_IDLE_TIMEOUT", 600),
+        keepalive=get_int_env("CHANNEL_KEEPALIVE", 15),
+        connect_timeout=get_int_env("UPSTREAM_TIMEOUT", 30),
+        log=print_log,
+    )
+
+# Suffix of the paths of channels, after the session resource name.
+CHANNEL_SUFFIX = ":channel"
+
+
+# Tokens shared by the worker processes of the instance, e.g. in /dev/shm.
+SHARED_TOKEN_CACHE_PATH = os.environ.get("SHARED_TOKEN_CACHE_PATH", "")
+shared_token_store = None
+if SHARED_TOKEN_CACHE_PATH:
+    from shared_token_cache import SharedTokenStore
+
+    shared_token_store = SharedTokenStore(SHARED_TOKEN_CACHE_PATH, log=print_log)
+
+TOKEN_CACHE = TokenCache(
+    TOKEN_CACHE_MAX_ENTRIES, TOKEN_TTL, TOKEN_EXPIRY_MARGIN, shared_token_store
+)
+
+# ADC credentials, loaded once per scope set.
+_credentials_by_scopes = {}
+_credentials_lock = threading.Lock()
+
+
 def find_current_region():
     """Determines the Google Cloud region where the function is executing.
 
@@ -95,6 +433,8 @@ def find_current_region():
         str or None: The region string (e.g., 'us-central1') if found,
                      otherwise None.
     """
+    import requests
+
     cf_region = None
     metadata_headers = {"Metadata-Flavor": "Google"}
     if os.environ.get("DISABLE_REGION_CHECK", "false").lower() != "true":
@@ -114,14 +454,16 @@ def find_current_region():
         except requests.exceptions.RequestException as e:
             print_log(
                 "WARNING",
-                f"Could not contact metadata server to get region: {e}. Falling back to environment variable.",
+                f"Could not contact metadata server to get region: {e}. "
+                "Falling back to environment variable.",
             )
             # Fallback to environment variable if metadata server is not available.
             cf_region = os.environ.get("FUNCTION_REGION")
             if cf_region:
                 print_log(
                     "INFO",
-                    f"Got Cloud Function region from FUNCTION_REGION env var: {cf_region}.",
+                    "Got Cloud Function region from FUNCTION_REGION env var: "
+                    f"{cf_region}.",
                 )
     if not cf_region:
         print_log(
@@ -131,8 +473,30 @@ def find_current_region():
     return cf_region
 
 
-# Try to find the region where the Cloud Function is running.
-CF_REGION = find_current_region()
+# The region where the Cloud Function is running. Looking it up can take up to
+# 2 seconds, so it's done in a background thread instead of at import time;
+# requests are served without the region check until the lookup completes.
+CF_REGION = None
+
+# The lookup thread is started by the first request of each process, not at
+# import: the functions framework imports this module in the gunicorn master
+# before forking the workers, where the thread wouldn't run, and where it could
+# leave a module (e.g. `requests`) half imported if the fork happens mid-import.
+region_lookup_started = False
+
+
+def detect_current_region():
+    """Sets `CF_REGION`. Runs in a background thread started on first use."""
+    global CF_REGION
+    CF_REGION = find_current_region()
+
+
+def start_region_lookup():
+    """Starts `detect_current_region` once per process."""
+    global region_lookup_started
+    if not region_lookup_started:
+        region_lookup_started = True
+        threading.Thread(target=detect_current_region, daemon=True).start()
 
 
 @functions_framework.http
@@ -152,114 +516,309 @@ def ces_agent_request(request):
         The response includes CORS headers for allowed origins.
 
     """
+    trace = tracing.start_request(
+        "ces_agent_request", request.headers, "ces-web-proxy", print_log
+    )
+    response = None
+    try:
+        response = proxy_request(request, trace)
+    finally:
+        if response is None:
+            # An unhandled error, which Flask answers with a 500.
+            trace.end(500)
+    if trace is tracing.NULL_TRACE:
+        return response
+    # Lets pages of authorized origins read the `Server-Timing` header.
+    origin = request.headers.get("Origin", "").rstrip("/")
+    if not (origin and get_cors_headers(origin)):
+        origin = None
+    return trace.finish(response, origin)
+
+
+def proxy_request(request, trace):
+    """
+    Handles a request of `ces_agent_request`.
+
+    Args:
+        request (flask.Request): The request object.
+        trace (tracing.RequestTrace): Times the phases of the request.
+
+    Returns:
+        The response, as a Flask view return value.
+    """
+    if not region_lookup_started:
+        start_region_lookup()
+
+    if admin_profiling.ADMIN_TOKEN and request.path.startswith("/admin/"):
+        return admin_profiling.handle_admin_request(request, print_log)
 
     # Determine the origin and prepare CORS headers. These headers will be used
     # for both preflight and main requests to ensure consistency.
     origin = request.headers.get("Origin")
-
-    is_authorized = False
     if origin:
         origin = origin.rstrip("/")
-        if origin.startswith("http://localhost:"):
-            is_authorized = True
-        else:
-            for authorized_origin in authorized_origins:
-                if isinstance(authorized_origin, str) and origin == authorized_origin:
-                    is_authorized = True
-                    break
-                if hasattr(authorized_origin, "match") and authorized_origin.match(
-                    origin
-                ):
-                    is_authorized = True
-                    break
-
-    if is_authorized:
-        headers = {
-            "Access-Control-Allow-Origin": origin,
-            "Access-Control-Allow-Methods": "GET, POST",
-            "Access-Control-Allow-Headers": "Content-Type, user-agent, Authorization",
-            "Access-Control-Max-Age": "3600",
-        }
+        headers = get_cors_headers(origin)
     else:
-        headers = {}
+        headers = ()
 
     # Handle CORS preflight requests.
     if request.method == "OPTIONS":
         # For preflight, return a 204 response. If the origin is not allowed,
-        # the headers dict will be empty, and the browser will block the request.
+        # the headers will be empty, and the browser will block the request.
         return ("", 204, headers)
 
+    import requests
+
+    # Extract the project and location from the agent resource name, e.g.
+    # "projects/my-project-id/locations/us/apps/2462faec-84d5-41f8-9df5-34a68b2d7dac/..."
+    path_match = AGENT_PATH_PATTERN.search(request.path)
+    project_id, agent_location = path_match.groups() if path_match else (None, None)
+
     # --- Check Region ---
-    if CF_REGION:
-        check_region(CF_REGION, request.path)
+    if CF_REGION and agent_location:
+        with trace.phase("region"):
+            check_region(CF_REGION, agent_location)
+
+    if CHANNELS and request.path.endswith(CHANNEL_SUFFIX):
+        return handle_channel_request(
+            request, headers, project_id, agent_location, trace
+        )
 
     # --- Proxy the request ---
-    downstream_headers = dict(request.headers)
-    downstream_headers["Host"] = CES_API_DOMAIN
+    api_domain = get_api_domain(agent_location)
+    downstream_headers = {
+        k: v
+        for k, v in request.headers.items()
+        if k.lower() not in DROPPED_REQUEST_HEADERS
+    }
+    downstream_headers["Host"] = api_domain
 
     # Add an access token if not found in the original request headers
     if "Authorization" not in downstream_headers:
-        # Check if the token is cached and not expired
-        if (
-            CURRENT_TOKEN
-            and CURRENT_TOKEN_TIMESTAMP
-            and (time.time() - CURRENT_TOKEN_TIMESTAMP < TOKEN_TTL)
-        ):
-            print_log("DEBUG", "Returning cached access token.")
-        else:  # Otherwise, refresh it
-            print_log("DEBUG", "Cached token is expired or missing. Refreshing...")
-            if not refresh_token():
-                # If refresh fails, return an error. This ensures logs are flushed.
-                return (
-                    {
-                        "error": "Failed to generate a new access token. Check server logs for details."
-                    },
-                    500,
-                    headers,
-                )
-        downstream_headers["Authorization"] = f"Bearer {CURRENT_TOKEN}"
+        with trace.phase("token"):
+            access_token = get_cached_token(project_id)
+        if not access_token:
+            # If refresh fails, return an error. This ensures logs are flushed.
+            return (
+                {
+                    "error": "Failed to generate a new access token. "
+                    "Check server logs for details."
+                },
+                500,
+                headers,
+            )
+        downstream_headers["Authorization"] = f"Bearer {access_token}"
+        # The token isn't tied to a project: the agent's project is billed
+        # through the quota project header.
+        if project_id:
+            for key in [k for k in downstream_headers if k.lower() == QUOTA_HEADER]:
+                del downstream_headers[key]
+            downstream_headers["X-Goog-User-Project"] = project_id
     else:
         print_log(
             "DEBUG",
             "Authorization header already found in the original request headers.",
         )
 
-    downstream_url = f"https://{CES_API_DOMAIN}/{CES_API_VERSION}{request.path}"
+    downstream_url = f"https://{api_domain}/{CES_API_VERSION}{request.path}"
 
     print_log("DEBUG", f"Connecting to CES API: {downstream_url}")
 
+    if request.method not in ("GET", "POST"):
+        return (f"Unsupported method: {request.method}", 405, None)
+
+    # Captured here: `fetch` may run in a background thread, after the request
+    # context is gone, to refresh a stale cached response.
+    method = request.method
+    params = request.args
+    data = request.get_data() if method == "POST" else None
+    if IMAGE_DOWNSCALER and data:
+        with trace.phase("image"):
+            data = IMAGE_DOWNSCALER.process(data)
+        log_stats("Image downscaling", IMAGE_DOWNSCALER.stats)
+    accept_encoding = request.headers.get("Accept-Encoding", "")
+
+    def fetch(accept_encoding=None):
+        return forward_request(
+            method, downstream_url, downstream_headers, params, data, accept_encoding
+        )
+
+    # The connection time of the upstream request is split out of its phase.
+    take_connect_time()
+    upstream_start = time.perf_counter()
     try:
-        if request.method == "GET":
-            downstream_response = requests.get(
-                downstream_url,
-                headers=downstream_headers,
-                params=request.args,
-                timeout=30,
+        with trace.phase("upstream") as span:
+            trace.inject(downstream_headers, span)
+            content, status, response_headers = fetch_response(
+                request, fetch, accept_encoding, project_id, origin
             )
-        elif request.method == "POST":
-            downstream_response = requests.post(
-                downstream_url,
-                headers=downstream_headers,
-                data=request.get_data(),
-                params=request.args,
-                timeout=30,
-            )
-        else:
-            return (f"Unsupported method: {request.method}", 405, None)
-
     except requests.exceptions.RequestException as e:
         error_message = f"Error proxying request to downstream server: {e}"
         print_log("ERROR", error_message)
         return (error_message, 502, None)
+    finally:
+        connect_time = take_connect_time()
+        if connect_time:
+            trace.add("upstream-connect", connect_time, upstream_start)
+
+    if RESPONSE_COMPRESSOR:
+        with trace.phase("compress"):
+            content, response_headers = RESPONSE_COMPRESSOR.compress(
+                content, response_headers, accept_encoding
+            )
+        log_stats("Response compression", RESPONSE_COMPRESSOR.stats)
+
+    return (content, status, response_headers)
+
+
+def fetch_response(request, fetch, accept_encoding, project_id, origin):
+    """
+    Returns the upstream response to a request, from the cache if allowed.
+
+    Args:
+        request (flask.Request): The request object.
+        fetch (callable): Sends the request to the CES API.
+        accept_encoding (str): The client's `Accept-Encoding`.
+        project_id (str): The project of the agent.
+        origin (str): The `Origin` of the request.
+
+    Returns:
+        tuple: (content, status_code, response_headers).
+
+    Raises:
+        requests.exceptions.RequestException: If the request fails.
+    """
+    if (
+        request.method == "GET"
+        and RESPONSE_CACHE
+        and RESPONSE_CACHE.matches(request.path)
+    ):
+        # Responses may differ by caller and, because CES sets the CORS
+        # headers, by origin; both are part of the key.
+        if "Authorization" in request.headers:
+            principal = hashlib.sha256(
+                request.headers["Authorization"].encode()
+            ).hexdigest()
+        else:
+            principal = ("proxy", project_id)
+        key = (request.path, request.query_string, principal, origin)
+        content, status, response_headers, cache_status = RESPONSE_CACHE.get(key, fetch)
+        log_stats("Response cache", RESPONSE_CACHE.stats)
+        return content, status, response_headers + [("X-Proxy-Cache", cache_status)]
+    return fetch(accept_encoding)
+
+
+def handle_channel_request(request, headers, project_id, agent_location, trace):
+    """
+    Opens a channel (GET), or sends a message on it (POST). See `channel.py`.
+
+    Args:
+        request (flask.Request): The request, for `<session>:channel`.
+        headers (tuple): The CORS headers of the response.
+        project_id (str): The project of the session.
+        agent_location (str): The location of the session.
+        trace (tracing.RequestTrace): Times the phases of the request.
+
+    Returns:
+        A Flask response, or a (body, status, headers) tuple.
+    """
+    session = request.path[1 : -len(CHANNEL_SUFFIX)]
+    if request.method == "POST":
+        data = request.get_data()
+        if IMAGE_DOWNSCALER and data:
+            data = IMAGE_DOWNSCALER.process(data)
+            log_stats("Image downscaling", IMAGE_DOWNSCALER.stats)
+        return CHANNELS.send(request.args.get("id"), session, data, headers)
+    if request.method != "GET":
+        return (f"Unsupported method: {request.method}", 405, None)
+    if not agent_location:
+        return ({"error": "Not a session resource name."}, 400, headers)
+
+    authorization = request.headers.get("Authorization")
+    if not authorization:
+        with trace.phase("token"):
+            access_token = get_cached_token(project_id)
+        if not access_token:
+            return (
+                {
+                    "error": "Failed to generate a new access token. "
+                    "Check server logs for details."
+                },
+                500,
+                headers,
+            )
+        authorization = f"Bearer {access_token}"
+    upstream_headers = {"Authorization": authorization}
+    if project_id and "Authorization" not in request.headers:
+        upstream_headers["X-Goog-User-Project"] = project_id
+
+    config = {"session": session}
+    if request.args.get("deployment"):
+        config["deployment"] = request.args["deployment"]
+    url = (
+        f"wss://{get_api_domain(agent_location)}/ws/google.cloud.ces."
+        f"{CES_API_VERSION}.SessionService/BidiRunSession/locations/{agent_location}"
+    )
+    print_log("DEBUG", f"Opening channel to CES API: {url}")
+    with trace.phase("upstream-connect") as span:
+        trace.inject(upstream_headers, span)
+        return CHANNELS.open(
+            url, upstream_headers, session, {"config": config}, headers
+        )
+
+
+def forward_request(method, url, headers, params=None, data=None, accept_encoding=None):
+    """
+    Sends a request to the CES API, retrying it if it's safe to do so.
+
+    Args:
+        method (str): The HTTP method, "GET" or "POST".
+        url (str): The CES API URL.
+        headers (dict): The request headers, including `Authorization`.
+        params (dict): The query string parameters.
+        data (bytes): The request body, for POST requests.
+        accept_encoding (str): The client's `Accept-Encoding`. When set, a
+            POST response that the CES API compressed with one of these
+            encodings is returned as received, with its `Content-Encoding`.
+            (GET responses may be retried or hedged, so they are always
+            read in full and decoded.)
+
+    Returns:
+        tuple: (content, status_code, response_headers), where response_headers
+        is a list of (name, value) tuples without the hop-by-hop headers.
+
+    Raises:
+        requests.exceptions.RequestException: If the request fails.
+    """
+    stream = accept_encoding is not None and method == "POST"
+    downstream_response = UPSTREAM.request(
+        method,
+        url,
+        headers=headers,
+        data=data,
+        params=params,
+        stream=stream,
+    )
+    log_stats("Upstream", UPSTREAM.stats)
+
+    excluded_headers = EXCLUDED_RESPONSE_HEADERS
+    content_encoding = downstream_response.headers.get("Content-Encoding")
+    if stream and content_encoding and accepts(accept_encoding, content_encoding):
+        import requests
+        import urllib3
+
+        # Pass the compressed content through, without decoding it.
+        try:
+            content = downstream_response.raw.read(decode_content=False)
+        except urllib3.exceptions.HTTPError as e:
+            raise requests.exceptions.ConnectionError(e) from e
+        finally:
+            downstream_response.close()
+        excluded_headers = EXCLUDED_RESPONSE_HEADERS - {"content-encoding"}
+    else:
+        content = downstream_response.content
 
-    # --- Return Downstream Response ---
     # Exclude certain headers from being forwarded
-    excluded_headers = [
-        "content-encoding",
-        "content-length",
-        "transfer-encoding",
-        "connection",
-    ]
     response_headers = [
         (k, v)
         for k, v in downstream_response.headers.items()
@@ -267,48 +826,82 @@ def ces_agent_request(request):
     ]
 
     return (
-        downstream_response.content,
+        content,
         downstream_response.status_code,
         response_headers,
     )
 
 
-def refresh_token():
+def get_cached_token(project_id=None):
     """
-    Generates an access token using Application Default Credentials and saves it
-    in a global variable.
+    Returns an access token for the given project, from the cache if possible.
+
+    The scopes come from `OAUTH_SCOPES_BY_PROJECT` when the project has an
+    override, and from `OAUTH_SCOPES` otherwise.
+
+    Args:
+        project_id (str): The project the request is addressed to, if known.
 
     Returns:
-        bool: True on success, False on failure.
+        str or None: The access token, or None on failure.
     """
-    global CURRENT_TOKEN
-    global CURRENT_TOKEN_TIMESTAMP
     try:
         # 1. Get configuration from environment variables.
         # These are set in deploy.sh from values.sh.
         # Scopes are expected to be a comma-separated string.
-        print_log("INFO", "Refreshing access token...")
-        scopes_str = os.environ["OAUTH_SCOPES"]
-        scopes = [scope.strip() for scope in scopes_str.split(",") if scope.strip()]
+        scopes = scopes_by_project.get(project_id) or parse_scopes(
+            os.environ["OAUTH_SCOPES"]
+        )
         if not scopes:
             raise ValueError(
-                "OAUTH_SCOPES environment variable cannot be empty or contain only commas."
+                "OAUTH_SCOPES environment variable cannot be empty or contain "
+                "only commas."
             )
-        print_log("DEBUG", f"Using OAuth scopes: {scopes}")
-
     except KeyError as e:
         print_log("CRITICAL", f"Missing environment variable: {e.args[0]}")
-        return False
+        return None
     except ValueError as e:
         print_log("CRITICAL", f"Invalid environment variable: {e}")
-        return False
+        return None
 
     try:
-        # 2. Generate an access token using Application Default Credentials (ADC).
-        # The ADC are taken from the service account attached to the Cloud Run Job.
-        print_log("DEBUG", "Generating access token using ADC...")
-        credentials, _ = google.auth.default(scopes=scopes)
+        # 2. Load the Application Default Credentials (ADC) for these scopes.
+        # The ADC are taken from the service account attached to the Cloud Function.
+        with _credentials_lock:
+            credentials = _credentials_by_scopes.get(scopes)
+            if credentials is None:
+                print_log("DEBUG", f"Loading ADC for OAuth scopes: {list(scopes)}")
+                credentials, _ = google.auth.default(scopes=list(scopes))
+                _credentials_by_scopes[scopes] = credentials
+    except google.auth.exceptions.DefaultCredentialsError as e:
+        print_log("ERROR", f"A Google Cloud error occurred: {e}")
+        return None
+
+    # Tokens don't depend on the project, which is sent in the
+    # `X-Goog-User-Project` header instead: projects taken from request paths
+    # don't each mint a token.
+    principal = getattr(credentials, "service_account_email", None) or "default"
+    key = (principal, scopes)
+    token = TOKEN_CACHE.get(key, lambda: refresh_token(credentials))
+    log_stats("Token cache", TOKEN_CACHE.stats)
+    return token
+
 
+def refresh_token(credentials):
+    """
+    Generates an access token from the given credentials.
+
+    Args:
+        credentials (google.auth.credentials.Credentials): The ADC to refresh.
+
+    Returns:
+        tuple: (access_token, expiry_timestamp_seconds), or (None, None) on failure.
+    """
+    import google.auth.transport.requests
+    from google.api_core import exceptions
+
+    try:
+        print_log("INFO", "Refreshing access token...")
         # The token needs to be refreshed to be valid.
         credentials.refresh(google.auth.transport.requests.Request())
         access_token = credentials.token
@@ -317,55 +910,84 @@ def refresh_token():
             raise RuntimeError("Failed to retrieve a valid access token.")
         print_log("DEBUG", "Successfully generated access token.")
 
-        # 3. Save the access token and its expiry as global variable.
-        CURRENT_TOKEN = access_token
-        CURRENT_TOKEN_TIMESTAMP = time.time()
-        return True
+        # google-auth reports the expiry as a naive UTC datetime.
+        expiry = credentials.expiry
+        if expiry:
+            expiry = expiry.replace(tzinfo=datetime.timezone.utc).timestamp()
+        return access_token, expiry
     except (
-        google.auth.exceptions.DefaultCredentialsError,
+        google.auth.exceptions.RefreshError,
         exceptions.GoogleAPICallError,
     ) as e:
         print_log("ERROR", f"A Google Cloud error occurred: {e}")
         print_log(
             "ERROR",
-            "Ensure the service account has the required IAM permissions on the secret and/or project.",
+            "Ensure the service account has the required IAM permissions on the "
+            "secret and/or project.",
         )
-        return False
+        return None, None
     except Exception as e:
         print_log("ERROR", f"An unexpected error occurred: {e}")
-        return False
+        return None, None
+
+
+@functools.lru_cache(maxsize=256)
+def resolve_region(agent_location):
+    """Maps a CES location to the specific region that serves it.
+
+    Multi-regions (e.g., 'us', 'eu') are mapped to default specific regions,
+    and specific regions (e.g., 'us-east1') are returned unchanged.
 
+    Args:
+        agent_location (str): The location segment of the agent resource name.
+
+    Returns:
+        str: The specific region.
+    """
+    return MULTI_REGION_MAP.get(agent_location, agent_location)
+
+
+@functools.lru_cache(maxsize=256)
+def get_api_domain(agent_location):
+    """Returns the CES API domain that requests for a location are sent to.
+
+    Locations listed in `CES_REGIONAL_API_DOMAINS` are routed to their regional
+    endpoint; any other location uses the global `CES_API_DOMAIN`.
+
+    Args:
+        agent_location (str): The location segment of the agent resource name.
+
+    Returns:
+        str: The API domain, e.g. 'ces.googleapis.com'.
+    """
+    if agent_location in regional_api_domains:
+        return regional_api_domains[agent_location]
+    return regional_api_domains.get(resolve_region(agent_location), CES_API_DOMAIN)
 
-def check_region(cf_region, agent_id):
+
+@functools.lru_cache(maxsize=256)
+def check_region(cf_region, agent_location):
     """Compares the region of the Cloud Function with the region of the CES agent.
 
     If the regions do not match, a warning is logged, as this can lead to
-    increased latency. This function handles both specific regions (e.g.,
-    'us-east1') and multi-regions (e.g., 'us', 'eu') by mapping them to
-    default specific regions.
+    increased latency. Results are memoized, so the warning is logged once per
+    agent location rather than on every request.
 
     Args:
         cf_region (str): The region of the Cloud Function.
-        agent_id (str): The full resource name of the CES agent, from which
-                        the agent's region is extracted.
-                        e.g., "projects/my-project/locations/us-east1/apps/my-app"
+        agent_location (str): The location of the CES agent, as found in its
+                              resource name. e.g., "us" or "us-east1"
 
     Returns:
-        None. This function only logs a warning if regions do not match.
+        bool: True if the regions match, False otherwise.
     """
-    if not cf_region:
-        return
-
-    multi_region_map = {"eu": "europe-west1", "us": "us-central1"}
-
-    # extract the location from the agent ID: "projects/my-project-id/locations/us/apps/2462faec-84d5-41f8-9df5-34a68b2d7dac/tools/d7fb8be4-732d-491c-9670-00c2700145d9"
-    match = re.search(r"projects/[^/]+/locations/([^/]+)", agent_id)
-    if match:
-        agent_region = match.group(1)
-        agent_region = multi_region_map.get(agent_region, agent_region)
-        # Compare the base region, ignoring zones (e.g., 'us-east1' vs 'us-east1-b')
-        if not agent_region.startswith(cf_region):
-            print_log(
-                "WARNING",
-                f"Cloud Function region '{cf_region}' does not match agent region '{agent_region}'. This may cause increased latency.",
-            )
+    agent_region = resolve_region(agent_location)
+    # Compare the base region, ignoring zones (e.g., 'us-east1' vs 'us-east1-b')
+    if not agent_region.startswith(cf_region):
+        print_log(
+            "WARNING",
+            f"Cloud Function region '{cf_region}' does not match agent region "
+            f"'{agent_region}'. This may cause increased latency.",
+        )
+        return False
+    return True
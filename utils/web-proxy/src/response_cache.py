@@ -0,0 +1,237 @@
+"""In-memory cache for idempotent CES API responses.
+
+Used by `main.ces_agent_request` to serve allow-listed GET requests (e.g. app,
+agent or tool metadata, which is the same for every user of a widget) without
+a round trip to the CES API. See `ResponseCache` for the caching rules.
+"""
+
+import re
+import threading
+import time
+from collections import OrderedDict
+
+# Rough per-entry bookkeeping overhead, counted towards the memory budget.
+ENTRY_OVERHEAD_BYTES = 512
+
+
+class CachedResponse:
+    """A stored upstream response and its freshness deadlines."""
+
+    __slots__ = ("content", "status", "headers", "fresh_until", "stale_until", "size")
+
+    def __init__(self, content, status, headers, fresh_until, stale_until):
+        self.content = content
+        self.status = status
+        self.headers = headers
+        self.fresh_until = fresh_until
+        self.stale_until = stale_until
+        self.size = (
+            len(content)
+            + sum(len(k) + len(v) for k, v in headers)
+            + ENTRY_OVERHEAD_BYTES
+        )
+
+
+class InFlight:
+    """An upstream request shared by the concurrent misses for a key."""
+
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+def parse_cache_control(headers):
+    """Parses the `Cache-Control` header of a response.
+
+    Args:
+        headers (list): The response headers, as (name, value) tuples.
+
+    Returns:
+        dict: Directive names (lowercase) mapped to their value, or None for
+        directives without a value.
+    """
+    directives = {}
+    for name, value in headers:
+        if name.lower() != "cache-control":
+            continue
+        for directive in value.split(","):
+            key, _, argument = directive.strip().partition("=")
+            if key:
+                directives[key.lower()] = argument.strip('"') or None
+    return directives
+
+
+class ResponseCache:
+    """Size-bounded LRU cache of upstream responses.
+
+    - Only 200 responses are stored, and never when the upstream marks them
+      `no-store` or `no-cache`.
+    - Entries are fresh for the upstream `max-age` if present, or for
+      `default_ttl` seconds otherwise.
+    - After that, entries are served stale for up to `stale_ttl` more seconds
+      (or the upstream `stale-while-revalidate`), while a background thread
+      refreshes them.
+    - Concurrent misses for the same key are coalesced into a single upstream
+      request, whose response (even if it can't be stored) or exception is
+      handed to all of them.
+    - The least recently used entries are evicted once the stored responses
+      exceed `max_bytes`.
+
+    Callers are responsible for building keys that keep responses for
+    different principals or origins apart.
+    """
+
+    def __init__(self, path_patterns, max_bytes, default_ttl, stale_ttl, log=None):
+        self.path_patterns = [re.compile(pattern) for pattern in path_patterns]
+        self.max_bytes = max_bytes
+        self.default_ttl = default_ttl
+        self.stale_ttl = stale_ttl
+        self.log = log or (lambda severity, message: None)
+        self.size = 0
+        self.hits = 0
+        self.stale_hits = 0
+        self.coalesced = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # key -> CachedResponse
+        self._inflight = {}  # key -> InFlight
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+    def matches(self, path):
+        """Whether responses for `path` may be cached."""
+        return any(pattern.search(path) for pattern in self.path_patterns)
+
+    def get(self, key, fetch):
+        """Returns the response for `key`, calling `fetch` when needed.
+
+        Args:
+            key (hashable): The cache key.
+            fetch (callable): Performs the upstream request and returns a
+                `(content, status, headers)` tuple. Exceptions are propagated
+                to the callers waiting for it on a miss.
+
+        Returns:
+            tuple: `(content, status, headers, cache_status)`, where
+            cache_status is one of "HIT", "STALE" or "MISS". Requests that
+            waited for another one's upstream request get a "HIT".
+        """
+        leader = False
+        with self._lock:
+            entry = self._lookup(key)
+            if entry and time.time() < entry.fresh_until:
+                self.hits += 1
+                return entry.content, entry.status, entry.headers, "HIT"
+            if entry:
+                self.stale_hits += 1
+                if key not in self._refreshing:
+                    self._refreshing.add(key)
+                    threading.Thread(
+                        target=self._refresh, args=(key, fetch), daemon=True
+                    ).start()
+                return entry.content, entry.status, entry.headers, "STALE"
+            flight = self._inflight.get(key)
+            if flight:
+                self.coalesced += 1
+            else:
+                flight = self._inflight[key] = InFlight()
+                self.misses += 1
+                leader = True
+
+        if not leader:
+            # Wait for the request in flight, whatever its outcome.
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            content, status, headers = flight.result
+            return content, status, headers, "HIT"
+
+        try:
+            flight.result = content, status, headers = fetch()
+            self._store(key, content, status, headers)
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[key]
+            flight.done.set()
+        return content, status, headers, "MISS"
+
+    def stats(self):
+        """Returns the cache counters, for logging."""
+        lookups = self.hits + self.stale_hits + self.coalesced + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self.size,
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "coalesced": self.coalesced,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": (
+                round((lookups - self.misses) / lookups, 3) if lookups else None
+            ),
+        }
+
+    def _lookup(self, key):
+        """Returns the usable (fresh or stale) entry for `key`. Requires `_lock`."""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if time.time() >= entry.stale_until:
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def _refresh(self, key, fetch):
+        """Re-fetches a stale entry. Runs in a background thread."""
+        try:
+            content, status, headers = fetch()
+            self._store(key, content, status, headers)
+        except Exception as e:
+            self.log("WARNING", f"Background refresh of cached response failed: {e}")
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def _store(self, key, content, status, headers):
+        """Stores a response, if it's cacheable, and enforces the size limit."""
+        if status != 200:
+            return
+        directives = parse_cache_control(headers)
+        if "no-store" in directives or "no-cache" in directives:
+            return
+        try:
+            ttl = int(directives.get("max-age") or self.default_ttl)
+            stale_ttl = int(directives.get("stale-while-revalidate") or self.stale_ttl)
+        except ValueError:
+            ttl, stale_ttl = self.default_ttl, self.stale_ttl
+        if ttl <= 0:
+            return
+
+        now = time.time()
+        entry = CachedResponse(
+            content, status, headers, now + ttl, now + ttl + stale_ttl
+        )
+        if entry.size > self.max_bytes:
+            return
+
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = entry
+            self.size += entry.size
+            while self.size > self.max_bytes:
+                evicted_key = next(iter(self._entries))
+                self._remove(evicted_key)
+                self.evictions += 1
+
+    def _remove(self, key):
+        """Removes an entry, if present. Requires `_lock`."""
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry.size
@@ -0,0 +1,138 @@
+"""Compression of the responses sent to the browser.
+
+Used by `main.ces_agent_request`. Agent responses are JSON, which typically
+compresses 4-10x. See `ResponseCompressor`.
+"""
+
+import importlib.util
+import zlib
+
+# Encodings the proxy can produce, in order of preference. Brotli is only
+# used when the optional `brotli` package is installed.
+ENCODINGS = ("br", "gzip") if importlib.util.find_spec("brotli") else ("gzip",)
+
+# Content types worth compressing (images and audio already are).
+COMPRESSIBLE_TYPES = ("application/json", "text/", "application/javascript")
+
+
+def parse_accept_encoding(header):
+    """Returns the encodings of an `Accept-Encoding` header with their q-value.
+
+    Args:
+        header (str): The header value, e.g. `gzip, deflate, br;q=0.9`.
+
+    Returns:
+        dict: The q-value of each encoding (lowercase), including `*`.
+    """
+    accepted = {}
+    for item in (header or "").split(","):
+        coding, _, params = item.strip().partition(";")
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params.split(";"):
+            name, _, value = param.strip().partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[coding] = q
+    return accepted
+
+
+def accepts(header, encoding):
+    """Whether a client sending `Accept-Encoding: header` accepts `encoding`."""
+    accepted = parse_accept_encoding(header)
+    return accepted.get(encoding.lower(), accepted.get("*", 0.0)) > 0
+
+
+def negotiate(header):
+    """Returns the preferred encoding for a client, or None for identity."""
+    accepted = parse_accept_encoding(header)
+    best, best_q = None, 0.0
+    for encoding in ENCODINGS:
+        q = accepted.get(encoding, accepted.get("*", 0.0))
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
+
+
+def is_compressible(content_type):
+    content_type = (content_type or "").lower()
+    return content_type.startswith(COMPRESSIBLE_TYPES) or "+json" in content_type
+
+
+class ResponseCompressor:
+    """Compresses responses for the encodings their client accepts.
+
+    - Only responses with a compressible content type and at least
+      `min_bytes` of content are compressed, with gzip at `gzip_level`, or
+      Brotli at `brotli_quality` when available and preferred by the client.
+    - Responses that already have a `Content-Encoding` (passed through from
+      the CES API) are not compressed again.
+    - `Vary: Accept-Encoding` is added to every compressible response, so
+      that caches between the proxy and the browser keep the variants apart.
+    """
+
+    def __init__(self, min_bytes, gzip_level, brotli_quality):
+        self.min_bytes = min_bytes
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+        self.responses = 0
+        self.compressed = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def compress(self, content, headers, accept_encoding):
+        """Returns the content and headers to send to the client.
+
+        Args:
+            content (bytes): The response content.
+            headers (list): The response headers, as (name, value) tuples.
+            accept_encoding (str): The `Accept-Encoding` header of the request.
+
+        Returns:
+            tuple: (content, headers), compressed if worthwhile.
+        """
+        content_type = encoded = None
+        for name, value in headers:
+            name = name.lower()
+            if name == "content-encoding":
+                encoded = value
+            elif name == "content-type":
+                content_type = value
+        if not is_compressible(content_type):
+            return content, headers
+        headers = headers + [("Vary", "Accept-Encoding")]
+        if encoded:
+            return content, headers
+        self.responses += 1
+        if len(content) < self.min_bytes:
+            return content, headers
+        encoding = negotiate(accept_encoding)
+        if encoding is None:
+            return content, headers
+
+        if encoding == "br":
+            import brotli
+
+            compressed = brotli.compress(
+                content, mode=brotli.MODE_TEXT, quality=self.brotli_quality
+            )
+        else:
+            compressed = zlib.compress(content, self.gzip_level, wbits=31)
+        self.compressed += 1
+        self.bytes_in += len(content)
+        self.bytes_out += len(compressed)
+        return compressed, headers + [("Content-Encoding", encoding)]
+
+    def stats(self):
+        """Returns the compression counters, for logging."""
+        return {
+            "responses": self.responses,
+            "compressed": self.compressed,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+        }
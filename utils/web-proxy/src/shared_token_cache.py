@@ -0,0 +1,158 @@
+"""Token cache shared by the worker processes of an instance.
+
+Used by `token_cache.TokenCache` when `SHARED_TOKEN_CACHE_PATH` is set.
+Without it, each gunicorn (or uvicorn) worker mints and refreshes its own
+tokens. See `SharedTokenStore`.
+
+web-proxy and token-broker each have a copy of this module, as they're
+deployed from their own `src` directory: keep the copies identical
+(`web-proxy/tests/test_shared_modules.py` checks it).
+"""
+
+import fcntl
+import json
+import os
+import time
+
+
+class SharedTokenStore:
+    """Tokens stored in a file, locked with `flock`, shared by local processes.
+
+    - The file should be on a memory-backed filesystem, e.g. `/dev/shm`. It's
+      created readable by the current user only, and not used if anyone else
+      could have written to it.
+    - It's only read when a process doesn't have a valid token in memory. If
+      the file has none either, the process takes an exclusive lock, checks
+      again, mints the token and writes it: the other processes wait for it
+      instead of minting their own (for at most `lock_timeout` seconds).
+    - It's rewritten in place, under the exclusive lock: replacing it with
+      `os.replace` would leave the processes that opened the old file locking
+      a different one. A file left half-written, e.g. by a process killed
+      while writing it, is treated as empty and overwritten.
+    - On any other error, tokens are minted by the process as if there was no
+      shared cache, and the file is not used for `retry_after` seconds.
+    """
+
+    def __init__(self, path, lock_timeout=10, retry_after=60, log=None):
+        self.path = path
+        self.lock_timeout = lock_timeout
+        self.retry_after = retry_after
+        self.log = log or (lambda severity, message: None)
+        self.hits = 0
+        self.refreshes = 0
+        self.errors = 0
+        self._disabled_until = 0
+
+    def get(self, key, mint):
+        """Returns the shared token for `key`, calling `mint` if there is none.
+
+        Args:
+            key: The cache key. Must be JSON-serializable.
+            mint (callable): Returns a `(token, valid_until)` tuple, where the
+                token is JSON-serializable and valid_until a POSIX timestamp.
+                A falsy token signals a failure.
+
+        Returns:
+            tuple: (token, valid_until), or (None, None) if minting failed.
+        """
+        if time.time() < self._disabled_until:
+            return mint()
+        name = json.dumps(key)
+        minted = None
+        try:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            with os.fdopen(fd, "r+") as f:
+                stat = os.fstat(fd)
+                if stat.st_uid != os.getuid() or stat.st_mode & 0o022:
+                    raise PermissionError(f"{self.path} is writable by other users")
+
+                self._lock(fd, fcntl.LOCK_SH)
+                try:
+                    entry = (self._read(f) or {}).get(name)
+                finally:
+                    fcntl.flock(fd, fcntl.LOCK_UN)
+                if entry and time.time() < entry[1]:
+                    self.hits += 1
+                    return tuple(entry)
+
+                self._lock(fd, fcntl.LOCK_EX)
+                try:
+                    # Another process may have refreshed it while we waited.
+                    entries = self._read(f)
+                    if entries is None:
+                        self.log(
+                            "WARNING",
+                            f"Shared token cache {self.path} is corrupt, "
+                            "overwriting it.",
+                        )
+                        entries = {}
+                    entry = entries.get(name)
+                    now = time.time()
+                    if entry and now < entry[1]:
+                        self.hits += 1
+                        return tuple(entry)
+                    minted = mint()
+                    if not minted[0]:
+                        return minted
+                    self.refreshes += 1
+                    entries = {k: v for k, v in entries.items() if now < v[1]}
+                    entries[name] = list(minted)
+                    content = json.dumps(entries)
+                    f.seek(0)
+                    f.truncate()
+                    f.write(content)
+                    f.flush()
+                finally:
+                    fcntl.flock(fd, fcntl.LOCK_UN)
+            return minted
+        except (OSError, ValueError, TypeError, IndexError) as e:
+            self.errors += 1
+            self._disabled_until = time.time() + self.retry_after
+            self.log(
+                "WARNING",
+                f"Shared token cache {self.path} unavailable, "
+                f"using the per-process cache for {self.retry_after}s: {e}",
+            )
+            return minted or mint()
+
+    def _read(self, f):
+        """Returns the entries of the file, as `{name: [token, valid_until]}`.
+
+        Returns None if the file can't be decoded, and skips malformed entries.
+        """
+        f.seek(0)
+        content = f.read()
+        if not content:
+            return {}
+        try:
+            entries = json.loads(content)
+        except ValueError:
+            return None
+        if not isinstance(entries, dict):
+            return None
+        return {
+            name: entry
+            for name, entry in entries.items()
+            if isinstance(entry, list)
+            and len(entry) == 2
+            and isinstance(entry[1], (int, float))
+        }
+
+    def _lock(self, fd, operation):
+        """Takes the `LOCK_SH` or `LOCK_EX` lock, within `lock_timeout` seconds.
+
+        Readers time out too, e.g. behind a process stuck minting a token.
+        """
+        deadline = time.monotonic() + self.lock_timeout
+        while True:
+            try:
+                fcntl.flock(fd, operation | fcntl.LOCK_NB)
+                return
+            except BlockingIOError:
+                if time.monotonic() > deadline:
+                    raise TimeoutError("Timed out waiting for the token cache lock")
+                time.sleep(0.01)
+
+    def stats(self):
+        """Returns the shared cache counters, for logging."""
+        return {"hits": self.hits, "refreshes": self.refreshes, "errors": self.errors}
@@ -0,0 +1,315 @@
+"""HTTP client for the CES API with retries, hedging and a retry budget.
+
+Used by `main.forward_request`. See `UpstreamClient` for the retry rules.
+"""
+
+import http.cookiejar
+import queue
+import random
+import threading
+import time
+from collections import deque
+
+# Methods that are safe to send more than once.
+IDEMPOTENT_METHODS = frozenset(["GET", "HEAD", "OPTIONS"])
+
+# Upstream statuses that are worth retrying.
+RETRYABLE_STATUS_CODES = frozenset([429, 502, 503, 504])
+
+# Seconds each thread spent opening connections, see `take_connect_time`.
+_connect_time = threading.local()
+
+
+def take_connect_time():
+    """Returns the seconds the current thread spent opening connections.
+
+    Covers DNS resolution, TCP and TLS handshakes since the previous call, so
+    0 when the requests reused pooled connections. Connections opened for
+    hedged requests, in other threads, are not counted.
+    """
+    seconds = getattr(_connect_time, "seconds", 0.0)
+    _connect_time.seconds = 0.0
+    return seconds
+
+
+def timed_adapter():
+    """Returns a `requests` adapter that times the connections it opens."""
+    import requests.adapters
+    from urllib3.connection import HTTPConnection, HTTPSConnection
+    from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+    def timed(connection_class):
+        class TimedConnection(connection_class):
+            def connect(self):
+                start = time.perf_counter()
+                try:
+                    super().connect()
+                finally:
+                    _connect_time.seconds = (
+                        getattr(_connect_time, "seconds", 0.0)
+                        + time.perf_counter()
+                        - start
+                    )
+
+        return TimedConnection
+
+    class TimedHTTPConnectionPool(HTTPConnectionPool):
+        ConnectionCls = timed(HTTPConnection)
+
+    class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+        ConnectionCls = timed(HTTPSConnection)
+
+    class TimedAdapter(requests.adapters.HTTPAdapter):
+        def init_poolmanager(self, *args, **kwargs):
+            super().init_poolmanager(*args, **kwargs)
+            self.poolmanager.pool_classes_by_scheme = {
+                "http": TimedHTTPConnectionPool,
+                "https": TimedHTTPSConnectionPool,
+            }
+
+    return TimedAdapter()
+
+
+class RetryBudget:
+    """Limits retries and hedged requests to a fraction of the traffic.
+
+    Over a sliding window of `window` seconds, at most `minimum` extra
+    attempts plus `ratio` extra attempts per request are allowed. This keeps
+    the proxy from multiplying the load on an upstream that is already
+    struggling.
+    """
+
+    def __init__(self, ratio, minimum, window=10):
+        self.ratio = ratio
+        self.minimum = minimum
+        self.window = window
+        self._requests = deque()
+        self._retries = deque()
+        self._lock = threading.Lock()
+
+    def _prune(self, now):
+        """Drops events older than the window. Requires `_lock`."""
+        for events in (self._requests, self._retries):
+            while events and events[0] < now - self.window:
+                events.popleft()
+
+    def record_request(self):
+        """Records a request, which earns `ratio` retries."""
+        now = time.monotonic()
+        with self._lock:
+            self._prune(now)
+            self._requests.append(now)
+
+    def withdraw(self):
+        """Returns whether an extra attempt is allowed, and records it if so."""
+        now = time.monotonic()
+        with self._lock:
+            self._prune(now)
+            if len(self._retries) >= self.minimum + self.ratio * len(self._requests):
+                return False
+            self._retries.append(now)
+            return True
+
+
+class UpstreamClient:
+    """Sends requests to the CES API over a shared connection pool.
+
+    - Requests with an idempotent method that fail with a connection error
+      (including a connect timeout) or a retryable status are retried up to
+      `max_retries` times, with exponential backoff and full jitter starting
+      at `backoff` seconds. Read timeouts are not retried: the upstream may
+      still be working on the request, and a retry would wait as long again.
+    - If `hedging` is set, an idempotent request that hasn't completed after
+      the 95th percentile of recent latencies (and at least `hedge_min_delay`
+      seconds) is sent a second time, and the first response wins; the other
+      one is closed.
+    - Retries and hedged requests are drawn from a shared `RetryBudget`.
+      Non-idempotent requests are sent exactly once.
+    """
+
+    def __init__(
+        self,
+        timeout,
+        max_retries,
+        backoff,
+        hedging,
+        hedge_min_delay,
+        retry_budget,
+        log=None,
+    ):
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.hedging = hedging
+        self.hedge_min_delay = hedge_min_delay
+        self.retry_budget = retry_budget
+        self.log = log or (lambda severity, message: None)
+        self.requests = 0
+        self.retries = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.budget_exhausted = 0
+        self._latencies = deque(maxlen=200)
+        # Guards the counters and the latencies, updated by concurrent requests.
+        self._lock = threading.Lock()
+        self._session = None
+        self._session_lock = threading.Lock()
+
+    @property
+    def session(self):
+        """The `requests.Session`, created on first use."""
+        if self._session is None:
+            with self._session_lock:
+                if self._session is None:
+                    import requests
+
+                    session = requests.Session()
+                    adapter = timed_adapter()
+                    session.mount("https://", adapter)
+                    session.mount("http://", adapter)
+                    # The session is shared by all callers: never store cookies.
+                    session.cookies.set_policy(
+                        http.cookiejar.DefaultCookiePolicy(allowed_domains=[])
+                    )
+                    self._session = session
+        return self._session
+
+    def request(self, method, url, **kwargs):
+        """Sends a request, retrying and hedging it when allowed.
+
+        Args:
+            method (str): The HTTP method.
+            url (str): The URL.
+            **kwargs: Passed to `requests.Session.request`.
+
+        Returns:
+            requests.Response: The response. A retryable status is returned as
+            is once no more retries are allowed.
+
+        Raises:
+            requests.exceptions.RequestException: If the last attempt failed.
+        """
+        import requests
+
+        idempotent = method in IDEMPOTENT_METHODS
+        self._count("requests")
+        self.retry_budget.record_request()
+        attempt = 0
+        while True:
+            error = None
+            try:
+                if idempotent and self.hedging:
+                    response = self._send_hedged(method, url, **kwargs)
+                else:
+                    response = self._send(method, url, **kwargs)
+                if response.status_code not in RETRYABLE_STATUS_CODES:
+                    return response
+            except requests.ConnectionError as e:
+                # Also covers `ConnectTimeout`, but not `ReadTimeout`.
+                response, error = None, e
+
+            if not idempotent or attempt >= self.max_retries:
+                break
+            if not self.retry_budget.withdraw():
+                self._count("budget_exhausted")
+                self.log("WARNING", "Upstream retry budget exhausted, not retrying.")
+                break
+            attempt += 1
+            self._count("retries")
+            delay = random.uniform(0, self.backoff * 2 ** (attempt - 1))
+            self.log(
+                "WARNING",
+                f"Upstream request failed ({error or response.status_code}), "
+                f"retry {attempt}/{self.max_retries} in {delay:.3f}s.",
+            )
+            time.sleep(delay)
+
+        if error:
+            raise error
+        return response
+
+    def stats(self):
+        """Returns the client counters, for logging."""
+        with self._lock:
+            stats = {
+                "requests": self.requests,
+                "retries": self.retries,
+                "hedges": self.hedges,
+                "hedge_wins": self.hedge_wins,
+                "budget_exhausted": self.budget_exhausted,
+            }
+        stats["hedge_delay"] = self.hedge_delay()
+        return stats
+
+    def _count(self, counter):
+        """Increments one of the counters."""
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def hedge_delay(self):
+        """Returns how long to wait before hedging, or None to not hedge yet."""
+        with self._lock:
+            latencies = sorted(self._latencies)
+        if len(latencies) < 20:
+            return None
+        return max(self.hedge_min_delay, latencies[int(len(latencies) * 0.95)])
+
+    def _send(self, method, url, **kwargs):
+        """Sends a single attempt and records its latency."""
+        kwargs.setdefault("timeout", self.timeout)
+        start = time.monotonic()
+        response = self.session.request(method, url, **kwargs)
+        if response.status_code not in RETRYABLE_STATUS_CODES:
+            with self._lock:
+                self._latencies.append(time.monotonic() - start)
+        return response
+
+    def _send_hedged(self, method, url, **kwargs):
+        """Sends an attempt, and a second one if the first is slow."""
+        delay = self.hedge_delay()
+        if delay is None:
+            return self._send(method, url, **kwargs)
+
+        results = queue.Queue()
+        settled = threading.Lock()
+        done = False
+
+        def attempt(hedged):
+            try:
+                result = (hedged, self._send(method, url, **kwargs), None)
+            except Exception as e:
+                result = (hedged, None, e)
+            with settled:
+                if not done:
+                    results.put(result)
+                    return
+            # The other attempt won: release this one's connection.
+            if result[1] is not None:
+                result[1].close()
+
+        threading.Thread(target=attempt, args=(False,), daemon=True).start()
+        try:
+            hedged, response, error = results.get(timeout=delay)
+        except queue.Empty:
+            if not self.retry_budget.withdraw():
+                self._count("budget_exhausted")
+                hedged, response, error = results.get()
+            else:
+                self._count("hedges")
+                threading.Thread(target=attempt, args=(True,), daemon=True).start()
+                hedged, response, error = results.get()
+                if error is not None:
+                    # Fall back to the other attempt.
+                    hedged, response, error = results.get()
+                if hedged and error is None:
+                    self._count("hedge_wins")
+        with settled:
+            done = True
+            # The other attempt may have completed in the meantime.
+            while not results.empty():
+                _, other, _ = results.get()
+                if other is not None:
+                    other.close()
+        if error is not None:
+            raise error
+        return response
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The service's modules are imported as top-level modules, as when deployed.
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
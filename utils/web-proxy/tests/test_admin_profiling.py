@@ -0,0 +1,34 @@
+import admin_profiling
+import flask
+import pytest
+
+app = flask.Flask(__name__)
+
+
+@pytest.fixture(autouse=True)
+def admin_token(monkeypatch):
+    monkeypatch.setattr(admin_profiling, "ADMIN_TOKEN", "secret")
+
+
+def admin_request(path, token="secret"):
+    with app.test_request_context(path, headers={"X-Admin-Token": token}):
+        return admin_profiling.handle_admin_request(flask.request, lambda *args: None)
+
+
+def test_token_is_required():
+    assert admin_request("/admin/threads", token="other")[1] == 401
+
+
+@pytest.mark.parametrize("seconds", ["-1", "0", "nan", "inf", "31", "five"])
+def test_invalid_seconds_are_rejected(seconds):
+    assert admin_request(f"/admin/stacks?seconds={seconds}")[1] == 400
+
+
+@pytest.mark.parametrize("query", ["interval_ms=nan", "limit=0"])
+def test_invalid_parameters_are_rejected(query):
+    assert admin_request(f"/admin/memory?seconds=1&{query}")[1] == 400
+
+
+def test_stacks_are_sampled():
+    response = admin_request("/admin/stacks?seconds=0.05&interval_ms=5")
+    assert response[1] == 200
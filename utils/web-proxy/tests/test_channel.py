@@ -0,0 +1,112 @@
+import json
+import socket
+import threading
+import time
+
+import flask
+import pytest
+from channel import ChannelRegistry
+from websockets.sync.server import serve
+
+SESSION = "projects/p/locations/us/apps/a/sessions/s"
+
+
+@pytest.fixture
+def ces():
+    """A fake BidiRunSession endpoint, slow to accept connections."""
+    received = []
+
+    def process_request(connection, request):
+        time.sleep(0.2)
+
+    def handler(websocket):
+        for message in websocket:
+            received.append(message)
+
+    with serve(handler, "127.0.0.1", 0, process_request=process_request) as server:
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        port = server.socket.getsockname()[1]
+        yield f"ws://127.0.0.1:{port}", received
+        server.shutdown()
+
+
+def registry(max_channels):
+    return ChannelRegistry(
+        max_channels, idle_timeout=60, keepalive=15, connect_timeout=5
+    )
+
+
+def open_channel(channels, url):
+    return channels.open(url, {}, SESSION, {"config": {"session": SESSION}})
+
+
+def test_concurrent_opens_respect_the_limit(ces):
+    url, _ = ces
+    channels = registry(2)
+    responses = []
+    threads = [
+        threading.Thread(target=lambda: responses.append(open_channel(channels, url)))
+        for _ in range(5)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    opened = [r for r in responses if isinstance(r, flask.Response)]
+    assert len(opened) == 2
+    assert sorted(r[1] for r in responses if isinstance(r, tuple)) == [503] * 3
+    assert channels.stats()["open"] == 2
+    for response in opened:
+        response.close()
+    assert channels.stats()["open"] == 0
+
+
+def test_failed_opens_release_their_slot():
+    with socket.socket() as unused:
+        unused.bind(("127.0.0.1", 0))
+        port = unused.getsockname()[1]
+    channels = registry(1)
+    assert open_channel(channels, f"ws://127.0.0.1:{port}")[1] == 502
+    assert open_channel(channels, f"ws://127.0.0.1:{port}")[1] == 502
+    assert channels.rejected == 0
+
+
+def channel_id(response):
+    event = next(iter(response.response))
+    return json.loads(event.decode().split("data: ")[1])["channel"]
+
+
+def test_messages_are_sent_to_the_ces_api(ces):
+    url, received = ces
+    channels = registry(1)
+    response = open_channel(channels, url)
+    message = {"realtimeInput": {"text": "Grüß dich"}}
+    data = json.dumps(message, ensure_ascii=False).encode()
+    assert channels.send(channel_id(response), SESSION, data)[1] == 202
+    response.close()
+    assert [json.loads(m) for m in received] == [
+        {"config": {"session": SESSION}},
+        message,
+    ]
+
+
+@pytest.mark.parametrize(
+    "data",
+    [
+        '{"realtimeInput": {"text": "Hi"}}'.encode("utf-16"),
+        b"[1, 2]",
+        b"not json",
+    ],
+    ids=["utf-16", "array", "not-json"],
+)
+def test_invalid_messages_are_rejected(ces, data):
+    url, _ = ces
+    channels = registry(1)
+    response = open_channel(channels, url)
+    assert channels.send(channel_id(response), SESSION, data)[1] == 400
+    response.close()
+
+
+def test_unknown_channels_are_not_found():
+    assert registry(1).send("nope", SESSION, b"{}")[1] == 404
@@ -0,0 +1,57 @@
+import flask
+import main
+import pytest
+from token_cache import TokenCache
+
+
+class Credentials:
+    service_account_email = "proxy@example.iam.gserviceaccount.com"
+
+
+@pytest.fixture
+def mints(monkeypatch):
+    """Fake ADC, and the list of tokens minted with them."""
+    mints = []
+
+    def refresh_token(credentials):
+        mints.append(credentials)
+        return f"token-{len(mints)}", None
+
+    monkeypatch.setenv("OAUTH_SCOPES", "https://www.googleapis.com/auth/cloud-platform")
+    monkeypatch.setattr(
+        main.google.auth, "default", lambda scopes: (Credentials(), None)
+    )
+    monkeypatch.setattr(main, "_credentials_by_scopes", {})
+    monkeypatch.setattr(main, "refresh_token", refresh_token)
+    monkeypatch.setattr(main, "TOKEN_CACHE", TokenCache(2, 300, 60))
+    return mints
+
+
+def test_projects_share_a_token(mints):
+    tokens = {main.get_cached_token(f"project-{i}") for i in range(100)}
+    assert tokens == {"token-1"}
+    assert len(mints) == 1
+    stats = main.TOKEN_CACHE.stats()
+    assert (stats["entries"], stats["evictions"], stats["hit_rate"]) == (1, 0, 0.99)
+
+
+def test_project_is_sent_as_quota_project(mints, monkeypatch):
+    sent = []
+
+    def forward_request(method, url, headers, *args):
+        sent.append(dict(headers))
+        return b"{}", 200, [("Content-Type", "application/json")]
+
+    monkeypatch.setattr(main, "forward_request", forward_request)
+    monkeypatch.setattr(main, "region_lookup_started", True)
+    app = flask.Flask(__name__)
+    path = "/projects/my-project/locations/us/apps/my-app/sessions/s1:runSession"
+    with app.test_request_context(
+        path, method="POST", data=b"{}", headers={"X-Goog-User-Project": "other"}
+    ):
+        response = main.ces_agent_request(flask.request)
+    assert response[1] == 200
+    assert sent[0]["Authorization"] == "Bearer token-1"
+    assert [v for k, v in sent[0].items() if k.lower() == "x-goog-user-project"] == [
+        "my-project"
+    ]
@@ -0,0 +1,107 @@
+import re
+
+import flask
+import main
+import pytest
+from requests.structures import CaseInsensitiveDict
+
+PATH = "/projects/p/locations/us/apps/a/sessions/s:runSession"
+
+
+@pytest.fixture
+def origins(monkeypatch):
+    """An allowlist with an origin and a pattern, and empty memoization."""
+    allowed = ["https://app.example.com", re.compile(r"https://[a-z]+\.example\.org")]
+    monkeypatch.setattr(main, "authorized_origins", allowed)
+    monkeypatch.setattr(
+        main,
+        "cors_headers_by_origin",
+        {"https://app.example.com": main.build_cors_headers("https://app.example.com")},
+    )
+    main.get_cors_headers.cache_clear()
+    yield
+    main.get_cors_headers.cache_clear()
+
+
+@pytest.mark.parametrize(
+    "origin",
+    ["https://app.example.com", "https://docs.example.org", "http://localhost:5173"],
+)
+def test_authorized_origins_get_cors_headers(origins, origin):
+    headers = dict(main.get_cors_headers(origin))
+    assert headers["Access-Control-Allow-Origin"] == origin
+    assert "Authorization" in headers["Access-Control-Allow-Headers"]
+
+
+@pytest.mark.parametrize(
+    "origin", ["https://evil.example.com", "https://app.example.com.evil", "null"]
+)
+def test_other_origins_get_no_cors_headers(origins, origin):
+    assert main.get_cors_headers(origin) == ()
+
+
+def test_cors_headers_are_prebuilt_and_memoized(origins):
+    prebuilt = main.cors_headers_by_origin["https://app.example.com"]
+    assert main.get_cors_headers("https://app.example.com") is prebuilt
+    first = main.get_cors_headers("http://localhost:3000")
+    assert main.get_cors_headers("http://localhost:3000") is first
+    assert main.get_cors_headers.cache_info().hits == 1
+
+
+def test_dropped_request_headers_are_not_forwarded(monkeypatch):
+    sent = []
+
+    def forward_request(method, url, headers, *args):
+        sent.append(headers)
+        return b"{}", 200, [("Content-Type", "application/json")]
+
+    monkeypatch.setattr(main, "forward_request", forward_request)
+    monkeypatch.setattr(main, "region_lookup_started", True)
+    monkeypatch.setattr(main, "CF_REGION", None)
+    app = flask.Flask(__name__)
+    with app.test_request_context(
+        PATH,
+        method="POST",
+        data=b"{}",
+        headers={
+            "Authorization": "Bearer t",
+            "Content-Type": "application/json",
+            "Cookie": "session=secret",
+            "Connection": "keep-alive",
+            "Accept-Encoding": "gzip, br",
+            "X-Forwarded-For": "203.0.113.7",
+            "X-Custom": "kept",
+        },
+    ):
+        assert main.ces_agent_request(flask.request)[1] == 200
+    headers = {name.lower(): value for name, value in sent[0].items()}
+    assert not main.DROPPED_REQUEST_HEADERS.intersection(headers) - {"host"}
+    assert headers["host"] == main.get_api_domain("us")
+    assert headers["authorization"] == "Bearer t"
+    assert headers["x-custom"] == "kept"
+    assert headers["content-type"] == "application/json"
+
+
+class Response:
+    status_code = 200
+    content = b"{}"
+
+    def __init__(self, headers):
+        self.headers = CaseInsensitiveDict(headers)
+
+
+def test_hop_by_hop_response_headers_are_excluded(monkeypatch):
+    upstream_headers = {
+        "Content-Type": "application/json",
+        "Content-Length": "2",
+        "Content-Encoding": "gzip",
+        "Transfer-Encoding": "chunked",
+        "Connection": "keep-alive",
+        "X-Custom": "kept",
+    }
+    monkeypatch.setattr(
+        main.UPSTREAM, "request", lambda *args, **kwargs: Response(upstream_headers)
+    )
+    _, status, headers = main.forward_request("GET", "https://ces/", {})
+    assert status == 200
+    assert headers == [("Content-Type", "application/json"), ("X-Custom", "kept")]
@@ -0,0 +1,68 @@
+import base64
+import io
+import json
+import threading
+
+import pytest
+
+PIL = pytest.importorskip("PIL.Image")
+
+from image_resize import ImageDownscaler  # noqa: E402
+
+
+def image_body(width, height):
+    img = PIL.frombytes(
+        "RGB", (width, height), bytes(range(256)) * (width * height * 3 // 256 + 1)
+    )
+    output = io.BytesIO()
+    img.save(output, "PNG")
+    data = base64.b64encode(output.getvalue()).decode()
+    return json.dumps({"inputs": [{"image": {"data": data, "mimeType": "image/png"}}]})
+
+
+def test_large_image_is_downscaled():
+    downscaler = ImageDownscaler(64, quality=80, min_bytes=0, workers=1)
+    body = downscaler.process(image_body(512, 512).encode())
+    image = json.loads(body)["inputs"][0]["image"]
+    assert image["mimeType"] == "image/jpeg"
+    with PIL.open(io.BytesIO(base64.b64decode(image["data"]))) as img:
+        assert max(img.size) == 64
+    assert downscaler.stats()["resized"] == 1
+
+
+def test_invalid_image_is_forwarded():
+    downscaler = ImageDownscaler(64, quality=80, min_bytes=0, workers=1)
+    data = base64.b64encode(b"not an image").decode()
+    body = json.dumps({"image": {"data": data}}).encode()
+    assert downscaler.process(body) is body
+
+
+def test_unexpected_error_forwards_the_image(monkeypatch):
+    downscaler = ImageDownscaler(64, quality=80, min_bytes=0, workers=1)
+
+    def fail(*args, **kwargs):
+        raise RuntimeError("Pillow bug")
+
+    monkeypatch.setattr(PIL, "open", fail)
+    body = image_body(128, 128).encode()
+    assert downscaler.process(body) is body
+
+
+def test_images_over_max_pending_are_forwarded():
+    downscaler = ImageDownscaler(
+        64, quality=80, min_bytes=0, workers=1, max_pending=1, timeout=0.05
+    )
+    release = threading.Event()
+    original = downscaler._downscale
+    downscaler._downscale = lambda image: release.wait() and original(image)
+    body = image_body(512, 512).encode()
+    try:
+        # The first image times out, and keeps the worker busy.
+        assert downscaler.process(body) is body
+        assert downscaler.process(body) is body
+        assert downscaler.stats()["skipped"] == 1
+    finally:
+        release.set()
+    downscaler._pool.submit(lambda: None).result()
+    downscaler._downscale = original
+    assert downscaler.process(body) is not body
@@ -0,0 +1,43 @@
+import main
+import pytest
+
+
+@pytest.fixture
+def logs(monkeypatch):
+    """The logged messages, and the clock of `log_stats`."""
+    logged = []
+    clock = [1000.0]
+    monkeypatch.setattr(
+        main, "print_log", lambda severity, message: logged.append(message)
+    )
+    monkeypatch.setattr(main.time, "monotonic", lambda: clock[0])
+    monkeypatch.setattr(main, "_stats_logged", {})
+    monkeypatch.setattr(main, "STATS_LOG_INTERVAL", 60)
+    return logged, clock
+
+
+def test_stats_are_logged_at_most_once_per_interval(logs):
+    logged, clock = logs
+    counter = {"hits": 0}
+    for _ in range(100):
+        counter["hits"] += 1
+        main.log_stats("Token cache", lambda: dict(counter))
+    assert logged == ["Token cache stats: {'hits': 1}"]
+    clock[0] += 60
+    main.log_stats("Token cache", lambda: dict(counter))
+    assert logged[-1] == "Token cache stats: {'hits': 100}"
+
+
+def test_unchanged_stats_are_not_logged_again(logs):
+    logged, clock = logs
+    main.log_stats("Upstream", lambda: {"requests": 1})
+    clock[0] += 600
+    main.log_stats("Upstream", lambda: {"requests": 1})
+    assert len(logged) == 1
+
+
+def test_components_are_logged_independently(logs):
+    logged, _ = logs
+    main.log_stats("Upstream", lambda: {"requests": 1})
+    main.log_stats("Response cache", lambda: {"hits": 1})
+    assert len(logged) == 2
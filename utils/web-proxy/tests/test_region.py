@@ -0,0 +1,133 @@
+import threading
+
+import flask
+import main
+import pytest
+import requests
+
+
+@pytest.fixture(autouse=True)
+def region_caches(monkeypatch):
+    """Regional domains for `us-central1` and `eu`, and empty memoization."""
+    monkeypatch.setattr(
+        main,
+        "regional_api_domains",
+        {"us-central1": "us-central1-ces.example.com", "eu": "eu-ces.example.com"},
+    )
+    monkeypatch.setattr(main, "CES_API_DOMAIN", "ces.example.com")
+    for function in (main.resolve_region, main.get_api_domain, main.check_region):
+        function.cache_clear()
+    yield
+    for function in (main.resolve_region, main.get_api_domain, main.check_region):
+        function.cache_clear()
+
+
+@pytest.mark.parametrize(
+    "location,region",
+    [("us", "us-central1"), ("eu", "europe-west1"), ("us-east1", "us-east1")],
+)
+def test_resolve_region(location, region):
+    assert main.resolve_region(location) == region
+
+
+@pytest.mark.parametrize(
+    "location,domain",
+    [
+        # Multi-regions use the domain of their default region...
+        ("us", "us-central1-ces.example.com"),
+        ("us-central1", "us-central1-ces.example.com"),
+        # ...unless they have a domain of their own.
+        ("eu", "eu-ces.example.com"),
+        ("europe-west1", "ces.example.com"),
+        ("asia-east1", "ces.example.com"),
+    ],
+)
+def test_get_api_domain(location, domain):
+    assert main.get_api_domain(location) == domain
+
+
+def test_requests_are_sent_to_the_regional_domain(monkeypatch):
+    urls = []
+
+    def forward_request(method, url, headers, *args):
+        urls.append(url)
+        return b"{}", 200, [("Content-Type", "application/json")]
+
+    monkeypatch.setattr(main, "forward_request", forward_request)
+    monkeypatch.setattr(main, "region_lookup_started", True)
+    monkeypatch.setattr(main, "CF_REGION", None)
+    app = flask.Flask(__name__)
+    for location in ("us", "asia-east1"):
+        path = f"/projects/p/locations/{location}/apps/a/sessions/s:runSession"
+        with app.test_request_context(
+            path, method="POST", data=b"{}", headers={"Authorization": "Bearer t"}
+        ):
+            assert main.ces_agent_request(flask.request)[1] == 200
+    assert urls[0].startswith("https://us-central1-ces.example.com/v1/projects/p/")
+    assert urls[1].startswith("https://ces.example.com/v1/projects/p/")
+
+
+def test_check_region_warns_once_per_location(monkeypatch):
+    logged = []
+    monkeypatch.setattr(
+        main, "print_log", lambda severity, message: logged.append(severity)
+    )
+    assert main.check_region("us-central1", "us") is True
+    assert main.check_region("us-central1-b", "us-central1-b") is True
+    for _ in range(3):
+        assert main.check_region("us-central1", "eu") is False
+    assert logged == ["WARNING"]
+
+
+class MetadataResponse:
+    text = "projects/123456/regions/europe-west1"
+
+    def raise_for_status(self):
+        pass
+
+
+def test_region_from_the_metadata_server(monkeypatch):
+    monkeypatch.delenv("DISABLE_REGION_CHECK", raising=False)
+    monkeypatch.setattr(requests, "get", lambda *args, **kwargs: MetadataResponse())
+    assert main.find_current_region() == "europe-west1"
+
+
+def test_region_falls_back_to_the_environment(monkeypatch):
+    def unreachable(*args, **kwargs):
+        raise requests.exceptions.ConnectionError("no metadata server")
+
+    monkeypatch.delenv("DISABLE_REGION_CHECK", raising=False)
+    monkeypatch.setenv("FUNCTION_REGION", "us-east1")
+    monkeypatch.setattr(requests, "get", unreachable)
+    assert main.find_current_region() == "us-east1"
+
+
+def test_region_check_can_be_disabled(monkeypatch):
+    monkeypatch.setenv("DISABLE_REGION_CHECK", "true")
+    monkeypatch.setenv("FUNCTION_REGION", "us-east1")
+    assert main.find_current_region() is None
+
+
+def test_region_is_looked_up_once_in_the_background(monkeypatch):
+    started, release = threading.Event(), threading.Event()
+    lookups = []
+
+    def find_current_region():
+        lookups.append(threading.current_thread())
+        started.set()
+        release.wait(5)
+        return "us-central1"
+
+    monkeypatch.setattr(main, "find_current_region", find_current_region)
+    monkeypatch.setattr(main, "region_lookup_started", False)
+    monkeypatch.setattr(main, "CF_REGION", None)
+    main.start_region_lookup()
+    main.start_region_lookup()
+    # The requests don't wait for the lookup.
+    assert started.wait(5)
+    assert main.CF_REGION is None
+    release.set()
+    lookups[0].join(5)
+    assert main.CF_REGION == "us-central1"
+    assert len(lookups) == 1
+    assert lookups[0] is not threading.current_thread()
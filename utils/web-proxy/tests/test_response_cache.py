@@ -0,0 +1,207 @@
+import threading
+import time
+
+import pytest
+import response_cache
+from response_cache import ResponseCache, parse_cache_control
+
+JSON = [("Content-Type", "application/json")]
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1_000_000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(response_cache.time, "time", clock)
+    return clock
+
+
+class Upstream:
+    """Fetches numbered responses, with the given status and headers."""
+
+    def __init__(self, status=200, headers=JSON, delay=0):
+        self.status = status
+        self.headers = headers
+        self.delay = delay
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        time.sleep(self.delay)
+        return f"response-{self.calls}".encode(), self.status, self.headers
+
+
+def make_cache(max_bytes=1 << 20, default_ttl=60, stale_ttl=30):
+    return ResponseCache([r"/apps/[^/]+$"], max_bytes, default_ttl, stale_ttl)
+
+
+def test_matches_allow_listed_paths():
+    cache = make_cache()
+    assert cache.matches("/projects/p/locations/us/apps/a")
+    assert not cache.matches("/projects/p/locations/us/apps/a/sessions/s")
+
+
+def test_parse_cache_control():
+    headers = [("cache-control", 'max-age=30, No-Store, x="y"'), ("Age", "1")]
+    assert parse_cache_control(headers) == {
+        "max-age": "30",
+        "no-store": None,
+        "x": "y",
+    }
+
+
+def test_hit_after_miss(clock):
+    cache, fetch = make_cache(), Upstream()
+    assert cache.get("key", fetch)[3] == "MISS"
+    content, status, headers, cache_status = cache.get("key", fetch)
+    assert (content, status, cache_status) == (b"response-1", 200, "HIT")
+    assert fetch.calls == 1
+    assert cache.stats()["hit_rate"] == 0.5
+
+
+@pytest.mark.parametrize(
+    "status,headers",
+    [
+        (404, JSON),
+        (200, [("Cache-Control", "no-store")]),
+        (200, [("Cache-Control", "private, no-cache")]),
+        (200, [("Cache-Control", "max-age=0")]),
+    ],
+)
+def test_uncacheable_responses_are_not_stored(clock, status, headers):
+    cache, fetch = make_cache(), Upstream(status, headers)
+    cache.get("key", fetch)
+    assert cache.get("key", fetch)[3] == "MISS"
+    assert fetch.calls == 2
+
+
+def test_upstream_max_age_overrides_the_default_ttl(clock):
+    cache = make_cache(default_ttl=60, stale_ttl=0)
+    fetch = Upstream(headers=[("Cache-Control", "max-age=5")])
+    cache.get("key", fetch)
+    clock.now += 4
+    assert cache.get("key", fetch)[3] == "HIT"
+    clock.now += 2
+    assert cache.get("key", fetch)[3] == "MISS"
+
+
+def test_stale_entries_are_served_while_refreshed(clock):
+    cache, fetch = make_cache(default_ttl=60, stale_ttl=30), Upstream()
+    cache.get("key", fetch)
+    clock.now += 70
+    content, _, _, cache_status = cache.get("key", fetch)
+    assert (content, cache_status) == (b"response-1", "STALE")
+    for _ in range(100):  # The refresh runs in a background thread.
+        if not cache._refreshing:
+            break
+        time.sleep(0.01)
+    content, _, _, cache_status = cache.get("key", fetch)
+    assert (content, cache_status) == (b"response-2", "HIT")
+    assert fetch.calls == 2
+
+
+def test_entries_expire_after_the_stale_window(clock):
+    cache, fetch = make_cache(default_ttl=60, stale_ttl=30), Upstream()
+    cache.get("key", fetch)
+    clock.now += 91
+    assert cache.get("key", fetch)[3] == "MISS"
+
+
+def test_concurrent_misses_are_coalesced():
+    cache, fetch = make_cache(), Upstream(delay=0.05)
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(cache.get("key", fetch)))
+        for _ in range(8)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert fetch.calls == 1
+    assert {result[0] for result in results} == {b"response-1"}
+    stats = cache.stats()
+    assert (stats["misses"], stats["coalesced"]) == (1, 7)
+
+
+def concurrent_gets(cache, fetch, count=5):
+    """Gets `key` from `count` threads, and returns their results or errors."""
+    results = []
+
+    def get():
+        try:
+            results.append(cache.get("key", fetch))
+        except Exception as e:
+            results.append(e)
+
+    threads = [threading.Thread(target=get) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+@pytest.mark.parametrize(
+    "status,headers", [(200, [("Cache-Control", "no-store")]), (503, JSON)]
+)
+def test_uncacheable_response_is_shared_by_concurrent_misses(status, headers):
+    cache = make_cache()
+    fetch = Upstream(status=status, headers=headers, delay=0.1)
+    results = concurrent_gets(cache, fetch)
+    assert fetch.calls == 1
+    assert {result[:2] for result in results} == {(b"response-1", status)}
+    assert sorted(result[3] for result in results) == ["HIT"] * 4 + ["MISS"]
+    # It isn't stored, so the next request goes upstream again.
+    assert cache.get("key", fetch)[3] == "MISS"
+    assert fetch.calls == 2
+
+
+def test_fetch_error_is_raised_to_concurrent_misses():
+    cache, calls = make_cache(), []
+
+    def fail():
+        calls.append(1)
+        time.sleep(0.1)
+        raise ConnectionError("upstream down")
+
+    results = concurrent_gets(cache, fail)
+    assert len(calls) == 1
+    assert all(isinstance(result, ConnectionError) for result in results)
+    assert len(results) == 5
+    assert not cache._inflight
+
+
+def test_least_recently_used_entries_are_evicted(clock):
+    # Room for two entries of this size.
+    size = len(b"response-1") + len("Content-Type") + len("application/json")
+    cache = make_cache(max_bytes=2 * (size + response_cache.ENTRY_OVERHEAD_BYTES))
+    fetch = Upstream()
+    cache.get("a", fetch)
+    cache.get("b", fetch)
+    cache.get("a", fetch)  # "b" is now the least recently used.
+    cache.get("c", fetch)
+    stats = cache.stats()
+    assert (stats["entries"], stats["evictions"]) == (2, 1)
+    assert stats["bytes"] <= cache.max_bytes
+    assert cache.get("a", fetch)[3] == "HIT"
+    assert cache.get("b", fetch)[3] == "MISS"
+
+
+def test_fetch_errors_are_raised_and_not_cached(clock):
+    cache = make_cache()
+
+    def fail():
+        raise ConnectionError("upstream down")
+
+    with pytest.raises(ConnectionError):
+        cache.get("key", fail)
+    assert not cache._inflight
+    assert cache.get("key", Upstream())[3] == "MISS"
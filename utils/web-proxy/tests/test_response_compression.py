@@ -0,0 +1,81 @@
+import gzip
+
+import pytest
+import response_compression
+from response_compression import (
+    ResponseCompressor,
+    accepts,
+    negotiate,
+    parse_accept_encoding,
+)
+
+JSON = [("Content-Type", "application/json")]
+
+
+@pytest.mark.parametrize(
+    "header, expected",
+    [
+        (None, {}),
+        ("", {}),
+        ("gzip", {"gzip": 1.0}),
+        ("gzip, deflate, br;q=0.9", {"gzip": 1.0, "deflate": 1.0, "br": 0.9}),
+        (" GZip ;Q=0.5 , *;q=0", {"gzip": 0.5, "*": 0.0}),
+        ("gzip;level=1;q=0.2", {"gzip": 0.2}),
+        ("gzip;q=high", {"gzip": 0.0}),
+        (",, gzip,", {"gzip": 1.0}),
+    ],
+)
+def test_parse_accept_encoding(header, expected):
+    assert parse_accept_encoding(header) == expected
+
+
+@pytest.mark.parametrize(
+    "header, encoding, expected",
+    [
+        ("gzip", "gzip", True),
+        ("gzip;q=0", "gzip", False),
+        ("deflate", "gzip", False),
+        ("*", "gzip", True),
+        ("*;q=0, gzip", "gzip", True),
+        ("*, gzip;q=0", "gzip", False),
+        (None, "gzip", False),
+    ],
+)
+def test_accepts(header, encoding, expected):
+    assert accepts(header, encoding) is expected
+
+
+def test_negotiate_follows_the_client_preference(monkeypatch):
+    monkeypatch.setattr(response_compression, "ENCODINGS", ("br", "gzip"))
+    assert negotiate("gzip, br") == "br"
+    assert negotiate("gzip, br;q=0.5") == "gzip"
+    assert negotiate("br;q=0, gzip;q=0") is None
+    assert negotiate("identity") is None
+
+
+def test_compressible_responses_are_compressed(monkeypatch):
+    monkeypatch.setattr(response_compression, "ENCODINGS", ("gzip",))
+    compressor = ResponseCompressor(min_bytes=10, gzip_level=6, brotli_quality=5)
+    content = b'{"text": "' + b"a" * 1000 + b'"}'
+    compressed, headers = compressor.compress(content, JSON, "gzip, br")
+    assert gzip.decompress(compressed) == content
+    assert ("Content-Encoding", "gzip") in headers
+    assert ("Vary", "Accept-Encoding") in headers
+    assert compressor.stats()["compressed"] == 1
+
+
+@pytest.mark.parametrize(
+    "content, headers",
+    [
+        (b"{}", JSON),
+        (b"x" * 100, [("Content-Type", "image/png")]),
+        (b"x" * 100, JSON + [("Content-Encoding", "gzip")]),
+    ],
+)
+def test_other_responses_are_not_compressed(content, headers):
+    compressor = ResponseCompressor(min_bytes=10, gzip_level=6, brotli_quality=5)
+    result, result_headers = compressor.compress(content, headers, "gzip")
+    assert result is content
+    assert result_headers.count(("Content-Encoding", "gzip")) == headers.count(
+        ("Content-Encoding", "gzip")
+    )
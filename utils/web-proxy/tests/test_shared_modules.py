@@ -0,0 +1,29 @@
+"""Checks that the modules copied between the services are identical.
+
+Each service is deployed from its own `src` directory, so modules used by
+several services are copied into each of them.
+"""
+
+import os
+
+import pytest
+
+UTILS_DIR = os.path.join(os.path.dirname(__file__), "..", "..")
+
+SHARED_MODULES = [
+    ("token_cache.py", ["web-proxy", "websocket-proxy", "token-broker"]),
+    ("shared_token_cache.py", ["web-proxy", "token-broker"]),
+    ("tracing.py", ["web-proxy", "token-broker"]),
+]
+
+
+def read(service, module):
+    with open(os.path.join(UTILS_DIR, service, "src", module)) as f:
+        return f.read()
+
+
+@pytest.mark.parametrize("module,services", SHARED_MODULES)
+def test_copies_are_identical(module, services):
+    source = read(services[0], module)
+    for service in services[1:]:
+        assert read(service, module) == source, f"{service}/src/{module} differs"
@@ -0,0 +1,133 @@
+import fcntl
+import json
+import os
+import threading
+import time
+
+import pytest
+from shared_token_cache import SharedTokenStore
+from token_cache import TokenCache
+
+KEY = ("sa@example.iam.gserviceaccount.com", ("scope",))
+
+
+class Minter:
+    """Mints numbered tokens, valid for an hour."""
+
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        return f"token-{self.calls}", time.time() + 3600
+
+
+@pytest.fixture
+def path(tmp_path):
+    """The path of the shared file, not created yet."""
+    return str(tmp_path / "tokens.json")
+
+
+def test_processes_share_tokens(path):
+    mint = Minter()
+    first, second = SharedTokenStore(path), SharedTokenStore(path)
+    token, valid_until = first.get(KEY, mint)
+    assert second.get(KEY, mint) == (token, valid_until)
+    assert mint.calls == 1
+    assert (first.refreshes, second.hits) == (1, 1)
+    assert os.stat(path).st_mode & 0o777 == 0o600
+
+
+def test_expired_tokens_are_refreshed_and_dropped(path):
+    with open(path, "w") as f:
+        json.dump({json.dumps(KEY): ["old", time.time() - 1], "other": ["x", 0]}, f)
+    mint = Minter()
+    assert SharedTokenStore(path).get(KEY, mint)[0] == "token-1"
+    with open(path) as f:
+        assert list(json.load(f)) == [json.dumps(KEY)]
+
+
+def test_waits_for_the_process_refreshing_the_token(path):
+    store = SharedTokenStore(path, lock_timeout=5)
+    mint = Minter()
+    with open(path, "w") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        results = []
+        waiter = threading.Thread(target=lambda: results.append(store.get(KEY, mint)))
+        waiter.start()
+        time.sleep(0.1)
+        # The other process writes its token, then releases the lock.
+        json.dump({json.dumps(KEY): ["theirs", time.time() + 3600]}, f)
+        f.flush()
+        fcntl.flock(f, fcntl.LOCK_UN)
+        waiter.join(5)
+    assert results[0][0] == "theirs"
+    assert mint.calls == 0
+    assert store.hits == 1
+
+
+def test_lock_timeout_falls_back_to_minting(path):
+    store = SharedTokenStore(path, lock_timeout=0.05)
+    mint = Minter()
+    with open(path, "w") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        assert store.get(KEY, mint)[0] == "token-1"
+    assert store.errors == 1
+
+
+@pytest.mark.parametrize("content", ['{"truncat', "[1, 2]", '{"k": "v"}'])
+def test_corrupt_file_is_overwritten(path, content):
+    with open(path, "w") as f:
+        f.write(content)
+    os.chmod(path, 0o600)
+    store = SharedTokenStore(path)
+    mint = Minter()
+    assert store.get(KEY, mint)[0] == "token-1"
+    assert store.errors == 0
+    assert SharedTokenStore(path).get(KEY, mint)[0] == "token-1"
+    assert mint.calls == 1
+
+
+def test_file_writable_by_others_is_not_used(path):
+    with open(path, "w") as f:
+        json.dump({json.dumps(KEY): ["planted", time.time() + 3600]}, f)
+    os.chmod(path, 0o666)
+    store = SharedTokenStore(path)
+    assert store.get(KEY, Minter())[0] == "token-1"
+    assert store.errors == 1
+
+
+@pytest.mark.skipif(os.getuid() != 0, reason="needs root to change the owner")
+def test_file_of_another_user_is_not_used(path):
+    with open(path, "w") as f:
+        json.dump({json.dumps(KEY): ["planted", time.time() + 3600]}, f)
+    os.chmod(path, 0o600)
+    os.chown(path, 65534, -1)
+    store = SharedTokenStore(path)
+    assert store.get(KEY, Minter())[0] == "token-1"
+    assert store.errors == 1
+
+
+def test_unavailable_file_falls_back_and_is_skipped(tmp_path):
+    path = str(tmp_path / "missing" / "tokens.json")
+    logged = []
+    store = SharedTokenStore(
+        path, retry_after=60, log=lambda severity, message: logged.append(severity)
+    )
+    mint = Minter()
+    assert store.get(KEY, mint)[0] == "token-1"
+    os.mkdir(tmp_path / "missing")
+    # The file isn't tried again before `retry_after`.
+    assert store.get(KEY, mint)[0] == "token-2"
+    assert not os.path.exists(path)
+    assert (store.errors, logged) == (1, ["WARNING"])
+
+
+def test_token_cache_uses_the_shared_store(path):
+    mint = Minter()
+    caches = [
+        TokenCache(4, ttl=300, expiry_margin=60, shared=SharedTokenStore(path))
+        for _ in range(2)
+    ]
+    assert [cache.get(KEY, mint) for cache in caches] == ["token-1", "token-1"]
+    assert mint.calls == 1
@@ -0,0 +1,85 @@
+import threading
+import time
+
+from token_cache import TokenCache
+
+
+class Minter:
+    """Mints numbered tokens, expiring `lifetime` seconds from now."""
+
+    def __init__(self, lifetime=3600, delay=0):
+        self.lifetime = lifetime
+        self.delay = delay
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        time.sleep(self.delay)
+        expiry = time.time() + self.lifetime if self.lifetime else None
+        return f"token-{self.calls}", expiry
+
+
+def test_hits_and_hit_rate():
+    cache = TokenCache(4, ttl=300, expiry_margin=60)
+    mint = Minter()
+    tokens = [cache.get("key", mint) for _ in range(10)]
+    assert tokens == ["token-1"] * 10
+    assert mint.calls == 1
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["hit_rate"]) == (9, 1, 0.9)
+
+
+def test_evicts_least_recently_used():
+    cache = TokenCache(2, ttl=300, expiry_margin=60)
+    mint = Minter()
+    cache.get("a", mint)
+    cache.get("b", mint)
+    cache.get("a", mint)  # "b" is now the least recently used.
+    cache.get("c", mint)
+    assert cache.stats()["evictions"] == 1
+    assert cache.valid_until("b") is None
+    assert cache.get("a", mint) == "token-1"
+    assert cache.get("b", mint) == "token-4"
+    assert cache.stats()["entries"] == 2
+
+
+def test_expires_at_ttl_or_before_real_expiry():
+    cache = TokenCache(4, ttl=300, expiry_margin=60)
+    now = time.time()
+    cache.get("long", Minter(lifetime=3600))
+    cache.get("short", Minter(lifetime=100))
+    cache.get("unknown", Minter(lifetime=None))
+    assert now + 299 < cache.valid_until("long") <= time.time() + 300
+    assert now + 39 < cache.valid_until("short") <= time.time() + 40
+    assert now + 299 < cache.valid_until("unknown") <= time.time() + 300
+
+
+def test_expired_tokens_are_minted_again():
+    cache = TokenCache(4, ttl=300, expiry_margin=60)
+    mint = Minter(lifetime=60)  # Already within the margin.
+    assert cache.get("key", mint) == "token-1"
+    assert cache.get("key", mint) == "token-2"
+
+
+def test_concurrent_misses_mint_once():
+    cache = TokenCache(4, ttl=300, expiry_margin=60)
+    mint = Minter(delay=0.05)
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(cache.get("key", mint)))
+        for _ in range(8)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == ["token-1"] * 8
+    assert mint.calls == 1
+
+
+def test_failures_are_not_cached():
+    cache = TokenCache(4, ttl=300, expiry_margin=60)
+    assert cache.get("key", lambda: (None, None)) is None
+    assert cache.stats()["entries"] == 0
+    assert not cache._key_locks
+    assert cache.get("key", Minter()) == "token-1"
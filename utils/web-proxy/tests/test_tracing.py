@@ -0,0 +1,133 @@
+import os
+import re
+import subprocess
+import sys
+import time
+
+import flask
+import main
+import pytest
+import tracing
+
+PATH = "/projects/p/locations/us/apps/a/sessions/s:runSession"
+SRC_DIR = os.path.join(os.path.dirname(__file__), "..", "src")
+
+
+@pytest.fixture
+def spans(monkeypatch):
+    """Traces requests to an in-memory exporter, which is returned."""
+    pytest.importorskip("opentelemetry.sdk.trace")
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import SimpleSpanProcessor
+    from opentelemetry.sdk.trace.export.in_memory_span_exporter import (
+        InMemorySpanExporter,
+    )
+
+    exporter = InMemorySpanExporter()
+    provider = TracerProvider()
+    provider.add_span_processor(SimpleSpanProcessor(exporter))
+    monkeypatch.setattr(tracing, "OTEL_ENABLED", True)
+    monkeypatch.setattr(tracing, "_tracer", provider.get_tracer(__name__))
+    return exporter
+
+
+@pytest.fixture
+def upstream(monkeypatch):
+    """A stubbed CES API, and no region lookup."""
+    monkeypatch.setattr(
+        main,
+        "forward_request",
+        lambda *args: (b"{}", 200, [("Content-Type", "application/json")]),
+    )
+    monkeypatch.setattr(main, "region_lookup_started", True)
+    monkeypatch.setattr(main, "CF_REGION", None)
+
+
+def send(origin):
+    app = flask.Flask(__name__)
+    with app.test_request_context(
+        PATH,
+        method="POST",
+        data=b"{}",
+        headers={"Authorization": "Bearer t", "Origin": origin},
+    ):
+        return flask.make_response(main.ces_agent_request(flask.request))
+
+
+def test_server_timing_format(monkeypatch):
+    monkeypatch.setattr(tracing, "SERVER_TIMING", True)
+    monkeypatch.setattr(tracing, "OTEL_ENABLED", False)
+    trace = tracing.start_request("request", {}, "test", print)
+    with trace.phase("token"):
+        pass
+    trace.add("upstream-connect", 0.0123, time.perf_counter())
+    assert re.fullmatch(
+        r"token;dur=\d+\.\d, upstream-connect;dur=12\.3, total;dur=\d+\.\d",
+        trace.server_timing(),
+    )
+
+
+@pytest.mark.parametrize(
+    "origin,allowed",
+    [("http://localhost:5173", True), ("https://evil.example.com", False)],
+)
+def test_timing_allow_origin_only_for_authorized_origins(
+    monkeypatch, upstream, origin, allowed
+):
+    monkeypatch.setattr(tracing, "SERVER_TIMING", True)
+    monkeypatch.setattr(tracing, "OTEL_ENABLED", False)
+    response = send(origin)
+    assert response.status_code == 200
+    assert "upstream;dur=" in response.headers["Server-Timing"]
+    assert response.headers.get("Timing-Allow-Origin") == (origin if allowed else None)
+
+
+def test_no_timing_without_server_timing(monkeypatch, upstream):
+    monkeypatch.setattr(tracing, "SERVER_TIMING", False)
+    monkeypatch.setattr(tracing, "OTEL_ENABLED", False)
+    response = send("http://localhost:5173")
+    assert "Server-Timing" not in response.headers
+    assert "Timing-Allow-Origin" not in response.headers
+
+
+def test_null_trace_without_importing_opentelemetry():
+    environment = {
+        name: value
+        for name, value in os.environ.items()
+        if not name.startswith("OTEL_") and name != "SERVER_TIMING"
+    }
+    code = (
+        "import sys, tracing\n"
+        "assert tracing.start_request('r', {}, 's', print) is tracing.NULL_TRACE\n"
+        "import main\n"
+        "assert not [m for m in sys.modules if m.startswith('opentelemetry')]\n"
+    )
+    subprocess.run(
+        [sys.executable, "-c", code], cwd=SRC_DIR, env=environment, check=True
+    )
+
+
+def test_inject_replaces_incoming_trace_context_in_any_case(spans):
+    trace = tracing.RequestTrace("request", {}, tracing._tracer)
+    headers = {
+        "TraceParent": "00-0af7651916cd43dd8448eb211c80319c-b7ad6b7169203331-01",
+        "TRACESTATE": "vendor=incoming",
+        "X-Custom": "kept",
+    }
+    trace.inject(headers)
+    trace_id = format(trace.span.get_span_context().trace_id, "032x")
+    assert sorted(headers) == ["X-Custom", "traceparent"]
+    assert headers["traceparent"].split("-")[1] == trace_id
+    assert trace_id != "0af7651916cd43dd8448eb211c80319c"
+
+
+def test_request_span_ends_on_unhandled_errors(monkeypatch, spans):
+    def proxy_request(request, trace):
+        raise RuntimeError("bug")
+
+    monkeypatch.setattr(main, "proxy_request", proxy_request)
+    with pytest.raises(RuntimeError):
+        send("http://localhost:5173")
+    (span,) = spans.get_finished_spans()
+    assert span.name == "ces_agent_request"
+    assert span.attributes["http.response.status_code"] == 500
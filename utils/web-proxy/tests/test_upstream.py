@@ -0,0 +1,220 @@
+import threading
+import time
+
+import pytest
+import requests
+import upstream
+from upstream import RetryBudget, UpstreamClient
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(upstream.time, "monotonic", clock)
+    return clock
+
+
+class FakeResponse:
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class FakeSession:
+    """Answers each request with the next of `statuses`, or raises it."""
+
+    def __init__(self, *statuses, delays=()):
+        self.statuses = list(statuses)
+        self.delays = list(delays)
+        self.calls = []
+        self.responses = []
+        self._lock = threading.Lock()
+
+    def request(self, method, url, **kwargs):
+        with self._lock:
+            self.calls.append(method)
+            status = (
+                self.statuses.pop(0) if len(self.statuses) > 1 else self.statuses[0]
+            )
+            delay = self.delays.pop(0) if self.delays else 0
+        time.sleep(delay)
+        if isinstance(status, Exception):
+            raise status
+        response = FakeResponse(status)
+        with self._lock:
+            self.responses.append(response)
+        return response
+
+
+def make_client(session, budget=None, **kwargs):
+    options = dict(
+        timeout=1,
+        max_retries=2,
+        backoff=0,
+        hedging=False,
+        hedge_min_delay=0.05,
+        retry_budget=budget or RetryBudget(ratio=0.1, minimum=10),
+    )
+    options.update(kwargs)
+    client = UpstreamClient(**options)
+    client._session = session
+    return client
+
+
+def test_budget_allows_minimum_without_requests(clock):
+    budget = RetryBudget(ratio=0.1, minimum=3)
+    assert [budget.withdraw() for _ in range(4)] == [True, True, True, False]
+
+
+def test_budget_earns_ratio_per_request(clock):
+    budget = RetryBudget(ratio=0.5, minimum=0)
+    assert not budget.withdraw()
+    for _ in range(4):
+        budget.record_request()
+    assert [budget.withdraw() for _ in range(3)] == [True, True, False]
+
+
+def test_budget_forgets_events_after_window(clock):
+    budget = RetryBudget(ratio=0, minimum=1, window=10)
+    assert budget.withdraw()
+    assert not budget.withdraw()
+    clock.now += 11
+    assert budget.withdraw()
+
+
+def test_budget_requests_expire_with_window(clock):
+    budget = RetryBudget(ratio=1, minimum=0, window=10)
+    budget.record_request()
+    clock.now += 11
+    assert not budget.withdraw()
+
+
+def test_retries_idempotent_request_on_retryable_status():
+    session = FakeSession(503, 200)
+    client = make_client(session)
+    assert client.request("GET", "https://ces").status_code == 200
+    assert session.calls == ["GET", "GET"]
+    assert client.stats()["retries"] == 1
+
+
+def test_returns_last_retryable_status_after_max_retries():
+    session = FakeSession(503)
+    client = make_client(session)
+    assert client.request("GET", "https://ces").status_code == 503
+    assert len(session.calls) == 3
+
+
+def test_raises_last_connection_error():
+    session = FakeSession(requests.ConnectionError("refused"))
+    client = make_client(session, max_retries=1)
+    with pytest.raises(requests.ConnectionError):
+        client.request("GET", "https://ces")
+    assert len(session.calls) == 2
+
+
+def test_retries_connect_timeout():
+    session = FakeSession(requests.ConnectTimeout("connect timed out"), 200)
+    client = make_client(session)
+    assert client.request("GET", "https://ces").status_code == 200
+    assert len(session.calls) == 2
+
+
+def test_does_not_retry_read_timeout():
+    session = FakeSession(requests.ReadTimeout("read timed out"), 200)
+    client = make_client(session)
+    with pytest.raises(requests.ReadTimeout):
+        client.request("GET", "https://ces")
+    assert len(session.calls) == 1
+
+
+def test_does_not_retry_post():
+    session = FakeSession(503, 200)
+    client = make_client(session)
+    assert client.request("POST", "https://ces").status_code == 503
+    assert session.calls == ["POST"]
+
+
+def test_does_not_retry_other_errors():
+    session = FakeSession(500, 200)
+    client = make_client(session)
+    assert client.request("GET", "https://ces").status_code == 500
+    assert len(session.calls) == 1
+
+
+def test_stops_retrying_when_budget_is_exhausted():
+    session = FakeSession(503)
+    client = make_client(session, budget=RetryBudget(ratio=0, minimum=1))
+    client.request("GET", "https://ces")
+    client.request("GET", "https://ces")
+    # One retry for the first request, none for the second.
+    assert len(session.calls) == 3
+    assert client.stats()["budget_exhausted"] == 2
+
+
+def test_hedge_delay_needs_recent_latencies():
+    client = make_client(FakeSession(200), hedge_min_delay=0.2)
+    assert client.hedge_delay() is None
+    client._latencies.extend([0.01] * 19 + [1.0])
+    assert client.hedge_delay() == 1.0
+    client._latencies.clear()
+    client._latencies.extend([0.01] * 20)
+    assert client.hedge_delay() == 0.2
+
+
+def test_hedges_slow_request_and_first_response_wins():
+    session = FakeSession(200, delays=[0.5, 0])
+    client = make_client(session, hedging=True, hedge_min_delay=0.05)
+    client._latencies.extend([0.01] * 20)
+    start = time.monotonic()
+    assert client.request("GET", "https://ces").status_code == 200
+    assert time.monotonic() - start < 0.4
+    stats = client.stats()
+    assert stats["hedges"] == 1
+    assert stats["hedge_wins"] == 1
+
+
+def test_does_not_hedge_post():
+    session = FakeSession(200, delays=[0.1])
+    client = make_client(session, hedging=True, hedge_min_delay=0.01)
+    client._latencies.extend([0.001] * 20)
+    client.request("POST", "https://ces")
+    assert session.calls == ["POST"]
+    assert client.stats()["hedges"] == 0
+
+
+def test_losing_hedged_response_is_closed():
+    session = FakeSession(200, delays=[0.3, 0])
+    client = make_client(session, hedging=True, hedge_min_delay=0.05)
+    client._latencies.extend([0.01] * 20)
+    winner = client.request("GET", "https://ces")
+    assert not winner.closed
+    time.sleep(0.4)
+    assert [response.closed for response in session.responses] == [False, True]
+
+
+def test_counters_are_consistent_under_concurrency():
+    session = FakeSession(200)
+    client = make_client(session, hedging=True)
+    client._latencies.extend([10.0] * 20)
+
+    def send():
+        for _ in range(200):
+            client.request("GET", "https://ces")
+
+    threads = [threading.Thread(target=send) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert client.stats()["requests"] == 1600
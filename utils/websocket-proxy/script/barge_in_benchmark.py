@@ -0,0 +1,289 @@
+"""Measures how fast the agent's audio stops when the user interrupts it.
+
+Runs the proxy (``src/main.py``) in-process, with the environment of the
+benchmark, between:
+
+- a fake upstream, which streams a long answer of audio faster than real
+  time, and sends an ``interruptionSignal`` some time after it receives the
+  user's speech, as an agent would once its speech recognition notices it;
+- a client, which sends audio continuously (silence, then speech at
+  ``--speak-at``), and plays the agent's audio in real time, as soon as it
+  arrives. With ``--ignore-interruptions``, it keeps playing what it has
+  received when the interruption arrives, like a client that doesn't handle
+  it.
+
+Optionally, the link from the proxy to the client is limited to
+``--link-kbps``, as on a mobile network. The benchmark reports the
+time-to-silence (from the start of the user's speech until the client stops
+playing the agent's audio) and the audio sent and played in vain. Compare
+runs with and without ``OUTPUT_AUDIO_LEAD_MS`` and ``BARGE_IN_SPEECH_MS``.
+
+Usage:
+    OUTPUT_AUDIO_LEAD_MS=500 python script/barge_in_benchmark.py [--link-kbps 1000]
+"""
+
+import argparse
+import asyncio
+import base64
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import websockets
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+sys.path.insert(0, SRC_DIR)
+
+SESSION = "projects/benchmark/locations/us/apps/benchmark/sessions/benchmark"
+SAMPLE_RATE = 16000
+FRAME_MS = 20
+
+
+def audio_message(field, pcm):
+    return json.dumps({field: {"audio": base64.b64encode(pcm).decode("ascii")}})
+
+
+def speech_frame(rng, index):
+    """Returns a frame of speech-like audio: a voiced, modulated tone."""
+    t = (
+        np.arange(SAMPLE_RATE * FRAME_MS // 1000)
+        + index * SAMPLE_RATE * FRAME_MS // 1000
+    )
+    t = t / SAMPLE_RATE
+    envelope = 0.6 + 0.4 * np.sin(2 * np.pi * 4 * t)
+    signal = envelope * np.sin(2 * np.pi * 180 * t) + 0.05 * rng.normal(size=len(t))
+    return (signal * 8000).astype("<i2").tobytes()
+
+
+def silence_frame(rng):
+    return (rng.normal(0, 30, SAMPLE_RATE * FRAME_MS // 1000)).astype("<i2").tobytes()
+
+
+def is_speech(message):
+    pcm = base64.b64decode(json.loads(message)["realtimeInput"]["audio"])
+    samples = np.frombuffer(pcm, dtype="<i2").astype(np.float32)
+    return float(np.sqrt(np.mean(np.square(samples)))) > 1000
+
+
+async def throttled_link(proxy_port, kbps):
+    """A TCP relay to the proxy, limiting the proxy-to-client direction."""
+
+    async def relay(client_reader, client_writer):
+        proxy_reader, proxy_writer = await asyncio.open_connection(
+            "127.0.0.1", proxy_port
+        )
+
+        async def pipe(reader, writer, rate):
+            try:
+                while data := await reader.read(4096):
+                    writer.write(data)
+                    await writer.drain()
+                    if rate:
+                        await asyncio.sleep(len(data) * 8 / rate)
+            except ConnectionError:
+                pass
+            finally:
+                writer.close()
+
+        await asyncio.gather(
+            pipe(client_reader, proxy_writer, None),
+            pipe(proxy_reader, client_writer, kbps * 1000),
+        )
+
+    return await asyncio.start_server(relay, "127.0.0.1", 0)
+
+
+async def benchmark(args):
+    rng = np.random.default_rng(0)
+    chunk_samples = SAMPLE_RATE * args.chunk_ms // 1000
+    chunk_seconds = args.chunk_ms / 1000
+    events = {}
+
+    async def fake_upstream(websocket):
+        await websocket.recv()  # The config message.
+        interrupted = asyncio.Event()
+
+        async def receive():
+            async for message in websocket:
+                if "speech_received" not in events and is_speech(message):
+                    events["speech_received"] = time.monotonic()
+                    await asyncio.sleep(args.upstream_detect_ms / 1000)
+                    events["interruption_sent"] = time.monotonic()
+                    interrupted.set()
+                    await websocket.send(json.dumps({"interruptionSignal": True}))
+
+        receiver = asyncio.create_task(receive())
+        start = time.monotonic()
+        for index in range(int(args.answer_seconds / chunk_seconds)):
+            delay = (
+                start + index * chunk_seconds / args.generation_speed - time.monotonic()
+            )
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if interrupted.is_set():
+                break
+            # Noisy audio, which doesn't compress, like speech.
+            pcm = rng.normal(0, 3000, chunk_samples).astype("<i2").tobytes()
+            await websocket.send(audio_message("sessionOutput", pcm))
+        await receiver
+
+    async with websockets.serve(fake_upstream, "127.0.0.1", 0) as upstream:
+        upstream_port = upstream.sockets[0].getsockname()[1]
+        os.environ["PS_ENDPOINT_TEMPLATE_BENCHMARK"] = (
+            f"ws://127.0.0.1:{upstream_port}/{{location}}"
+        )
+        import main
+
+        proxy = await websockets.serve(main.handle_client, "127.0.0.1", 0)
+        port = proxy.sockets[0].getsockname()[1]
+        link = None
+        if args.link_kbps:
+            link = await throttled_link(port, args.link_kbps)
+            port = link.sockets[0].getsockname()[1]
+
+        async with websockets.connect(
+            f"ws://127.0.0.1:{port}", max_size=None
+        ) as client:
+            await client.send(
+                json.dumps(
+                    {
+                        "config": {
+                            "session": SESSION,
+                            "environment": "benchmark",
+                            "accessToken": "benchmark",
+                            "outputAudioConfig": {
+                                "audioEncoding": "LINEAR16",
+                                "sampleRateHertz": SAMPLE_RATE,
+                            },
+                        }
+                    }
+                )
+            )
+            start = time.monotonic()
+            speak_at = start + args.speak_at
+            playout_end = 0.0
+            played_after_speech = 0.0
+            received_after_speech = 0
+
+            async def play():
+                nonlocal playout_end, played_after_speech, received_after_speech
+                async for message in client:
+                    now = time.monotonic()
+                    data = json.loads(message)
+                    if data.get("interruptionSignal"):
+                        events.setdefault("interruption_received", now)
+                        if not args.ignore_interruptions and now < playout_end:
+                            played_after_speech -= playout_end - now
+                            playout_end = now
+                        continue
+                    audio = data.get("sessionOutput", {}).get("audio")
+                    if not audio:
+                        continue
+                    seconds = len(base64.b64decode(audio)) / (2 * SAMPLE_RATE)
+                    begin = max(now, playout_end)
+                    playout_end = begin + seconds
+                    if now >= speak_at:
+                        received_after_speech += 1
+                    played_after_speech += max(0.0, playout_end - max(begin, speak_at))
+
+            player = asyncio.create_task(play())
+            index = 0
+            while time.monotonic() < speak_at + args.answer_seconds:
+                now = time.monotonic()
+                if now >= speak_at:
+                    frame = speech_frame(rng, index)
+                    events.setdefault("speech_sent", now)
+                else:
+                    frame = silence_frame(rng)
+                await client.send(audio_message("realtimeInput", frame))
+                index += 1
+                # Until the upstream's interruption, and the audio, are over.
+                if (
+                    "interruption_sent" in events
+                    and "interruption_received" in events
+                    and now > max(playout_end, events["interruption_sent"]) + 1
+                ):
+                    break
+                await asyncio.sleep(
+                    max(0.0, start + index * FRAME_MS / 1000 - time.monotonic())
+                )
+            player.cancel()
+        if link:
+            link.close()
+        proxy.close()
+        await proxy.wait_closed()
+
+    speech = events.get("speech_sent", speak_at)
+    silence = max(playout_end, speech)
+    print(
+        f"Answer of {args.answer_seconds}s generated at {args.generation_speed}x, "
+        f"link {args.link_kbps or 'unlimited'} kbps, "
+        f"OUTPUT_AUDIO_LEAD_MS={main.OUTPUT_AUDIO_LEAD_MS}, "
+        f"BARGE_IN_SPEECH_MS={main.BARGE_IN_SPEECH_MS}"
+    )
+    if "interruption_received" in events:
+        print(
+            f"Interruption reached the client "
+            f"{(events['interruption_received'] - speech) * 1000:.0f} ms after speech "
+            f"started (upstream sent it after "
+            f"{(events.get('interruption_sent', speech) - speech) * 1000:.0f} ms)"
+        )
+    print(f"Time-to-silence: {(silence - speech) * 1000:.0f} ms")
+    print(
+        "Agent audio played after speech started: "
+        f"{played_after_speech * 1000:.0f} ms, "
+        f"{received_after_speech} messages received"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--answer-seconds",
+        type=float,
+        default=30,
+        help="Length of the agent's answer (default: 30).",
+    )
+    parser.add_argument(
+        "--generation-speed",
+        type=float,
+        default=4,
+        help="How much faster than real time the upstream "
+        "generates audio (default: 4).",
+    )
+    parser.add_argument(
+        "--chunk-ms",
+        type=int,
+        default=100,
+        help="Audio per upstream message (default: 100).",
+    )
+    parser.add_argument(
+        "--speak-at",
+        type=float,
+        default=4,
+        help="When the user starts speaking, in seconds (default: 4).",
+    )
+    parser.add_argument(
+        "--upstream-detect-ms",
+        type=int,
+        default=500,
+        help="Delay before the upstream sends the interruption (default: 500).",
+    )
+    parser.add_argument(
+        "--link-kbps",
+        type=int,
+        default=0,
+        help="Bandwidth of the proxy-to-client link (default: unlimited).",
+    )
+    parser.add_argument(
+        "--ignore-interruptions",
+        action="store_true",
+        help="Simulate a client that doesn't stop on an interruption.",
+    )
+    asyncio.run(benchmark(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+"""Measures the upstream sends and CPU saved by coalescing client audio.
+
+Runs the proxy (``src/main.py``) in this process, and the clients and a fake
+upstream in a child process, so that the CPU time measured is the proxy's.
+``--sessions`` clients each stream ``--seconds`` of audio in real time, in
+``--frame-ms`` frames, once for each ``AUDIO_COALESCE_MS`` of
+``--windows``. Reports, per second of audio of a session:
+
+- the upstream messages: each is written to the upstream socket with one
+  ``send`` system call, so this is the number of send calls of the proxy
+  on the upstream leg;
+- the CPU time used by the proxy process, which also includes receiving the
+  client frames, unaffected by coalescing.
+
+Usage:
+    python script/coalesce_benchmark.py [--sessions 50] [--windows 0 20 40]
+"""
+
+import argparse
+import asyncio
+import base64
+import importlib
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import time
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+sys.path.insert(0, SRC_DIR)
+
+SESSION = "projects/benchmark/locations/us/apps/benchmark/sessions/benchmark"
+CONFIG = json.dumps(
+    {
+        "config": {
+            "session": SESSION,
+            "environment": "benchmark",
+            "accessToken": "benchmark",
+        }
+    }
+)
+
+
+async def run_peers(connection, args):
+    """Runs the fake upstream and the clients, as told by ``connection``."""
+    import websockets
+
+    received = {"messages": 0, "bytes": 0}
+
+    async def fake_upstream(websocket):
+        await websocket.recv()  # The config message.
+        async for message in websocket:
+            received["messages"] += 1
+            received["bytes"] += len(message)
+
+    # LINEAR16 at 16 kHz: 32 bytes per millisecond.
+    frame = json.dumps(
+        {
+            "realtimeInput": {
+                "audio": base64.b64encode(os.urandom(32 * args.frame_ms)).decode()
+            }
+        }
+    )
+    frames = args.seconds * 1000 // args.frame_ms
+
+    async def stream(port):
+        async with websockets.connect(f"ws://127.0.0.1:{port}") as client:
+            await client.send(CONFIG)
+            start = time.monotonic()
+            for index in range(frames):
+                await client.send(frame)
+                delay = start + (index + 1) * args.frame_ms / 1000 - time.monotonic()
+                await asyncio.sleep(max(0.0, delay))
+            # Let the proxy send the last coalesced audio.
+            await asyncio.sleep(0.2)
+
+    loop = asyncio.get_running_loop()
+    async with websockets.serve(fake_upstream, "127.0.0.1", 0) as upstream:
+        connection.send(upstream.sockets[0].getsockname()[1])
+        while port := await loop.run_in_executor(None, connection.recv):
+            received.update(messages=0, bytes=0)
+            await asyncio.gather(*(stream(port) for _ in range(args.sessions)))
+            connection.send(dict(received))
+
+
+def peers_process(connection, args):
+    asyncio.run(run_peers(connection, args))
+
+
+async def benchmark(args):
+    import websockets
+
+    parent, child = multiprocessing.Pipe()
+    peers = multiprocessing.Process(
+        target=peers_process, args=(child, args), daemon=True
+    )
+    peers.start()
+    loop = asyncio.get_running_loop()
+    upstream_port = parent.recv()
+    os.environ["PS_ENDPOINT_TEMPLATE_BENCHMARK"] = (
+        f"ws://127.0.0.1:{upstream_port}/{{location}}"
+    )
+    audio_seconds = args.sessions * args.seconds
+    print(
+        f"{args.sessions} sessions, {args.seconds}s of audio each, "
+        f"{args.frame_ms} ms frames"
+    )
+    for window in args.windows:
+        os.environ["AUDIO_COALESCE_MS"] = str(window)
+        import main
+
+        main = importlib.reload(main)
+        async with websockets.serve(main.handle_client, "127.0.0.1", 0) as proxy:
+            cpu = time.process_time()
+            parent.send(proxy.sockets[0].getsockname()[1])
+            received = await loop.run_in_executor(None, parent.recv)
+            cpu = time.process_time() - cpu
+        print(
+            f"AUDIO_COALESCE_MS={window}: "
+            f"{received['messages'] / audio_seconds:.1f} upstream sends, "
+            f"{cpu * 1000 / audio_seconds:.2f} ms of proxy CPU "
+            f"per second of audio"
+        )
+    parent.send(0)
+    peers.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--sessions",
+        type=int,
+        default=50,
+        help="Concurrent sessions (default: 50).",
+    )
+    parser.add_argument(
+        "--seconds",
+        type=int,
+        default=5,
+        help="Audio streamed by each session, in seconds (default: 5).",
+    )
+    parser.add_argument(
+        "--frame-ms",
+        type=int,
+        default=10,
+        help="Audio per client message (default: 10).",
+    )
+    parser.add_argument(
+        "--windows",
+        type=int,
+        nargs="+",
+        default=[0, 20, 40],
+        help="AUDIO_COALESCE_MS values to compare (default: 0 20 40).",
+    )
+    logging.basicConfig(level=logging.ERROR)
+    asyncio.run(benchmark(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+"""Measures how fast the proxy reclaims the sessions of unresponsive clients.
+
+Runs the proxy (``src/main.py``) in-process between a fake upstream and
+``--sessions`` clients, which send audio for a second and then either:
+
+- stop responding (``dead``): they stop reading from the connection, so
+  they no longer answer the proxy's keepalive pings, like a phone that lost
+  its network without closing the connection;
+- stay connected without sending audio (``idle``), like a widget left open
+  in a background tab.
+
+For each configuration of the keepalive pings and ``AUDIO_IDLE_TIMEOUT``,
+reports how long the upstream sessions stayed open after the clients went
+silent (the time they kept being billed), and the proxy's reclaimed session
+counters. Sessions still open after ``--max-wait`` seconds are reported as
+not reclaimed.
+
+Usage:
+    python script/dead_client_benchmark.py [--sessions 5] [--max-wait 15]
+"""
+
+import argparse
+import asyncio
+import base64
+import importlib
+import json
+import logging
+import os
+import statistics
+import sys
+import time
+
+import websockets
+from websockets.exceptions import ConnectionClosed
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+sys.path.insert(0, SRC_DIR)
+
+SESSION = "projects/benchmark/locations/us/apps/benchmark/sessions/benchmark"
+CONFIG = json.dumps(
+    {
+        "config": {
+            "session": SESSION,
+            "environment": "benchmark",
+            "accessToken": "benchmark",
+        }
+    }
+)
+AUDIO = json.dumps({"realtimeInput": {"audio": base64.b64encode(bytes(640)).decode()}})
+
+CONFIGURATIONS = [
+    ("Pings disabled", {"CLIENT_PING_INTERVAL": "0", "AUDIO_IDLE_TIMEOUT": "0"}),
+    (
+        "Pings every 2s, 2s timeout",
+        {
+            "CLIENT_PING_INTERVAL": "2",
+            "CLIENT_PING_TIMEOUT": "2",
+            "AUDIO_IDLE_TIMEOUT": "0",
+        },
+    ),
+    (
+        "Pings every 2s, 2s timeout, AUDIO_IDLE_TIMEOUT=5",
+        {
+            "CLIENT_PING_INTERVAL": "2",
+            "CLIENT_PING_TIMEOUT": "2",
+            "AUDIO_IDLE_TIMEOUT": "5",
+        },
+    ),
+]
+
+
+async def run_client(port, behavior, silent_at):
+    """Sends audio for a second, then goes silent the way of ``behavior``."""
+    client = await websockets.connect(f"ws://127.0.0.1:{port}", ping_interval=None)
+    await client.send(CONFIG)
+    for _ in range(50):
+        await client.send(AUDIO)
+        await asyncio.sleep(0.02)
+    silent_at.append(time.monotonic())
+    if behavior == "dead":
+        # The client's pongs are sent when it reads the pings.
+        client.transport.pause_reading()
+    return client
+
+
+async def run(args, behavior, environment, closed):
+    """Runs the clients against a proxy configured with ``environment``.
+
+    Returns:
+        tuple: How long each upstream session stayed open after its client
+        went silent (None if not reclaimed), and the proxy's session stats.
+    """
+    os.environ.update(environment)
+    import main
+
+    main = importlib.reload(main)
+    silent_at = []
+    async with websockets.serve(
+        main.handle_client,
+        "127.0.0.1",
+        0,
+        ping_interval=main.CLIENT_PING_INTERVAL,
+        ping_timeout=main.CLIENT_PING_TIMEOUT,
+        close_timeout=main.CLOSE_TIMEOUT,
+    ) as proxy:
+        port = proxy.sockets[0].getsockname()[1]
+        clients = await asyncio.gather(
+            *(run_client(port, behavior, silent_at) for _ in range(args.sessions))
+        )
+        # Sessions of the previous run may have been closed meanwhile.
+        closed.clear()
+        deadline = max(silent_at) + args.max_wait
+        while len(closed) < args.sessions and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        # Aborting the clients closes the sessions that are left.
+        reclaimed = list(closed)
+        for client in clients:
+            client.transport.abort()
+        stats = dict(main.SESSION_STATS)
+    start = min(silent_at)
+    durations = [end - start for end in reclaimed]
+    durations += [None] * (args.sessions - len(durations))
+    return durations, stats
+
+
+async def benchmark(args):
+    closed = []
+
+    async def fake_upstream(websocket):
+        try:
+            async for _ in websocket:
+                pass
+        except ConnectionClosed:
+            pass
+        closed.append(time.monotonic())
+
+    async with websockets.serve(fake_upstream, "127.0.0.1", 0) as upstream:
+        upstream_port = upstream.sockets[0].getsockname()[1]
+        os.environ["PS_ENDPOINT_TEMPLATE_BENCHMARK"] = (
+            f"ws://127.0.0.1:{upstream_port}/{{location}}"
+        )
+        for behavior in ("dead", "idle"):
+            print(f"{behavior.capitalize()} clients:")
+            for name, environment in CONFIGURATIONS:
+                durations, stats = await run(args, behavior, environment, closed)
+                reclaimed = [d for d in durations if d is not None]
+                if reclaimed:
+                    result = (
+                        f"{len(reclaimed)}/{args.sessions} upstream sessions "
+                        f"closed after {statistics.median(reclaimed):.1f}s"
+                    )
+                else:
+                    result = f"no upstream session closed in {args.max_wait}s"
+                print(
+                    f"  {name}: {result} (reclaimed dead "
+                    f"{stats['reclaimed_dead_client']}, idle "
+                    f"{stats['reclaimed_idle']})"
+                )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--sessions",
+        type=int,
+        default=5,
+        help="Concurrent client sessions (default: 5).",
+    )
+    parser.add_argument(
+        "--max-wait",
+        type=float,
+        default=15,
+        help="Seconds to wait for the sessions to be reclaimed (default: 15).",
+    )
+    logging.basicConfig(level=logging.ERROR)
+    asyncio.run(benchmark(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+"""Measures the memory used by each proxied session, with ``tracemalloc``.
+
+Runs the proxy (``src/main.py``) in this process, with the environment of
+the benchmark, and the clients and a fake upstream in a child process, so
+that only the proxy's allocations are traced. For each number of sessions
+in ``--sessions``, the clients open that many sessions, and each exchanges
+``--messages`` audio messages with the fake upstream in each direction.
+Reports, per session:
+
+- the steady-state memory: allocated and still held by the proxy once all
+  the sessions are open and idle;
+- the peak memory: the highest allocation reached while opening the
+  sessions and exchanging the messages, over the memory before.
+
+Compare runs with different ``CLIENT_MAX_QUEUE`` / ``UPSTREAM_MAX_QUEUE``,
+transforms or recording settings.
+
+Usage:
+    python script/memory_benchmark.py [--sessions 1000 5000] [--messages 5]
+"""
+
+import argparse
+import asyncio
+import base64
+import gc
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import sys
+import tracemalloc
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+sys.path.insert(0, SRC_DIR)
+
+SESSION = "projects/benchmark/locations/us/apps/benchmark/sessions/benchmark"
+# 20 ms of 16 kHz LINEAR16 audio.
+AUDIO = base64.b64encode(os.urandom(640)).decode("ascii")
+
+
+def raise_file_limit():
+    """Allows as many open connections as the system allows."""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return hard
+
+
+async def run_peers(connection, messages):
+    """Runs the fake upstream and the clients, as told by ``connection``."""
+    import websockets
+
+    async def fake_upstream(websocket):
+        await websocket.recv()  # The config message.
+        async for _ in websocket:
+            message = {"sessionOutput": {"audio": AUDIO}}
+            await websocket.send(json.dumps(message))
+
+    config = json.dumps(
+        {
+            "config": {
+                "session": SESSION,
+                "environment": "benchmark",
+                "accessToken": "benchmark",
+            }
+        }
+    )
+
+    async def open_session(port):
+        client = await websockets.connect(f"ws://127.0.0.1:{port}", max_size=None)
+        await client.send(config)
+        for _ in range(messages):
+            await client.send(json.dumps({"realtimeInput": {"audio": AUDIO}}))
+            await client.recv()
+        return client
+
+    loop = asyncio.get_running_loop()
+    async with websockets.serve(fake_upstream, "127.0.0.1", 0) as upstream:
+        connection.send(upstream.sockets[0].getsockname()[1])
+        port = await loop.run_in_executor(None, connection.recv)
+        clients = []
+        while True:
+            command, count = await loop.run_in_executor(None, connection.recv)
+            if command == "open":
+                # In batches, not to overflow the proxy's listen backlog.
+                for _ in range(0, count, 100):
+                    batch = min(100, count - len(clients))
+                    clients += await asyncio.gather(
+                        *(open_session(port) for _ in range(batch))
+                    )
+            elif command == "close":
+                await asyncio.gather(*(client.close() for client in clients))
+                clients = []
+            else:
+                break
+            connection.send("done")
+
+
+def peers_process(connection, messages):
+    raise_file_limit()
+    asyncio.run(run_peers(connection, messages))
+
+
+async def benchmark(args):
+    import websockets
+
+    parent, child = multiprocessing.Pipe()
+    peers = multiprocessing.Process(
+        target=peers_process, args=(child, args.messages), daemon=True
+    )
+    peers.start()
+    loop = asyncio.get_running_loop()
+    upstream_port = parent.recv()
+    os.environ["PS_ENDPOINT_TEMPLATE_BENCHMARK"] = (
+        f"ws://127.0.0.1:{upstream_port}/{{location}}"
+    )
+    import main
+
+    async with websockets.serve(
+        main.handle_client,
+        "127.0.0.1",
+        0,
+        max_size=main.CLIENT_MAX_SIZE,
+        max_queue=main.CLIENT_MAX_QUEUE,
+        backlog=1024,
+    ) as proxy:
+        parent.send(proxy.sockets[0].getsockname()[1])
+        tracemalloc.start()
+        for count in args.sessions:
+            gc.collect()
+            before = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            parent.send(("open", count))
+            await loop.run_in_executor(None, parent.recv)
+            peak = tracemalloc.get_traced_memory()[1]
+            gc.collect()
+            current = tracemalloc.get_traced_memory()[0]
+            active = main.SESSION_STATS["active"]
+            print(
+                f"{count} sessions ({active} active): "
+                f"steady state {(current - before) / count / 1024:.1f} KiB, "
+                f"peak {(peak - before) / count / 1024:.1f} KiB per session"
+            )
+            if args.top:
+                snapshot = tracemalloc.take_snapshot()
+                for stat in snapshot.statistics("lineno")[: args.top]:
+                    print(f"  {stat}")
+            parent.send(("close", 0))
+            await loop.run_in_executor(None, parent.recv)
+            while main.SESSION_STATS["active"]:
+                await asyncio.sleep(0.1)
+        tracemalloc.stop()
+        parent.send(("exit", 0))
+    peers.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--sessions",
+        type=int,
+        nargs="+",
+        default=[1000, 5000],
+        help="Numbers of concurrent sessions to measure (default: 1000 5000).",
+    )
+    parser.add_argument(
+        "--messages",
+        type=int,
+        default=5,
+        help="Audio messages exchanged per direction per session (default: 5).",
+    )
+    parser.add_argument(
+        "--top",
+        type=int,
+        default=0,
+        help="Also lists the lines that allocated the most memory.",
+    )
+    args = parser.parse_args()
+    # Each session holds two connections in the proxy.
+    if raise_file_limit() < 2 * max(args.sessions) + 100:
+        sys.exit("Not enough file descriptors for that many sessions.")
+    logging.basicConfig(level=logging.ERROR)
+    asyncio.run(benchmark(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,203 @@
+"""Replays a session recording through the WebSocket proxy.
+
+Recordings are made by the proxy itself, see ``RECORD_SAMPLE_PERCENT`` in the
+README. The replayer plays both sides of the session, with their recorded
+timing (optionally accelerated):
+
+- a client, sending the recorded client messages to the proxy;
+- a fake upstream, sending the recorded upstream messages to the proxy.
+
+It then reports how long the proxy took to forward messages in each
+direction. Messages whose content wasn't recorded are replaced by silent audio
+messages of the recorded size, and recorded contents are padded to that size.
+
+By default the proxy (``src/main.py``) runs in-process, with the environment
+of the replayer. To replay against a proxy running separately, pass
+``--proxy``, and start that proxy with
+``PS_ENDPOINT_TEMPLATE_REPLAY=ws://127.0.0.1:<upstream-port>/{location}``.
+
+Usage:
+    python script/replay.py RECORDING [--speed 4] [--proxy ws://localhost:8765]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import re
+import statistics
+import sys
+import time
+
+import websockets
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+sys.path.insert(0, SRC_DIR)
+
+from recorder import CONFIG, FROM_CLIENT, FROM_UPSTREAM, read_recording  # noqa: E402
+
+DEFAULT_SESSION = "projects/replay/locations/us/apps/replay/sessions/replay"
+
+
+def synthesize(direction, size):
+    """Returns a silent audio message of about ``size`` bytes."""
+    field = "realtimeInput" if direction == FROM_CLIENT else "sessionOutput"
+    overhead = len(json.dumps({field: {"audio": ""}}))
+    return json.dumps({field: {"audio": "A" * max(0, size - overhead)}})
+
+
+def message_content(direction, size, content):
+    """Returns the message to send for a record, of the recorded size."""
+    if not content:
+        return synthesize(direction, size)
+    # Redacted contents can be shorter than the message, e.g. in recordings
+    # made before they were padded: JSON allows trailing whitespace.
+    return content.ljust(size).decode("utf-8", "surrogatepass")
+
+
+def config_message(content, session):
+    """Returns the config message to send, pointing at the fake upstream."""
+    try:
+        message = json.loads(content)
+        config = message.get("configMessage", message.get("config"))
+        config["session"]
+    except (json.JSONDecodeError, ValueError, TypeError, AttributeError, KeyError):
+        message = config = None
+    if config is None:
+        message = {"configMessage": {}}
+        config = message["configMessage"]
+    if session or not re.search(
+        r"projects/[^/]+/locations/", config.get("session", "")
+    ):
+        # Redacted recordings don't have a usable session name.
+        config["session"] = session or DEFAULT_SESSION
+    config["environment"] = "replay"
+    # The fake upstream doesn't check it, and it avoids minting real tokens.
+    config["accessToken"] = "replay"
+    return json.dumps(message)
+
+
+def percentiles(values):
+    """Formats the p50, p95 and max of a list of seconds, in milliseconds."""
+    if not values:
+        return "n/a"
+    values = sorted(values)
+    p95 = values[min(len(values) - 1, int(len(values) * 0.95))]
+    return (
+        f"p50 {statistics.median(values) * 1000:.2f} ms, "
+        f"p95 {p95 * 1000:.2f} ms, max {values[-1] * 1000:.2f} ms"
+    )
+
+
+async def replay(records, proxy_uri, upstream_port, speed, session):
+    config = next((r for r in records if r[1] == CONFIG), None)
+    config_time = config[0] if config else 0.0
+    client_records = [r for r in records if r[1] == FROM_CLIENT]
+    upstream_records = [r for r in records if r[1] == FROM_UPSTREAM]
+
+    # Send and receive times, matched by position: the proxy keeps the order.
+    client_sent, upstream_received = [], []
+    upstream_sent, client_received = [], []
+    upstream_done = asyncio.Event()
+
+    async def fake_upstream(websocket):
+        await websocket.recv()  # The config message.
+        start = time.monotonic()
+
+        async def receive():
+            async for _ in websocket:
+                upstream_received.append(time.monotonic())
+
+        receiver = asyncio.create_task(receive())
+        for elapsed, direction, size, content in upstream_records:
+            delay = start + (elapsed - config_time) / speed - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            upstream_sent.append(time.monotonic())
+            await websocket.send(message_content(direction, size, content))
+        upstream_done.set()
+        await receiver
+
+    async with websockets.serve(fake_upstream, "127.0.0.1", upstream_port) as upstream:
+        upstream_port = upstream.sockets[0].getsockname()[1]
+        proxy = None
+        if proxy_uri is None:
+            os.environ["PS_ENDPOINT_TEMPLATE_REPLAY"] = (
+                f"ws://127.0.0.1:{upstream_port}/{{location}}"
+            )
+            os.environ["PBL_ENDPOINT_TEMPLATE_REPLAY"] = (
+                f"ws://127.0.0.1:{upstream_port}/{{location}}"
+            )
+            import main
+
+            proxy = await websockets.serve(main.handle_client, "127.0.0.1", 0)
+            proxy_uri = f"ws://127.0.0.1:{proxy.sockets[0].getsockname()[1]}"
+        else:
+            print(f"Fake upstream listening on port {upstream_port}")
+
+        async with websockets.connect(proxy_uri, max_size=None) as client:
+
+            async def receive():
+                async for _ in client:
+                    client_received.append(time.monotonic())
+
+            receiver = asyncio.create_task(receive())
+            await client.send(config_message(config[3] if config else b"", session))
+            start = time.monotonic()
+            lateness = []
+            for elapsed, direction, size, content in client_records:
+                target = start + (elapsed - config_time) / speed
+                delay = target - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                lateness.append(max(0.0, time.monotonic() - target))
+                client_sent.append(time.monotonic())
+                await client.send(message_content(direction, size, content))
+            await upstream_done.wait()
+            # Give the proxy time to forward the last messages.
+            await asyncio.sleep(0.5)
+            receiver.cancel()
+        if proxy:
+            proxy.close()
+            await proxy.wait_closed()
+
+    duration = records[-1][0] - config_time if records else 0.0
+    print(f"Replayed {duration:.1f}s of session at {speed}x speed")
+    to_upstream = [r - s for s, r in zip(client_sent, upstream_received)]
+    to_client = [r - s for s, r in zip(upstream_sent, client_received)]
+    print(
+        f"Client -> upstream: {len(upstream_received)}/{len(client_records)} "
+        f"messages, latency {percentiles(to_upstream)}"
+    )
+    print(
+        f"Upstream -> client: {len(client_received)}/{len(upstream_records)} "
+        f"messages, latency {percentiles(to_client)}"
+    )
+    print(f"Client send lateness: {percentiles(lateness)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("recording", help="A session recording (.rec) file.")
+    parser.add_argument(
+        "--speed", type=float, default=1.0, help="Replay speed factor (default: 1)."
+    )
+    parser.add_argument(
+        "--proxy", help="URI of a running proxy. By default, the proxy runs in-process."
+    )
+    parser.add_argument(
+        "--upstream-port", type=int, default=0, help="Port of the fake upstream."
+    )
+    parser.add_argument(
+        "--session", help="Session name to use instead of the recorded one."
+    )
+    args = parser.parse_args()
+
+    records = list(read_recording(args.recording))
+    asyncio.run(
+        replay(records, args.proxy, args.upstream_port, args.speed, args.session)
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+"""Measures how sessions recover when the upstream connection drops.
+
+Runs the proxy (``src/main.py``) in-process between:
+
+- a fake upstream, which echoes each client message back, and aborts its
+  connection without a close frame after ``--drop-rate`` of the messages,
+  like a crashed or restarted upstream server. The message that triggered
+  the drop is lost;
+- a client, which sends ``--messages`` messages every ``--interval-ms``,
+  and reconnects with a new session when the proxy closes its connection,
+  as the widget does. Rebuilding a session takes the widget a new token, a
+  new config and a new connection, modelled by ``--rebuild-ms``.
+
+Runs once with ``UPSTREAM_RESUME`` off and once with it on, and reports the
+messages echoed back, the client reconnections, the round-trip latency of
+the messages, and the longest gap between two echoes, i.e. the time the
+client went without answers because of a drop.
+
+Usage:
+    python script/resume_benchmark.py [--messages 500] [--drop-rate 0.02]
+        [--rebuild-ms 1000]
+"""
+
+import argparse
+import asyncio
+import importlib
+import json
+import logging
+import os
+import random
+import statistics
+import sys
+import time
+
+import websockets
+from websockets.exceptions import ConnectionClosed
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+sys.path.insert(0, SRC_DIR)
+
+SESSION = "projects/benchmark/locations/us/apps/benchmark/sessions/benchmark"
+CONFIG = json.dumps(
+    {
+        "config": {
+            "session": SESSION,
+            "environment": "benchmark",
+            "accessToken": "benchmark",
+        }
+    }
+)
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+async def run_client(port, args):
+    """Sends the messages, reconnecting when the session is closed.
+
+    Returns:
+        tuple: The send and receive times of each message, and the number of
+        reconnections.
+    """
+    sent, received = {}, {}
+    reconnects = -1
+    index = 0
+
+    async def receive(client):
+        try:
+            async for message in client:
+                text = json.loads(message).get("sessionOutput", {}).get("text")
+                if text is not None:
+                    received[int(text)] = time.monotonic()
+        except ConnectionClosed:
+            pass
+
+    while index < args.messages:
+        reconnects += 1
+        if reconnects:
+            await asyncio.sleep(args.rebuild_ms / 1000)
+        async with websockets.connect(f"ws://127.0.0.1:{port}") as client:
+            await client.send(CONFIG)
+            receiver = asyncio.create_task(receive(client))
+            while index < args.messages and not receiver.done():
+                sent[index] = time.monotonic()
+                message = json.dumps({"realtimeInput": {"text": str(index)}})
+                try:
+                    await client.send(message)
+                except ConnectionClosed:
+                    break
+                index += 1
+                await asyncio.sleep(args.interval_ms / 1000)
+            # Wait for the last echoes.
+            deadline = time.monotonic() + 2
+            while len(received) < len(sent) and time.monotonic() < deadline:
+                if receiver.done():
+                    break
+                await asyncio.sleep(0.01)
+            receiver.cancel()
+    return sent, received, reconnects
+
+
+async def run(args, resume):
+    os.environ["UPSTREAM_RESUME"] = "true" if resume else "false"
+    import main
+
+    main = importlib.reload(main)
+    async with websockets.serve(main.handle_client, "127.0.0.1", 0) as proxy:
+        port = proxy.sockets[0].getsockname()[1]
+        return await run_client(port, args)
+
+
+async def benchmark(args):
+    rng = random.Random(args.seed)
+    counts = {"connections": 0, "drops": 0}
+
+    async def fake_upstream(websocket):
+        counts["connections"] += 1
+        await websocket.recv()  # The config message.
+        async for message in websocket:
+            if rng.random() < args.drop_rate:
+                counts["drops"] += 1
+                websocket.transport.abort()
+                return
+            text = json.loads(message)["realtimeInput"]["text"]
+            await websocket.send(json.dumps({"sessionOutput": {"text": text}}))
+
+    async with websockets.serve(fake_upstream, "127.0.0.1", 0) as upstream:
+        upstream_port = upstream.sockets[0].getsockname()[1]
+        os.environ["PS_ENDPOINT_TEMPLATE_BENCHMARK"] = (
+            f"ws://127.0.0.1:{upstream_port}/{{location}}"
+        )
+        for resume in (False, True):
+            counts.update(connections=0, drops=0)
+            rng.seed(args.seed)
+            sent, received, reconnects = await run(args, resume)
+            round_trips = [received[i] - sent[i] for i in received]
+            times = sorted(received.values())
+            gap = max(b - a for a, b in zip(times, times[1:])) if times else 0
+            print(f"UPSTREAM_RESUME={'true' if resume else 'false'}:")
+            print(
+                f"  {len(received)}/{args.messages} messages echoed, "
+                f"{counts['drops']} upstream drops, {counts['connections']} "
+                f"upstream connections, {reconnects} client reconnections"
+            )
+            if round_trips:
+                print(
+                    f"  round trip p50 "
+                    f"{statistics.median(round_trips) * 1000:.1f} ms, "
+                    f"p99 {percentile(round_trips, 0.99) * 1000:.1f} ms, "
+                    f"longest gap between echoes {gap * 1000:.0f} ms"
+                )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--messages",
+        type=int,
+        default=500,
+        help="Messages sent by the client (default: 500).",
+    )
+    parser.add_argument(
+        "--interval-ms",
+        type=float,
+        default=20,
+        help="Delay between two client messages (default: 20).",
+    )
+    parser.add_argument(
+        "--drop-rate",
+        type=float,
+        default=0.02,
+        help="Share of the messages after which the upstream drops the "
+        "connection (default: 0.02).",
+    )
+    parser.add_argument(
+        "--rebuild-ms",
+        type=float,
+        default=1000,
+        help="Time the client takes to rebuild a closed session (default: 1000).",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    # The proxy logs a warning for every drop.
+    logging.basicConfig(level=logging.ERROR)
+    asyncio.run(benchmark(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
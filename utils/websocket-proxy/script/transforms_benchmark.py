@@ -0,0 +1,146 @@
+"""Measures the cost of transform pipelines as stages are added.
+
+Generates a mix of upstream messages (audio output, transcripts with personal
+data, and messages carrying ``diagnosticInfo``), and sends it through
+pipelines of 0 to 3 stages (``metrics``, ``strip_keys``, ``redact_pii``).
+Each pipeline runs twice: as the proxy does, with a ``Message`` shared by the
+stages, and with each stage parsing and serializing the message on its own.
+
+Reports the cost per message and the JSON parses per message, showing that
+the cost grows with the work of the stages, while a message is parsed at most
+once however many stages need it.
+
+Usage:
+    python script/transforms_benchmark.py [--messages 20000] [--audio-ratio 0.8]
+"""
+
+import argparse
+import base64
+import json
+import os
+import random
+import sys
+import time
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+sys.path.insert(0, SRC_DIR)
+
+import transforms  # noqa: E402
+from transforms import Message, Pipeline  # noqa: E402
+
+STAGES = ("metrics", "strip_keys", "redact_pii")
+STRIPPED_KEYS = ("diagnosticInfo",)
+
+
+def make_messages(count, audio_ratio, seed=0):
+    """Returns a mix of upstream messages, as received (JSON strings)."""
+    rng = random.Random(seed)
+    # 40 ms of 16 kHz LINEAR16 audio.
+    audio = base64.b64encode(rng.randbytes(1280)).decode("ascii")
+    messages = []
+    for index in range(count):
+        draw = rng.random()
+        if draw < audio_ratio:
+            message = {"sessionOutput": {"audio": audio}}
+        elif draw < audio_ratio + (1 - audio_ratio) / 2:
+            message = {
+                "sessionOutput": {
+                    "text": f"Sure, I sent the receipt of order {index} to "
+                    "jane.doe@example.com, paid with 4111 1111 1111 1111.",
+                    "transcript": "Can you send me the receipt again?",
+                }
+            }
+        else:
+            message = {
+                "sessionOutput": {"text": "One moment please."},
+                "diagnosticInfo": {
+                    "latencies": {f"step{i}": rng.random() for i in range(20)},
+                    "trace": [{"span": i, "ok": True} for i in range(10)],
+                },
+            }
+        messages.append(json.dumps(message))
+    return messages
+
+
+class CountingJson:
+    """Stands for the ``json`` module of ``transforms``, counting parses."""
+
+    def __init__(self):
+        self.parses = 0
+        self.JSONDecodeError = json.JSONDecodeError
+        self.dumps = json.dumps
+
+    def loads(self, raw):
+        self.parses += 1
+        return json.loads(raw)
+
+
+def build(names):
+    return Pipeline.build(names, strip_keys={"keys": STRIPPED_KEYS})
+
+
+def shared(names, messages):
+    """Runs the messages through one pipeline, as the proxy does."""
+    pipeline = build(names)
+    for raw in messages:
+        if pipeline:
+            pipeline.process(raw)
+
+
+def per_stage(names, messages):
+    """Runs each stage on its own, parsing and serializing for every stage."""
+    pipelines = [build((name,)) for name in names]
+    for raw in messages:
+        for pipeline in pipelines:
+            message = Message(raw)
+            # Forces the parse, as a stage that doesn't share it would.
+            message.json
+            if not pipeline.apply(message):
+                break
+            raw = json.dumps(message.json)
+
+
+def measure(run, names, messages):
+    """Returns the cost per message, in microseconds, and the parses."""
+    counting = CountingJson()
+    transforms.json = counting
+    try:
+        start = time.perf_counter()
+        run(names, messages)
+        elapsed = time.perf_counter() - start
+    finally:
+        transforms.json = json
+    return elapsed / len(messages) * 1e6, counting.parses / len(messages)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument(
+        "--audio-ratio",
+        type=float,
+        default=0.8,
+        help="Share of audio messages (default: 0.8).",
+    )
+    args = parser.parse_args()
+
+    messages = make_messages(args.messages, args.audio_ratio)
+    size = sum(map(len, messages)) / len(messages)
+    print(
+        f"{len(messages)} messages, {args.audio_ratio:.0%} audio, "
+        f"{size:.0f} bytes on average"
+    )
+    for count in range(len(STAGES) + 1):
+        names = STAGES[:count]
+        cost, parses = measure(shared, names, messages)
+        split_cost, split_parses = measure(per_stage, names, messages)
+        print(
+            f"{count} stages ({', '.join(names) or 'none'}): "
+            f"shared message {cost:.2f} us, {parses:.2f} parses; "
+            f"parse per stage {split_cost:.2f} us, {split_parses:.2f} parses "
+            "per message"
+        )
+
+
+if __name__ == "__main__":
+    main()
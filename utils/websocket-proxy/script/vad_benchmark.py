@@ -0,0 +1,108 @@
+"""Measures the ``vad`` transform on synthetic speech and silence.
+
+Generates LINEAR16 16 kHz audio alternating talk spurts (voiced sounds, with
+quieter fricatives at their edges) and pauses (background noise), sends it
+through a client pipeline with the ``vad`` transform as audio messages, and
+reports the frames and bytes dropped, the speech frames lost, and the CPU
+cost per frame.
+
+Usage:
+    python script/vad_benchmark.py [--seconds 120] [--frame-ms 20] [--noise-db -60]
+"""
+
+import argparse
+import base64
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+sys.path.insert(0, SRC_DIR)
+
+from transforms import Pipeline  # noqa: E402
+
+SAMPLE_RATE = 16000
+
+
+def synthesize(seconds, noise_db, seed=0):
+    """Returns int16 audio, and whether each sample is speech."""
+    rng = np.random.default_rng(seed)
+    total = int(seconds * SAMPLE_RATE)
+    audio = rng.normal(0, 32768 * 10 ** (noise_db / 20), total)
+    speech = np.zeros(total, dtype=bool)
+    position = int(rng.uniform(0.5, 2) * SAMPLE_RATE)
+    while position < total:
+        # A talk spurt of 0.5 to 3 s, then a pause of 0.5 to 4 s.
+        length = min(int(rng.uniform(0.5, 3) * SAMPLE_RATE), total - position)
+        t = np.arange(length) / SAMPLE_RATE
+        pitch = rng.uniform(90, 250)
+        voiced = sum(np.sin(2 * np.pi * pitch * k * t) / k for k in range(1, 8))
+        # Syllables: a 4 Hz envelope, at -20 dBFS on average.
+        envelope = 0.1 * (0.6 + 0.4 * np.sin(2 * np.pi * 4 * t))
+        spurt = 32768 * envelope * voiced / 2
+        # Fricatives ("s", "f") at -40 dBFS in the first and last 80 ms.
+        edge = int(0.08 * SAMPLE_RATE)
+        hiss = rng.normal(0, 32768 * 0.01, length)
+        spurt[:edge] = hiss[:edge]
+        spurt[-edge:] = hiss[-edge:]
+        audio[position : position + length] += spurt
+        speech[position : position + length] = True
+        position += length + int(rng.uniform(0.5, 4) * SAMPLE_RATE)
+    return np.clip(audio, -32768, 32767).astype("<i2"), speech
+
+
+def run(audio, speech, frame_ms, vad):
+    frame_samples = frame_ms * SAMPLE_RATE // 1000
+    pipeline = Pipeline.build(("vad",) if vad else (), options={"vad": vad})
+    frames = sent_bytes = total_bytes = lost_speech = speech_frames = 0
+    elapsed = 0.0
+    for start in range(0, len(audio) - frame_samples + 1, frame_samples):
+        pcm = audio[start : start + frame_samples].tobytes()
+        message = json.dumps(
+            {"realtimeInput": {"audio": base64.b64encode(pcm).decode("ascii")}}
+        )
+        is_speech = speech[start : start + frame_samples].any()
+        t = time.perf_counter()
+        forwarded = pipeline.process(message) if pipeline else message
+        elapsed += time.perf_counter() - t
+        frames += 1
+        total_bytes += len(message)
+        speech_frames += is_speech
+        if forwarded is None:
+            lost_speech += is_speech
+        else:
+            sent_bytes += len(forwarded)
+    dropped = pipeline.stats()["SilenceSuppressor"]["dropped"] if pipeline else 0
+    return {
+        "frames dropped": f"{dropped}/{frames} ({dropped / frames:.0%})",
+        "bytes saved": f"{1 - sent_bytes / total_bytes:.0%}",
+        "speech frames lost": f"{lost_speech}/{speech_frames}",
+        "cost per frame": f"{elapsed / frames * 1e6:.1f} us",
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--seconds", type=float, default=120)
+    parser.add_argument("--frame-ms", type=int, default=20)
+    parser.add_argument(
+        "--noise-db", type=float, default=-60, help="Background noise level (dBFS)."
+    )
+    args = parser.parse_args()
+
+    audio, speech = synthesize(args.seconds, args.noise_db)
+    print(
+        f"{args.seconds:.0f}s of audio, {speech.mean():.0%} speech, "
+        f"{args.frame_ms} ms frames, noise at {args.noise_db:.0f} dBFS"
+    )
+    for vad in ({"mode": "drop"}, {"mode": "thin"}, None):
+        results = run(audio, speech, args.frame_ms, vad)
+        mode = vad["mode"] if vad else "none"
+        print(f"{mode:>5}: " + ", ".join(f"{k} {v}" for k, v in results.items()))
+
+
+if __name__ == "__main__":
+    main()
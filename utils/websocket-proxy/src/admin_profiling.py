@@ -0,0 +1,200 @@
+"""On-demand profiling of a running proxy.
+
+When ``ADMIN_TOKEN`` is set, ``main.main`` passes ``process_request`` to the
+WebSocket server, so plain HTTP requests to the ``/admin/`` paths below are
+answered instead of being upgraded. They must carry an
+``X-Admin-Token: <ADMIN_TOKEN>`` header (not ``Authorization``, which
+Cloud Run uses for its own authentication):
+
+- ``/admin/profile?seconds=5``: cProfile of the event loop thread, which runs
+  all the sessions, for ``seconds``. Returns a pstats file, to read with
+  ``python -m pstats FILE`` or snakeviz, or a text report with
+  ``format=text``.
+- ``/admin/stacks?seconds=5&interval_ms=10``: samples the stacks of all the
+  threads every ``interval_ms``. Returns collapsed stacks (one
+  ``frame;frame;... count`` line per stack), for flamegraph.pl or speedscope.
+  Cheaper than cProfile, so better suited to a loaded instance.
+- ``/admin/memory?seconds=5&limit=30``: traces memory allocations for
+  ``seconds``, and returns the ``limit`` lines that allocated the most of the
+  memory still in use at the end.
+- ``/admin/tasks``: the stack of every asyncio task, e.g. to find sessions
+  stuck on an ``await``.
+
+Nothing is installed until a request arrives, so there is no overhead
+otherwise, and only one profile runs at a time. Durations must be at most
+``MAX_SECONDS``, because the server gives up on requests that take longer
+than its opening handshake timeout (10 seconds); other values are rejected
+with a 400.
+"""
+
+import asyncio
+import hmac
+import http
+import io
+import logging
+import math
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from urllib.parse import parse_qs, urlsplit
+
+from websockets.datastructures import Headers
+from websockets.http11 import Response
+
+# Enables the /admin/ endpoints, see above.
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+
+MAX_SECONDS = 8
+
+_busy = asyncio.Lock()
+
+
+def collapse(frame):
+    """Returns a stack as ``outermost;...;innermost`` frames."""
+    frames = []
+    while frame is not None:
+        code = frame.f_code
+        frames.append(
+            f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})"
+        )
+        frame = frame.f_back
+    return ";".join(reversed(frames))
+
+
+def sample_stacks(seconds, interval):
+    """Samples the stacks of all the other threads. Blocks for ``seconds``.
+
+    Returns:
+        Counter: The number of samples of each collapsed stack, across
+        threads.
+    """
+    own = threading.get_ident()
+    stacks = Counter()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        for ident, frame in sys._current_frames().items():
+            if ident != own:
+                stacks[collapse(frame)] += 1
+        time.sleep(interval)
+    return stacks
+
+
+async def cpu_profile(seconds, text):
+    """Profiles the event loop thread for ``seconds``."""
+    import cProfile
+    import marshal
+    import pstats
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        profiler.disable()
+    if text:
+        output = io.StringIO()
+        pstats.Stats(profiler, stream=output).sort_stats("cumulative").print_stats(60)
+        return output.getvalue().encode()
+    # What pstats.Stats.dump_stats writes to a file.
+    profiler.create_stats()
+    return marshal.dumps(profiler.stats)
+
+
+async def memory_report(seconds, limit):
+    """Traces allocations for ``seconds``, and reports the largest ones."""
+    import tracemalloc
+
+    # Tracing may also have been started with PYTHONTRACEMALLOC.
+    started = not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    try:
+        await asyncio.sleep(seconds)
+        snapshot = tracemalloc.take_snapshot()
+    finally:
+        if started:
+            tracemalloc.stop()
+    snapshot = snapshot.filter_traces(
+        (tracemalloc.Filter(False, tracemalloc.__file__),)
+    )
+    statistics = snapshot.statistics("lineno")
+    lines = [f"Total: {sum(stat.size for stat in statistics) / 1024:.1f} KiB"]
+    lines.extend(str(stat) for stat in statistics[:limit])
+    return "\n".join(lines).encode()
+
+
+def task_dump():
+    """Returns the stack of every asyncio task."""
+    output = io.StringIO()
+    tasks = asyncio.all_tasks()
+    output.write(f"{len(tasks)} tasks\n")
+    for task in sorted(tasks, key=lambda task: task.get_name()):
+        output.write("\n")
+        task.print_stack(file=output)
+    return output.getvalue().encode()
+
+
+def respond(status, body, content_type="text/plain; charset=utf-8"):
+    headers = Headers(
+        [
+            ("Content-Type", content_type),
+            ("Content-Length", str(len(body))),
+            ("Cache-Control", "no-store"),
+            ("Connection", "close"),
+        ]
+    )
+    status = http.HTTPStatus(status)
+    return Response(status.value, status.phrase, headers, body)
+
+
+async def process_request(connection, request):
+    """Answers the requests to the /admin/ paths, and lets others through.
+
+    Used as the ``process_request`` of the WebSocket server.
+    """
+    url = urlsplit(request.path)
+    if not url.path.startswith("/admin/"):
+        return None
+    token = request.headers.get("X-Admin-Token", "")
+    if not hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode()):
+        logging.warning(f"Rejected admin request from {connection.remote_address}")
+        return respond(401, b"Unauthorized\n")
+
+    query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+    try:
+        seconds = float(query.get("seconds", 5))
+        interval = float(query.get("interval_ms", 10)) / 1000
+        limit = int(query.get("limit", 30))
+    except ValueError:
+        return respond(400, b"Invalid parameter\n")
+    # Also rejects nan, for which every comparison is false.
+    if not 0 < seconds <= MAX_SECONDS:
+        return respond(400, f"seconds must be in (0, {MAX_SECONDS}]\n".encode())
+    if not math.isfinite(interval) or limit < 1:
+        return respond(400, b"Invalid parameter\n")
+    if url.path == "/admin/tasks":
+        return respond(200, task_dump())
+    if url.path not in ("/admin/profile", "/admin/stacks", "/admin/memory"):
+        return respond(404, b"Not found\n")
+    if _busy.locked():
+        return respond(409, b"A profile is already running\n")
+
+    async with _busy:
+        logging.info(f"Admin request: {url.path} for {seconds}s")
+        if url.path == "/admin/profile":
+            text = query.get("format") == "text"
+            body = await cpu_profile(seconds, text)
+            if not text:
+                return respond(200, body, "application/octet-stream")
+        elif url.path == "/admin/stacks":
+            stacks = await asyncio.to_thread(
+                sample_stacks, seconds, max(interval, 0.001)
+            )
+            body = "".join(
+                f"{stack} {count}\n" for stack, count in stacks.most_common()
+            ).encode()
+        else:
+            body = await memory_report(seconds, limit)
+        return respond(200, body)
@@ -12,36 +12,106 @@ Key features:
     the upstream connection.
   - Otherwise, it generates a new OAuth2 access token using the application's
     service account credentials (Application Default Credentials).
-- **Token Caching**: Caches the generated access token in memory to reduce
-  latency and avoid hitting token generation API quotas.
+- **Token Caching**: Caches generated access tokens in a bounded in-memory
+  cache keyed by (principal, scopes). The session's project is billed
+  through the ``X-Goog-User-Project`` header, so a single deployment can
+  serve sessions billed to several projects without minting extra tokens.
 - **Dynamic Upstream Endpoint**: Parses the `session` string from the client's
   initial message to determine the correct regional Google Cloud WebSocket
   endpoint for both Playbooks and Next Gen Agents.
 - **Message Proxying**: Transparently forwards messages between the client and
   the Google backend in both directions.
+- **Message Transforms**: Optionally applies a configurable pipeline of
+  transforms (key stripping, PII redaction, metrics, silence suppression) to
+  the messages of either direction, see `transforms.py`.
 - **Connection Management**: Manages the lifecycle of both client and remote
   connections, including graceful disconnections.
+- **Dead Peer Detection**: Keepalive pings on both legs, and an optional
+  timeout for sessions without client audio. The upstream session is closed
+  as soon as the client is gone, so it stops being billed.
+- **Phone Calls**: Optionally accepts Twilio Media Streams connections, and
+  bridges them to the same agents, see `twilio_bridge.py`.
+- **Upstream Resume**: Optionally reconnects to the upstream when its
+  connection drops, replaying the session config and the client messages
+  received in the meantime, so the client session survives the drop.
+- **Barge-in**: Optionally paces the agent's audio, so that the client has
+  little audio buffered, and drops the rest when the user interrupts the
+  agent, see `playout.py`.
+- **Profiling**: Optionally serves authenticated `/admin/` endpoints that
+  profile the running proxy on demand, see `admin_profiling.py`.
 
 Configuration is managed through environment variables:
-- `PROJECT_ID`: (Optional) GCP Project ID. If not set, it's inferred from the session string.
+- `PROJECT_ID`: (Optional) GCP Project ID. If not set, it's inferred from the
+  session string.
 - `WEBSOCKET_SERVER_PORT`: The local port for the proxy to listen on. Defaults to 8765.
 - `TOKEN_TTL`: The time-to-live for the cached token in seconds. Defaults to 300.
-- `OAUTH_SCOPES`: Comma-separated list of OAuth scopes for the token. Defaults to 'https://www.googleapis.com/auth/cloud-platform'.
+- `OAUTH_SCOPES`: Comma-separated list of OAuth scopes for the token. Defaults to
+  'https://www.googleapis.com/auth/cloud-platform'.
+- `OAUTH_SCOPES_BY_PROJECT`: Optional per-project scope overrides, formatted as
+  `project-a=scope1,scope2;project-b=scope3`.
+- `TOKEN_CACHE_MAX_ENTRIES`: Maximum number of cached tokens. Defaults to 64.
+- `TOKEN_EXPIRY_MARGIN`: Seconds before a token's real expiry at which it is no longer
+  served from the cache. Defaults to 60.
+- `UPSTREAM_RESUME`: Set to "true" to reconnect to the upstream, instead of closing the
+  client connection, when the upstream connection drops.
+- `UPSTREAM_RESUME_TIMEOUT`: Seconds allowed to reconnect to the upstream.
+  Defaults to 5.
+- `UPSTREAM_RESUME_BUFFER_BYTES`: Maximum size of the client messages buffered while
+  reconnecting. Defaults to 262144.
+- `CLIENT_PING_INTERVAL` / `CLIENT_PING_TIMEOUT`: Keepalive pings on the client
+  connection, in seconds. Default to 20. Set the interval to 0 to disable them.
+- `UPSTREAM_PING_INTERVAL` / `UPSTREAM_PING_TIMEOUT`: Keepalive pings on the upstream
+  connection, in seconds. Default to 20. Set the interval to 0 to disable them.
+- `CLOSE_TIMEOUT`: Seconds to wait for a peer to acknowledge a close, on both
+  connections. Defaults to 2.
+- `CLIENT_TRANSFORMS` / `UPSTREAM_TRANSFORMS`: Comma-separated transforms applied to the
+  messages from the client / from the upstream. See `transforms.py`.
+- `AUDIO_COALESCE_MS`: Merges consecutive client audio messages covering up to this many
+  milliseconds of audio into one upstream message. Defaults to 0 (disabled).
+- `TWILIO_PATH`: Path of the Twilio Media Streams endpoint, e.g. `/twilio`. Phone calls
+  are not accepted if not set, or if `TWILIO_AUTH_TOKEN` isn't set.
+- `TWILIO_SESSION_TEMPLATE`: Session of the calls without a `session` stream parameter,
+  e.g. `projects/p/locations/us/apps/a/sessions/{callSid}`.
+- `TWILIO_AUTH_TOKEN`: Twilio auth token, used to verify the signature of Twilio
+  connections. Required to accept phone calls.
+- `RECORD_SAMPLE_PERCENT`: Percentage of sessions recorded for replay with
+  `script/replay.py`. Defaults to 0.
+- `RECORD_DIR`: Where session recordings are written. Defaults to `/tmp/recordings`.
+- `RECORD_CONTENT`: What is recorded of each message: `none` (timing and sizes),
+  `redacted` or `full`. Defaults to `none`.
+- `CLIENT_MAX_SIZE` / `UPSTREAM_MAX_SIZE`: Maximum size of a received message, per
+  connection. Default to 1 MiB and 4 MiB.
+- `CLIENT_MAX_QUEUE` / `UPSTREAM_MAX_QUEUE`: Maximum number of received messages
+  buffered, per connection. Default to 16 and 8.
+- `AUDIO_IDLE_TIMEOUT`: Seconds without audio from the client after which the session is
+  closed. Defaults to 0 (disabled).
+- `OUTPUT_AUDIO_LEAD_MS`: Maximum agent audio sent to the client ahead of its playback,
+  in milliseconds. The rest is held by the proxy, and dropped on barge-in. Defaults to 0
+  (disabled).
+- `BARGE_IN_SPEECH_MS`: With `OUTPUT_AUDIO_LEAD_MS`, client speech after which the proxy
+  interrupts the agent's audio itself, in milliseconds. Defaults to 0 (disabled).
+- `ADMIN_TOKEN`: Token of the `/admin/` profiling endpoints, sent in an `X-Admin-Token`
+  header. They are disabled if not set.
 """
 
 import asyncio
+import datetime
 import json
 import logging
 import os
 import re
+import threading
 import time
 import traceback
+from collections import deque
 
+import admin_profiling
 import google.auth
-import google.cloud.logging
+import playout
+import recorder
 import websockets
-from google.api_core import exceptions
-from google.auth.transport import requests
+from token_cache import TokenCache
+from transforms import AudioCoalescer, Message, Pipeline, parse_transforms
 from websockets.client import connect
 from websockets.exceptions import ConnectionClosedError, ConnectionClosedOK
 
@@ -49,7 +119,8 @@ PROJECT_ID_ENV = os.getenv("PROJECT_ID")
 WEBSOCKET_SERVER_PORT = int(os.getenv("WEBSOCKET_SERVER_PORT", "8765"))
 
 # Authorized origins for WebSocket connections (semicolon-separated).
-# Example: "https://www.google.com;https://staging.google.com.fr;https://beta.google.com"
+# Example:
+# "https://www.google.com;https://staging.google.com.fr;https://beta.google.com"
 AUTHORIZED_ORIGINS_ENV = os.getenv("AUTHORIZED_ORIGINS", "")
 AUTHORIZED_ORIGINS = [
     o.strip().rstrip("/") for o in AUTHORIZED_ORIGINS_ENV.split(";") if o.strip()
@@ -57,11 +128,14 @@ AUTHORIZED_ORIGINS = [
 # Allow localhost origins only when explicitly enabled (for local development).
 ALLOW_LOCALHOST = os.getenv("ALLOW_LOCALHOST", "false").lower() in ("true", "1", "yes")
 
-PBL_ENDPOINT_TEMPLATE = "wss://{location}-dialogflow-webchannel.googleapis.com/ws/google.cloud.dialogflow.v3alpha1.Sessions/BidiStreamingDetectIntent"
-PS_ENDPOINT_TEMPLATE = "wss://ces.googleapis.com/ws/google.cloud.ces.v1.SessionService/BidiRunSession/locations/{location}"
-
-CURRENT_TOKEN = None
-CURRENT_TOKEN_TIMESTAMP = None
+PBL_ENDPOINT_TEMPLATE = (
+    "wss://{location}-dialogflow-webchannel.googleapis.com/ws/"
+    "google.cloud.dialogflow.v3alpha1.Sessions/BidiStreamingDetectIntent"
+)
+PS_ENDPOINT_TEMPLATE = (
+    "wss://ces.googleapis.com/ws/google.cloud.ces.v1.SessionService/"
+    "BidiRunSession/locations/{location}"
+)
 
 # Keys to strip from upstream JSON messages before forwarding to the client.
 # Example: STRIPPED_KEYS="diagnosticInfo;rootSpan"
@@ -72,15 +146,110 @@ _SENSITIVE_KEYS = (
     else None
 )
 
+# Transforms applied to client and upstream messages, see transforms.py.
+# Example: UPSTREAM_TRANSFORMS="redact_pii,metrics"
+CLIENT_TRANSFORMS = parse_transforms(
+    os.getenv("CLIENT_TRANSFORMS", ""), "CLIENT_TRANSFORMS"
+)
+UPSTREAM_TRANSFORMS = parse_transforms(
+    os.getenv("UPSTREAM_TRANSFORMS", ""), "UPSTREAM_TRANSFORMS"
+)
+if _SENSITIVE_KEYS and "strip_keys" not in UPSTREAM_TRANSFORMS:
+    UPSTREAM_TRANSFORMS = ("strip_keys",) + UPSTREAM_TRANSFORMS
+
+
+def get_int_env(name, default):
+    """Reads an integer environment variable, falling back to `default`."""
+    value = os.environ.get(name, str(default))
+    try:
+        return int(value)
+    except (ValueError, TypeError):
+        logging.warning(f"Invalid value for {name}: '{value}'. It must be an integer.")
+        return default
+
+
 # We'll keep updated tokens only for a few minutes.
-TOKEN_TTL = os.environ.get("TOKEN_TTL", "300")
-try:
-    TOKEN_TTL = int(TOKEN_TTL)
-except (ValueError, TypeError):
-    logging.warning(
-        f"Invalid value for TOKEN_TTL: '{TOKEN_TTL}'. It must be an integer."
+TOKEN_TTL = get_int_env("TOKEN_TTL", 300)
+TOKEN_CACHE_MAX_ENTRIES = get_int_env("TOKEN_CACHE_MAX_ENTRIES", 64)
+TOKEN_EXPIRY_MARGIN = get_int_env("TOKEN_EXPIRY_MARGIN", 60)
+
+# Reconnection to the upstream when its connection drops.
+UPSTREAM_RESUME = os.getenv("UPSTREAM_RESUME", "false").lower() in ("true", "1", "yes")
+UPSTREAM_RESUME_TIMEOUT = get_int_env("UPSTREAM_RESUME_TIMEOUT", 5)
+UPSTREAM_RESUME_BUFFER_BYTES = get_int_env("UPSTREAM_RESUME_BUFFER_BYTES", 256 * 1024)
+
+# Keepalive and dead peer detection. A ping interval of 0 disables pings.
+CLIENT_PING_INTERVAL = get_int_env("CLIENT_PING_INTERVAL", 20) or None
+CLIENT_PING_TIMEOUT = get_int_env("CLIENT_PING_TIMEOUT", 20)
+UPSTREAM_PING_INTERVAL = get_int_env("UPSTREAM_PING_INTERVAL", 20) or None
+UPSTREAM_PING_TIMEOUT = get_int_env("UPSTREAM_PING_TIMEOUT", 20)
+CLOSE_TIMEOUT = get_int_env("CLOSE_TIMEOUT", 2)
+AUDIO_IDLE_TIMEOUT = get_int_env("AUDIO_IDLE_TIMEOUT", 0)
+
+# Per-leg limits on the size of a message and on the number of received
+# messages buffered before reading from the socket pauses. The worst-case
+# receive buffer of a session is roughly max_size * max_queue on each leg.
+CLIENT_MAX_SIZE = get_int_env("CLIENT_MAX_SIZE", 2**20)
+CLIENT_MAX_QUEUE = get_int_env("CLIENT_MAX_QUEUE", 16)
+UPSTREAM_MAX_SIZE = get_int_env("UPSTREAM_MAX_SIZE", 2**22)
+UPSTREAM_MAX_QUEUE = get_int_env("UPSTREAM_MAX_QUEUE", 8)
+
+# Window over which consecutive client audio messages are merged before being
+# sent upstream, in milliseconds of audio. 0 disables coalescing.
+AUDIO_COALESCE_MS = get_int_env("AUDIO_COALESCE_MS", 0)
+
+# Paced delivery of the agent's audio and barge-in, see playout.py. 0
+# disables them.
+OUTPUT_AUDIO_LEAD_MS = get_int_env("OUTPUT_AUDIO_LEAD_MS", 0)
+BARGE_IN_SPEECH_MS = get_int_env("BARGE_IN_SPEECH_MS", 0)
+
+# Path of the Twilio Media Streams endpoint, see twilio_bridge.py. Phone calls
+# are only accepted when it's set, e.g. to "/twilio".
+TWILIO_PATH = os.getenv("TWILIO_PATH", "")
+if TWILIO_PATH and not os.getenv("TWILIO_AUTH_TOKEN"):
+    # Calls aren't subject to AUTHORIZED_ORIGINS: their Twilio signature is
+    # the only thing keeping anyone from opening sessions on our account.
+    logging.error("TWILIO_PATH is set without TWILIO_AUTH_TOKEN, phone calls disabled.")
+    TWILIO_PATH = ""
+
+# Sampled session recording, see recorder.py.
+RECORD_SAMPLE_PERCENT = get_int_env("RECORD_SAMPLE_PERCENT", 0)
+RECORD_DIR = os.getenv("RECORD_DIR", "/tmp/recordings")
+RECORD_CONTENT = os.getenv("RECORD_CONTENT", "none").lower()
+if RECORD_CONTENT not in recorder.CONTENT_MODES:
+    logging.warning(f"Invalid RECORD_CONTENT '{RECORD_CONTENT}', using 'none'.")
+    RECORD_CONTENT = "none"
+
+# Session counters, logged when a session ends.
+SESSION_STATS = {
+    "active": 0,
+    "reclaimed_dead_client": 0,
+    "reclaimed_idle": 0,
+}
+
+
+def parse_scopes(scopes_str):
+    """Splits a comma-separated scope list into a sorted, de-duplicated tuple."""
+    return tuple(
+        sorted({scope.strip() for scope in scopes_str.split(",") if scope.strip()})
     )
-    TOKEN_TTL = 300
+
+
+# Per-project scope overrides, e.g. "project-a=scope1,scope2;project-b=scope3".
+SCOPES_BY_PROJECT = {}
+for _entry in os.getenv("OAUTH_SCOPES_BY_PROJECT", "").split(";"):
+    _project, _, _project_scopes = _entry.partition("=")
+    if _project.strip() and parse_scopes(_project_scopes):
+        SCOPES_BY_PROJECT[_project.strip()] = parse_scopes(_project_scopes)
+    elif _entry.strip():
+        logging.warning(f"Ignoring invalid OAUTH_SCOPES_BY_PROJECT entry: '{_entry}'")
+
+
+TOKEN_CACHE = TokenCache(TOKEN_CACHE_MAX_ENTRIES, TOKEN_TTL, TOKEN_EXPIRY_MARGIN)
+
+# ADC credentials, loaded once per scope set.
+_credentials_by_scopes = {}
+_credentials_lock = threading.Lock()
 
 
 def is_origin_allowed(origin):
@@ -88,7 +257,8 @@ def is_origin_allowed(origin):
     Checks whether the given Origin header value is in the allow-list.
 
     Returns True if:
-      - AUTHORIZED_ORIGINS is empty (not configured — permissive fallback, logged as warning at startup).
+      - AUTHORIZED_ORIGINS is empty (not configured — permissive fallback,
+        logged as warning at startup).
       - The origin matches one of the configured AUTHORIZED_ORIGINS exactly.
       - ALLOW_LOCALHOST is enabled and the origin is http://localhost[:port].
     """
@@ -110,81 +280,126 @@ def is_origin_allowed(origin):
     return False
 
 
-def _strip_keys_recursive(obj):
-    """Recursively remove sensitive keys from a JSON-like structure.
+def build_remote_headers(access_token, project_id):
+    """Returns the headers of the upstream WebSocket handshake."""
+    headers = {
+        "Authorization": f"Bearer {access_token}",
+        "Content-Type": "application/json",
+    }
+
+    # Add the GCP billing project ID
+    if project_id:
+        headers["X-Goog-User-Project"] = project_id
+    return headers
+
+
+async def connect_remote(url, headers):
+    """Opens the upstream WebSocket connection."""
+    return await connect(
+        url,
+        max_size=UPSTREAM_MAX_SIZE,
+        max_queue=UPSTREAM_MAX_QUEUE,
+        extra_headers=headers,
+        ping_interval=UPSTREAM_PING_INTERVAL,
+        ping_timeout=UPSTREAM_PING_TIMEOUT,
+        close_timeout=CLOSE_TIMEOUT,
+    )
 
-    Walks dicts and lists in-place, deleting any key present in
-    ``_SENSITIVE_KEYS``.
 
-    Returns:
-        True if at least one key was removed anywhere in the tree.
-    """
-    modified = False
-    if isinstance(obj, dict):
-        for key in _SENSITIVE_KEYS & obj.keys():
-            del obj[key]
-            modified = True
-        for value in obj.values():
-            if _strip_keys_recursive(value):
-                modified = True
-    elif isinstance(obj, list):
-        for item in obj:
-            if _strip_keys_recursive(item):
-                modified = True
-    return modified
-
-
-def _strip_diagnostic_info(message):
-    """Remove sensitive fields from an upstream JSON message.
+def is_audio_message(message):
+    """Whether a client message carries audio, without parsing it."""
+    if isinstance(message, bytes):
+        return b'"audio"' in message
+    return '"audio"' in message
 
-    Args:
-        message: The raw WebSocket message (str or bytes).
 
-    Returns:
-        The sanitized message as a string, or the original message unchanged.
+class ResumeBuffer:
+    """Client messages received while the upstream is reconnecting.
+
+    The buffer holds at most ``max_bytes``; the oldest messages are dropped
+    first, since stale audio is the least useful to the agent.
     """
-    if _SENSITIVE_KEYS is None or not _SENSITIVE_KEYS:
-        return message
 
-    if not isinstance(message, str):
-        return message
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.dropped = 0
+        self._messages = deque()
 
-    try:
-        data = json.loads(message)
-    except (json.JSONDecodeError, ValueError):
-        return message
+    def __bool__(self):
+        return bool(self._messages)
 
-    if not isinstance(data, dict):
-        return message
+    def append(self, message):
+        self._messages.append(message)
+        self.size += len(message)
+        while self.size > self.max_bytes:
+            self.size -= len(self._messages.popleft())
+            self.dropped += 1
 
-    if not _strip_keys_recursive(data):
+    def peek(self):
+        return self._messages[0]
+
+    def popleft(self):
+        message = self._messages.popleft()
+        self.size -= len(message)
         return message
 
-    return json.dumps(data)
 
+class ProxySession:
+    """State of a proxied session, between a client and the remote WebSocket.
 
-async def handle_client(client_websocket):
-    """
-    Handles a client connection, acting as a proxy to the remote WebSocket.
+    Sessions are long-lived and numerous, so the state is kept in slots, and
+    data only needed to set up the session (e.g. the parsed config message)
+    is not kept once the upstream connection is established.
     """
-    access_token = None
-    remote_websocket = None
-    project_id = PROJECT_ID_ENV
 
-    logging.info(f"Client connected from: {client_websocket.remote_address}")
+    __slots__ = (
+        "client_websocket",
+        "remote_websocket",
+        "remote_websocket_url",
+        "project_id",
+        "client_access_token",
+        "config_json",
+        "resume_buffer",
+        "last_audio",
+        "client_pipeline",
+        "upstream_pipeline",
+        "recorder",
+        "coalescer",
+        "flush_timer",
+        "pacer",
+    )
 
-    # --- Origin verification ---
-    origin = client_websocket.request.headers.get("Origin")
-    if not is_origin_allowed(origin):
-        logging.warning(
-            f"Rejected WebSocket connection from unauthorized origin: {origin}"
+    def __init__(self, client_websocket):
+        self.client_websocket = client_websocket
+        self.remote_websocket = None
+        self.remote_websocket_url = None
+        self.project_id = PROJECT_ID_ENV
+        # Only kept when ``UPSTREAM_RESUME`` is enabled, to resume the session.
+        self.client_access_token = None
+        self.config_json = None
+        # Set while reconnecting to the upstream, see ``resume_remote``.
+        self.resume_buffer = None
+        self.last_audio = time.monotonic()
+        self.client_pipeline = None
+        self.upstream_pipeline = None
+        self.recorder = recorder.SessionRecorder.sample(
+            RECORD_SAMPLE_PERCENT, RECORD_DIR, RECORD_CONTENT
         )
-        await client_websocket.close(code=4003, reason="Origin not allowed")
-        return
+        self.coalescer = (
+            AudioCoalescer(AUDIO_COALESCE_MS) if AUDIO_COALESCE_MS else None
+        )
+        self.flush_timer = None
+        self.pacer = None
 
-    try:
+    async def setup(self):
+        """
+        Handles the initial config message, and connects to the remote WebSocket.
 
-        # Step 1: Handle the initial config message
+        Returns:
+            True if the session is ready, False if the client connection was closed.
+        """
+        client_websocket = self.client_websocket
         try:
             first_message = await client_websocket.recv()
             first_message_json = json.loads(first_message)
@@ -196,26 +411,10 @@ async def handle_client(client_websocket):
                 logging.debug(f"Received config message: {first_message_json}")
                 access_token = config_message.pop("accessToken", None)
                 environment = config_message.pop("environment", None)
+                # Proxy-side silence suppression options, see SilenceSuppressor.
+                vad_options = config_message.pop("vad", None)
                 session_string = config_message.get("session", None)
 
-                if access_token:
-                    logging.debug("Extracted access token from config message.")
-                else:
-                    # Check if the token is cached and not expired
-                    if (
-                        CURRENT_TOKEN
-                        and CURRENT_TOKEN_TIMESTAMP
-                        and (time.time() - CURRENT_TOKEN_TIMESTAMP < TOKEN_TTL)
-                    ):
-                        logging.debug("Returning cached access token.")
-                    else:  # Otherwise, refresh it
-                        logging.debug(
-                            "Cached token is expired or missing. Refreshing..."
-                        )
-                        if not refresh_token():
-                            logging.warning("No access token found in config message.")
-                    access_token = CURRENT_TOKEN
-
                 if session_string:
                     # Extract location from the session string
                     match = re.search(
@@ -223,11 +422,10 @@ async def handle_client(client_websocket):
                         session_string,
                     )
                     if match:
-                        if not project_id:
-                            project_id = match.group(1)
+                        if not self.project_id:
+                            self.project_id = match.group(1)
                         location = match.group(2)
                         session_type = match.group(3)
-                        remote_websocket_url = None
                         url_template = None
                         if session_type == "agents":
                             # Playbooks Live
@@ -249,9 +447,12 @@ async def handle_client(client_websocket):
                                 )
                             else:
                                 url_template = PS_ENDPOINT_TEMPLATE
-                        remote_websocket_url = url_template.format(location=location)
+                        self.remote_websocket_url = url_template.format(
+                            location=location
+                        )
                         logging.info(
-                            f"Generated remote websocket URL {remote_websocket_url}"
+                            "Generated remote websocket URL "
+                            f"{self.remote_websocket_url}"
                         )
                     else:
                         logging.error(
@@ -260,31 +461,60 @@ async def handle_client(client_websocket):
                         await client_websocket.close(
                             code=1002, reason="Invalid session format"
                         )
-                        return
+                        return False
                 else:
                     logging.error("No session string found in config message")
                     await client_websocket.close(
                         code=1002, reason="No session provided"
                     )
-                    return
+                    return False
 
-                # Inject headers, forward config message (without access token)
-                headers = {
-                    "Authorization": f"Bearer {access_token}",
-                    "Content-Type": "application/json",
-                }
+                if UPSTREAM_RESUME:
+                    self.client_access_token = access_token
+                if access_token:
+                    logging.debug("Extracted access token from config message.")
+                else:
+                    access_token = get_cached_token(self.project_id)
+                    if not access_token:
+                        logging.warning("No access token found in config message.")
 
-                # Add the GCP billing project ID
-                if project_id:
-                    headers["X-Goog-User-Project"] = project_id
+                # Inject headers, forward config message (without access token)
+                headers = build_remote_headers(access_token, self.project_id)
+
+                # A session can enable silence suppression, or turn it off.
+                client_transforms = CLIENT_TRANSFORMS
+                if not isinstance(vad_options, dict):
+                    vad_options = None
+                elif vad_options.get("mode") == "off":
+                    client_transforms = tuple(
+                        t for t in client_transforms if t != "vad"
+                    )
+                elif "vad" not in client_transforms:
+                    client_transforms += ("vad",)
+                self.client_pipeline = Pipeline.build(
+                    client_transforms, options={"vad": vad_options}
+                )
+                self.upstream_pipeline = Pipeline.build(
+                    UPSTREAM_TRANSFORMS, strip_keys={"keys": _SENSITIVE_KEYS}
+                )
+                # Playbooks sessions are not paced: their barge-in is decided
+                # by the widget, see playout.py.
+                if OUTPUT_AUDIO_LEAD_MS and "/agents/" not in session_string:
+                    self.pacer = playout.OutputPacer(
+                        self.send_msg_to_client,
+                        OUTPUT_AUDIO_LEAD_MS,
+                        playout.output_bytes_per_second(config_message),
+                        BARGE_IN_SPEECH_MS,
+                        vad_options,
+                    )
 
                 # Connect to remote WS *after* getting the access token.
                 try:
                     logging.info(
-                        f"Connecting to remote WebSocket {remote_websocket_url}"
+                        f"Connecting to remote WebSocket {self.remote_websocket_url}"
                     )
-                    remote_websocket = await connect(
-                        remote_websocket_url, max_size=2**22, extra_headers=headers
+                    self.remote_websocket = await connect_remote(
+                        self.remote_websocket_url, headers
                     )
                     logging.debug("Connected to remote WebSocket.")
                 except Exception as e:
@@ -294,119 +524,350 @@ async def handle_client(client_websocket):
                     await client_websocket.close(
                         code=1011, reason="Upstream service unavailable"
                     )
-                    return  # close connection
+                    return False  # close connection
 
-                await remote_websocket.send(
-                    json.dumps(first_message_json)
-                )  # Send original first message
+                # Send original first message
+                config_json = json.dumps(first_message_json)
+                await self.remote_websocket.send(config_json)
+                if self.recorder:
+                    self.recorder.record(recorder.CONFIG, config_json)
+                if UPSTREAM_RESUME:
+                    self.config_json = config_json
+                return True
 
             else:
                 logging.warning(
                     "First message did not contain configMessage. Closing connection."
                 )
                 await client_websocket.close(code=1002, reason="Invalid first message")
-                return  # Close client connection if the first message is invalid
+                return False  # Close client connection if the first message is invalid
 
         except json.JSONDecodeError:
             logging.error("Invalid JSON in first message. Closing connection.")
             await client_websocket.close(code=1002, reason="Invalid JSON")
-            return
+            return False
         except Exception as e:
             logging.error(f"Error processing first message {e}")
             trace = traceback.format_exc()
             logging.error(f"Full traceback:\n{trace}")
 
             await client_websocket.close(code=1011, reason="Internal server error")
-            return
+            return False
 
-        # Step 2: Proxy subsequent messages
-        async def process_messages_from_client():
-            try:
-                async for message in client_websocket:
-                    # logging.info("Received message from client, forwarding to remote...")
-                    if remote_websocket and remote_websocket.close_code is None:
-                        await remote_websocket.send(message)
-                    elif not remote_websocket:
-                        logging.warning(
-                            "Remote WebSocket is not connected, cannot forward client message."
-                        )
-                    elif remote_websocket.close_code is not None:
-                        logging.warning(
-                            "Remote WebSocket is already closed, cannot forward client message."
-                        )
-                        break  # Exit the loop if remote is closed
-            except (ConnectionClosedOK, ConnectionClosedError) as e:
+    async def process_messages_from_client(self):
+        try:
+            async for message in self.client_websocket:
+                # logging.info("Received message from client, forwarding to remote...")
+                if AUDIO_IDLE_TIMEOUT and is_audio_message(message):
+                    self.last_audio = time.monotonic()
+                # Barge-in detection and the pipeline share the parsed
+                # message, and its decoded audio.
+                parsed = None
+                if self.pacer and self.pacer.speech_ms and is_audio_message(message):
+                    parsed = Message(message)
+                    if not await self.pacer.client_audio(parsed):
+                        break
+                if self.recorder:
+                    self.recorder.record(recorder.FROM_CLIENT, message)
+                if self.client_pipeline:
+                    parsed = parsed or Message(message)
+                    if not self.client_pipeline.apply(parsed):
+                        continue
+                    message = parsed.serialize()
+                if self.coalescer:
+                    if self.coalescer.add(message):
+                        if not self.coalescer.full():
+                            self.schedule_audio_flush()
+                            continue
+                        message = self.flush_audio()
+                    else:
+                        # Forward the pending audio first, to keep the order.
+                        pending = self.flush_audio()
+                        if pending and not await self.forward_to_remote(pending):
+                            break
+                if not await self.forward_to_remote(message):
+                    break  # Exit the loop if remote is closed
+            if self.coalescer:
+                pending = self.flush_audio()
+                if pending:
+                    await self.forward_to_remote(pending)
+            # The client closed the connection normally: end the upstream
+            # session too, instead of waiting for the upstream to time out.
+            if self.remote_websocket and self.remote_websocket.close_code is None:
+                logging.info("Client closed, explicitly closing remote websocket.")
+                await self.remote_websocket.close()
+        except (ConnectionClosedOK, ConnectionClosedError) as e:
+            logging.info(
+                f"Client disconnected:\n  code: {e.code}\n  reason: {e.reason}\n"
+                f"  error: {e}"
+            )
+            if self.remote_websocket and self.remote_websocket.close_code is None:
+                if e.rcvd is None:
+                    # The client vanished without a close frame, e.g. it
+                    # stopped answering keepalive pings.
+                    SESSION_STATS["reclaimed_dead_client"] += 1
                 logging.info(
-                    f"Client disconnected:\n  code: {e.code}\n  reason: {e.reason}\n  error: {e}"
+                    "Client disconnected, explicitly closing remote websocket."
                 )
-                if remote_websocket and remote_websocket.close_code is None:
-                    logging.info(
-                        "Client disconnected, explicitly closing remote websocket."
-                    )
-                    await remote_websocket.close()
-                return  # Exit the process_messages_from_client coroutine
-            except Exception as e:
-                logging.error(f"Error forwarding client message to remote: {e}")
-                if remote_websocket and remote_websocket.close_code is None:
-                    logging.info(
-                        "Error in client forwarding, attempting to close remote websocket."
-                    )
-                    await remote_websocket.close()
-                return  # Exit on error
+                await self.remote_websocket.close()
+            return  # Exit the process_messages_from_client coroutine
+        except Exception as e:
+            logging.error(f"Error forwarding client message to remote: {e}")
+            if self.remote_websocket and self.remote_websocket.close_code is None:
+                logging.info(
+                    "Error in client forwarding, attempting to close remote websocket."
+                )
+                await self.remote_websocket.close()
+            return  # Exit on error
+
+    async def forward_to_remote(self, message):
+        """Sends a client message to the remote WebSocket, or buffers it while
+        the upstream session is being resumed.
+
+        Returns:
+            False if the remote WebSocket is closed for good.
+        """
+        remote_websocket = self.remote_websocket
+        if self.resume_buffer is not None:
+            self.resume_buffer.append(message)
+        elif remote_websocket and remote_websocket.close_code is None:
+            try:
+                await remote_websocket.send(message)
+            except (ConnectionClosedOK, ConnectionClosedError):
+                if not UPSTREAM_RESUME:
+                    return False
+                # The remote loop is about to resume the session.
+                logging.info("Remote WebSocket closed, buffering client message.")
+                self.resume_buffer = ResumeBuffer(UPSTREAM_RESUME_BUFFER_BYTES)
+                self.resume_buffer.append(message)
+        elif not remote_websocket:
+            logging.warning(
+                "Remote WebSocket is not connected, cannot forward client message."
+            )
+        elif remote_websocket.close_code is not None:
+            logging.warning(
+                "Remote WebSocket is already closed, cannot forward client message."
+            )
+            return False
+        return True
 
-        async def process_messages_from_remote():
+    def flush_audio(self):
+        """Returns the coalesced client audio, if any, as one message."""
+        if self.flush_timer:
+            self.flush_timer.cancel()
+            self.flush_timer = None
+        return self.coalescer.flush()
+
+    def schedule_audio_flush(self):
+        """Makes sure coalesced audio is sent even if the client pauses."""
+        if self.flush_timer is None:
+            self.flush_timer = asyncio.get_running_loop().call_later(
+                AUDIO_COALESCE_MS / 1000,
+                lambda: asyncio.ensure_future(self.send_coalesced_audio()),
+            )
+
+    async def send_coalesced_audio(self):
+        self.flush_timer = None
+        message = self.flush_audio()
+        if message:
+            await self.forward_to_remote(message)
+
+    async def resume_remote(self):
+        """Reconnects to the upstream, replaying the session config and the
+        client messages buffered in the meantime.
+
+        Returns:
+            True if the session was resumed.
+        """
+        if self.resume_buffer is None:
+            self.resume_buffer = ResumeBuffer(UPSTREAM_RESUME_BUFFER_BYTES)
+        resume_buffer = self.resume_buffer
+        start = time.monotonic()
+        deadline = start + UPSTREAM_RESUME_TIMEOUT
+        attempt = 0
+        while self.client_websocket.close_code is None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            new_remote = None
             try:
-                async for message in remote_websocket:
-                    sanitized = _strip_diagnostic_info(message) if _SENSITIVE_KEYS is not None else message
-                    if not await send_msg_to_client(sanitized):
-                        logging.warning("send_msg_to_client failed. Breaking loop.")
-                        break
-            except (ConnectionClosedOK, ConnectionClosedError) as e:
-                logging.info(f"Remote connection closed: {e}")
-                # send a message to the client with the reson of the connection closure
-                error_msg = {
-                    "connection_closed": type(e).__name__,
-                    "reason": e.reason,
-                    "code": e.code,
-                }
-                await send_msg_to_client(json.dumps(error_msg))
-                # Then close the connection with the client
-                if client_websocket and client_websocket.close_code is None:
-                    logging.info(
-                        "Remote disconnected, explicitly closing client websocket."
-                    )
-                    await client_websocket.close()
+                # Tokens minted by the proxy may have been refreshed since.
+                token = self.client_access_token or get_cached_token(self.project_id)
+                new_remote = await asyncio.wait_for(
+                    connect_remote(
+                        self.remote_websocket_url,
+                        build_remote_headers(token, self.project_id),
+                    ),
+                    remaining,
+                )
+                await new_remote.send(self.config_json)
+                while resume_buffer:
+                    # Messages are only dropped from the buffer once sent, so
+                    # that the next attempt replays them if this one fails.
+                    await new_remote.send(resume_buffer.peek())
+                    resume_buffer.popleft()
             except Exception as e:
-                logging.error(f"Error in process_messages_from_remote: {e}")
-                trace = traceback.format_exc()
-                logging.error(f"Full traceback:\n{trace}")
-            finally:
-                logging.info("Exiting process_messages_from_remote loop.")
+                attempt += 1
+                logging.warning(f"Upstream resume attempt {attempt} failed: {e}")
+                if new_remote is not None:
+                    await new_remote.close()
+                await asyncio.sleep(min(0.1 * 2**attempt, 1))
+                continue
+            logging.info(
+                f"Resumed upstream session in {time.monotonic() - start:.3f}s "
+                f"({resume_buffer.dropped} buffered client messages dropped)."
+            )
+            # No await between the final buffer flush and this switch, so
+            # no client message can be lost in between.
+            self.remote_websocket, self.resume_buffer = new_remote, None
+            return True
+        logging.error("Could not resume the upstream session.")
+        return False
 
-        async def send_msg_to_client(message):
-            if client_websocket.close_code is None:
+    async def process_messages_from_remote(self):
+        client_websocket = self.client_websocket
+        try:
+            while True:
                 try:
-                    await client_websocket.send(message)
-                except (ConnectionClosedOK, ConnectionClosedError):
-                    logging.info(
-                        "Client connection closed, stopping forwarding from remote."
-                    )
-                    return False
-                except Exception as e:
-                    logging.error(f"Error sending to client: {e}")
-                    trace = traceback.format_exc()
-                    logging.error(f"Full traceback:\n{trace}")
-                    return False
-            else:
+                    async for message in self.remote_websocket:
+                        if self.recorder:
+                            self.recorder.record(recorder.FROM_UPSTREAM, message)
+                        if self.pacer:
+                            # The pacer reads the message parsed by the pipeline.
+                            parsed = Message(message)
+                            pipeline = self.upstream_pipeline
+                            if pipeline and not pipeline.apply(parsed):
+                                continue
+                            sent = await self.pacer.put(parsed)
+                        else:
+                            if self.upstream_pipeline:
+                                message = self.upstream_pipeline.process(message)
+                                if message is None:
+                                    continue
+                            sent = await self.send_msg_to_client(message)
+                        if not sent:
+                            logging.warning("send_msg_to_client failed. Breaking loop.")
+                            return
+                    break
+                except ConnectionClosedError as e:
+                    if not UPSTREAM_RESUME or client_websocket.close_code is not None:
+                        raise
+                    logging.warning(f"Remote connection dropped, resuming: {e}")
+                    if not await self.resume_remote():
+                        raise
+        except (ConnectionClosedOK, ConnectionClosedError) as e:
+            logging.info(f"Remote connection closed: {e}")
+            if self.pacer:
+                # Let the client play the rest of the agent's audio first.
+                await self.pacer.drain()
+            # send a message to the client with the reson of the connection closure
+            error_msg = {
+                "connection_closed": type(e).__name__,
+                "reason": e.reason,
+                "code": e.code,
+            }
+            await self.send_msg_to_client(json.dumps(error_msg))
+            # Then close the connection with the client
+            if client_websocket and client_websocket.close_code is None:
                 logging.info(
-                    "Client connection is closed, not forwarding message from remote."
+                    "Remote disconnected, explicitly closing client websocket."
+                )
+                await client_websocket.close()
+        except Exception as e:
+            logging.error(f"Error in process_messages_from_remote: {e}")
+            trace = traceback.format_exc()
+            logging.error(f"Full traceback:\n{trace}")
+        finally:
+            logging.info("Exiting process_messages_from_remote loop.")
+
+    async def send_msg_to_client(self, message):
+        client_websocket = self.client_websocket
+        if client_websocket.close_code is None:
+            try:
+                await client_websocket.send(message)
+            except (ConnectionClosedOK, ConnectionClosedError):
+                logging.info(
+                    "Client connection closed, stopping forwarding from remote."
                 )
                 return False
-            return True
+            except Exception as e:
+                logging.error(f"Error sending to client: {e}")
+                trace = traceback.format_exc()
+                logging.error(f"Full traceback:\n{trace}")
+                return False
+        else:
+            logging.info(
+                "Client connection is closed, not forwarding message from remote."
+            )
+            return False
+        return True
+
+    async def close_idle_session(self):
+        """Closes the session once the client stops sending audio."""
+        client_websocket = self.client_websocket
+        while client_websocket.close_code is None:
+            idle = time.monotonic() - self.last_audio
+            if idle >= AUDIO_IDLE_TIMEOUT:
+                SESSION_STATS["reclaimed_idle"] += 1
+                logging.info(f"No client audio for {idle:.0f}s, closing session.")
+                # The client loop then closes the remote websocket.
+                await client_websocket.close(code=4008, reason="Idle timeout")
+                return
+            await asyncio.sleep(AUDIO_IDLE_TIMEOUT - idle)
+
+
+async def handle_client(client_websocket):
+    """
+    Handles a client connection, acting as a proxy to the remote WebSocket.
+    """
+    logging.info(f"Client connected from: {client_websocket.remote_address}")
+
+    if TWILIO_PATH and client_websocket.request.path.split("?")[0] == TWILIO_PATH:
+        # Phone calls, authenticated by their Twilio signature rather than
+        # their origin. numpy is only loaded when the bridge is used.
+        import twilio_bridge
+
+        await twilio_bridge.handle_call(client_websocket, run_session)
+        return
+
+    # --- Origin verification ---
+    origin = client_websocket.request.headers.get("Origin")
+    if not is_origin_allowed(origin):
+        logging.warning(
+            f"Rejected WebSocket connection from unauthorized origin: {origin}"
+        )
+        await client_websocket.close(code=4003, reason="Origin not allowed")
+        return
+
+    await run_session(client_websocket)
+
+
+async def run_session(client_websocket):
+    """
+    Proxies a client session: the config message, then messages in both
+    directions until either side closes.
+    """
+    session = None
+    idle_watchdog = None
+    try:
+        # Counted inside the try, so that the finally block always uncounts it.
+        SESSION_STATS["active"] += 1
+        session = ProxySession(client_websocket)
+
+        # Step 1: Handle the initial config message
+        if not await session.setup():
+            return
+
+        # Step 2: Proxy subsequent messages
+        if AUDIO_IDLE_TIMEOUT:
+            idle_watchdog = asyncio.create_task(session.close_idle_session())
+        if session.pacer:
+            session.pacer.start()
 
         # Run forwarding tasks concurrently
         await asyncio.gather(
-            process_messages_from_client(), process_messages_from_remote()
+            session.process_messages_from_client(),
+            session.process_messages_from_remote(),
         )
 
     except ConnectionRefusedError as e:
@@ -417,52 +878,109 @@ async def handle_client(client_websocket):
         logging.error(f"An error occurred in handle_client: {e}")
     finally:
         logging.info(
-            f"Client disconnected from: {client_websocket.remote_address} (handle_client finally)"
+            f"Client disconnected from: {client_websocket.remote_address} "
+            "(run_session finally)"
         )
-        if remote_websocket and remote_websocket.close_code is None:
-            try:
-                await remote_websocket.close()  # Close connection in finally as a backup
-            except Exception as e:
-                logging.error(f"Error closing remote websocket in finally: {e}")
+        SESSION_STATS["active"] -= 1
+        logging.info(f"Session stats: {SESSION_STATS}")
+        if idle_watchdog:
+            idle_watchdog.cancel()
+        # Nothing else to clean up if the session failed to initialize.
+        if session is not None:
+            for name, pipeline in (
+                ("Client", session.client_pipeline),
+                ("Upstream", session.upstream_pipeline),
+            ):
+                if pipeline and pipeline.stats():
+                    logging.info(f"{name} transform stats: {pipeline.stats()}")
+            if session.recorder:
+                session.recorder.close()
+            if session.coalescer:
+                if session.flush_timer:
+                    session.flush_timer.cancel()
+                logging.info(f"Audio coalescing stats: {session.coalescer.stats()}")
+            if session.pacer:
+                session.pacer.close()
+                logging.info(f"Output audio pacing stats: {session.pacer.stats()}")
+            remote_websocket = session.remote_websocket
+            if remote_websocket and remote_websocket.close_code is None:
+                try:
+                    # Close connection in finally as a backup
+                    await remote_websocket.close()
+                except Exception as e:
+                    logging.error(f"Error closing remote websocket in finally: {e}")
 
 
-def refresh_token():
+def get_cached_token(project_id=None):
     """
-    Generates an access token using Application Default Credentials and saves it
-    in a global variable.
+    Returns an access token for the given project, from the cache if possible.
+
+    The scopes come from ``OAUTH_SCOPES_BY_PROJECT`` when the project has an
+    override, and from ``OAUTH_SCOPES`` otherwise.
+
+    Args:
+        project_id: The project billed for the session, if known.
 
     Returns:
-        bool: True on success, False on failure.
+        The access token, or None on failure.
     """
-    global CURRENT_TOKEN
-    global CURRENT_TOKEN_TIMESTAMP
     try:
         # 1. Get configuration from environment variables.
         # These are set in deploy.sh from values.sh.
         # Scopes are expected to be a comma-separated string.
-        scopes_str = os.environ.get(
-            "OAUTH_SCOPES", "https://www.googleapis.com/auth/cloud-platform"
+        scopes = SCOPES_BY_PROJECT.get(project_id) or parse_scopes(
+            os.environ.get(
+                "OAUTH_SCOPES", "https://www.googleapis.com/auth/cloud-platform"
+            )
         )
-        scopes = [scope.strip() for scope in scopes_str.split(",") if scope.strip()]
         if not scopes:
             raise ValueError(
-                "OAUTH_SCOPES environment variable cannot be empty or contain only commas."
+                "OAUTH_SCOPES environment variable cannot be empty or contain "
+                "only commas."
             )
-        logging.info(f"Using OAuth scopes: {scopes}")
-
-    except KeyError as e:
-        logging.error(f"Missing environment variable: {e.args[0]}")
-        return False
     except ValueError as e:
         logging.error(f"Invalid environment variable: {e}")
-        return False
+        return None
 
     try:
-        # 2. Generate an access token using Application Default Credentials (ADC).
-        # The ADC are taken from the service account attached to the Cloud Run Job.
-        logging.info("Generating access token using ADC...")
-        credentials, _ = google.auth.default(scopes=scopes)
+        # 2. Load the Application Default Credentials (ADC) for these scopes.
+        # The ADC are taken from the service account attached to the Cloud Run service.
+        with _credentials_lock:
+            credentials = _credentials_by_scopes.get(scopes)
+            if credentials is None:
+                logging.info(f"Loading ADC for OAuth scopes: {list(scopes)}")
+                credentials, _ = google.auth.default(scopes=list(scopes))
+                _credentials_by_scopes[scopes] = credentials
+    except google.auth.exceptions.DefaultCredentialsError as e:
+        logging.error(f"A Google Cloud error occurred: {e}")
+        return None
+
+    # Tokens don't depend on the project, which is sent in the
+    # ``X-Goog-User-Project`` header instead (see ``build_remote_headers``):
+    # projects taken from session names don't each mint a token.
+    principal = getattr(credentials, "service_account_email", None) or "default"
+    key = (principal, scopes)
+    token = TOKEN_CACHE.get(key, lambda: refresh_token(credentials))
+    logging.debug(f"Token cache stats: {TOKEN_CACHE.stats()}")
+    return token
+
 
+def refresh_token(credentials):
+    """
+    Generates an access token from the given credentials.
+
+    Args:
+        credentials: The ADC to refresh.
+
+    Returns:
+        tuple: (access_token, expiry_timestamp_seconds), or (None, None) on failure.
+    """
+    # Imported on first use, to keep them out of the startup path.
+    from google.api_core import exceptions
+    from google.auth.transport import requests
+
+    try:
+        logging.info("Generating access token...")
         # The token needs to be refreshed to be valid.
         credentials.refresh(requests.Request())
         access_token = credentials.token
@@ -471,25 +989,24 @@ def refresh_token():
             raise RuntimeError("Failed to retrieve a valid access token.")
         logging.debug("Successfully generated access token.")
 
-        # 3. Save the access token and its expiry as global variable.
-        logging.debug("Saving refreshed access token and expiry...")
-
-        # Create a JSON payload with the token and its expiry.
-        CURRENT_TOKEN = access_token
-        CURRENT_TOKEN_TIMESTAMP = time.time()
-        return True
+        # google-auth reports the expiry as a naive UTC datetime.
+        expiry = credentials.expiry
+        if expiry:
+            expiry = expiry.replace(tzinfo=datetime.timezone.utc).timestamp()
+        return access_token, expiry
     except (
-        google.auth.exceptions.DefaultCredentialsError,
+        google.auth.exceptions.RefreshError,
         exceptions.GoogleAPICallError,
     ) as e:
         logging.error(f"A Google Cloud error occurred: {e}")
         logging.error(
-            "Ensure the service account has the required IAM permissions on the project."
+            "Ensure the service account has the required IAM permissions on the "
+            "project."
         )
-        return False
+        return None, None
     except Exception as e:
         logging.error(f"An unexpected error occurred: {e}")
-        return False
+        return None, None
 
 
 async def main():
@@ -499,7 +1016,10 @@ async def main():
     """
     # If K_SERVICE is set, we are in a Google Cloud Run environment.
     if "K_SERVICE" in os.environ:
-        # Set up Google Cloud's structured logging.
+        # Set up Google Cloud's structured logging. The client library is only
+        # imported here, as it's by far the slowest dependency to load.
+        import google.cloud.logging
+
         client = google.cloud.logging.Client()
         client.setup_logging()
         logging.info("Cloud Logging initialized.")
@@ -512,7 +1032,9 @@ async def main():
 
     # --- Origin allow-list startup diagnostics ---
     if AUTHORIZED_ORIGINS:
-        logging.info(f"Origin allow-list active. Authorized origins: {AUTHORIZED_ORIGINS}")
+        logging.info(
+            f"Origin allow-list active. Authorized origins: {AUTHORIZED_ORIGINS}"
+        )
         if ALLOW_LOCALHOST:
             logging.info("Localhost origins are also allowed (ALLOW_LOCALHOST=true).")
     else:
@@ -521,7 +1043,29 @@ async def main():
             "Set AUTHORIZED_ORIGINS to restrict access (semicolon-separated list)."
         )
 
-    start_server = websockets.serve(handle_client, "0.0.0.0", WEBSOCKET_SERVER_PORT)
+    if RECORD_SAMPLE_PERCENT > 0:
+        os.makedirs(RECORD_DIR, exist_ok=True)
+        logging.info(
+            f"Recording {RECORD_SAMPLE_PERCENT}% of sessions to {RECORD_DIR} "
+            f"(content: {RECORD_CONTENT})."
+        )
+
+    if admin_profiling.ADMIN_TOKEN:
+        logging.info("Admin profiling endpoints enabled under /admin/.")
+
+    start_server = websockets.serve(
+        handle_client,
+        "0.0.0.0",
+        WEBSOCKET_SERVER_PORT,
+        ping_interval=CLIENT_PING_INTERVAL,
+        ping_timeout=CLIENT_PING_TIMEOUT,
+        close_timeout=CLOSE_TIMEOUT,
+        max_size=CLIENT_MAX_SIZE,
+        max_queue=CLIENT_MAX_QUEUE,
+        process_request=(
+            admin_profiling.process_request if admin_profiling.ADMIN_TOKEN else None
+        ),
+    )
 
     logging.info(f"WebSocket server started on port {WEBSOCKET_SERVER_PORT}")
 
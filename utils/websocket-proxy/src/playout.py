@@ -0,0 +1,325 @@
+"""Paced delivery of the agent's audio, and barge-in.
+
+The upstream generates the agent's audio faster than it plays. Forwarded as
+it comes, a long answer piles up in the client and in the socket buffers on
+the way, and when the user interrupts the agent, the ``interruptionSignal``
+reaches the client behind all that audio: slow clients keep playing until it
+arrives, and clients that don't handle it (or handle it late) play the rest
+of the answer.
+
+When ``OUTPUT_AUDIO_LEAD_MS`` is set, an ``OutputPacer`` keeps the agent's
+audio in the proxy instead, and sends it to the client so that it never has
+more than that much audio ahead of its playback (plus one message). On
+barge-in, the audio still held by the proxy is dropped:
+
+- when the upstream sends an ``interruptionSignal``, which is forwarded at
+  once, ahead of the held audio;
+- optionally (``BARGE_IN_SPEECH_MS``), when the client's own audio contains
+  speech for that long while the agent's audio is playing. The proxy then
+  sends the client an ``interruptionSignal`` itself, without waiting for the
+  upstream to notice, and holds the agent's audio for up to
+  ``BARGE_IN_HOLD_SECONDS``. If the upstream confirms the interruption, the
+  audio is dropped; otherwise it resumes where it stopped, and the proxy
+  leaves barge-in to the upstream until its next interruption (the speech
+  may have been noise, or the agent may not accept interruptions).
+
+Other upstream messages (text, transcripts, tool calls, ``turnCompleted``,
+``endSession``) are sent at once when no audio is held, and otherwise queued
+behind the audio, so that the client gets them in order: e.g. the widget
+ends the session as soon as it gets ``endSession``. Only the
+``interruptionSignal`` skips the queue. Only sessions of CES apps are paced:
+with Playbooks, the widget decides on barge-in from transcripts, which the
+proxy can't follow.
+
+The pacer reads the messages as parsed by the session's ``Pipeline`` (a
+``transforms.Message``), so that pacing doesn't parse them again.
+"""
+
+import asyncio
+import base64
+import binascii
+import struct
+from collections import deque
+
+from transforms import SilenceSuppressor
+
+# How long the agent's audio is held after a barge-in detected by the proxy,
+# for the upstream to confirm it.
+BARGE_IN_HOLD_SECONDS = 2.0
+
+# Sent to the client on a barge-in detected by the proxy.
+INTERRUPTION = '{"interruptionSignal": true}'
+
+# Bytes per second of client audio: LINEAR16 at 16 kHz.
+CLIENT_BYTES_PER_SECOND = 32000
+
+
+def output_bytes_per_second(config_message):
+    """Returns the bytes per second of the agent's audio, from a config message.
+
+    Returns:
+        int or None: None if the encoding is compressed, so the duration of
+        the audio can't be computed from its size.
+    """
+    output = config_message.get("outputAudioConfig")
+    if not isinstance(output, dict):
+        output = {}
+    rate = output.get("sampleRateHertz") or output.get("sample_rate_hertz") or 16000
+    encoding = str(output.get("audioEncoding") or "LINEAR16").upper().replace("_", "")
+    if "LINEAR16" in encoding:
+        width = 2
+    elif "MULAW" in encoding or "ALAW" in encoding:
+        width = 1
+    else:
+        return None
+    try:
+        return int(rate) * width
+    except (ValueError, TypeError):
+        return None
+
+
+def _contains(message, keyword):
+    if isinstance(message, bytes):
+        return keyword.encode() in message
+    return keyword in message
+
+
+class OutputPacer:
+    """Sends the upstream messages of a session to its client, pacing audio.
+
+    Audio messages are queued, and sent by a task started with ``start``
+    whenever the client has less than ``lead_ms`` of audio left to play. The
+    client is assumed to play audio as soon as it arrives, one message after
+    the other. Other messages received while audio is queued are queued
+    behind it, and sent as soon as the audio before them is.
+    """
+
+    __slots__ = (
+        "send",
+        "lead",
+        "bytes_per_second",
+        "speech_ms",
+        "closed",
+        "messages",
+        "interruptions",
+        "barge_ins",
+        "unconfirmed",
+        "dropped",
+        "dropped_ms",
+        "_detector",
+        "_speech_ms",
+        "_queue",
+        "_playout_end",
+        "_held_until",
+        "_detecting",
+        "_wakeup",
+        "_task",
+    )
+
+    def __init__(self, send, lead_ms, bytes_per_second, speech_ms=0, vad_options=None):
+        """
+        Args:
+            send: Coroutine function sending a message to the client, and
+                returning False if the client connection is closed.
+            lead_ms: Maximum audio sent ahead of the client's playback.
+            bytes_per_second: Of the agent's audio, from
+                ``output_bytes_per_second``.
+            speech_ms: Client speech after which the proxy interrupts the
+                agent's audio itself. 0 disables it.
+            vad_options: The ``vad`` options of the session, for the speech
+                detector, see ``SilenceSuppressor``.
+        """
+        self.send = send
+        self.lead = lead_ms / 1000
+        self.bytes_per_second = bytes_per_second
+        self.speech_ms = speech_ms
+        self.closed = False
+        self.messages = 0
+        self.interruptions = 0
+        self.barge_ins = 0
+        self.unconfirmed = 0
+        self.dropped = 0
+        self.dropped_ms = 0
+        self._detector = SilenceSuppressor({"vad": vad_options}) if speech_ms else None
+        self._speech_ms = 0
+        self._queue = deque()  # (message, seconds), seconds is None if not audio
+        self._playout_end = 0.0  # When the client is done playing, loop time.
+        self._held_until = 0.0
+        self._detecting = True
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self.run())
+
+    def close(self):
+        if self._task:
+            self._task.cancel()
+
+    def playing(self):
+        """Whether the client has agent audio to play, or will have."""
+        return (
+            bool(self._queue) or asyncio.get_running_loop().time() < self._playout_end
+        )
+
+    async def put(self, message):
+        """Sends an upstream message to the client, or queues it.
+
+        Args:
+            message (transforms.Message): The message, after the upstream
+                pipeline, if any.
+
+        Returns:
+            False if the client connection is closed.
+        """
+        if self.closed:
+            return False
+        raw = message.raw
+        if _contains(raw, '"interruptionSignal"') and self.is_interruption(message):
+            self.interruptions += 1
+            return await self.interrupt(message.serialize())
+        seconds = self.audio_seconds(message) if _contains(raw, '"audio"') else None
+        if seconds is None and not self._queue:
+            return await self.send(message.serialize())
+        self._queue.append((message.serialize(), seconds))
+        self._wakeup.set()
+        return True
+
+    async def interrupt(self, message):
+        """Drops the queued audio, and sends ``message`` to the client."""
+        audio = [seconds for _, seconds in self._queue if seconds is not None]
+        if audio:
+            self.dropped += len(audio)
+            self.dropped_ms += round(sum(audio) * 1000)
+            # The other messages are still sent, after the interruption.
+            self._queue = deque(item for item in self._queue if item[1] is None)
+        # The client stops playing when it gets the message.
+        self._playout_end = self._held_until = 0.0
+        self._speech_ms = 0
+        self._detecting = True
+        sent = await self.send(message)
+        self._wakeup.set()
+        return sent
+
+    async def client_audio(self, message):
+        """Checks a client audio message for speech over the agent's audio.
+
+        Args:
+            message (transforms.Message): The message, whose decoded audio
+                is then reused by the client pipeline.
+
+        Returns:
+            False if the client connection is closed.
+        """
+        now = asyncio.get_running_loop().time()
+        if not self._detecting or not self.playing() or now < self._held_until:
+            self._speech_ms = 0
+            return True
+        pcm = message.audio
+        if not pcm:
+            return True
+        if not self._detector.is_speech(pcm):
+            self._speech_ms = 0
+            return True
+        self._speech_ms += len(pcm) * 1000 // CLIENT_BYTES_PER_SECOND
+        if self._speech_ms < self.speech_ms:
+            return True
+        self.barge_ins += 1
+        self._speech_ms = 0
+        # Hold the audio until the upstream confirms the interruption.
+        self._playout_end = 0.0
+        self._held_until = now + BARGE_IN_HOLD_SECONDS
+        return await self.send(INTERRUPTION)
+
+    async def run(self):
+        """Sends the queued audio, as the client plays it."""
+        loop = asyncio.get_running_loop()
+        while True:
+            now = loop.time()
+            if self._held_until and now >= self._held_until:
+                # Not confirmed by the upstream: resume the agent's audio.
+                self._held_until = 0.0
+                self._detecting = False
+                self.unconfirmed += 1
+            timeout = None
+            if self._queue:
+                timeout = self._held_until - now
+                if self._queue[0][1] is not None:
+                    timeout = max(timeout, self._playout_end - self.lead - now)
+            if timeout is None or timeout > 0:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except TimeoutError:
+                    pass
+                continue
+            message, seconds = self._queue.popleft()
+            if seconds is not None:
+                self._playout_end = max(now, self._playout_end) + seconds
+                self.messages += 1
+            if not await self.send(message):
+                self.closed = True
+                return
+
+    async def drain(self):
+        """Waits until the queued messages are sent, e.g. before closing."""
+        while self._queue and not self.closed and self._task and not self._task.done():
+            await asyncio.sleep(0.05)
+
+    def is_interruption(self, message):
+        data = message.json
+        return data is not None and bool(data.get("interruptionSignal"))
+
+    def audio_seconds(self, message):
+        """Returns how long the audio of an agent message plays.
+
+        The duration is computed from the size of the base64 audio, which
+        isn't decoded.
+
+        Returns:
+            float or None: None if the message has no audio, or audio of an
+            unknown duration.
+        """
+        data = message.json
+        if data is None:
+            return None
+        output = data.get("sessionOutput") or data.get("audioOutput")
+        if not isinstance(output, dict) or not isinstance(output.get("audio"), str):
+            return None
+        audio = output["audio"]
+        size = len(audio) * 3 // 4 - (len(audio) - len(audio.rstrip("=")))
+        bytes_per_second = self.bytes_per_second
+        if audio.startswith("UklGR"):  # "RIFF": audio with a WAV header.
+            header, bytes_per_second = _wav_header(audio, bytes_per_second)
+            size -= header
+        if not bytes_per_second:
+            return None
+        return max(size, 0) / bytes_per_second
+
+    def stats(self):
+        """Returns the pacing counters, for logging."""
+        return {
+            "messages": self.messages,
+            "interruptions": self.interruptions,
+            "barge_ins": self.barge_ins,
+            "unconfirmed": self.unconfirmed,
+            "dropped": self.dropped,
+            "dropped_ms": self.dropped_ms,
+        }
+
+
+def _wav_header(audio, bytes_per_second):
+    """Returns the size of the WAV header of base64 audio, and its byte rate."""
+    try:
+        head = base64.b64decode(audio[:256])
+    except (binascii.Error, ValueError):
+        return 0, bytes_per_second
+    offset = 12
+    while offset + 8 <= len(head):
+        chunk, size = struct.unpack_from("<4sI", head, offset)
+        if chunk == b"fmt " and offset + 20 <= len(head):
+            bytes_per_second = struct.unpack_from("<I", head, offset + 16)[0]
+        elif chunk == b"data":
+            return offset + 8, bytes_per_second
+        offset += 8 + size
+    return 0, bytes_per_second
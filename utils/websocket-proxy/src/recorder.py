@@ -0,0 +1,166 @@
+"""Session recording for offline performance testing.
+
+A sample of sessions can be recorded to compact, append-only files, which
+``script/replay.py`` plays back against the proxy. Each file starts with
+``MAGIC`` and contains one record per message:
+
+- a ``RECORD_HEADER`` struct: time since the session started (microseconds),
+  direction, message size and recorded content size;
+- the recorded content, if any (see ``RECORD_CONTENT``).
+
+Files are written by a single background thread, from buffers filled by the
+event loop, so recording never blocks message forwarding on disk I/O.
+"""
+
+import json
+import logging
+import os
+import random
+import struct
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+MAGIC = b"CESWSREC1\n"
+
+# Microseconds since the session started, direction, message size and
+# recorded content size.
+RECORD_HEADER = struct.Struct("<QBII")
+
+# Message directions.
+CONFIG = 0  # The config message, without the access token.
+FROM_CLIENT = 1
+FROM_UPSTREAM = 2
+
+# What is recorded of each message: "none" (timing and sizes only),
+# "redacted" (the JSON structure, with every string replaced by as many "A"s
+# as it has UTF-8 bytes, which also turns audio into silence) or "full".
+CONTENT_MODES = ("none", "redacted", "full")
+
+FLUSH_BYTES = 64 * 1024
+
+_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="recorder")
+
+
+def redact(message):
+    """Returns a message with the same JSON structure and size, and no content.
+
+    Numbers are kept as written (e.g. ``1e5`` isn't turned into
+    ``100000.0``), so they can't make the redacted JSON longer. It's
+    serialized compactly, then padded with spaces to the size of the message,
+    since escapes and whitespace make it shorter.
+    """
+    try:
+        data = json.loads(
+            message, parse_float=_Number, parse_int=_Number, parse_constant=_Number
+        )
+    except (json.JSONDecodeError, ValueError, TypeError):
+        return b""
+    return _redact_value(data).encode("utf-8", "surrogatepass").ljust(len(message))
+
+
+class _Number(str):
+    """A JSON number (or ``NaN``/``Infinity``), as written in the message."""
+
+    __slots__ = ()
+
+
+def _redact_value(value):
+    """Returns the compact JSON of a parsed value, with its strings redacted."""
+    if isinstance(value, _Number):
+        return value
+    if isinstance(value, str):
+        return '"' + "A" * len(value.encode("utf-8", "surrogatepass")) + '"'
+    if isinstance(value, dict):
+        return (
+            "{"
+            + ",".join(
+                json.dumps(key, ensure_ascii=False) + ":" + _redact_value(item)
+                for key, item in value.items()
+            )
+            + "}"
+        )
+    if isinstance(value, list):
+        return "[" + ",".join(_redact_value(item) for item in value) + "]"
+    return json.dumps(value)
+
+
+class SessionRecorder:
+    """Records the messages of one session to a file."""
+
+    __slots__ = ("path", "content", "start", "_buffer")
+
+    def __init__(self, directory, content):
+        self.path = os.path.join(
+            directory, f"{time.strftime('%Y%m%dT%H%M%S')}-{uuid.uuid4().hex[:8]}.rec"
+        )
+        self.content = content
+        self.start = time.monotonic()
+        self._buffer = bytearray(MAGIC)
+
+    @classmethod
+    def sample(cls, rate, directory, content):
+        """Returns a recorder for a new session, or None if it isn't sampled.
+
+        Args:
+            rate: The percentage of sessions to record.
+            directory: Where recordings are written.
+            content: One of ``CONTENT_MODES``.
+        """
+        if rate <= 0 or random.uniform(0, 100) >= rate:
+            return None
+        return cls(directory, content)
+
+    def record(self, direction, message):
+        """Adds a message to the recording."""
+        if isinstance(message, str):
+            message = message.encode()
+        if self.content == "full":
+            content = message
+        elif self.content == "redacted":
+            content = redact(message)
+        else:
+            content = b""
+        elapsed = int((time.monotonic() - self.start) * 1_000_000)
+        self._buffer += RECORD_HEADER.pack(
+            elapsed, direction, len(message), len(content)
+        )
+        self._buffer += content
+        if len(self._buffer) >= FLUSH_BYTES:
+            self.flush()
+
+    def flush(self):
+        """Hands the buffered records to the writer thread."""
+        if self._buffer:
+            data, self._buffer = bytes(self._buffer), bytearray()
+            _writer.submit(self._write, data)
+
+    def close(self):
+        """Writes the remaining records."""
+        self.flush()
+        logging.info(f"Session recorded to {self.path}")
+
+    def _write(self, data):
+        try:
+            with open(self.path, "ab") as f:
+                f.write(data)
+        except OSError as e:
+            logging.error(f"Error writing session recording {self.path}: {e}")
+
+
+def read_recording(path):
+    """Reads a recording.
+
+    Args:
+        path: The recording file.
+
+    Yields:
+        tuple: ``(seconds, direction, size, content)`` for each message, where
+        content is empty if it wasn't recorded.
+    """
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a session recording.")
+        while header := f.read(RECORD_HEADER.size):
+            elapsed, direction, size, content_size = RECORD_HEADER.unpack(header)
+            yield elapsed / 1_000_000, direction, size, f.read(content_size)
@@ -0,0 +1,605 @@
+"""Per-message transforms applied by the WebSocket proxy.
+
+Each direction of a session (client to upstream, and upstream to client) has
+a ``Pipeline`` of ``Transform`` stages. Stages declare what they need from a
+message:
+
+- ``RAW``: the message as received (str or bytes).
+- ``JSON``: the parsed JSON object.
+- ``AUDIO``: the decoded audio of an audio message, as LINEAR16 PCM bytes.
+
+A ``Message`` parses its JSON and decodes its audio lazily, at most once, no
+matter how many stages use them, and is serialized again only if a stage
+modified it. Stages that need JSON or audio are skipped for messages that
+don't have them, so a pipeline never parses a message just to find out.
+
+Stages are listed by name in the ``CLIENT_TRANSFORMS`` and
+``UPSTREAM_TRANSFORMS`` environment variables, see ``TRANSFORMS``.
+"""
+
+import base64
+import binascii
+import json
+import logging
+import re
+
+RAW = "raw"
+JSON = "json"
+AUDIO = "audio"
+
+# Where audio is found in the messages of each protocol, in both directions.
+AUDIO_FIELDS = (
+    ("realtimeInput", "audio"),
+    ("inputData", "audio"),
+    ("sessionOutput", "audio"),
+    ("audioOutput", "audio"),
+)
+
+
+class Message:
+    """A message passing through a pipeline.
+
+    Attributes:
+        raw: The message as received.
+        dropped: Whether a stage dropped the message.
+    """
+
+    __slots__ = (
+        "raw",
+        "dropped",
+        "_json",
+        "_audio",
+        "_audio_field",
+        "_audio_modified",
+        "_modified",
+    )
+
+    _UNSET = object()
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.dropped = False
+        self._json = Message._UNSET
+        self._audio = Message._UNSET
+        self._audio_field = None  # The dict holding the encoded audio.
+        self._audio_modified = False
+        self._modified = False
+
+    @property
+    def json(self):
+        """The parsed message, or None if it isn't a JSON object."""
+        if self._json is Message._UNSET:
+            try:
+                data = json.loads(self.raw)
+            except (json.JSONDecodeError, ValueError, TypeError):
+                data = None
+            self._json = data if isinstance(data, dict) else None
+        elif self._audio_modified:
+            # Keep the JSON in sync with audio replaced by a stage.
+            self._audio_field["audio"] = base64.b64encode(self._audio).decode("ascii")
+            self._audio_modified = False
+        return self._json
+
+    @property
+    def audio(self):
+        """The decoded audio, or None if this isn't an audio message."""
+        if self._audio is Message._UNSET:
+            self._audio = None
+            data = self.json
+            for field, key in AUDIO_FIELDS if data is not None else ():
+                container = data.get(field)
+                if isinstance(container, dict) and isinstance(container.get(key), str):
+                    try:
+                        self._audio = base64.b64decode(container[key])
+                    except binascii.Error:
+                        break
+                    self._audio_field = container
+                    break
+        return self._audio
+
+    @audio.setter
+    def audio(self, pcm):
+        if self.audio is None:
+            raise ValueError("Not an audio message.")
+        self._audio = pcm
+        self._audio_modified = True
+        self._modified = True
+
+    def mark_modified(self):
+        """Must be called by stages that modify ``json`` in place."""
+        self._modified = True
+
+    def drop(self):
+        """Drops the message: it won't be forwarded."""
+        self.dropped = True
+
+    def serialize(self):
+        """Returns the message to forward, serializing it only if modified.
+
+        Binary messages stay binary, so that they're forwarded as binary
+        frames.
+        """
+        if not self._modified:
+            return self.raw
+        serialized = json.dumps(self.json)
+        if isinstance(self.raw, bytes):
+            return serialized.encode()
+        return serialized
+
+
+class Transform:
+    """A pipeline stage.
+
+    Subclasses set ``needs`` and implement ``process``, which may read or
+    modify the message, or drop it. Stages are created once per session and
+    direction, so they can keep per-session state.
+
+    Attributes:
+        needs: What the stage reads: ``RAW``, ``JSON`` or ``AUDIO``.
+        keywords: Optional substrings, one of which must be present in the raw
+            message for the stage to run. This lets a stage skip messages
+            without parsing them.
+    """
+
+    needs = RAW
+    keywords = ()
+
+    def __init__(self, options=None):
+        self.options = options or {}
+
+    def process(self, message):
+        raise NotImplementedError
+
+    def stats(self):
+        """Returns the stage counters, if any, for logging."""
+        return None
+
+
+class StripKeys(Transform):
+    """Removes keys (e.g. ``diagnosticInfo``) from JSON messages, at any depth.
+
+    The keys come from the ``STRIPPED_KEYS`` environment variable.
+    """
+
+    needs = JSON
+
+    def __init__(self, options=None, keys=None):
+        super().__init__(options)
+        self.keys = frozenset(keys or ())
+        # Only parse messages that mention one of the keys.
+        self.keywords = tuple(f'"{key}"' for key in self.keys)
+
+    def process(self, message):
+        if self.keys and _strip_keys_recursive(message.json, self.keys):
+            message.mark_modified()
+
+
+def _strip_keys_recursive(obj, keys):
+    """Recursively remove ``keys`` from a JSON-like structure, in place.
+
+    Returns:
+        True if at least one key was removed anywhere in the tree.
+    """
+    modified = False
+    if isinstance(obj, dict):
+        for key in keys & obj.keys():
+            del obj[key]
+            modified = True
+        for value in obj.values():
+            if _strip_keys_recursive(value, keys):
+                modified = True
+    elif isinstance(obj, list):
+        for item in obj:
+            if _strip_keys_recursive(item, keys):
+                modified = True
+    return modified
+
+
+class RedactPii(Transform):
+    """Masks e-mail addresses, phone and card numbers in transcripts and text."""
+
+    needs = JSON
+    keywords = ('"text"', '"transcript"')
+
+    FIELDS = frozenset(["text", "transcript"])
+    PATTERNS = (
+        re.compile(r"[\w.+-]+@[\w-]+\.[\w.-]+"),
+        re.compile(r"\b(?:\d[ -]?){13,19}\b"),
+        re.compile(r"\+?\d[\d ().-]{7,}\d"),
+    )
+
+    def __init__(self, options=None):
+        super().__init__(options)
+        self.redactions = 0
+
+    def process(self, message):
+        if self._redact(message.json):
+            message.mark_modified()
+
+    def _redact(self, obj):
+        modified = False
+        if isinstance(obj, dict):
+            for key, value in obj.items():
+                if key in self.FIELDS and isinstance(value, str):
+                    redacted = value
+                    for pattern in self.PATTERNS:
+                        redacted = pattern.sub("[REDACTED]", redacted)
+                    if redacted != value:
+                        obj[key] = redacted
+                        self.redactions += 1
+                        modified = True
+                elif self._redact(value):
+                    modified = True
+        elif isinstance(obj, list):
+            for item in obj:
+                if self._redact(item):
+                    modified = True
+        return modified
+
+    def stats(self):
+        return {"redactions": self.redactions}
+
+
+class MetricsTap(Transform):
+    """Counts the messages and bytes passing through, without parsing them."""
+
+    needs = RAW
+
+    def __init__(self, options=None):
+        super().__init__(options)
+        self.messages = 0
+        self.bytes = 0
+
+    def process(self, message):
+        self.messages += 1
+        self.bytes += len(message.raw)
+
+    def stats(self):
+        return {"messages": self.messages, "bytes": self.bytes}
+
+
+class SilenceSuppressor(Transform):
+    """Drops (or thins out) client audio frames that contain no speech.
+
+    Each frame is split into 10 ms blocks, and a block is speech if its
+    energy is above ``thresholdDb`` (dBFS), or a little below it with a high
+    zero-crossing rate (quiet fricatives like "s" or "f"). Both are computed
+    for all the blocks of a frame at once with numpy. The thresholds are
+    raised above the background noise, which is tracked from the quietest
+    blocks, so steady noise isn't taken for speech.
+
+    - After speech, audio keeps being forwarded for ``hangoverMs``, so the
+      ends of words and the pause that ends a turn reach the upstream.
+    - The last ``prerollMs`` of dropped audio is prepended to the first
+      speech frame, so word onsets aren't clipped.
+    - In ``thin`` mode, one silent frame in ``keepEvery`` is still
+      forwarded, for upstreams that expect a continuous stream.
+
+    Options come from the ``vad`` object of the session config message, e.g.
+    ``{"mode": "thin", "thresholdDb": -45}``, and default to ``DEFAULTS``.
+    Audio is LINEAR16 at 16 kHz.
+    """
+
+    needs = AUDIO
+    keywords = ('"audio"',)
+
+    DEFAULTS = {
+        "mode": "drop",  # "drop", "thin" or "off".
+        "thresholdDb": -45.0,
+        "hangoverMs": 400,
+        "prerollMs": 100,
+        "keepEvery": 10,
+    }
+
+    SAMPLE_RATE = 16000
+    BLOCK_SAMPLES = 160  # 10 ms
+    # Zero crossings per sample above which a quiet block counts as speech.
+    FRICATIVE_ZCR = 0.25
+    FRICATIVE_MARGIN_DB = 10.0
+    # Minimum margins above the background noise, in dB.
+    NOISE_MARGIN_DB = 9.0
+    NOISE_FRICATIVE_MARGIN_DB = 6.0
+    NOISE_RISE_DB = 3.0
+
+    def __init__(self, options=None):
+        super().__init__(options)
+        import numpy
+
+        self._np = numpy
+        vad = {**self.DEFAULTS, **((options or {}).get("vad") or {})}
+        try:
+            threshold_db = float(vad["thresholdDb"])
+            hangover_ms = int(vad["hangoverMs"])
+            preroll_ms = int(vad["prerollMs"])
+            keep_every = int(vad["keepEvery"])
+        except (ValueError, TypeError):
+            logging.warning(f"Invalid vad options {vad}, using the defaults.")
+            vad = self.DEFAULTS
+            threshold_db, hangover_ms, preroll_ms, keep_every = (
+                vad["thresholdDb"],
+                vad["hangoverMs"],
+                vad["prerollMs"],
+                vad["keepEvery"],
+            )
+        self.mode = vad["mode"]
+        # Compare mean squares instead of computing dBFS for every block.
+        self._threshold = 10 ** (threshold_db / 10) * 32768.0**2
+        self._fricative_threshold = self._threshold / 10 ** (
+            self.FRICATIVE_MARGIN_DB / 10
+        )
+        self._hangover = hangover_ms * self.SAMPLE_RATE // 1000
+        self._preroll_bytes = preroll_ms * self.SAMPLE_RATE // 1000 * 2
+        self._keep_every = max(1, keep_every)
+        self._since_speech = self._hangover  # Samples since the last speech.
+        self._preroll = bytearray()
+        self._silent_run = 0
+        self._noise = None  # Background noise energy.
+        self._noise_margin = 10 ** (self.NOISE_MARGIN_DB / 10)
+        self._noise_fricative_margin = 10 ** (self.NOISE_FRICATIVE_MARGIN_DB / 10)
+        self.frames = 0
+        self.dropped = 0
+        self.bytes_dropped = 0
+
+    def is_speech(self, pcm):
+        """Whether a frame of LINEAR16 audio contains speech."""
+        np = self._np
+        samples = np.frombuffer(pcm, dtype="<i2", count=len(pcm) // 2)
+        usable = len(samples) - len(samples) % self.BLOCK_SAMPLES
+        if usable:
+            blocks = samples[:usable].reshape(-1, self.BLOCK_SAMPLES)
+        else:
+            blocks = samples.reshape(1, -1)
+        if not blocks.size:
+            return False
+        # Frames only have a few blocks: numpy computes the per-block values,
+        # and the comparisons are cheaper on a list than on tiny arrays.
+        width = blocks.shape[1]
+        energy = [
+            e / width for e in np.square(blocks.astype(np.float32)).sum(axis=1).tolist()
+        ]
+        # The noise floor follows quieter blocks at once, and rises by at most
+        # NOISE_RISE_DB per second, so it doesn't catch up with long speech.
+        floor = min(energy)
+        noise = self._noise
+        if noise is None or floor < noise:
+            noise = max(floor, 1.0)
+        else:
+            seconds = len(samples) / self.SAMPLE_RATE
+            noise = min(floor, noise * 10 ** (self.NOISE_RISE_DB * seconds / 10))
+        self._noise = noise
+        if max(energy) > max(self._threshold, noise * self._noise_margin):
+            return True
+        quiet_threshold = max(
+            self._fricative_threshold, noise * self._noise_fricative_margin
+        )
+        quiet = [e > quiet_threshold for e in energy]
+        if not any(quiet):
+            return False
+        crossings = ((blocks[:, 1:] ^ blocks[:, :-1]) < 0).sum(axis=1).tolist()
+        limit = self.FRICATIVE_ZCR * width
+        return any(q and c > limit for q, c in zip(quiet, crossings))
+
+    def process(self, message):
+        if self.mode == "off":
+            return
+        pcm = message.audio
+        self.frames += 1
+        if self.is_speech(pcm):
+            self._since_speech = 0
+        else:
+            self._since_speech += len(pcm) // 2
+        if self._since_speech <= self._hangover:
+            if self._preroll:
+                message.audio = bytes(self._preroll) + pcm
+                self._preroll.clear()
+            self._silent_run = 0
+            return
+        self._silent_run += 1
+        if self.mode == "thin" and self._silent_run % self._keep_every == 0:
+            return
+        message.drop()
+        self.dropped += 1
+        self.bytes_dropped += len(message.raw)
+        if self._preroll_bytes:
+            self._preroll += pcm
+            del self._preroll[: -self._preroll_bytes]
+
+    def stats(self):
+        return {
+            "frames": self.frames,
+            "dropped": self.dropped,
+            "bytes_dropped": self.bytes_dropped,
+        }
+
+
+class AudioCoalescer:
+    """Merges consecutive client audio messages into fewer, larger ones.
+
+    Only plain audio messages (e.g. ``{"realtimeInput": {"audio": ...}}``,
+    without other fields) are merged; the caller must forward the pending
+    audio, from ``flush``, before any other message. Messages are matched
+    with a regular expression rather than parsed, and their audio is decoded
+    only if it can't be joined as is, so that coalescing costs less than the
+    sends it saves.
+    """
+
+    __slots__ = (
+        "window_bytes",
+        "frames_in",
+        "frames_out",
+        "_field",
+        "_chunks",
+        "_size",
+    )
+
+    # Client audio is LINEAR16 at 16 kHz: 32 bytes per millisecond.
+    BYTES_PER_MS = 32
+
+    PATTERN = re.compile(
+        r'\{\s*"(realtimeInput|inputData)"\s*:'
+        r'\s*\{\s*"audio"\s*:\s*"([A-Za-z0-9+/]*=*)"\s*\}\s*\}\s*'
+    )
+
+    def __init__(self, window_ms):
+        self.window_bytes = window_ms * self.BYTES_PER_MS
+        self.frames_in = 0
+        self.frames_out = 0
+        self._field = None
+        self._chunks = []  # Base64-encoded audio.
+        self._size = 0
+
+    def add(self, raw):
+        """Buffers a message if it's a plain audio message.
+
+        Returns:
+            True if the message was buffered, False if it must be forwarded
+            as is (after flushing).
+        """
+        if not isinstance(raw, str):
+            return False
+        match = self.PATTERN.fullmatch(raw)
+        if match is None:
+            return False
+        field, audio = match.groups()
+        if self._field is not None and field != self._field:
+            return False
+        self._field = field
+        self._chunks.append(audio)
+        self._size += len(audio) * 3 // 4
+        self.frames_in += 1
+        return True
+
+    def full(self):
+        """Whether the buffered audio covers the coalescing window."""
+        return self._size >= self.window_bytes
+
+    def flush(self):
+        """Returns the buffered audio as a single message, or None."""
+        if not self._chunks:
+            return None
+        chunks = self._chunks
+        if any(chunk.endswith("=") for chunk in chunks[:-1]):
+            # Padding in the middle: the audio must be encoded again.
+            try:
+                audio = base64.b64encode(
+                    b"".join(base64.b64decode(chunk) for chunk in chunks)
+                ).decode("ascii")
+            except binascii.Error:
+                audio = None
+        else:
+            audio = "".join(chunks)
+        message = (
+            f'{{"{self._field}": {{"audio": "{audio}"}}}}'
+            if audio is not None
+            else None
+        )
+        self._field = None
+        self._chunks = []
+        self._size = 0
+        self.frames_out += 1
+        return message
+
+    def stats(self):
+        return {"frames_in": self.frames_in, "frames_out": self.frames_out}
+
+
+# Transforms that can be listed in CLIENT_TRANSFORMS and UPSTREAM_TRANSFORMS.
+TRANSFORMS = {
+    "strip_keys": StripKeys,
+    "redact_pii": RedactPii,
+    "metrics": MetricsTap,
+    "vad": SilenceSuppressor,
+}
+
+
+def parse_transforms(names, env_name):
+    """Looks up a comma-separated list of transform names.
+
+    Args:
+        names: The list, e.g. "redact_pii,metrics".
+        env_name: The environment variable it comes from, for logging.
+
+    Returns:
+        tuple: The transform names, without the unknown ones.
+    """
+    transforms = []
+    for name in names.split(","):
+        name = name.strip()
+        if name in TRANSFORMS:
+            transforms.append(name)
+        elif name:
+            logging.warning(f"Ignoring unknown transform in {env_name}: '{name}'")
+    return tuple(transforms)
+
+
+class Pipeline:
+    """The transforms applied to the messages of one direction of a session."""
+
+    __slots__ = ("stages",)
+
+    def __init__(self, stages):
+        self.stages = stages
+
+    @classmethod
+    def build(cls, names, options=None, **kwargs):
+        """Creates a pipeline from transform names.
+
+        Args:
+            names: Transform names, from ``parse_transforms``.
+            options: Session options, passed to every stage.
+            **kwargs: Extra arguments for specific stages, by name, e.g.
+                ``strip_keys={"keys": ...}``.
+
+        Returns:
+            Pipeline or None: None if there are no stages.
+        """
+        if not names:
+            return None
+        return cls(
+            tuple(TRANSFORMS[name](options, **kwargs.get(name, {})) for name in names)
+        )
+
+    def process(self, raw):
+        """Runs a message through the stages.
+
+        Args:
+            raw: The message as received.
+
+        Returns:
+            The message to forward, or None if it was dropped.
+        """
+        message = Message(raw)
+        return message.serialize() if self.apply(message) else None
+
+    def apply(self, message):
+        """Runs a ``Message`` through the stages, for callers that read it too.
+
+        Returns:
+            False if a stage dropped the message.
+        """
+        for stage in self.stages:
+            if stage.keywords and not _contains_any(message.raw, stage.keywords):
+                continue
+            if stage.needs == JSON and message.json is None:
+                continue
+            if stage.needs == AUDIO and message.audio is None:
+                continue
+            stage.process(message)
+            if message.dropped:
+                return False
+        return True
+
+    def stats(self):
+        """Returns the counters of the stages that have any."""
+        return {
+            type(stage).__name__: stage.stats()
+            for stage in self.stages
+            if stage.stats() is not None
+        }
+
+
+def _contains_any(raw, keywords):
+    """Whether the raw message contains one of the keywords."""
+    if isinstance(raw, bytes):
+        return any(keyword.encode() in raw for keyword in keywords)
+    return any(keyword in raw for keyword in keywords)
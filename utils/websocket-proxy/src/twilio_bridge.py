@@ -0,0 +1,305 @@
+"""Bridge between Twilio Media Streams and the CES bidirectional endpoints.
+
+Twilio connects to the proxy with a WebSocket when a call reaches a
+``<Connect><Stream url="wss://<proxy><TWILIO_PATH>">`` TwiML verb, and sends
+JSON events (``connected``, ``start``, ``media``, ``mark``, ``stop``) with
+8 kHz mu-law audio. ``TwilioConnection`` wraps that WebSocket so it looks
+like a ces-messenger client to ``main.ProxySession``:
+
+- the ``start`` event becomes the config message, with 16 kHz LINEAR16 input
+  and output audio, so the upstream routing and access token logic are the
+  same as for the widget;
+- ``media`` events become audio messages, converted to 16 kHz LINEAR16;
+- upstream audio is converted back to 8 kHz mu-law ``media`` events, and an
+  ``interruptionSignal`` clears the audio Twilio has buffered (barge-in).
+  Other upstream messages have nothing to show on a phone and are dropped.
+
+Transcoding uses lookup tables and resampling uses polyphase FIR filters,
+both with numpy on whole frames. Filters keep their state between frames, so
+a call is converted as one continuous stream.
+
+The session comes from the ``session`` custom parameter of the stream
+(``<Parameter name="session" value="projects/.../sessions/..."/>``), or from
+``TWILIO_SESSION_TEMPLATE``. ``deployment`` and ``environment`` parameters
+are passed on too.
+"""
+
+import base64
+import json
+import logging
+import os
+
+import numpy as np
+from websockets.exceptions import ConnectionClosedError, ConnectionClosedOK
+
+# Session used when the stream has no "session" parameter, e.g.
+# "projects/my-project/locations/us/apps/my-app/sessions/{callSid}".
+TWILIO_SESSION_TEMPLATE = os.getenv("TWILIO_SESSION_TEMPLATE", "")
+# Verifies the X-Twilio-Signature of incoming connections. Without it, all
+# connections are rejected.
+TWILIO_AUTH_TOKEN = os.getenv("TWILIO_AUTH_TOKEN", "")
+
+AGENT_RATE = 16000
+
+
+def _ulaw_tables():
+    """Returns the G.711 mu-law decoding and encoding tables.
+
+    Returns:
+        tuple: int16 samples for each of the 256 mu-law bytes, and mu-law
+        bytes for each of the 65536 LINEAR16 samples, indexed by the sample
+        as an unsigned 16-bit integer.
+    """
+    codes = ~np.arange(256, dtype=np.uint8)
+    exponent = (codes >> 4) & 0x07
+    mantissa = (codes & 0x0F).astype(np.int32)
+    magnitude = (((mantissa << 3) + 0x84) << exponent) - 0x84
+    decode = np.where(codes & 0x80, -magnitude, magnitude).astype(np.int16)
+
+    samples = np.arange(65536, dtype=np.uint32).astype(np.uint16).view(np.int16)
+    samples = samples.astype(np.int32)
+    sign = np.where(samples < 0, 0x80, 0)
+    # 14-bit magnitude, clipped, plus the bias (as in G.711 and audioop).
+    magnitude = np.minimum(np.where(samples < 0, -(samples >> 2), samples >> 2), 8159)
+    magnitude = np.minimum(magnitude + 0x21, 0x1FFF)
+    exponent = np.floor(np.log2(magnitude)).astype(np.int32) - 5
+    mantissa = (magnitude >> (exponent + 1)) & 0x0F
+    encode = (~(sign | (exponent << 4) | mantissa) & 0xFF).astype(np.uint8)
+    return decode, encode
+
+
+ULAW_DECODE, ULAW_ENCODE = _ulaw_tables()
+
+
+def _lowpass(taps=32, cutoff=3600):
+    """A windowed-sinc low-pass filter for 16 kHz audio, below 4 kHz."""
+    n = np.arange(taps) - (taps - 1) / 2
+    fc = cutoff / AGENT_RATE
+    h = 2 * fc * np.sinc(2 * fc * n) * np.hamming(taps)
+    return h / h.sum()
+
+
+LOWPASS = _lowpass()
+
+
+class Upsampler:
+    """Converts a stream of 8 kHz samples to 16 kHz."""
+
+    __slots__ = ("_phases", "_history")
+
+    def __init__(self):
+        # Polyphase: each input sample gives one output sample per phase.
+        self._phases = (2 * LOWPASS[0::2], 2 * LOWPASS[1::2])
+        self._history = np.zeros(len(self._phases[0]) - 1)
+
+    def process(self, samples):
+        buffer = np.concatenate((self._history, samples))
+        self._history = buffer[len(samples) :]
+        out = np.empty(2 * len(samples))
+        out[0::2] = np.convolve(buffer, self._phases[0], "valid")
+        out[1::2] = np.convolve(buffer, self._phases[1], "valid")
+        return out
+
+
+class Downsampler:
+    """Converts a stream of 16 kHz samples to 8 kHz."""
+
+    __slots__ = ("_history", "_phase")
+
+    def __init__(self):
+        self._history = np.zeros(len(LOWPASS) - 1)
+        self._phase = 0  # Index of the next kept sample in the next chunk.
+
+    def process(self, samples):
+        buffer = np.concatenate((self._history, samples))
+        self._history = buffer[len(samples) :]
+        out = np.convolve(buffer, LOWPASS, "valid")[self._phase :: 2]
+        self._phase = (self._phase + len(samples)) % 2
+        return out
+
+
+def phone_to_agent(payload, upsampler):
+    """Converts a base64 8 kHz mu-law payload to base64 16 kHz LINEAR16."""
+    samples = ULAW_DECODE[np.frombuffer(base64.b64decode(payload), dtype=np.uint8)]
+    pcm = np.clip(np.rint(upsampler.process(samples)), -32768, 32767).astype("<i2")
+    return base64.b64encode(pcm.tobytes()).decode("ascii")
+
+
+def agent_to_phone(audio, downsampler):
+    """Converts base64 16 kHz LINEAR16 audio to a base64 8 kHz mu-law payload."""
+    pcm = base64.b64decode(audio)
+    samples = np.frombuffer(pcm, dtype="<i2", count=len(pcm) // 2)
+    out = np.clip(np.rint(downsampler.process(samples)), -32768, 32767).astype(np.int16)
+    return base64.b64encode(ULAW_ENCODE[out.view(np.uint16)].tobytes()).decode("ascii")
+
+
+def is_signature_valid(websocket):
+    """Checks the X-Twilio-Signature of a connection against TWILIO_AUTH_TOKEN.
+
+    Connections are never valid without TWILIO_AUTH_TOKEN: calls aren't
+    subject to AUTHORIZED_ORIGINS, so the signature is their only check.
+    """
+    if not TWILIO_AUTH_TOKEN:
+        return False
+    from twilio.request_validator import RequestValidator
+
+    headers = websocket.request.headers
+    url = f"wss://{headers.get('Host', '')}{websocket.request.path}"
+    return RequestValidator(TWILIO_AUTH_TOKEN).validate(
+        url, {}, headers.get("X-Twilio-Signature", "")
+    )
+
+
+class TwilioConnection:
+    """A Twilio Media Streams WebSocket, seen as a ces-messenger client."""
+
+    __slots__ = (
+        "websocket",
+        "stream_sid",
+        "audio_field",
+        "upsampler",
+        "downsampler",
+        "frames_in",
+        "frames_out",
+    )
+
+    def __init__(self, websocket):
+        self.websocket = websocket
+        self.stream_sid = None
+        self.audio_field = "realtimeInput"
+        self.upsampler = Upsampler()
+        self.downsampler = Downsampler()
+        self.frames_in = 0
+        self.frames_out = 0
+
+    @property
+    def remote_address(self):
+        return self.websocket.remote_address
+
+    @property
+    def request(self):
+        return self.websocket.request
+
+    @property
+    def close_code(self):
+        return self.websocket.close_code
+
+    async def close(self, code=1000, reason=""):
+        await self.websocket.close(code, reason)
+
+    async def recv(self):
+        """Waits for the ``start`` event, and returns it as a config message."""
+        async for message in self.websocket:
+            event = json.loads(message)
+            if event.get("event") == "start":
+                return json.dumps(self.config_message(event.get("start", {})))
+            logging.debug(f"Twilio event before start: {event.get('event')}")
+        return "{}"  # The stream ended before starting.
+
+    def config_message(self, start):
+        """Builds the config message for a call, from its ``start`` event."""
+        self.stream_sid = start.get("streamSid")
+        parameters = start.get("customParameters") or {}
+        call_sid = start.get("callSid", "")
+        session = parameters.get("session") or TWILIO_SESSION_TEMPLATE.format(
+            callSid=call_sid, streamSid=self.stream_sid
+        )
+        logging.info(f"Twilio call {call_sid} started, session {session}")
+        if "/agents/" in session:
+            # Playbooks Live
+            self.audio_field = "inputData"
+            key = "configMessage"
+            config = {
+                "session": session,
+                "inputAudioConfig": {
+                    "audioEncoding": "AUDIO_ENCODING_LINEAR_16",
+                    "sampleRateHertz": AGENT_RATE,
+                },
+                "outputAudioConfig": {
+                    "audioEncoding": "OUTPUT_AUDIO_ENCODING_LINEAR_16",
+                    "sample_rate_hertz": AGENT_RATE,
+                },
+            }
+        else:
+            key = "config"
+            config = {
+                "session": session,
+                "inputAudioConfig": {
+                    "audioEncoding": "LINEAR16",
+                    "sampleRateHertz": AGENT_RATE,
+                },
+                "outputAudioConfig": {
+                    "audioEncoding": "LINEAR16",
+                    "sampleRateHertz": AGENT_RATE,
+                },
+            }
+            if parameters.get("deployment"):
+                config["deployment"] = parameters["deployment"]
+        if parameters.get("environment"):
+            # Selects the upstream endpoint, like the widget's environment.
+            config["environment"] = parameters["environment"]
+        return {key: config}
+
+    def __aiter__(self):
+        return self.messages()
+
+    async def messages(self):
+        """Yields the caller's audio as client audio messages, until ``stop``."""
+        field = self.audio_field
+        async for message in self.websocket:
+            event = json.loads(message)
+            kind = event.get("event")
+            if kind == "media":
+                media = event["media"]
+                if media.get("track", "inbound") != "inbound":
+                    continue
+                self.frames_in += 1
+                audio = phone_to_agent(media["payload"], self.upsampler)
+                yield f'{{"{field}": {{"audio": "{audio}"}}}}'
+            elif kind == "stop":
+                logging.info(f"Twilio stream {self.stream_sid} stopped.")
+                return
+
+    async def send(self, message):
+        """Sends upstream audio to the caller, and clears it on barge-in."""
+        data = json.loads(message)
+        if data.get("interruptionSignal"):
+            await self.websocket.send(
+                json.dumps({"event": "clear", "streamSid": self.stream_sid})
+            )
+        output = data.get("sessionOutput") or data.get("audioOutput")
+        if isinstance(output, dict) and output.get("audio"):
+            self.frames_out += 1
+            payload = agent_to_phone(output["audio"], self.downsampler)
+            await self.websocket.send(
+                json.dumps(
+                    {
+                        "event": "media",
+                        "streamSid": self.stream_sid,
+                        "media": {"payload": payload},
+                    }
+                )
+            )
+
+
+async def handle_call(websocket, run_session):
+    """Handles a Twilio Media Streams connection.
+
+    Args:
+        websocket: The connection from Twilio.
+        run_session: ``main.run_session``, which proxies a client session.
+    """
+    if not is_signature_valid(websocket):
+        logging.warning("Rejected Twilio connection with an invalid signature.")
+        await websocket.close(code=4003, reason="Invalid signature")
+        return
+    connection = TwilioConnection(websocket)
+    try:
+        await run_session(connection)
+    except (ConnectionClosedOK, ConnectionClosedError):
+        pass
+    finally:
+        logging.info(
+            f"Twilio stream {connection.stream_sid} ended: "
+            f"{connection.frames_in} frames in, {connection.frames_out} out."
+        )
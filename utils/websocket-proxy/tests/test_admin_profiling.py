@@ -0,0 +1,40 @@
+import asyncio
+
+import admin_profiling
+import pytest
+from websockets.datastructures import Headers
+from websockets.http11 import Request
+
+
+@pytest.fixture(autouse=True)
+def admin_token(monkeypatch):
+    monkeypatch.setattr(admin_profiling, "ADMIN_TOKEN", "secret")
+
+
+def admin_request(path, token="secret"):
+    connection = type("Connection", (), {"remote_address": ("127.0.0.1", 0)})
+    request = Request(path, Headers({"X-Admin-Token": token}))
+    return asyncio.run(admin_profiling.process_request(connection, request))
+
+
+def test_other_paths_are_not_answered():
+    assert admin_request("/", token="other") is None
+
+
+def test_token_is_required():
+    assert admin_request("/admin/tasks", token="other").status_code == 401
+
+
+@pytest.mark.parametrize("seconds", ["-1", "0", "nan", "inf", "9", "five"])
+def test_invalid_seconds_are_rejected(seconds):
+    assert admin_request(f"/admin/profile?seconds={seconds}").status_code == 400
+
+
+@pytest.mark.parametrize("query", ["interval_ms=nan", "limit=0"])
+def test_invalid_parameters_are_rejected(query):
+    assert admin_request(f"/admin/memory?seconds=1&{query}").status_code == 400
+
+
+def test_stacks_are_sampled():
+    response = admin_request("/admin/stacks?seconds=0.05&interval_ms=5")
+    assert response.status_code == 200
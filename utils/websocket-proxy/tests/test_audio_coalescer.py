@@ -0,0 +1,54 @@
+import base64
+import json
+
+from transforms import AudioCoalescer
+
+
+def audio_message(pcm, field="realtimeInput"):
+    return json.dumps({field: {"audio": base64.b64encode(pcm).decode("ascii")}})
+
+
+def decoded(message):
+    data = json.loads(message)
+    ((field, value),) = data.items()
+    return field, base64.b64decode(value["audio"])
+
+
+def test_merges_frames_until_the_window_is_full():
+    coalescer = AudioCoalescer(window_ms=20)
+    assert coalescer.add(audio_message(b"\x01" * 320))
+    assert not coalescer.full()
+    assert coalescer.add(audio_message(b"\x02" * 320))
+    assert coalescer.full()
+    assert decoded(coalescer.flush()) == (
+        "realtimeInput",
+        b"\x01" * 320 + b"\x02" * 320,
+    )
+    assert coalescer.flush() is None
+    assert coalescer.stats() == {"frames_in": 2, "frames_out": 1}
+
+
+def test_reencodes_audio_with_padding_in_the_middle():
+    coalescer = AudioCoalescer(window_ms=40)
+    # 10 bytes encode with padding, so the payloads can't just be joined.
+    coalescer.add(audio_message(b"\x01" * 10))
+    coalescer.add(audio_message(b"\x02" * 10))
+    assert decoded(coalescer.flush())[1] == b"\x01" * 10 + b"\x02" * 10
+
+
+def test_does_not_buffer_other_messages():
+    coalescer = AudioCoalescer(window_ms=40)
+    assert not coalescer.add('{"realtimeInput": {"text": "hi"}}')
+    assert not coalescer.add(
+        '{"realtimeInput": {"audio": "AAAA", "mimeType": "audio/pcm"}}'
+    )
+    assert not coalescer.add(audio_message(b"\x00" * 4).encode())
+    assert coalescer.flush() is None
+
+
+def test_does_not_mix_fields():
+    coalescer = AudioCoalescer(window_ms=40)
+    assert coalescer.add(audio_message(b"\x01" * 3, field="inputData"))
+    assert not coalescer.add(audio_message(b"\x02" * 3))
+    assert decoded(coalescer.flush()) == ("inputData", b"\x01" * 3)
+    assert coalescer.add(audio_message(b"\x02" * 3))
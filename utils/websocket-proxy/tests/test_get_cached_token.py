@@ -0,0 +1,39 @@
+import main
+import pytest
+from token_cache import TokenCache
+
+
+class Credentials:
+    service_account_email = "proxy@example.iam.gserviceaccount.com"
+
+
+@pytest.fixture
+def mints(monkeypatch):
+    """Fake ADC, and the list of tokens minted with them."""
+    mints = []
+
+    def refresh_token(credentials):
+        mints.append(credentials)
+        return f"token-{len(mints)}", None
+
+    monkeypatch.setattr(
+        main.google.auth, "default", lambda scopes: (Credentials(), None)
+    )
+    monkeypatch.setattr(main, "_credentials_by_scopes", {})
+    monkeypatch.setattr(main, "refresh_token", refresh_token)
+    monkeypatch.setattr(main, "TOKEN_CACHE", TokenCache(2, 300, 60))
+    return mints
+
+
+def test_projects_share_a_token(mints):
+    tokens = {main.get_cached_token(f"project-{i}") for i in range(100)}
+    assert tokens == {"token-1"}
+    assert len(mints) == 1
+    stats = main.TOKEN_CACHE.stats()
+    assert (stats["entries"], stats["evictions"], stats["hit_rate"]) == (1, 0, 0.99)
+
+
+def test_project_is_sent_as_quota_project():
+    headers = main.build_remote_headers("token-1", "my-project")
+    assert headers["Authorization"] == "Bearer token-1"
+    assert headers["X-Goog-User-Project"] == "my-project"
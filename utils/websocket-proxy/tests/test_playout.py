@@ -0,0 +1,157 @@
+import asyncio
+import base64
+import json
+
+import numpy as np
+import pytest
+import transforms
+from playout import INTERRUPTION, OutputPacer
+from transforms import Message, Pipeline
+
+# 100 ms of 16 kHz LINEAR16 audio.
+AUDIO_BYTES = 3200
+
+
+def agent_audio(index):
+    audio = base64.b64encode(bytes([index]) * AUDIO_BYTES).decode("ascii")
+    return json.dumps({"sessionOutput": {"audio": audio}})
+
+
+async def pace(messages, lead_ms=0):
+    """Puts the messages in a pacer, and returns what it sent, with when."""
+    loop = asyncio.get_running_loop()
+    sent = []
+
+    async def send(message):
+        sent.append((loop.time(), message))
+        return True
+
+    pacer = OutputPacer(send, lead_ms, 32000)
+    pacer.start()
+    for message in messages:
+        await pacer.put(Message(message))
+    await pacer.drain()
+    pacer.close()
+    return sent, pacer
+
+
+def test_messages_without_queued_audio_are_sent_at_once():
+    async def run():
+        sent = []
+
+        async def send(message):
+            sent.append(message)
+            return True
+
+        pacer = OutputPacer(send, 0, 32000)
+        assert await pacer.put(Message('{"text": "hi"}'))
+        return sent
+
+    assert asyncio.run(run()) == ['{"text": "hi"}']
+
+
+def test_messages_are_queued_behind_audio():
+    messages = [
+        agent_audio(1),
+        '{"text": "hi"}',
+        agent_audio(2),
+        '{"turnCompleted": true}',
+        '{"endSession": {}}',
+    ]
+    sent, pacer = asyncio.run(pace(messages))
+    assert [message for _, message in sent] == messages
+    times = [time for time, _ in sent]
+    # The second audio is sent when the first has played, and the end of
+    # the turn right after it.
+    assert times[2] - times[0] >= 0.09
+    assert times[3] - times[2] < 0.05
+    assert pacer.stats()["messages"] == 2
+
+
+def test_interruption_skips_the_queue_and_drops_audio_only():
+    async def run():
+        sent = []
+
+        async def send(message):
+            sent.append(message)
+            return True
+
+        pacer = OutputPacer(send, 0, 32000)
+        pacer.start()
+        await pacer.put(Message(agent_audio(1)))
+        await asyncio.sleep(0)
+        for message in (agent_audio(2), agent_audio(3), '{"endSession": {}}'):
+            await pacer.put(Message(message))
+        await pacer.put(Message(INTERRUPTION))
+        await pacer.drain()
+        pacer.close()
+        return sent, pacer
+
+    sent, pacer = asyncio.run(run())
+    assert sent == [agent_audio(1), INTERRUPTION, '{"endSession": {}}']
+    assert pacer.stats()["dropped"] == 2
+    assert pacer.stats()["dropped_ms"] == 200
+
+
+@pytest.fixture
+def count_decoding(monkeypatch):
+    calls = {"loads": 0, "b64decode": 0}
+    loads, b64decode = json.loads, base64.b64decode
+
+    def counting_loads(*args, **kwargs):
+        calls["loads"] += 1
+        return loads(*args, **kwargs)
+
+    def counting_b64decode(*args, **kwargs):
+        calls["b64decode"] += 1
+        return b64decode(*args, **kwargs)
+
+    monkeypatch.setattr(transforms.json, "loads", counting_loads)
+    monkeypatch.setattr(transforms.base64, "b64decode", counting_b64decode)
+    return calls
+
+
+def test_pacing_reuses_the_pipeline_message(count_decoding):
+    pipeline = Pipeline.build(("strip_keys",), strip_keys={"keys": {"diagnosticInfo"}})
+    data = json.loads(agent_audio(1))
+    data["diagnosticInfo"] = {}
+    count_decoding["loads"] = 0
+
+    async def run():
+        sent = []
+
+        async def send(message):
+            sent.append(message)
+            return True
+
+        pacer = OutputPacer(send, 0, 32000)
+        message = Message(json.dumps(data))
+        assert pipeline.apply(message)
+        await pacer.put(message)
+        return pacer
+
+    pacer = asyncio.run(run())
+    assert count_decoding == {"loads": 1, "b64decode": 0}
+    assert pacer._queue[0][1] == pytest.approx(0.1, abs=0.001)
+
+
+def test_barge_in_shares_the_decoded_client_audio(count_decoding):
+    t = np.arange(320) / 16000
+    speech = (8000 * np.sin(2 * np.pi * 300 * t)).astype("<i2").tobytes()
+    raw = json.dumps({"realtimeInput": {"audio": base64.b64encode(speech).decode()}})
+    pipeline = Pipeline.build(("vad",), options={"vad": None})
+
+    async def run():
+        async def send(message):
+            return True
+
+        pacer = OutputPacer(send, 0, 32000, speech_ms=100)
+        await pacer.put(Message(agent_audio(1)))  # The agent is speaking.
+        count_decoding.update(loads=0, b64decode=0)
+        message = Message(raw)
+        assert await pacer.client_audio(message)
+        pipeline.apply(message)
+        return pacer
+
+    asyncio.run(run())
+    assert count_decoding == {"loads": 1, "b64decode": 1}
@@ -0,0 +1,62 @@
+import base64
+import json
+
+import pytest
+import recorder
+from recorder import FROM_CLIENT, FROM_UPSTREAM, SessionRecorder, read_recording
+
+
+@pytest.mark.parametrize(
+    "message",
+    [
+        '{"text": "hello"}',
+        '{"text":"café ☕"}',
+        '{"text": "line\\nbreak \\u00e9"}',
+        '{\n  "sessionOutput": {\n    "text": "pretty"\n  }\n}',
+        json.dumps(
+            {"realtimeInput": {"audio": base64.b64encode(b"\x01" * 64).decode()}}
+        ),
+    ],
+)
+def test_redact_keeps_the_size_in_bytes(message):
+    raw = message.encode()
+    assert len(recorder.redact(raw)) == len(raw)
+
+
+def test_redact_keeps_the_structure():
+    raw = json.dumps({"text": "café", "n": 3, "list": [{"k": "vv"}], "ok": True})
+    redacted = json.loads(recorder.redact(raw.encode()))
+    assert redacted == {"text": "AAAAA", "n": 3, "list": [{"k": "AA"}], "ok": True}
+
+
+@pytest.mark.parametrize(
+    "message", ['{"t":1e5}', '{"t":1.0000000000000001}', "[-0,1E-7,NaN]", "12"]
+)
+def test_redact_keeps_numbers_as_written(message):
+    assert recorder.redact(message.encode()) == message.encode()
+
+
+def test_redact_drops_non_json_messages():
+    assert recorder.redact(b"\x00\x01binary") == b""
+
+
+@pytest.mark.parametrize("content", ["none", "redacted", "full"])
+def test_recording_round_trip(tmp_path, content):
+    session = SessionRecorder(str(tmp_path), content)
+    session.record(FROM_CLIENT, '{"text": "hi"}')
+    session.record(FROM_UPSTREAM, b'{"text": "hello"}')
+    session.close()
+    recorder._writer.submit(lambda: None).result()
+
+    records = list(read_recording(session.path))
+    assert [r[1:3] for r in records] == [(FROM_CLIENT, 14), (FROM_UPSTREAM, 17)]
+    contents = [r[3] for r in records]
+    if content == "none":
+        assert contents == [b"", b""]
+    elif content == "full":
+        assert contents == [b'{"text": "hi"}', b'{"text": "hello"}']
+    else:
+        assert [json.loads(c) for c in contents] == [
+            {"text": "AA"},
+            {"text": "AAAAA"},
+        ]
@@ -0,0 +1,67 @@
+import asyncio
+from types import SimpleNamespace
+
+import main
+from main import ResumeBuffer
+
+
+def test_keeps_messages_in_order():
+    buffer = ResumeBuffer(max_bytes=100)
+    buffer.append("one")
+    buffer.append(b"two")
+    assert buffer.size == 6
+    assert buffer.popleft() == "one"
+    assert buffer.popleft() == b"two"
+    assert not buffer
+    assert buffer.size == 0
+
+
+def test_drops_oldest_messages_over_max_bytes():
+    buffer = ResumeBuffer(max_bytes=10)
+    for message in ("aaaa", "bbbb", "cccc"):
+        buffer.append(message)
+    assert buffer.dropped == 1
+    assert buffer.size == 8
+    assert buffer.popleft() == "bbbb"
+
+
+class FakeRemote:
+    """An upstream connection whose sends fail after `fail_after` messages."""
+
+    def __init__(self, fail_after=None):
+        self.fail_after = fail_after
+        self.sent = []
+        self.closed = False
+
+    async def send(self, message):
+        if self.fail_after is not None and len(self.sent) >= self.fail_after:
+            raise ConnectionError("upstream closed")
+        self.sent.append(message)
+
+    async def close(self):
+        self.closed = True
+
+
+def test_failed_resume_attempt_is_closed_and_buffer_is_replayed(monkeypatch):
+    remotes = [FakeRemote(fail_after=2), FakeRemote()]
+    connections = iter(remotes)
+
+    async def connect_remote(url, headers):
+        return next(connections)
+
+    monkeypatch.setattr(main, "connect_remote", connect_remote)
+    session = main.ProxySession(SimpleNamespace(close_code=None))
+    session.remote_websocket_url = "wss://ces"
+    session.client_access_token = "token"
+    session.config_json = "config"
+    session.resume_buffer = ResumeBuffer(max_bytes=100)
+    for message in ("one", "two", "three"):
+        session.resume_buffer.append(message)
+
+    assert asyncio.run(session.resume_remote())
+    assert remotes[0].closed
+    assert remotes[0].sent == ["config", "one"]
+    # The message whose send failed is replayed, with the rest of the buffer.
+    assert remotes[1].sent == ["config", "two", "three"]
+    assert session.remote_websocket is remotes[1] and not remotes[1].closed
+    assert session.resume_buffer is None
@@ -0,0 +1,33 @@
+import asyncio
+from types import SimpleNamespace
+
+import main
+import pytest
+
+CLIENT = SimpleNamespace(remote_address=("127.0.0.1", 1234), close_code=None)
+
+
+@pytest.fixture
+def stats(monkeypatch):
+    """Session counters of their own."""
+    monkeypatch.setattr(main, "SESSION_STATS", {"active": 0})
+    return main.SESSION_STATS
+
+
+def test_session_failing_to_initialize_is_uncounted(monkeypatch, stats):
+    def broken_session(client_websocket):
+        raise RuntimeError("no session")
+
+    monkeypatch.setattr(main, "ProxySession", broken_session)
+    asyncio.run(main.run_session(CLIENT))
+    assert stats["active"] == 0
+
+
+def test_session_rejected_at_setup_is_uncounted(monkeypatch, stats):
+    async def setup(self):
+        assert stats["active"] == 1
+        return False
+
+    monkeypatch.setattr(main.ProxySession, "setup", setup)
+    asyncio.run(main.run_session(CLIENT))
+    assert stats["active"] == 0
@@ -0,0 +1,87 @@
+import base64
+import json
+
+import pytest
+import transforms
+from transforms import Message, Pipeline
+
+
+def audio_message(pcm, field="realtimeInput"):
+    return json.dumps({field: {"audio": base64.b64encode(pcm).decode("ascii")}})
+
+
+@pytest.fixture
+def count_loads(monkeypatch):
+    calls = []
+    loads = json.loads
+
+    def counting_loads(*args, **kwargs):
+        calls.append(args)
+        return loads(*args, **kwargs)
+
+    monkeypatch.setattr(transforms.json, "loads", counting_loads)
+    return calls
+
+
+def test_message_is_parsed_once(count_loads):
+    message = Message(audio_message(b"\x01\x02"))
+    assert message.json is message.json
+    assert message.audio == b"\x01\x02"
+    assert message.audio == b"\x01\x02"
+    assert len(count_loads) == 1
+
+
+def test_unmodified_message_is_forwarded_as_received():
+    raw = b'{"text": "hi",  "diagnosticInfo": {}}'
+    message = Message(raw)
+    assert message.json == {"text": "hi", "diagnosticInfo": {}}
+    assert message.serialize() is raw
+
+
+@pytest.mark.parametrize("raw", ['{"a": 1, "b": 2}', b'{"a": 1, "b": 2}'])
+def test_modified_message_keeps_its_type(raw):
+    message = Message(raw)
+    del message.json["b"]
+    message.mark_modified()
+    serialized = message.serialize()
+    assert type(serialized) is type(raw)
+    assert json.loads(serialized) == {"a": 1}
+
+
+def test_audio_setter_updates_json():
+    message = Message(audio_message(b"\x01\x02"))
+    message.audio = b"\x03\x04"
+    assert json.loads(message.serialize()) == json.loads(audio_message(b"\x03\x04"))
+
+
+def test_non_object_messages_have_no_json():
+    assert Message("[1, 2]").json is None
+    assert Message(b"\xff\xfe").json is None
+    assert Message('{"text": "hi"}').audio is None
+
+
+def test_strip_keys_keeps_binary_frames_binary():
+    pipeline = Pipeline.build(("strip_keys",), strip_keys={"keys": {"diagnosticInfo"}})
+    raw = json.dumps({"text": "hi", "nested": [{"diagnosticInfo": 1}]}).encode()
+    processed = pipeline.process(raw)
+    assert isinstance(processed, bytes)
+    assert json.loads(processed) == {"text": "hi", "nested": [{}]}
+
+
+def test_pipeline_skips_messages_without_keywords(count_loads):
+    pipeline = Pipeline.build(
+        ("strip_keys", "redact_pii"), strip_keys={"keys": {"diagnosticInfo"}}
+    )
+    raw = audio_message(b"\x00" * 640)
+    assert pipeline.process(raw) is raw
+    assert count_loads == []
+
+
+def test_pipeline_parses_once_for_several_stages(count_loads):
+    pipeline = Pipeline.build(
+        ("strip_keys", "redact_pii"), strip_keys={"keys": {"diagnosticInfo"}}
+    )
+    raw = json.dumps({"text": "mail me at a@b.co", "diagnosticInfo": {}})
+    processed = pipeline.process(raw)
+    assert len(count_loads) == 1
+    assert json.loads(processed) == {"text": "mail me at [REDACTED]"}
@@ -0,0 +1,163 @@
+"""Synthetic Twilio Media Streams calls, through the proxy and a fake upstream."""
+
+import asyncio
+import base64
+import importlib
+import json
+
+import main
+import numpy as np
+import pytest
+import twilio_bridge
+import websockets
+
+SESSION = "projects/test/locations/us/apps/app/sessions/{callSid}"
+FRAME_SAMPLES = 160  # 20 ms at 8 kHz, as sent by Twilio.
+
+
+def media_event(samples):
+    pcm = np.clip(samples, -32768, 32767).astype(np.int16)
+    payload = twilio_bridge.ULAW_ENCODE[pcm.view(np.uint16)].tobytes()
+    return json.dumps(
+        {
+            "event": "media",
+            "streamSid": "MZ1",
+            "media": {
+                "track": "inbound",
+                "payload": base64.b64encode(payload).decode(),
+            },
+        }
+    )
+
+
+def start_event():
+    return json.dumps(
+        {
+            "event": "start",
+            "start": {
+                "streamSid": "MZ1",
+                "callSid": "CA1",
+                "customParameters": {"environment": "test"},
+            },
+        }
+    )
+
+
+@pytest.fixture
+def proxy(monkeypatch):
+    monkeypatch.setattr(main, "TWILIO_PATH", "/twilio")
+    monkeypatch.setattr(twilio_bridge, "TWILIO_AUTH_TOKEN", "secret")
+    monkeypatch.setattr(twilio_bridge, "TWILIO_SESSION_TEMPLATE", SESSION)
+    # Calls have no access token: the proxy mints one.
+    monkeypatch.setattr(main, "get_cached_token", lambda project_id=None: "token")
+    # Signatures are checked by the twilio package, see test_signature_*.
+    monkeypatch.setattr(twilio_bridge, "is_signature_valid", lambda websocket: True)
+
+
+async def call(frames, agent_audio):
+    """Sends a call's audio through the proxy to a fake upstream.
+
+    Returns:
+        tuple: What the upstream received, and the events Twilio received.
+    """
+    upstream_received = []
+
+    async def fake_upstream(websocket):
+        upstream_received.append(json.loads(await websocket.recv()))
+        for index in range(len(frames)):
+            upstream_received.append(json.loads(await websocket.recv()))
+            if index == 0:
+                audio = base64.b64encode(agent_audio).decode()
+                await websocket.send(json.dumps({"sessionOutput": {"audio": audio}}))
+                await websocket.send(json.dumps({"interruptionSignal": True}))
+        await websocket.wait_closed()
+
+    async with websockets.serve(fake_upstream, "127.0.0.1", 0) as upstream:
+        port = upstream.sockets[0].getsockname()[1]
+        with pytest.MonkeyPatch.context() as monkeypatch:
+            monkeypatch.setenv(
+                "PS_ENDPOINT_TEMPLATE_TEST", f"ws://127.0.0.1:{port}/{{location}}"
+            )
+            async with websockets.serve(main.handle_client, "127.0.0.1", 0) as proxy:
+                proxy_port = proxy.sockets[0].getsockname()[1]
+                async with websockets.connect(
+                    f"ws://127.0.0.1:{proxy_port}/twilio"
+                ) as twilio:
+                    await twilio.send(json.dumps({"event": "connected"}))
+                    await twilio.send(start_event())
+                    for samples in frames:
+                        await twilio.send(media_event(samples))
+                    received = [json.loads(await twilio.recv()) for _ in range(2)]
+                    await twilio.send(json.dumps({"event": "stop"}))
+                    async for message in twilio:
+                        received.append(json.loads(message))
+    return upstream_received, received
+
+
+def test_call_is_transcoded_both_ways(proxy):
+    t = np.arange(3 * FRAME_SAMPLES) / 8000
+    tone = 8000 * np.sin(2 * np.pi * 440 * t)
+    frames = np.split(tone, 3)
+    agent_audio = (
+        (8000 * np.sin(2 * np.pi * 440 * np.arange(640) / 16000))
+        .astype("<i2")
+        .tobytes()
+    )
+
+    upstream_received, received = asyncio.run(call(frames, agent_audio))
+
+    config = upstream_received[0]["config"]
+    assert config["session"] == "projects/test/locations/us/apps/app/sessions/CA1"
+    assert config["inputAudioConfig"] == {
+        "audioEncoding": "LINEAR16",
+        "sampleRateHertz": 16000,
+    }
+    # Each 8 kHz mu-law frame reaches the agent as 16 kHz LINEAR16.
+    pcm = b"".join(
+        base64.b64decode(message["realtimeInput"]["audio"])
+        for message in upstream_received[1:]
+    )
+    assert len(pcm) == 3 * FRAME_SAMPLES * 2 * 2
+    samples = np.frombuffer(pcm, dtype="<i2")[64:]  # After the filter's delay.
+    assert 4000 < np.abs(samples).max() < 10000
+
+    media, clear = received[:2]
+    assert media["event"] == "media" and media["streamSid"] == "MZ1"
+    # 640 samples at 16 kHz are 320 mu-law bytes at 8 kHz.
+    assert len(base64.b64decode(media["media"]["payload"])) == 320
+    assert clear == {"event": "clear", "streamSid": "MZ1"}
+
+
+def test_calls_are_rejected_without_auth_token(monkeypatch):
+    monkeypatch.setattr(twilio_bridge, "TWILIO_AUTH_TOKEN", "")
+    assert not twilio_bridge.is_signature_valid(None)
+
+
+def test_twilio_path_requires_auth_token(monkeypatch):
+    monkeypatch.setenv("TWILIO_PATH", "/twilio")
+    monkeypatch.delenv("TWILIO_AUTH_TOKEN", raising=False)
+    try:
+        assert importlib.reload(main).TWILIO_PATH == ""
+        monkeypatch.setenv("TWILIO_AUTH_TOKEN", "secret")
+        assert importlib.reload(main).TWILIO_PATH == "/twilio"
+    finally:
+        monkeypatch.undo()
+        importlib.reload(main)
+
+
+@pytest.mark.parametrize("valid", [True, False])
+def test_signature_is_verified(monkeypatch, valid):
+    validator = pytest.importorskip("twilio.request_validator").RequestValidator
+    monkeypatch.setattr(twilio_bridge, "TWILIO_AUTH_TOKEN", "secret")
+    url = "wss://proxy.example.com/twilio"
+    signature = validator("secret" if valid else "other").compute_signature(url, {})
+    request = type(
+        "Request",
+        (),
+        {
+            "path": "/twilio",
+            "headers": {"Host": "proxy.example.com", "X-Twilio-Signature": signature},
+        },
+    )
+    websocket = type("WebSocket", (), {"request": request})
+    assert twilio_bridge.is_signature_valid(websocket) is valid